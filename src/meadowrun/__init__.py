@@ -79,8 +79,10 @@ from meadowrun.run_job import (
     run_function,
     run_map,
     run_map_as_completed,
+    run_map_ordered,
 )
 from meadowrun.alloc_cloud_instance import AllocCloudInstance
+from meadowrun.result_sink import ResultHandle, ResultSink
 from meadowrun.run_job_core import (
     Resources,
     RunMapTasksFailedException,
@@ -102,6 +104,9 @@ __all__ = [
     "run_function",
     "run_map",
     "run_map_as_completed",
+    "run_map_ordered",
+    "ResultSink",
+    "ResultHandle",
     "AwsSecret",
     "AzureSecret",
     "CondaEnvironmentFile",
@@ -0,0 +1,51 @@
+from __future__ import annotations
+
+import abc
+from typing import List, Tuple
+
+
+class AbstractResultQueue(abc.ABC):
+    """
+    A wrapper around SQS or other similar message queues that workers use to tell the
+    driver which results they've written to the storage bucket. This means that the
+    driver (see receive_results) doesn't need to poll the storage bucket with
+    list_objects to find out about new results, which is slow and gets more expensive
+    the more results there are.
+
+    Small task result batches (see TaskResultBatcher) can also be sent directly on the
+    queue, which saves writing, downloading and deleting an object in the storage
+    bucket.
+
+    Messages may be delivered more than once, so the driver must deduplicate keys and
+    task results.
+    """
+
+    @abc.abstractmethod
+    def max_inline_batch_bytes(self) -> int:
+        """
+        Task result batches up to this size can be sent with send_result_batch. Larger
+        batches must be written to the storage bucket and sent with send_result_keys.
+        """
+        ...
+
+    @abc.abstractmethod
+    async def send_result_keys(self, keys: List[str]) -> None:
+        """Tells the driver that the objects at keys have been written"""
+        ...
+
+    @abc.abstractmethod
+    async def send_result_batch(self, batch: bytes) -> None:
+        """
+        Sends a serialized task result batch (see serialize_task_result_batch) directly
+        to the driver
+        """
+        ...
+
+    @abc.abstractmethod
+    async def receive_results(self, wait_seconds: int) -> Tuple[List[str], List[bytes]]:
+        """
+        Waits up to wait_seconds for messages sent by send_result_keys or
+        send_result_batch. Returns (keys, task result batches), which will both be empty
+        if there are no new messages.
+        """
+        ...
@@ -21,6 +21,10 @@ class AbstractStorageBucket(abc.ABC):
     username/password.
     """
 
+    # False if list_objects might only return the first page of results, in which case
+    # list_objects shouldn't be used to check whether many keys exist
+    list_objects_returns_all_keys = False
+
     async def __aenter__(self) -> AbstractStorageBucket:
         return self
 
@@ -68,9 +72,35 @@ class AbstractStorageBucket(abc.ABC):
     async def exists(self, key: str) -> bool:
         ...
 
-    async def write_bytes_if_not_exists(self, data: bytes, key: str) -> None:
-        if not await self.exists(key):
-            await self.write_bytes(data, key)
+    async def write_bytes_if_not_exists(self, data: bytes, key: str) -> bool:
+        """Returns True if we wrote key, False if it already existed"""
+        if await self.exists(key):
+            return False
+        await self.write_bytes(data, key)
+        return True
+
+    async def write_bytes_exclusive(self, data: bytes, key: str) -> bool:
+        """
+        Like write_bytes_if_not_exists, but atomic, i.e. if multiple callers try to
+        write the same key at the same time, exactly one of them will succeed. Returns
+        True if we wrote key, False if it already existed.
+        """
+        raise NotImplementedError(
+            f"write_bytes_exclusive is not implemented for {type(self).__name__}"
+        )
+
+    def check_write_bytes_exclusive_supported(self) -> None:
+        """
+        Raises an exception if write_bytes_exclusive won't work, so that a job that
+        relies on it can fail before it starts any workers
+        """
+        if (
+            type(self).write_bytes_exclusive
+            is AbstractStorageBucket.write_bytes_exclusive
+        ):
+            raise NotImplementedError(
+                f"write_bytes_exclusive is not implemented for {type(self).__name__}"
+            )
 
     @abc.abstractmethod
     async def get_file(self, key: str, local_filename: str) -> None:
@@ -1,10 +1,13 @@
 from __future__ import annotations
 
 import abc
+import array
 import asyncio
+import bisect
 import collections
 import dataclasses
 import itertools
+import math
 import pickle
 import time
 import traceback
@@ -12,16 +15,20 @@ import uuid
 from typing import (
     Any,
     AsyncIterable,
+    AsyncIterator,
     Callable,
+    Deque,
     Dict,
     Generic,
     Iterable,
     List,
     Optional,
     Sequence,
+    Set,
     Tuple,
     Type,
     TypeVar,
+    Union,
     cast,
     TYPE_CHECKING,
 )
@@ -40,6 +47,8 @@ from meadowrun.run_job_core import (
     WaitOption,
     get_log_path,
 )
+from meadowrun.run_job_local import NUM_TASK_WORKERS_KWARG
+from meadowrun.shared import cancel_task
 from meadowrun.storage_keys import construct_job_object_id, parse_job_id
 
 if TYPE_CHECKING:
@@ -66,7 +75,7 @@ class AllocVM(Host, abc.ABC):
     async def run_map_as_completed(
         self,
         function: Callable[[_T], _U],
-        args: Sequence[_T],
+        args: Union[Sequence[_T], AsyncIterable[_T]],
         resources_required_per_task: Optional[ResourcesInternal],
         job_fields: Dict[str, Any],
         num_concurrent_tasks: int,
@@ -74,6 +83,9 @@ class AllocVM(Host, abc.ABC):
         wait_for_result: WaitOption,
         max_num_task_attempts: int,
         retry_with_more_memory: bool,
+        speculative_execution_multiple: Optional[float],
+        num_task_workers_per_agent: int,
+        max_num_concurrent_tasks: Optional[int],
     ) -> AsyncIterable[TaskResult[_U]]:
         if resources_required_per_task is None:
             raise ValueError(
@@ -90,18 +102,23 @@ class AllocVM(Host, abc.ABC):
         async with self._create_grid_job_worker_launcher(
             base_job_id, function, pickle_protocol, job_fields, wait_for_result
         ) as worker_launcher, self._create_grid_job_cloud_interface(
-            base_job_id
+            base_job_id, job_fields.get("compression", "")
         ) as cloud_interface:
             driver = GridJobDriver(
                 cloud_interface,
                 worker_launcher,
                 num_concurrent_tasks,
                 resources_required_per_task,
+                num_task_workers_per_agent,
+                max_num_concurrent_tasks,
             )
             run_worker_loops = asyncio.create_task(driver.run_worker_functions())
             num_tasks_done = 0
             async for result in driver.add_tasks_and_get_results(
-                args, max_num_task_attempts, retry_with_more_memory
+                args,
+                max_num_task_attempts,
+                retry_with_more_memory,
+                speculative_execution_multiple,
             ):
                 yield result
                 num_tasks_done += 1
@@ -111,15 +128,15 @@ class AllocVM(Host, abc.ABC):
         # this is for extra safety--the only case where we don't get all of our results
         # back should be if run_worker_loops throws an exception because there were
         # worker failures
-        if num_tasks_done < len(args):
+        if num_tasks_done < driver.num_tasks:
             raise ValueError(
                 "Gave up retrieving task results, most likely due to worker failures. "
-                f"Received {num_tasks_done}/{len(args)} task results."
+                f"Received {num_tasks_done}/{driver.num_tasks} task results."
             )
 
     @abc.abstractmethod
     def _create_grid_job_cloud_interface(
-        self, base_job_id: str
+        self, base_job_id: str, compression: str
     ) -> GridJobCloudInterface:
         pass
 
@@ -152,7 +169,7 @@ class GridJobCloudInterface(abc.ABC, Generic[_T, _U]):
     """
     See also GridJobDriver. The GridJobDriver is a concrete class that handles the
     cloud-independent logic for running a grid job, e.g. replacing workers that exit
-    unexpectedly (not implemented yet), retrying vs giving up on tasks. The
+    unexpectedly, retrying vs giving up on tasks. The
     GridJobCloudInterface is an interface that we can implement for different cloud
     providers. The GridJobDriver always has a single GridJobCloudInterface
     implementation that it uses to actually "do things" in the real world like launch
@@ -182,6 +199,17 @@ class GridJobCloudInterface(abc.ABC, Generic[_T, _U]):
         """
         ...
 
+    async def add_tasks(self, tasks: Sequence[_T]) -> None:
+        """
+        Adds more tasks to queue 0 after setup_and_add_tasks. Task ids continue on from
+        the tasks that have already been added. GridJobDriver calls this when the
+        run_map's args are an AsyncIterable, see add_tasks_and_get_results.
+        """
+        raise NotImplementedError(
+            f"{type(self).__name__} does not support adding tasks after "
+            "setup_and_add_tasks"
+        )
+
     @abc.abstractmethod
     async def get_agent_function(
         self, queue_index: int
@@ -209,6 +237,48 @@ class GridJobCloudInterface(abc.ABC, Generic[_T, _U]):
     async def shutdown_workers(self, num_workers: int, queue_index: int) -> None:
         ...
 
+    async def get_leased_tasks(self, worker_id: str) -> List[Tuple[int, int]]:
+        """
+        Returns the (task_id, attempt) of the tasks that the specified worker had taken
+        off of a queue but not completed, so that GridJobDriver can reschedule them if
+        the worker exits unexpectedly. The default implementation doesn't keep track of
+        this, so tasks on a worker that exits unexpectedly are lost.
+        """
+        return []
+
+    async def get_unresponsive_workers(self, worker_ids: Sequence[str]) -> List[str]:
+        """
+        Returns the subset of worker_ids that seem to have died without reporting it,
+        e.g. because their spot instance was interrupted, so that GridJobDriver can
+        replace them and reschedule their tasks. Queue-launched workers that die this
+        way otherwise go unnoticed. The default implementation doesn't detect this.
+        """
+        return []
+
+
+def _agent_job(
+    base_job_id: str,
+    user_function: Callable[..., Any],
+    pickle_protocol: int,
+    job_fields: Dict[str, Any],
+    qualified_agent_function_name: QualifiedFunctionName,
+    agent_function_arguments: Sequence[Any],
+    num_task_workers: int,
+) -> Job:
+    """Returns the Job that a GridJobWorkerLauncher runs for each worker"""
+    return Job(
+        base_job_id=base_job_id,
+        py_agent=PyAgentJob(
+            pickled_function=cloudpickle.dumps(user_function, protocol=pickle_protocol),
+            qualified_agent_function_name=qualified_agent_function_name,
+            pickled_agent_function_arguments=pickle.dumps(
+                (agent_function_arguments, {NUM_TASK_WORKERS_KWARG: num_task_workers}),
+                protocol=pickle_protocol,
+            ),
+        ),
+        **job_fields,
+    )
+
 
 class GridJobWorkerLauncher(abc.ABC):
     async def __aenter__(self) -> GridJobWorkerLauncher:
@@ -227,10 +297,16 @@ class GridJobWorkerLauncher(abc.ABC):
         self,
         agent_function_task: asyncio.Task[Tuple[QualifiedFunctionName, Sequence[Any]]],
         num_workers_to_launch: int,
-        resources_required_per_task: ResourcesInternal,
+        resources_required_per_worker: ResourcesInternal,
+        num_task_workers: int,
         queue_index: int,
         abort_launching_new_workers: asyncio.Event,
     ) -> AsyncIterable[List[WorkerTask]]:
+        """
+        Launches num_workers_to_launch workers, i.e. agent jobs, each of which runs
+        num_task_workers task workers (see NUM_TASK_WORKERS_KWARG) and requires
+        resources_required_per_worker
+        """
         # https://github.com/python/mypy/issues/5070
         if False:
             yield
@@ -291,6 +367,7 @@ class GridJobSshWorkerLauncher(GridJobWorkerLauncher):
         ssh_host: SshHost,
         worker_job_id: str,
         agent_function_task: asyncio.Task[Tuple[QualifiedFunctionName, Sequence[Any]]],
+        num_task_workers: int,
     ) -> JobCompletion:
 
         (
@@ -298,19 +375,14 @@ class GridJobSshWorkerLauncher(GridJobWorkerLauncher):
             agent_function_arguments,
         ) = await agent_function_task
 
-        job = Job(
-            base_job_id=self._base_job_id,
-            py_agent=PyAgentJob(
-                pickled_function=cloudpickle.dumps(
-                    self._user_function, protocol=self._pickle_protocol
-                ),
-                qualified_agent_function_name=qualified_agent_function_name,
-                pickled_agent_function_arguments=pickle.dumps(
-                    (agent_function_arguments, {}),
-                    protocol=self._pickle_protocol,
-                ),
-            ),
-            **self._job_fields,
+        job = _agent_job(
+            self._base_job_id,
+            self._user_function,
+            self._pickle_protocol,
+            self._job_fields,
+            qualified_agent_function_name,
+            agent_function_arguments,
+            num_task_workers,
         )
 
         async def deallocator() -> None:
@@ -330,13 +402,14 @@ class GridJobSshWorkerLauncher(GridJobWorkerLauncher):
         self,
         agent_function_task: asyncio.Task[Tuple[QualifiedFunctionName, Sequence[Any]]],
         num_workers_to_launch: int,
-        resources_required_per_task: ResourcesInternal,
+        resources_required_per_worker: ResourcesInternal,
+        num_task_workers: int,
         queue_index: int,
         abort_launching_new_workers: asyncio.Event,
     ) -> AsyncIterable[List[WorkerTask]]:
         async for allocated_hosts in allocate_jobs_to_instances(
             self._instance_registrar,
-            resources_required_per_task,
+            resources_required_per_worker,
             self._base_job_id,
             self._next_worker_suffix,
             num_workers_to_launch,
@@ -359,14 +432,19 @@ class GridJobSshWorkerLauncher(GridJobWorkerLauncher):
                             queue_index,
                             asyncio.create_task(
                                 self.launch_worker(
-                                    ssh_host, job_id, agent_function_task
+                                    ssh_host,
+                                    job_id,
+                                    agent_function_task,
+                                    num_task_workers,
                                 )
                             ),
-                            # the worker_ids concept is for when we launch workers via
-                            # queues and need to correlate WorkerProcessStates with the
-                            # WorkerQueue that the worker was for. In the case of
-                            # SshWorkerLauncher, we won't get WorkerProcessStates
-                            [""],
+                            # the worker_ids concept is mostly for when we launch
+                            # workers via queues and need to correlate
+                            # WorkerProcessStates with the WorkerQueue that the worker
+                            # was for. In the case of SshWorkerLauncher, we won't get
+                            # WorkerProcessStates, but we still use the worker_id to
+                            # reschedule the worker's tasks if it exits unexpectedly
+                            [job_id],
                         )
                     )
             yield worker_tasks
@@ -444,25 +522,21 @@ class GridJobQueueWorkerLauncher(GridJobWorkerLauncher):
         self,
         agent_function_task: asyncio.Task[Tuple[QualifiedFunctionName, Sequence[Any]]],
         job_object_id: str,
+        num_task_workers: int,
     ) -> None:
         (
             qualified_agent_function_name,
             agent_function_arguments,
         ) = await agent_function_task
 
-        job = Job(
-            base_job_id=self._base_job_id,
-            py_agent=PyAgentJob(
-                pickled_function=cloudpickle.dumps(
-                    self._user_function, protocol=self._pickle_protocol
-                ),
-                qualified_agent_function_name=qualified_agent_function_name,
-                pickled_agent_function_arguments=pickle.dumps(
-                    (agent_function_arguments, {}),
-                    protocol=self._pickle_protocol,
-                ),
-            ),
-            **self._job_fields,
+        job = _agent_job(
+            self._base_job_id,
+            self._user_function,
+            self._pickle_protocol,
+            self._job_fields,
+            qualified_agent_function_name,
+            agent_function_arguments,
+            num_task_workers,
         )
 
         await self._upload_job_object(job_object_id, job)
@@ -508,13 +582,14 @@ class GridJobQueueWorkerLauncher(GridJobWorkerLauncher):
         self,
         agent_function_task: asyncio.Task[Tuple[QualifiedFunctionName, Sequence[Any]]],
         num_workers_to_launch: int,
-        resources_required_per_task: ResourcesInternal,
+        resources_required_per_worker: ResourcesInternal,
+        num_task_workers: int,
         queue_index: int,
         abort_launching_new_workers: asyncio.Event,
     ) -> AsyncIterable[List[WorkerTask]]:
         async for allocated_hosts in allocate_jobs_to_instances(
             self._instance_registrar,
-            resources_required_per_task,
+            resources_required_per_worker,
             self._base_job_id,
             self._next_worker_suffix,
             num_workers_to_launch,
@@ -531,7 +606,7 @@ class GridJobQueueWorkerLauncher(GridJobWorkerLauncher):
                 if job_object_id not in self._job_object_uploads:
                     self._job_object_uploads[job_object_id] = asyncio.create_task(
                         self._upload_job_object_wrapper(
-                            agent_function_task, job_object_id
+                            agent_function_task, job_object_id, num_task_workers
                         )
                     )
                 await self._job_object_uploads[job_object_id]
@@ -576,6 +651,36 @@ class GridJobQueueWorkerLauncher(GridJobWorkerLauncher):
 
 _PRINT_RECEIVED_TASKS_SECONDS = 10
 
+# See _StragglerSpeculator
+_SPECULATION_CHECK_INTERVAL_SECONDS = 5
+# We need at least this many successful tasks to estimate the median task duration
+_SPECULATION_MIN_COMPLETED_TASKS = 3
+# See _DurationWindow
+_DURATION_WINDOW_SIZE = 1000
+
+# See _WorkerAutoscaler. We add workers to a queue if its backlog would take longer than
+# this to finish with the current workers. This is roughly how long it takes to start a
+# new worker, so adding workers for smaller backlogs doesn't help.
+_AUTOSCALE_TARGET_BACKLOG_SECONDS = 120
+# We need at least this many results from a queue to estimate its throughput
+_AUTOSCALE_MIN_RESULTS = 3
+
+# See WorkerQueue.replace_workers_that_exited
+_CRASH_LOOP_MIN_EXITS = 3
+# A task on a worker that exits unexpectedly is rescheduled without counting towards
+# max_num_task_attempts at most this many times, in case the task is what's causing the
+# worker to exit. After that, rescheduling counts as a normal attempt, and once the task
+# is out of attempts, it fails with state WORKER_LOST
+_MAX_LOST_TASK_RESCHEDULES = 2
+
+# How often GridJobDriver checks for workers that have died without reporting it, see
+# GridJobCloudInterface.get_unresponsive_workers
+_UNRESPONSIVE_WORKERS_CHECK_SECONDS = 60
+
+# When a run_map's args are an AsyncIterable, we only take this many tasks per worker
+# from it at a time, see add_tasks_and_get_results
+_LAZY_ARGS_TASKS_PER_WORKER = 4
+
 
 @dataclasses.dataclass
 class WorkerQueue:
@@ -590,10 +695,33 @@ class WorkerQueue:
     num_workers_launched: int = 0
     num_worker_shutdown_messages_sent: int = 0
     num_workers_exited_unexpectedly: int = 0
+    # reset whenever we get a task result from this queue
+    num_workers_exited_since_last_result: int = 0
     get_agent_function_task: Optional[
         asyncio.Task[Tuple[QualifiedFunctionName, Sequence[Any]]]
     ] = None
 
+    def replace_workers_that_exited(self) -> bool:
+        """
+        Returns whether we should launch replacements for workers that exited
+        unexpectedly. This is a guard against crash loops: if a worker exits because
+        e.g. the environment can't be built, its replacement will exit as well, so we
+        stop replacing workers once every worker we need (or _CRASH_LOOP_MIN_EXITS
+        workers, if that's more) has exited unexpectedly without this queue making any
+        progress.
+        """
+        return self.num_workers_exited_since_last_result < max(
+            _CRASH_LOOP_MIN_EXITS, self.num_workers_needed
+        )
+
+    def num_workers_running(self) -> int:
+        """Workers that have been launched and haven't exited or been shut down"""
+        return (
+            self.num_workers_launched
+            - self.num_worker_shutdown_messages_sent
+            - self.num_workers_exited_unexpectedly
+        )
+
 
 @dataclasses.dataclass(frozen=True)
 class WorkerTask:
@@ -636,11 +764,431 @@ def _resources_for_queue_index(
         )
 
 
+async def _take(iterator: AsyncIterator[_T], n: int) -> List[_T]:
+    """Returns the next n items from iterator, or fewer if iterator runs out"""
+    items: List[_T] = []
+    while len(items) < n:
+        try:
+            items.append(await iterator.__anext__())
+        except StopAsyncIteration:
+            break
+    return items
+
+
+def _remove_workers(
+    worker_index_to_worker: Dict[int, Tuple[int, str]], worker_ids: Iterable[str]
+) -> List[Tuple[int, str]]:
+    """
+    Removes the specified workers from worker_index_to_worker (see
+    GridJobDriver.run_worker_functions) and returns their (queue index, worker id)
+    """
+    worker_ids = set(worker_ids)
+    removed = []
+    for worker_index, worker in list(worker_index_to_worker.items()):
+        if worker[1] in worker_ids:
+            removed.append(worker)
+            del worker_index_to_worker[worker_index]
+    return removed
+
+
+def _raise_if_failed(tasks: Iterable[Optional[asyncio.Task[None]]]) -> None:
+    """
+    Reraises the exception of any of tasks that has failed. These are "background"
+    tasks that would otherwise only be cancelled, which would swallow their exceptions
+    """
+    for task in tasks:
+        if task is not None and task.done() and not task.cancelled():
+            task.result()
+
+
+async def _with_lost_task_results(
+    batches: AsyncIterable[Tuple[List[TaskProcessState], List[WorkerProcessState]]],
+    lost_task_results: asyncio.Queue[TaskResult],
+) -> AsyncIterable[
+    Tuple[List[TaskProcessState], List[WorkerProcessState], List[TaskResult]]
+]:
+    """
+    Yields the batches from GridJobCloudInterface.receive_task_results along with any
+    results that GridJobDriver._reschedule_lost_tasks puts on lost_task_results. Lost
+    task results are yielded as soon as they're available, even if no other results are
+    coming in, e.g. because the lost task was the last outstanding task.
+    """
+    iterator = batches.__aiter__()
+    next_batch = asyncio.ensure_future(iterator.__anext__())
+    try:
+        while True:
+            next_lost = asyncio.ensure_future(lost_task_results.get())
+            await asyncio.wait(
+                [next_batch, next_lost], return_when=asyncio.FIRST_COMPLETED
+            )
+            lost = []
+            if next_lost.done():
+                lost.append(next_lost.result())
+            else:
+                next_lost.cancel()
+            while not lost_task_results.empty():
+                lost.append(lost_task_results.get_nowait())
+
+            if not next_batch.done():
+                yield [], [], lost
+                continue
+            try:
+                task_batch, worker_batch = next_batch.result()
+            except StopAsyncIteration:
+                if lost:
+                    yield [], [], lost
+                return
+            yield task_batch, worker_batch, lost
+            next_batch = asyncio.ensure_future(iterator.__anext__())
+    finally:
+        if not next_batch.done():
+            await cancel_task(next_batch)
+
+
+class _TaskStates:
+    """
+    The state of each task in GridJobDriver.add_tasks_and_get_results. This is kept in
+    arrays rather than lists so that jobs with millions of tasks don't need millions of
+    Python objects, and the number of outstanding tasks on each queue is updated
+    incrementally so that processing a task result takes constant time regardless of
+    how many tasks there are.
+    """
+
+    def __init__(self) -> None:
+        # task_id -> the queue the task is assigned to. Initially tasks are all
+        # assigned to the 0th queue, and if they fail because of suspected lack of
+        # memory and retry_with_more_memory is set, then we will increase their queue
+        # index. -1 indicates that the task is done (successful or exhausted retries) so
+        # it is no longer assigned to any queue
+        self.queue_index = array.array("h")
+        # task_id -> the most recent attempt we've started for the task. With
+        # speculative execution, there can be more than one attempt of a task running
+        # at the same time
+        self.latest_attempts = array.array("I")
+        # queue_index -> number of tasks assigned to that queue that aren't done. Queues
+        # without any outstanding tasks are omitted
+        self.num_outstanding: Dict[int, int] = {}
+
+    def __len__(self) -> int:
+        return len(self.queue_index)
+
+    def add_tasks(self, num_tasks: int) -> None:
+        self.queue_index.extend(array.array("h", [0]) * num_tasks)
+        self.latest_attempts.extend(array.array("I", [1]) * num_tasks)
+        if num_tasks:
+            self.num_outstanding[0] = self.num_outstanding.get(0, 0) + num_tasks
+
+    def is_done(self, task_id: int) -> bool:
+        return self.queue_index[task_id] == -1
+
+    def set_queue_index(self, task_id: int, queue_index: int) -> None:
+        prev_queue_index = self.queue_index[task_id]
+        if prev_queue_index == queue_index:
+            return
+        if prev_queue_index != -1:
+            if self.num_outstanding[prev_queue_index] == 1:
+                del self.num_outstanding[prev_queue_index]
+            else:
+                self.num_outstanding[prev_queue_index] -= 1
+        if queue_index != -1:
+            self.num_outstanding[queue_index] = (
+                self.num_outstanding.get(queue_index, 0) + 1
+            )
+        self.queue_index[task_id] = queue_index
+
+    def mark_done(self, task_id: int) -> None:
+        self.set_queue_index(task_id, -1)
+
+
+class _DurationWindow:
+    """
+    Keeps the most recent _DURATION_WINDOW_SIZE task durations so that we can get their
+    median. Adding a duration takes the same time no matter how many tasks have
+    completed, and the median follows changes in task durations over the course of a
+    job.
+    """
+
+    def __init__(self, size: int = _DURATION_WINDOW_SIZE):
+        self._size = size
+        # in the order they were added
+        self._recent: Deque[float] = collections.deque()
+        # the same durations, sorted
+        self._sorted: List[float] = []
+
+    def __len__(self) -> int:
+        return len(self._recent)
+
+    def add(self, duration_seconds: float) -> None:
+        if len(self._recent) >= self._size:
+            oldest = self._recent.popleft()
+            del self._sorted[bisect.bisect_left(self._sorted, oldest)]
+        self._recent.append(duration_seconds)
+        bisect.insort(self._sorted, duration_seconds)
+
+    def median(self) -> float:
+        return self._sorted[len(self._sorted) // 2]
+
+
+class _StragglerSpeculator:
+    """
+    Implements speculative execution for GridJobDriver: if there are idle workers and a
+    task has been running for longer than `multiple` times the median task duration, we
+    start another attempt of the task, and whichever attempt finishes first wins. If an
+    attempt fails while the other attempt is still running, we wait for the other
+    attempt rather than treating the task as failed.
+
+    We don't know when workers pick up tasks, but once a queue has at least as many
+    workers as outstanding tasks, all of the outstanding tasks on that queue must have
+    been picked up. We use that time (or the time when the task was retried, if that's
+    later) as a conservative estimate of when a task started running. That's also the
+    only time we need to look through all of the tasks, after that we keep track of the
+    running tasks on that queue incrementally, so checking for stragglers only looks at
+    tasks that are running.
+
+    Each task is speculatively executed at most once. Each worker runs num_task_workers
+    tasks at a time.
+    """
+
+    def __init__(self, multiple: float, num_task_workers: int = 1):
+        self._multiple = multiple
+        self._num_task_workers = num_task_workers
+        # durations of recent successful tasks
+        self._durations = _DurationWindow()
+        # queue index -> task_id -> when the task started running, for queues where all
+        # of the outstanding tasks have been picked up. Tasks that have been
+        # speculatively executed are omitted. The inner dicts are in the order that
+        # tasks started running
+        self._running: Dict[int, Dict[int, float]] = {}
+        # task_id -> queue index for speculatively executed tasks that aren't done
+        self._speculated_outstanding: Dict[int, int] = {}
+        # task_id -> the attempts of a speculatively executed task that are still
+        # running
+        self._live_attempts: Dict[int, Set[int]] = {}
+        # task_ids that we've started a speculative attempt for
+        self.speculated: Set[int] = set()
+
+    def task_succeeded(self, duration_seconds: float) -> None:
+        self._durations.add(duration_seconds)
+
+    def tasks_added(self, first_task_id: int, num_tasks: int) -> None:
+        running = self._running.get(0)
+        if running is not None:
+            now = time.time()
+            for task_id in range(first_task_id, first_task_id + num_tasks):
+                running[task_id] = now
+
+    def task_retried(self, task_id: int, queue_index: int) -> None:
+        """Should be called when we start a new (non-speculative) attempt of a task"""
+        for running in self._running.values():
+            running.pop(task_id, None)
+        self._live_attempts.pop(task_id, None)
+        if task_id in self._speculated_outstanding:
+            self._speculated_outstanding[task_id] = queue_index
+        elif queue_index in self._running:
+            self._running[queue_index][task_id] = time.time()
+
+    def task_done(self, task_id: int) -> None:
+        for running in self._running.values():
+            running.pop(task_id, None)
+        self._speculated_outstanding.pop(task_id, None)
+        self._live_attempts.pop(task_id, None)
+
+    def attempt_failed(self, task_id: int, attempt: int) -> Optional[bool]:
+        """
+        Should be called when an attempt of a task fails or its worker exits. Returns
+        None if we're not keeping track of multiple attempts for this task, otherwise
+        returns whether another attempt of this task is still running.
+        """
+        live_attempts = self._live_attempts.get(task_id)
+        if live_attempts is None:
+            return None
+        live_attempts.discard(attempt)
+        if live_attempts:
+            return True
+        del self._live_attempts[task_id]
+        return False
+
+    def _find_running(self, task_states: _TaskStates, queue_index: int) -> None:
+        now = time.time()
+        running = {}
+        num_outstanding = task_states.num_outstanding[queue_index]
+        for task_id, task_queue_index in enumerate(task_states.queue_index):
+            if task_queue_index == queue_index:
+                if task_id not in self.speculated:
+                    running[task_id] = now
+                num_outstanding -= 1
+                if num_outstanding == 0:
+                    break
+        self._running[queue_index] = running
+
+    def get_stragglers(
+        self, task_states: _TaskStates, worker_queues: List[WorkerQueue]
+    ) -> List[int]:
+        """
+        Returns the task_ids that should be speculatively executed now, and marks them
+        as speculated
+        """
+        if len(self._durations) < _SPECULATION_MIN_COMPLETED_TASKS:
+            return []
+        min_straggler_seconds = self._multiple * self._durations.median()
+
+        outstanding_tasks = task_states.num_outstanding
+        outstanding_speculated_tasks = collections.Counter(
+            self._speculated_outstanding.values()
+        )
+
+        now = time.time()
+        stragglers = []
+        for worker_queue in worker_queues:
+            queue_index = worker_queue.queue_index
+            num_workers = worker_queue.num_workers_running() * self._num_task_workers
+            if (
+                outstanding_tasks.get(queue_index, 0) == 0
+                or num_workers < outstanding_tasks[queue_index]
+            ):
+                self._running.pop(queue_index, None)
+                continue
+            if queue_index not in self._running:
+                self._find_running(task_states, queue_index)
+
+            num_idle_workers = (
+                num_workers
+                - outstanding_tasks[queue_index]
+                - outstanding_speculated_tasks[queue_index]
+            )
+            running = self._running[queue_index]
+            queue_stragglers = []
+            for task_id, started in running.items():
+                if num_idle_workers <= 0 or now - started <= min_straggler_seconds:
+                    # the rest of the tasks started running later
+                    break
+                queue_stragglers.append(task_id)
+                num_idle_workers -= 1
+
+            for task_id in queue_stragglers:
+                del running[task_id]
+                self.speculated.add(task_id)
+                self._speculated_outstanding[task_id] = queue_index
+                # the attempt that's running and the speculative attempt we're about to
+                # start
+                attempt = task_states.latest_attempts[task_id]
+                self._live_attempts[task_id] = {attempt, attempt + 1}
+            stragglers.extend(queue_stragglers)
+
+        return stragglers
+
+
+class _WorkerAutoscaler:
+    """
+    Decides when GridJobDriver should add workers to a WorkerQueue, e.g. when a retry
+    queue created by retry_with_more_memory (which starts with one worker) has a large
+    backlog.
+
+    For each queue, we estimate how long each worker takes per task, which is the larger
+    of the median task duration and the time per task implied by the queue's observed
+    throughput (which includes overhead like downloading arguments). Queues that don't
+    have any results yet use the estimate for queue 0. Then we request enough workers to
+    finish the queue's backlog in about _AUTOSCALE_TARGET_BACKLOG_SECONDS, but never
+    more workers than outstanding tasks.
+
+    A worker on queue i requests (1 + i) times as much memory as a worker on queue 0
+    (see _resources_for_queue_index), so we count it as (1 + i) "worker units" and keep
+    the total number of worker units needed across all queues at or below
+    max_worker_units. This acts as a cost ceiling, see run_map's
+    max_num_concurrent_tasks.
+
+    Each worker runs num_task_workers tasks at a time, see NUM_TASK_WORKERS_KWARG.
+    """
+
+    def __init__(self, max_worker_units: int, num_task_workers: int = 1):
+        self._max_worker_units = max_worker_units
+        self._num_task_workers = num_task_workers
+        # queue_index -> durations of recent tasks that ran on that queue
+        self._durations: Dict[int, _DurationWindow] = collections.defaultdict(
+            _DurationWindow
+        )
+        # queue_index -> (time of first result, number of results)
+        self._results: Dict[int, Tuple[float, int]] = {}
+
+    def task_completed(self, queue_index: int, duration_seconds: float) -> None:
+        self._durations[queue_index].add(duration_seconds)
+        first_result_time, num_results = self._results.get(
+            queue_index, (time.time(), 0)
+        )
+        self._results[queue_index] = first_result_time, num_results + 1
+
+    def _seconds_per_task(self, worker_queue: WorkerQueue) -> Optional[float]:
+        queue_index = worker_queue.queue_index
+        if not self._durations.get(queue_index):
+            queue_index = 0
+        durations = self._durations.get(queue_index)
+        if not durations:
+            return None
+        seconds_per_task = durations.median()
+
+        first_result_time, num_results = self._results[queue_index]
+        if num_results >= _AUTOSCALE_MIN_RESULTS:
+            # each task worker completes num_results / num_task_workers tasks in the
+            # time since the first result
+            seconds_per_task = max(
+                seconds_per_task,
+                (time.time() - first_result_time)
+                * worker_queue.num_workers_needed
+                * self._num_task_workers
+                / num_results,
+            )
+        return seconds_per_task
+
+    def scale_up(
+        self, worker_queues: List[WorkerQueue], outstanding_tasks: Dict[int, int]
+    ) -> bool:
+        """
+        Increases num_workers_needed on worker_queues as needed. outstanding_tasks maps
+        queue_index to the number of outstanding tasks on that queue. Returns True if
+        any num_workers_needed changed.
+        """
+        worker_units_needed = sum(
+            worker_queue.num_workers_needed * (1 + worker_queue.queue_index)
+            for worker_queue in worker_queues
+        )
+        changed = False
+        for worker_queue in worker_queues:
+            backlog = outstanding_tasks.get(worker_queue.queue_index, 0)
+            if backlog <= worker_queue.num_workers_needed * self._num_task_workers:
+                continue
+            seconds_per_task = self._seconds_per_task(worker_queue)
+            if seconds_per_task is None:
+                continue
+
+            task_workers_wanted = min(
+                backlog,
+                math.ceil(
+                    backlog * seconds_per_task / _AUTOSCALE_TARGET_BACKLOG_SECONDS
+                ),
+            )
+            workers_wanted = math.ceil(task_workers_wanted / self._num_task_workers)
+            new_workers = min(
+                workers_wanted - worker_queue.num_workers_needed,
+                (self._max_worker_units - worker_units_needed)
+                // (1 + worker_queue.queue_index),
+            )
+            if new_workers > 0:
+                print(
+                    f"Adding {new_workers} workers for queue "
+                    f"{worker_queue.queue_index}, {backlog} tasks outstanding"
+                )
+                worker_queue.num_workers_needed += new_workers
+                worker_units_needed += new_workers * (1 + worker_queue.queue_index)
+                changed = True
+
+        return changed
+
+
 class GridJobDriver:
     """
     See GridJobCloudInterface. This class handles the cloud-independent logic for
-    running a grid job, e.g. replacing workers that exit unexpectedly (not implemented
-    yet), retrying vs giving up on tasks.
+    running a grid job, e.g. replacing workers that exit unexpectedly, retrying vs
+    giving up on tasks.
 
     The basic design is that there are two "loops" run_worker_functions and
     add_tasks_and_get_results that run "in parallel" via asyncio. They interact using
@@ -653,35 +1201,80 @@ class GridJobDriver:
         worker_launcher: GridJobWorkerLauncher,
         num_concurrent_tasks: int,
         resources_required_per_task: ResourcesInternal,
+        num_task_workers_per_agent: int = 1,
+        max_num_concurrent_tasks: Optional[int] = None,
     ):
-        """This constructor must be called on an EventLoop"""
+        """
+        This constructor must be called on an EventLoop.
+
+        Each worker runs num_task_workers_per_agent task workers (see
+        NUM_TASK_WORKERS_KWARG), so workers are counted in WorkerQueue, launched and
+        shut down as a whole, and require num_task_workers_per_agent times
+        resources_required_per_task.
+
+        _WorkerAutoscaler never adds workers beyond max_num_concurrent_tasks tasks'
+        worth of resources, which defaults to num_concurrent_tasks.
+        """
         self._cloud_interface = cloud_interface
         self._worker_launcher = worker_launcher
         self._resources_required_per_task = resources_required_per_task
+        self._num_task_workers = num_task_workers_per_agent
 
         # run_worker_functions will set this to indicate to add_tasks_and_get_results
         # that there all of our workers have either exited unexpectedly (and we have
         # given up trying to restore them), or have been told to shutdown normally
         self._no_workers_available = asyncio.Event()
 
-        self._worker_queues = [WorkerQueue(0, num_concurrent_tasks)]
+        num_workers = math.ceil(num_concurrent_tasks / num_task_workers_per_agent)
+        self._worker_queues = [WorkerQueue(0, num_workers)]
         self._num_workers_needed_changed = asyncio.Event()
+        max_num_concurrent_tasks = max(
+            num_concurrent_tasks, max_num_concurrent_tasks or num_concurrent_tasks
+        )
+        self._autoscaler = _WorkerAutoscaler(
+            math.ceil(max_num_concurrent_tasks / num_task_workers_per_agent),
+            num_task_workers_per_agent,
+        )
 
         self._abort_launching_new_workers = asyncio.Event()
 
         self._worker_process_states: List[List[WorkerProcessState]] = []
         self._worker_process_state_received = asyncio.Event()
 
+        # run_worker_functions adds the ids of workers that exited unexpectedly here and
+        # sets _worker_lost so that add_tasks_and_get_results can reschedule their tasks
+        self._lost_worker_ids: List[str] = []
+        self._worker_lost = asyncio.Event()
+
+        # the number of tasks that add_tasks_and_get_results has added so far
+        self.num_tasks = 0
+
+    def _worker_exited_unexpectedly(self, queue_index: int, worker_id: str) -> None:
+        worker_queue = self._worker_queues[queue_index]
+        worker_queue.num_workers_exited_unexpectedly += 1
+        worker_queue.num_workers_exited_since_last_result += 1
+        if worker_queue.num_workers_exited_since_last_result == max(
+            _CRASH_LOOP_MIN_EXITS, worker_queue.num_workers_needed
+        ):
+            print(
+                f"{worker_queue.num_workers_exited_since_last_result} workers for "
+                f"queue {queue_index} have exited unexpectedly without any tasks "
+                "completing, so we will not replace them"
+            )
+        self._lost_worker_ids.append(worker_id)
+        self._worker_lost.set()
+
     async def run_worker_functions(self) -> None:
         """
         Allocates cloud instances, runs a worker function on them, sends worker shutdown
         messages when requested by add_tasks_and_get_results, and generally manages
-        workers (e.g. replacing workers when they exit unexpectedly, not implemented
-        yet).
+        workers (e.g. replacing workers when they exit unexpectedly, see
+        WorkerQueue.replace_workers_that_exited).
         """
 
         worker_tasks: List[WorkerTask] = []
-        worker_index_to_queue_index: Dict[int, int] = {}
+        # worker index -> (queue index, worker id)
+        worker_index_to_worker: Dict[int, Tuple[int, str]] = {}
 
         workers_needed_changed_wait_task = asyncio.create_task(
             self._num_workers_needed_changed.wait()
@@ -689,6 +1282,9 @@ class GridJobDriver:
         worker_process_state_received_task = asyncio.create_task(
             self._worker_process_state_received.wait()
         )
+        check_unresponsive_workers_task = asyncio.create_task(
+            asyncio.sleep(_UNRESPONSIVE_WORKERS_CHECK_SECONDS)
+        )
         pickled_worker_function_task: Optional[asyncio.Task[bytes]] = None
         async_cancel_exception = False
 
@@ -704,17 +1300,16 @@ class GridJobDriver:
 
             while True:
                 for worker_queue in self._worker_queues:
-                    # TODO we should subtract workers_exited_unexpectedly from
-                    # workers_launched, this would mean we replace workers that exited
-                    # unexpectedly. Implementing this properly means we should add more
-                    # code that will tell us why workers exited unexpectedly (e.g.
-                    # segfault in user code, spot instance eviction, vs an issue
-                    # creating the environment). The main concern is ending up in an
-                    # infinite loop where we're constantly launching workers that fail.
-                    new_workers_to_launch = worker_queue.num_workers_needed - (
-                        worker_queue.num_workers_launched
-                        - worker_queue.num_worker_shutdown_messages_sent
-                    )
+                    if worker_queue.replace_workers_that_exited():
+                        new_workers_to_launch = (
+                            worker_queue.num_workers_needed
+                            - worker_queue.num_workers_running()
+                        )
+                    else:
+                        new_workers_to_launch = worker_queue.num_workers_needed - (
+                            worker_queue.num_workers_launched
+                            - worker_queue.num_worker_shutdown_messages_sent
+                        )
 
                     # launch new workers if they're needed
                     if new_workers_to_launch > 0:
@@ -731,7 +1326,8 @@ class GridJobDriver:
                             _resources_for_queue_index(
                                 worker_queue.queue_index,
                                 self._resources_required_per_task,
-                            ),
+                            ).multiply(self._num_task_workers),
+                            self._num_task_workers,
                             worker_queue.queue_index,
                             self._abort_launching_new_workers,
                         ):
@@ -742,9 +1338,10 @@ class GridJobDriver:
                                         raise ValueError(
                                             f"Cannot parse worker_id {worker_id}"
                                         )
-                                    worker_index_to_queue_index[
-                                        parsed_job_id[1]
-                                    ] = worker_queue.queue_index
+                                    worker_index_to_worker[parsed_job_id[1]] = (
+                                        worker_queue.queue_index,
+                                        worker_id,
+                                    )
                             worker_queue.num_workers_launched += sum(
                                 len(worker_task.worker_ids)
                                 for worker_task in new_worker_tasks
@@ -752,13 +1349,10 @@ class GridJobDriver:
                             worker_tasks.extend(new_worker_tasks)
 
                     # shutdown workers if they're no longer needed
-                    # once we have the lost worker replacement logic this should
-                    # just be -workers_to_launch
                     workers_to_shutdown = (
-                        worker_queue.num_workers_launched
-                        - worker_queue.num_worker_shutdown_messages_sent
-                        - worker_queue.num_workers_exited_unexpectedly
-                    ) - (worker_queue.num_workers_needed)
+                        worker_queue.num_workers_running()
+                        - worker_queue.num_workers_needed
+                    )
                     if workers_to_shutdown > 0:
                         await self._cloud_interface.shutdown_workers(
                             workers_to_shutdown, worker_queue.queue_index
@@ -769,10 +1363,7 @@ class GridJobDriver:
 
                 # this means all workers are either done or shutting down
                 if all(
-                    worker_queue.num_workers_launched
-                    - worker_queue.num_worker_shutdown_messages_sent
-                    - worker_queue.num_workers_exited_unexpectedly
-                    <= 0
+                    worker_queue.num_workers_running() <= 0
                     for worker_queue in self._worker_queues
                 ):
                     break
@@ -788,6 +1379,7 @@ class GridJobDriver:
                         (
                             workers_needed_changed_wait_task,
                             worker_process_state_received_task,
+                            check_unresponsive_workers_task,
                         ),
                     ),
                     return_when=asyncio.FIRST_COMPLETED,
@@ -795,6 +1387,11 @@ class GridJobDriver:
                 new_worker_tasks = []
                 for worker_task in worker_tasks:
                     if worker_task.task.done():
+                        # workers we haven't already given up on via
+                        # get_unresponsive_workers
+                        workers_not_lost = _remove_workers(
+                            worker_index_to_worker, worker_task.worker_ids
+                        )
                         exception = worker_task.task.exception()
                         if exception is not None:
                             print(
@@ -809,11 +1406,10 @@ class GridJobDriver:
                                     )
                                 )
                             )
-                            self._worker_queues[
-                                worker_task.queue_index
-                            ].num_workers_exited_unexpectedly += 1
-                            # TODO ideally we would tell the receive_results loop to
-                            # reschedule whatever task the worker was working on
+                            if workers_not_lost:
+                                self._worker_exited_unexpectedly(
+                                    worker_task.queue_index, worker_task.worker_ids[0]
+                                )
                         #  TODO do something with worker_task.result()
                     else:
                         new_worker_tasks.append(worker_task)
@@ -826,7 +1422,7 @@ class GridJobDriver:
                     )
                     while self._worker_process_states:
                         for worker_process_state in self._worker_process_states.pop():
-                            queue_index = worker_index_to_queue_index.pop(
+                            worker = worker_index_to_worker.pop(
                                 int(worker_process_state.worker_index), None
                             )
 
@@ -834,21 +1430,40 @@ class GridJobDriver:
                                 worker_process_state.result.state
                                 != ProcessState.ProcessStateEnum.SUCCEEDED
                             ):
-                                if queue_index is not None:
+                                if worker is not None:
                                     # This doesn't check to make sure that we're not
                                     # double-counting a worker whose task raised an
                                     # exception. It must never be the case that
                                     # worker_task.task raises an exception AND a
                                     # worker_process_state is received
-                                    self._worker_queues[
-                                        queue_index
-                                    ].num_workers_exited_unexpectedly += 1
+                                    self._worker_exited_unexpectedly(*worker)
 
                                 print(
                                     "Error running worker: "
                                     f"{MeadowrunException(worker_process_state.result)}"
                                 )
 
+                if check_unresponsive_workers_task.done():
+                    check_unresponsive_workers_task = asyncio.create_task(
+                        asyncio.sleep(_UNRESPONSIVE_WORKERS_CHECK_SECONDS)
+                    )
+                    unresponsive_workers = (
+                        await self._cloud_interface.get_unresponsive_workers(
+                            [
+                                worker_id
+                                for _, worker_id in worker_index_to_worker.values()
+                            ]
+                        )
+                    )
+                    for worker in _remove_workers(
+                        worker_index_to_worker, unresponsive_workers
+                    ):
+                        print(
+                            f"Worker {worker[1]} for queue {worker[0]} has stopped "
+                            "responding, assuming it has exited unexpectedly"
+                        )
+                        self._worker_exited_unexpectedly(*worker)
+
                 if workers_needed_changed_wait_task.done():
                     self._num_workers_needed_changed.clear()
                     workers_needed_changed_wait_task = asyncio.create_task(
@@ -886,160 +1501,431 @@ class GridJobDriver:
 
             workers_needed_changed_wait_task.cancel()
             worker_process_state_received_task.cancel()
+            check_unresponsive_workers_task.cancel()
             if pickled_worker_function_task is not None:
                 pickled_worker_function_task.cancel()
 
+    async def _speculate_stragglers(
+        self,
+        speculator: _StragglerSpeculator,
+        task_states: _TaskStates,
+    ) -> None:
+        """
+        Runs alongside add_tasks_and_get_results and periodically starts additional
+        attempts of straggling tasks
+        """
+        while True:
+            await asyncio.sleep(_SPECULATION_CHECK_INTERVAL_SECONDS)
+            for task_id in speculator.get_stragglers(task_states, self._worker_queues):
+                attempt = task_states.latest_attempts[task_id]
+                task_states.latest_attempts[task_id] += 1
+                print(
+                    f"Task {task_id} is taking much longer than the median task, "
+                    f"starting a speculative attempt {attempt + 1}"
+                )
+                await self._cloud_interface.retry_task(
+                    task_id, attempt, task_states.queue_index[task_id]
+                )
+
+    async def _reschedule_lost_tasks(
+        self,
+        task_states: _TaskStates,
+        num_reschedules: Dict[int, int],
+        speculator: Optional[_StragglerSpeculator],
+        max_num_task_attempts: int,
+        lost_task_results: asyncio.Queue[TaskResult],
+    ) -> None:
+        """
+        Runs alongside add_tasks_and_get_results and reschedules the tasks that workers
+        were running when they exited unexpectedly (see
+        GridJobCloudInterface.get_leased_tasks), so that we don't have to wait for e.g.
+        a queue's visibility timeout, or lose the task altogether. Tasks that run out of
+        attempts are marked as done and their failed results are put on
+        lost_task_results for add_tasks_and_get_results to yield.
+        """
+        while True:
+            await self._worker_lost.wait()
+            self._worker_lost.clear()
+            while self._lost_worker_ids:
+                worker_id = self._lost_worker_ids.pop()
+                leased_tasks = await self._cloud_interface.get_leased_tasks(worker_id)
+                for task_id, attempt in leased_tasks:
+                    if task_states.is_done(task_id):
+                        continue
+                    other_attempts_running = (
+                        speculator.attempt_failed(task_id, attempt)
+                        if speculator is not None
+                        else None
+                    )
+                    if other_attempts_running or (
+                        other_attempts_running is None
+                        and attempt != task_states.latest_attempts[task_id]
+                    ):
+                        # another attempt of the task is still running or a newer
+                        # attempt has already been started
+                        continue
+                    latest_attempt = task_states.latest_attempts[task_id]
+                    if num_reschedules[task_id] < _MAX_LOST_TASK_RESCHEDULES:
+                        print(
+                            f"Worker {worker_id} exited unexpectedly while running "
+                            f"task {task_id}, attempt {attempt}, rescheduling it"
+                        )
+                        num_reschedules[task_id] += 1
+                    else:
+                        num_attempts = (
+                            latest_attempt
+                            - (
+                                speculator is not None
+                                and task_id in speculator.speculated
+                            )
+                            - num_reschedules[task_id]
+                        )
+                        if num_attempts >= max_num_task_attempts:
+                            message = (
+                                f"Worker {worker_id} exited unexpectedly while running "
+                                f"task {task_id}, attempt {attempt}. The task has "
+                                "already been rescheduled "
+                                f"{num_reschedules[task_id]} times, and max attempts "
+                                f"is {max_num_task_attempts}, not retrying"
+                            )
+                            print(message)
+                            task_states.mark_done(task_id)
+                            if speculator is not None:
+                                speculator.task_done(task_id)
+                            lost_task_results.put_nowait(
+                                TaskResult(
+                                    task_id,
+                                    is_success=False,
+                                    state="WORKER_LOST",
+                                    exception=("", message, message + "\n"),
+                                    attempt=attempt,
+                                )
+                            )
+                            continue
+
+                        print(
+                            f"Worker {worker_id} exited unexpectedly while running "
+                            f"task {task_id}, attempt {attempt}. The task has already "
+                            f"been rescheduled {num_reschedules[task_id]} times, "
+                            "retrying it"
+                        )
+
+                    task_states.latest_attempts[task_id] += 1
+                    queue_index = task_states.queue_index[task_id]
+                    if speculator is not None:
+                        speculator.task_retried(task_id, queue_index)
+                    await self._cloud_interface.retry_task(
+                        task_id, latest_attempt, queue_index
+                    )
+
     async def add_tasks_and_get_results(
         self,
-        args: Sequence[_T],
+        args: Union[Sequence[_T], AsyncIterable[_T]],
         max_num_task_attempts: int,
         retry_with_more_memory: bool,
+        speculative_execution_multiple: Optional[float] = None,
     ) -> AsyncIterable[TaskResult]:
         """
         Adds the specified tasks to the "queue", and retries tasks as needed. Yields
-        TaskResult objects as soon as tasks complete.
+        TaskResult objects as soon as tasks complete. If speculative_execution_multiple
+        is set, also starts additional attempts of straggling tasks, see
+        _StragglerSpeculator. Tasks on workers that exit unexpectedly are rescheduled,
+        see _reschedule_lost_tasks.
+
+        args can also be an AsyncIterable, e.g. for parameter sweeps that don't fit in
+        memory. In that case, we never take more than _LAZY_ARGS_TASKS_PER_WORKER tasks
+        per worker from args at a time. Once half of those tasks are done, we add
+        another batch of tasks via GridJobCloudInterface.add_tasks. This means that
+        consuming args keeps pace with how quickly the workers run tasks.
         """
 
-        # this keeps track of which queue each arg is assigned to. Initially they are
-        # all assigned to the 0th queue, and if they fail because of suspected lack of
-        # memory and retry_with_more_memory is set, then we will increase their queue
-        # index. -1 indicates that the arg is done so it is no longer assigned to any
-        # queue
-        arg_to_queue_index = [0] * len(args)
-        await self._cloud_interface.setup_and_add_tasks(args)
+        # if args is an AsyncIterable, arg_iterator is the remaining args, and None once
+        # we've taken all of the args
+        arg_iterator: Optional[AsyncIterator[_T]] = None
+        max_outstanding_tasks = 0
+        if isinstance(args, Sequence):
+            tasks: Sequence[_T] = args
+        else:
+            max_outstanding_tasks = (
+                _LAZY_ARGS_TASKS_PER_WORKER
+                * self._worker_queues[0].num_workers_needed
+                * self._num_task_workers
+            )
+            arg_iterator = args.__aiter__()
+            tasks = await _take(arg_iterator, max_outstanding_tasks)
+            if len(tasks) < max_outstanding_tasks:
+                arg_iterator = None
+        # tasks only get added to task_states once they've been uploaded, otherwise
+        # _speculate_stragglers or _reschedule_lost_tasks could try to retry a task that
+        # the cloud interface doesn't know about yet
+        await self._cloud_interface.setup_and_add_tasks(tasks)
+        task_states = _TaskStates()
+        task_states.add_tasks(len(tasks))
+        # task_id -> number of attempts started by _reschedule_lost_tasks. These don't
+        # count towards max_num_task_attempts
+        num_reschedules: Dict[int, int] = collections.defaultdict(int)
+        self.num_tasks = len(tasks)
+        del tasks
 
         # done = successful or exhausted retries
         num_tasks_done = 0
         # stop_receiving tells _cloud_interface.receive_task_results that there are no
         # more results to get
         stop_receiving = asyncio.Event()
-        if len(args) == num_tasks_done:
+
+        def background_task_done(task: asyncio.Task[None]) -> None:
+            # if a background task fails, stop receiving results so that we can raise
+            # its exception (via _raise_if_failed) rather than waiting forever
+            if not task.cancelled() and task.exception() is not None:
+                stop_receiving.set()
+
+        speculator: Optional[_StragglerSpeculator] = None
+        speculate_task: Optional[asyncio.Task[None]] = None
+        if speculative_execution_multiple is not None:
+            speculator = _StragglerSpeculator(
+                speculative_execution_multiple, self._num_task_workers
+            )
+            speculate_task = asyncio.create_task(
+                self._speculate_stragglers(speculator, task_states)
+            )
+            speculate_task.add_done_callback(background_task_done)
+        # see _reschedule_lost_tasks
+        lost_task_results: asyncio.Queue[TaskResult] = asyncio.Queue()
+        reschedule_task = asyncio.create_task(
+            self._reschedule_lost_tasks(
+                task_states,
+                num_reschedules,
+                speculator,
+                max_num_task_attempts,
+                lost_task_results,
+            )
+        )
+        reschedule_task.add_done_callback(background_task_done)
+        background_tasks = (speculate_task, reschedule_task)
+
+        if arg_iterator is None and self.num_tasks == num_tasks_done:
             stop_receiving.set()
         last_printed_update = time.time()
         print(
-            f"Waiting for task results. Requested: {len(args)}, "
-            f"Done: {num_tasks_done}"
+            f"Waiting for task results. Requested: {self.num_tasks}"
+            f"{'+' if arg_iterator is not None else ''}, Done: {num_tasks_done}"
         )
-        async for task_batch, worker_batch in await self._cloud_interface.receive_task_results(  # noqa: E501
-            stop_receiving=stop_receiving, workers_done=self._no_workers_available
-        ):
-            if worker_batch:
-                self._worker_process_states.append(worker_batch)
-                self._worker_process_state_received.set()
+        try:
+            async for task_batch, worker_batch, lost_batch in _with_lost_task_results(
+                await self._cloud_interface.receive_task_results(
+                    stop_receiving=stop_receiving,
+                    workers_done=self._no_workers_available,
+                ),
+                lost_task_results,
+            ):
+                _raise_if_failed(background_tasks)
 
-            for task in task_batch:
-                task_result = TaskResult.from_process_state(task)
-                if task_result.is_success:
+                for task_result in lost_batch:
+                    # _reschedule_lost_tasks has already marked these tasks as done
                     num_tasks_done += 1
-                    arg_to_queue_index[task.task_id] = -1
                     yield task_result
-                elif (
-                    task.attempt < max_num_task_attempts
-                    and task_result.state != "RESULT_CANNOT_BE_UNPICKLED"
-                ):
-                    prev_queue_index = arg_to_queue_index[task.task_id]
-                    prev_memory_requirement = _memory_gb_for_queue_index(
-                        prev_queue_index, self._resources_required_per_task
+
+                if worker_batch:
+                    self._worker_process_states.append(worker_batch)
+                    self._worker_process_state_received.set()
+
+                for task in task_batch:
+                    if task_states.is_done(task.task_id):
+                        # we've already yielded a result for this task, this is a result
+                        # from a slower speculative attempt
+                        continue
+
+                    prev_queue_index = task_states.queue_index[task.task_id]
+                    self._autoscaler.task_completed(
+                        prev_queue_index, task.result.duration_seconds
                     )
-                    if retry_with_more_memory and (
-                        (
-                            task.result.max_memory_used_gb
-                            >= 0.95 * prev_memory_requirement
+                    self._worker_queues[
+                        prev_queue_index
+                    ].num_workers_exited_since_last_result = 0
+                    task_result = TaskResult.from_process_state(task)
+                    # with speculative execution, this can be an attempt other than the
+                    # latest one
+                    latest_attempt = task_states.latest_attempts[task.task_id]
+                    # speculative and rescheduled attempts don't count towards
+                    # max_num_task_attempts
+                    num_attempts = (
+                        latest_attempt
+                        - (
+                            speculator is not None
+                            and task.task_id in speculator.speculated
                         )
-                        or task.result.was_oom_killed
-                    ):
-                        oom_message = ""
-                        if task.result.was_oom_killed:
-                            oom_message = " (OOM)"
-                        print(
-                            f"Task {task.task_id} failed at attempt "
-                            f"{task.attempt}{oom_message}, retrying with more memory "
-                            f"(task used {task.result.max_memory_used_gb:.2f}/"
-                            f"{prev_memory_requirement}GB requested): "
-                            f"{task_result._log_file_and_exception_traceback()}"
+                        - num_reschedules.get(task.task_id, 0)
+                    )
+                    other_attempts_running = None
+                    if speculator is not None and not task_result.is_success:
+                        other_attempts_running = speculator.attempt_failed(
+                            task.task_id, task.attempt
                         )
 
-                        new_queue_index = arg_to_queue_index[task.task_id] + 1
-                        arg_to_queue_index[task.task_id] = new_queue_index
-                        if len(self._worker_queues) < new_queue_index + 1:
-                            # TODO any new queue gets 1 worker by default. We should
-                            # increase this later depending on how the situation changes
-                            self._cloud_interface.create_queue()
-                            self._worker_queues.append(WorkerQueue(new_queue_index, 1))
-                        await self._cloud_interface.retry_task(
-                            task.task_id, task.attempt, new_queue_index
-                        )
-                    else:
+                    if task_result.is_success:
+                        num_tasks_done += 1
+                        task_states.mark_done(task.task_id)
+                        if speculator is not None:
+                            speculator.task_succeeded(task.result.duration_seconds)
+                            speculator.task_done(task.task_id)
+                        yield task_result
+                    elif other_attempts_running:
                         print(
                             f"Task {task.task_id} failed at attempt {task.attempt}, "
-                            "retrying: "
+                            "waiting for another attempt that is still running: "
                             f"{task_result._log_file_and_exception_traceback()}"
                         )
-                        await self._cloud_interface.retry_task(
-                            task.task_id, task.attempt, prev_queue_index
-                        )
-                else:
-                    if (
-                        task.attempt < max_num_task_attempts
-                        and task_result.state == "RESULT_CANNOT_BE_UNPICKLED"
+                    elif (
+                        other_attempts_running is None
+                        and task.attempt != latest_attempt
                     ):
                         print(
-                            f"Task {task.task_id} failed at attempt {task.attempt}, max"
-                            f" attempts is {max_num_task_attempts}, but not retrying "
-                            "because the failure happened when trying to unpickle the "
-                            "result on the client: "
+                            f"Task {task.task_id} failed at attempt {task.attempt}, "
+                            f"waiting for attempt {latest_attempt}: "
                             f"{task_result._log_file_and_exception_traceback()}"
                         )
+                    elif num_attempts < max_num_task_attempts:
+                        prev_memory_requirement = _memory_gb_for_queue_index(
+                            prev_queue_index, self._resources_required_per_task
+                        )
+                        if retry_with_more_memory and (
+                            (
+                                task.result.max_memory_used_gb
+                                >= 0.95 * prev_memory_requirement
+                            )
+                            or task.result.was_oom_killed
+                        ):
+                            oom_message = ""
+                            if task.result.was_oom_killed:
+                                oom_message = " (OOM)"
+                            print(
+                                f"Task {task.task_id} failed at attempt "
+                                f"{task.attempt}{oom_message}, retrying with more "
+                                "memory (task used "
+                                f"{task.result.max_memory_used_gb:.2f}/"
+                                f"{prev_memory_requirement}GB requested): "
+                                f"{task_result._log_file_and_exception_traceback()}"
+                            )
+
+                            new_queue_index = prev_queue_index + 1
+                            task_states.set_queue_index(task.task_id, new_queue_index)
+                            if len(self._worker_queues) < new_queue_index + 1:
+                                # any new queue gets 1 worker to start with,
+                                # _autoscaler will add more if needed
+                                self._cloud_interface.create_queue()
+                                self._worker_queues.append(
+                                    WorkerQueue(new_queue_index, 1)
+                                )
+                            task_states.latest_attempts[task.task_id] += 1
+                            if speculator is not None:
+                                speculator.task_retried(task.task_id, new_queue_index)
+                            await self._cloud_interface.retry_task(
+                                task.task_id, latest_attempt, new_queue_index
+                            )
+                        else:
+                            print(
+                                f"Task {task.task_id} failed at attempt "
+                                f"{task.attempt}, retrying: "
+                                f"{task_result._log_file_and_exception_traceback()}"
+                            )
+                            task_states.latest_attempts[task.task_id] += 1
+                            if speculator is not None:
+                                speculator.task_retried(task.task_id, prev_queue_index)
+                            await self._cloud_interface.retry_task(
+                                task.task_id, latest_attempt, prev_queue_index
+                            )
                     else:
                         print(
-                            f"Task {task.task_id} failed at attempt {task.attempt}, max"
-                            f" attempts is {max_num_task_attempts}, not retrying: "
+                            f"Task {task.task_id} failed at attempt "
+                            f"{task.attempt}, max attempts is "
+                            f"{max_num_task_attempts}, not retrying: "
                             f"{task_result._log_file_and_exception_traceback()}"
                         )
-                    num_tasks_done += 1
-                    arg_to_queue_index[task.task_id] = -1
-                    yield task_result
+                        num_tasks_done += 1
+                        task_states.mark_done(task.task_id)
+                        if speculator is not None:
+                            speculator.task_done(task.task_id)
+                        yield task_result
 
-            if num_tasks_done >= len(args):
-                stop_receiving.set()
-            else:
-                t0 = time.time()
-                if t0 - last_printed_update > _PRINT_RECEIVED_TASKS_SECONDS:
-                    print(
-                        f"Waiting for task results. Requested: {len(args)}, "
-                        f"Done: {num_tasks_done}"
+                if (
+                    arg_iterator is not None
+                    and self.num_tasks - num_tasks_done <= max_outstanding_tasks // 2
+                ):
+                    num_new_tasks = max_outstanding_tasks - (
+                        self.num_tasks - num_tasks_done
                     )
-                    last_printed_update = t0
-
-            # reduce the number of workers needed if we have more workers than
-            # outstanding tasks
-            num_workers_needed_per_queue = collections.Counter(arg_to_queue_index)
-            for worker_queue in self._worker_queues:
-                # num_workers_needed = min(outstanding tasks for this queue, current num
-                # workers needed for this queue)
-                # TODO at some point we might want to increase the number of workers
-                # needed?
-                num_workers_needed = min(
-                    num_workers_needed_per_queue.get(worker_queue.queue_index, 0),
-                    worker_queue.num_workers_needed,
-                )
-                if num_workers_needed < worker_queue.num_workers_needed:
-                    worker_queue.num_workers_needed = num_workers_needed
+                    new_tasks = await _take(arg_iterator, num_new_tasks)
+                    if len(new_tasks) < num_new_tasks:
+                        arg_iterator = None
+                    if new_tasks:
+                        await self._cloud_interface.add_tasks(new_tasks)
+                        if speculator is not None:
+                            speculator.tasks_added(len(task_states), len(new_tasks))
+                        task_states.add_tasks(len(new_tasks))
+                        self.num_tasks += len(new_tasks)
+
+                if arg_iterator is None and num_tasks_done >= self.num_tasks:
+                    stop_receiving.set()
+                else:
+                    t0 = time.time()
+                    if t0 - last_printed_update > _PRINT_RECEIVED_TASKS_SECONDS:
+                        print(
+                            f"Waiting for task results. Requested: {self.num_tasks}"
+                            f"{'+' if arg_iterator is not None else ''}, "
+                            f"Done: {num_tasks_done}"
+                        )
+                        last_printed_update = t0
+
+                # reduce the number of workers needed if we have more workers than
+                # outstanding tasks. If there are more args to come, we'll need the
+                # workers for those
+                outstanding_tasks = task_states.num_outstanding
+                # with speculative execution, keep an extra task worker around for
+                # each outstanding task so that it can be speculatively executed
+                task_workers_per_task = 1 if speculator is None else 2
+                num_workers_needed_per_queue = {
+                    queue_index: math.ceil(
+                        num_tasks * task_workers_per_task / self._num_task_workers
+                    )
+                    for queue_index, num_tasks in outstanding_tasks.items()
+                }
+                if arg_iterator is None:
+                    for worker_queue in self._worker_queues:
+                        # num_workers_needed = min(outstanding tasks for this queue,
+                        # current num workers needed for this queue)
+                        num_workers_needed = min(
+                            num_workers_needed_per_queue.get(
+                                worker_queue.queue_index, 0
+                            ),
+                            worker_queue.num_workers_needed,
+                        )
+                        if num_workers_needed < worker_queue.num_workers_needed:
+                            worker_queue.num_workers_needed = num_workers_needed
+                            self._num_workers_needed_changed.set()
+
+                # and increase it if queues have large backlogs
+                if self._autoscaler.scale_up(self._worker_queues, outstanding_tasks):
                     self._num_workers_needed_changed.set()
 
+            _raise_if_failed(background_tasks)
+        finally:
+            if speculate_task is not None:
+                speculate_task.cancel()
+            reschedule_task.cancel()
+
         # We could be more finegrained about aborting launching workers. This is the
         # easiest to implement, but ideally every time num_workers_needed changes we
         # would consider cancelling launching new workers
         self._abort_launching_new_workers.set()
 
-        if num_tasks_done < len(args):
+        if num_tasks_done < self.num_tasks:
             # It would make sense for this to raise an exception, but it's more helpful
             # to see the actual worker failures, and run_worker_functions should always
             # raise an exception in that case. The caller should still check though that
             # we returned all of the task results we were expecting.
             print(
                 "Gave up retrieving task results, most likely due to worker failures. "
-                f"Received {num_tasks_done}/{len(args)} task results."
+                f"Received {num_tasks_done}/{self.num_tasks} task results."
             )
         else:
-            print(f"Received all {len(args)} task results.")
+            print(f"Received all {self.num_tasks} task results.")
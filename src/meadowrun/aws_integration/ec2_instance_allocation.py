@@ -1,15 +1,18 @@
 from __future__ import annotations
 
+import array
 import asyncio
 import dataclasses
 import datetime
 import decimal
+import functools
 import itertools
 import json
 from typing import (
     TYPE_CHECKING,
     Any,
     AsyncIterable,
+    Awaitable,
     Callable,
     Dict,
     Iterable,
@@ -43,10 +46,12 @@ from meadowrun.aws_integration.ec2_ssh_keys import (
     get_meadowrun_ssh_key,
 )
 from meadowrun.aws_integration.grid_tasks_sqs import (
+    SqsResultQueue,
     add_tasks,
     add_worker_shutdown_messages,
     agent_function,
     create_request_queue,
+    create_result_queue,
     retry_task,
 )
 from meadowrun.aws_integration.ec2_instance_allocation_constants import (
@@ -88,7 +93,10 @@ from meadowrun.alloc_vm import (
 )
 from meadowrun.storage_grid_job import (
     S3Bucket,
+    WorkerHeartbeats,
     get_aws_s3_bucket,
+    get_aws_s3_bucket_async,
+    get_leased_tasks,
     receive_results,
 )
 from meadowrun.meadowrun_pb2 import QualifiedFunctionName
@@ -717,9 +725,9 @@ class AllocEC2Instance(AllocVM):
         )
 
     def _create_grid_job_cloud_interface(
-        self, base_job_id: str
+        self, base_job_id: str, compression: str
     ) -> GridJobCloudInterface:
-        return EC2GridJobInterface(self, base_job_id)
+        return EC2GridJobInterface(self, base_job_id, compression)
 
     def _create_grid_job_worker_launcher(
         self,
@@ -741,6 +749,12 @@ class AllocEC2Instance(AllocVM):
     async def get_storage_bucket(self) -> AbstractStorageBucket:
         return get_aws_s3_bucket(self._get_region_name())
 
+    def _get_storage_bucket_for_workers(
+        self,
+    ) -> Callable[[], Awaitable[AbstractStorageBucket]]:
+        # workers use the instance profile's permissions to access the bucket
+        return functools.partial(get_aws_s3_bucket_async, self._get_region_name())
+
 
 async def run_job_ec2_instance_registrar(
     job: Job,
@@ -778,7 +792,12 @@ class EC2GridJobInterface(GridJobCloudInterface):
     class should be in grid_tasks_sqs, but it's here because of circular import issues.
     """
 
-    def __init__(self, alloc_cloud_instance: AllocEC2Instance, base_job_id: str):
+    def __init__(
+        self,
+        alloc_cloud_instance: AllocEC2Instance,
+        base_job_id: str,
+        compression: str = "",
+    ):
         self._region_name = alloc_cloud_instance._get_region_name()
 
         # We keep multiple request queues so that we can retry tasks with more
@@ -786,12 +805,21 @@ class EC2GridJobInterface(GridJobCloudInterface):
         # (original_memory * (i + 1)) memory. For the happy path, we will only create
         # one queue with one set of workers having the originally requested memory
         self._request_queue_urls: List[asyncio.Task[str]] = []
-        self._task_argument_ranges: Optional[asyncio.Task[List[Tuple[int, int]]]] = None
+        # The TaskArgRange for each task, split into arrays because there can be
+        # millions of tasks. None until setup_and_add_tasks has been called
+        self._task_arg_segments: Optional[array.array[int]] = None
+        self._task_arg_ranges_from = array.array("q")
+        self._task_arg_ranges_end = array.array("q")
+        # workers use this queue to tell us about results they've written to S3
+        self._result_queue_url: Optional[asyncio.Task[str]] = None
 
         self._base_job_id = base_job_id
+        # see compression.py
+        self._compression = compression
 
         self._sqs_client: Optional[SQSClient] = None
         self._s3_bucket: Optional[S3Bucket] = None
+        self._worker_heartbeats: Optional[WorkerHeartbeats] = None
 
     async def __aenter__(self) -> EC2GridJobInterface:
         session = aiobotocore.session.get_session()
@@ -799,6 +827,7 @@ class EC2GridJobInterface(GridJobCloudInterface):
             "sqs", region_name=self._region_name
         ).__aenter__()
         self._s3_bucket = await get_aws_s3_bucket(self._region_name).__aenter__()
+        self._worker_heartbeats = WorkerHeartbeats(self._s3_bucket, self._base_job_id)
         return self
 
     async def __aexit__(
@@ -818,6 +847,14 @@ class EC2GridJobInterface(GridJobCloudInterface):
                     # we should have caught, but it's okay
                     queue_url_task.cancel()
 
+            if self._result_queue_url is not None:
+                if self._result_queue_url.done():
+                    await self._sqs_client.delete_queue(
+                        QueueUrl=self._result_queue_url.result()
+                    )
+                else:
+                    self._result_queue_url.cancel()
+
             await self._sqs_client.__aexit__(exc_type, exc_val, exc_tb)
 
         if self._s3_bucket is not None:
@@ -855,22 +892,39 @@ class EC2GridJobInterface(GridJobCloudInterface):
 
         # create SQS queues and add tasks to the request queue
         print(f"The current run_map's id is {self._base_job_id}")
+        self._result_queue_url = asyncio.create_task(
+            create_result_queue(self._base_job_id, self._sqs_client)
+        )
         queue_index = self.create_queue()
         if queue_index != 0:
             raise ValueError(
                 "setup_and_add_tasks was called more than once, or create_queue was "
                 "called before setup_and_add_tasks"
             )
-        self._task_argument_ranges = asyncio.create_task(
-            add_tasks(
-                self._base_job_id,
-                await self._request_queue_urls[queue_index],
-                self._s3_bucket,
-                self._sqs_client,
-                tasks,
-            )
+        self._task_arg_segments = array.array("q")
+        await self.add_tasks(tasks)
+
+    async def add_tasks(self, tasks: Sequence[_T]) -> None:
+        if self._sqs_client is None or self._s3_bucket is None:
+            raise ValueError("EC2GridJobInterface must be created with `async with`")
+        if self._task_arg_segments is None:
+            raise ValueError("setup_and_add_tasks must be called before add_tasks")
+
+        segments = self._task_arg_segments
+        ranges = await add_tasks(
+            self._base_job_id,
+            await self._request_queue_urls[0],
+            self._s3_bucket,
+            self._sqs_client,
+            tasks,
+            self._compression,
+            first_task_id=len(segments),
+            first_segment=segments[-1] + 1 if segments else 0,
         )
-        await self._task_argument_ranges
+        for segment, range_from, range_end in ranges:
+            segments.append(segment)
+            self._task_arg_ranges_from.append(range_from)
+            self._task_arg_ranges_end.append(range_end)
 
     async def shutdown_workers(self, num_workers: int, queue_index: int) -> None:
         if len(self._request_queue_urls) < queue_index + 1:
@@ -886,20 +940,32 @@ class EC2GridJobInterface(GridJobCloudInterface):
     ) -> Tuple[QualifiedFunctionName, Sequence[Any]]:
         if len(self._request_queue_urls) < queue_index + 1:
             raise ValueError(f"Queue {queue_index} has not been created yet")
+        if self._result_queue_url is None:
+            raise ValueError(
+                "setup_and_add_tasks must be called before get_agent_function"
+            )
 
         return (
             QualifiedFunctionName(
                 module_name=agent_function.__module__,
                 function_name=agent_function.__name__,
             ),
-            [await self._request_queue_urls[queue_index], self._region_name],
+            [
+                await self._request_queue_urls[queue_index],
+                self._region_name,
+                await self._result_queue_url,
+            ],
         )
 
     async def receive_task_results(
         self, *, stop_receiving: asyncio.Event, workers_done: asyncio.Event
     ) -> AsyncIterable[Tuple[List[TaskProcessState], List[WorkerProcessState]]]:
-        if self._s3_bucket is None:
+        if self._s3_bucket is None or self._sqs_client is None:
             raise ValueError("EC2GridJobInterface must be created with `async with`")
+        if self._result_queue_url is None:
+            raise ValueError(
+                "setup_and_add_tasks must be called before receive_task_results"
+            )
 
         # Note: download here is all via S3. It's important that downloads are fast
         # enough - in some cases (many workers, small-ish tasks) the rate of downloading
@@ -912,14 +978,16 @@ class EC2GridJobInterface(GridJobCloudInterface):
         # VPC/subnet, but even in that case, uploading to S3 first seems to be faster.
         # It's possible this would make sense in cases where we e.g. overwhelm the S3
         # bucket.
+        # We do use an SQS queue to find out which results are ready, though, as
+        # polling S3 with list_objects is slow. Each message contains the keys of
+        # results that are ready to be downloaded from S3.
 
         return receive_results(
             self._s3_bucket,
             self._base_job_id,
             stop_receiving=stop_receiving,
             all_workers_exited=workers_done,
-            # it's rare for any results to be ready in <4 seconds
-            initial_wait_seconds=4,
+            result_queue=SqsResultQueue(self._sqs_client, await self._result_queue_url),
         )
 
     async def retry_task(
@@ -927,7 +995,7 @@ class EC2GridJobInterface(GridJobCloudInterface):
     ) -> None:
         if len(self._request_queue_urls) < queue_index + 1:
             raise ValueError(f"Queue {queue_index} has not been created yet")
-        if self._task_argument_ranges is None:
+        if self._task_arg_segments is None:
             raise ValueError("setup_and_add_tasks must be called before retry_task")
         if self._sqs_client is None:
             raise ValueError("EC2GridJobInterface must be created with `async with`")
@@ -936,10 +1004,27 @@ class EC2GridJobInterface(GridJobCloudInterface):
             await self._request_queue_urls[queue_index],
             task_id,
             attempts_so_far + 1,
-            (await self._task_argument_ranges)[task_id],
+            (
+                self._task_arg_segments[task_id],
+                self._task_arg_ranges_from[task_id],
+                self._task_arg_ranges_end[task_id],
+            ),
             self._sqs_client,
         )
 
+    async def get_leased_tasks(self, worker_id: str) -> List[Tuple[int, int]]:
+        if self._s3_bucket is None:
+            raise ValueError("EC2GridJobInterface must be created with `async with`")
+
+        return await get_leased_tasks(self._s3_bucket, self._base_job_id, worker_id)
+
+    async def get_unresponsive_workers(self, worker_ids: Sequence[str]) -> List[str]:
+        if self._worker_heartbeats is None:
+            raise ValueError("EC2GridJobInterface must be created with `async with`")
+
+        # see agent_function, which heartbeats via TaskLeases
+        return await self._worker_heartbeats.get_unresponsive_workers(worker_ids)
+
 
 class EC2GridJobSshWorkerLauncher(GridJobSshWorkerLauncher):
     def __init__(
@@ -1,5 +1,8 @@
 from __future__ import annotations
 
+import asyncio
+import base64
+import collections
 import json
 import os
 import time
@@ -7,9 +10,11 @@ import traceback
 from typing import (
     TYPE_CHECKING,
     Any,
-    Callable,
+    Deque,
+    Dict,
     Iterable,
     List,
+    NoReturn,
     Optional,
     Tuple,
     TypeVar,
@@ -21,23 +26,35 @@ from meadowrun.aws_integration.ec2_instance_allocation_constants import (
     _MEADOWRUN_TAG,
     _MEADOWRUN_TAG_VALUE,
 )
+from meadowrun.abstract_result_queue import AbstractResultQueue
 from meadowrun.meadowrun_pb2 import ProcessState
-from meadowrun.shared import _chunker
-from meadowrun.run_job_local import restart_worker
+from meadowrun.shared import _chunker, cancel_task, gather_or_cancel
+from meadowrun.run_job_local import BackgroundUploads, restart_worker
 from meadowrun.storage_grid_job import (
     S3Bucket,
-    complete_task,
-    download_task_arg,
+    TaskArgRange,
+    TaskLeases,
+    TaskResultBatcher,
+    download_task_args,
     get_aws_s3_bucket,
-    upload_task_args,
+    upload_task_args_streaming,
 )
 
 if TYPE_CHECKING:
     from types_aiobotocore_sqs.client import SQSClient
 
-    from meadowrun.run_job_local import TaskWorkerServer, WorkerMonitor
+    from meadowrun.run_job_local import TaskWorker
 
 _REQUEST_QUEUE_NAME_PREFIX = "meadowrun-task-"
+# this needs to start with meadowrun-task so that delete_old_task_queues cleans it up
+_RESULT_QUEUE_NAME_PREFIX = "meadowrun-task-result-"
+
+# SQS doesn't allow receiving more than 10 messages at a time
+_MAX_TASKS_PER_RECEIVE = 10
+
+# SQS messages can be up to 256KB. Task result batches up to this size are sent directly
+# in result queue messages, which leaves room for base64 and JSON overhead
+_MAX_INLINE_RESULT_BATCH_BYTES = 160 * 1024
 
 _T = TypeVar("_T")
 
@@ -72,6 +89,75 @@ async def create_request_queue(job_id: str, sqs: SQSClient) -> str:
     return request_queue_url
 
 
+async def create_result_queue(job_id: str, sqs: SQSClient) -> str:
+    """
+    Creates the queue that workers use to tell the driver about results they've written
+    to S3, see SqsResultQueue
+    """
+    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs.html#SQS.Client.create_queue
+    result_queue_response = await sqs.create_queue(
+        QueueName=f"{_RESULT_QUEUE_NAME_PREFIX}{job_id}",
+        tags={_MEADOWRUN_TAG: _MEADOWRUN_TAG_VALUE},
+    )
+    return result_queue_response["QueueUrl"]
+
+
+class SqsResultQueue(AbstractResultQueue):
+    """
+    Each message is JSON, either {"keys": [...]} or {"batch": <base64-encoded task
+    result batch>}. SQS only lets us receive 10 messages at a time, but each message can
+    contain many keys or task results.
+    """
+
+    def __init__(self, sqs: SQSClient, queue_url: str):
+        self._sqs = sqs
+        self._queue_url = queue_url
+
+    def max_inline_batch_bytes(self) -> int:
+        return _MAX_INLINE_RESULT_BATCH_BYTES
+
+    async def _send(self, message: Dict[str, Any]) -> None:
+        # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs.html#SQS.Client.send_message
+        await self._sqs.send_message(
+            QueueUrl=self._queue_url, MessageBody=json.dumps(message)
+        )
+
+    async def send_result_keys(self, keys: List[str]) -> None:
+        await self._send({"keys": keys})
+
+    async def send_result_batch(self, batch: bytes) -> None:
+        await self._send({"batch": base64.b64encode(batch).decode("ascii")})
+
+    async def receive_results(self, wait_seconds: int) -> Tuple[List[str], List[bytes]]:
+        # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs.html#SQS.Client.receive_message
+        result = await self._sqs.receive_message(
+            QueueUrl=self._queue_url,
+            WaitTimeSeconds=wait_seconds,
+            MaxNumberOfMessages=_MAX_TASKS_PER_RECEIVE,
+        )
+        if "Messages" not in result:
+            return [], []
+
+        keys = []
+        batches = []
+        for message in result["Messages"]:
+            body = json.loads(message["Body"])
+            if "batch" in body:
+                batches.append(base64.b64decode(body["batch"]))
+            else:
+                keys.extend(body["keys"])
+
+        # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs.html#SQS.Client.delete_message_batch
+        await self._sqs.delete_message_batch(
+            QueueUrl=self._queue_url,
+            Entries=[
+                {"Id": str(i), "ReceiptHandle": message["ReceiptHandle"]}
+                for i, message in enumerate(result["Messages"])
+            ],
+        )
+        return keys, batches
+
+
 MESSAGE_PREFIX_TASK = "task"
 MESSAGE_PREFIX_WORKER_SHUTDOWN = "worker-shutdown"
 
@@ -82,57 +168,80 @@ async def add_tasks(
     s3_bucket: S3Bucket,
     sqs: SQSClient,
     run_map_args: Iterable[Any],
-) -> List[Tuple[int, int]]:
-    """
-    This can only be called once per request_queue_url. If we wanted to support calling
-    add_tasks more than once for the same job, we would need the caller to manage the
-    task_ids
+    compression: str = "",
+    first_task_id: int = 0,
+    first_segment: int = 0,
+) -> List[TaskArgRange]:
     """
+    Returns the TaskArgRange for each of run_map_args. To call add_tasks more than once
+    for the same job, the caller needs to pass in first_task_id and first_segment so
+    that the task ids and segments continue on from the previous call (see
+    upload_task_args_streaming).
 
-    byte_ranges = await upload_task_args(s3_bucket, base_job_id, run_map_args)
+    Tasks are added to the queue as soon as the segment containing their arguments has
+    been uploaded, so workers can start before all of the arguments have been uploaded.
+    """
 
-    for byte_ranges_chunk in _chunker(enumerate(byte_ranges), 10):
-        # this function can only take 10 messages at a time, so we chunk into
-        # batches of 10
-        # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs.html#SQS.Client.send_message_batch
+    byte_ranges: Dict[int, TaskArgRange] = {}
 
-        entries = [
-            {
-                "Id": str(i),
-                "MessageBody": json.dumps(
-                    {
-                        "task_id": i,
-                        "attempt": 1,
-                        "range_from": range_from,
-                        "range_end": range_to,
-                    }
-                ),
-            }
-            for i, (range_from, range_to) in byte_ranges_chunk
-        ]
+    async for segment_ranges in upload_task_args_streaming(
+        s3_bucket,
+        base_job_id,
+        run_map_args,
+        compression=compression,
+        first_task_id=first_task_id,
+        first_segment=first_segment,
+    ):
+        for byte_ranges_chunk in _chunker(segment_ranges, 10):
+            # this function can only take 10 messages at a time, so we chunk into
+            # batches of 10
+            # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs.html#SQS.Client.send_message_batch
+
+            entries = [
+                {
+                    "Id": str(i),
+                    "MessageBody": json.dumps(
+                        {
+                            "task_id": i,
+                            "attempt": 1,
+                            "segment": segment,
+                            "range_from": range_from,
+                            "range_end": range_to,
+                        }
+                    ),
+                }
+                for i, (segment, range_from, range_to) in byte_ranges_chunk
+            ]
+
+            result = await sqs.send_message_batch(
+                QueueUrl=request_queue_url, Entries=entries  # type: ignore
+            )
+            if "Failed" in result:
+                raise ValueError(
+                    f"Some grid tasks could not be queued: {result['Failed']}"
+                )
 
-        result = await sqs.send_message_batch(
-            QueueUrl=request_queue_url, Entries=entries  # type: ignore
-        )
-        if "Failed" in result:
-            raise ValueError(f"Some grid tasks could not be queued: {result['Failed']}")
+        byte_ranges.update(segment_ranges)
 
-    return byte_ranges
+    return [
+        byte_ranges[i] for i in range(first_task_id, first_task_id + len(byte_ranges))
+    ]
 
 
 async def retry_task(
     request_queue_url: str,
     task_id: int,
     attempt: int,
-    byte_range: Tuple[int, int],
+    byte_range: TaskArgRange,
     sqs_client: SQSClient,
 ) -> None:
     task = json.dumps(
         dict(
             task_id=task_id,
             attempt=attempt,
-            range_from=byte_range[0],
-            range_end=byte_range[1],
+            segment=byte_range[0],
+            range_from=byte_range[1],
+            range_end=byte_range[2],
         )
     )
 
@@ -170,88 +279,264 @@ async def add_worker_shutdown_messages(
 _GET_TASK_TIMEOUT_SECONDS = 60 * 2  # 2 minutes
 
 
-async def _get_task(
+def _raise_get_task_timeout() -> NoReturn:
+    raise TimeoutError(
+        f"Waited more than {_GET_TASK_TIMEOUT_SECONDS} for the next task but no task "
+        "was available. This is unexpected--the GridJobDriver should have sent a "
+        "shutdown message or a SIGINT explicitly"
+    )
+
+
+async def _get_tasks(
     sqs: SQSClient,
     s3_bucket: S3Bucket,
     request_queue_url: str,
     job_id: str,
     receive_message_wait_seconds: int,
-) -> Optional[Tuple[int, int, bytes]]:
+    max_num_tasks: int,
+    timeout_seconds: Optional[float] = _GET_TASK_TIMEOUT_SECONDS,
+    leases: Optional[TaskLeases] = None,
+) -> Tuple[List[Tuple[int, int, bytes]], bool]:
     """
-    Gets the next task from the specified request_queue, downloads the task argument
-    from S3, and then deletes the message from the request_queue.
-
-    Returns a tuple of task_id and pickled argument if there was a task, otherwise
-    returns None. Waits receive_message_wait_seconds for a task.
+    Gets up to max_num_tasks tasks from the specified request_queue with a single
+    receive_message call, downloads their task arguments from S3 (coalescing the byte
+    ranges where possible), and then deletes the messages from the request_queue with a
+    single delete_message_batch call. If leases is provided, the tasks are added to it
+    before the messages are deleted.
+
+    Returns a list of (task_id, attempt, pickled argument), and whether we received a
+    worker shutdown message. The caller should run the tasks before shutting down. Each
+    receive_message call waits receive_message_wait_seconds, and we keep trying for
+    timeout_seconds (or forever if it's None).
     """
-    # get the task message
+    # get the task messages
     t0 = time.time()
     while True:
-        if time.time() - t0 > _GET_TASK_TIMEOUT_SECONDS:
-            raise TimeoutError(
-                f"Waited more than {_GET_TASK_TIMEOUT_SECONDS} for the next task but no"
-                " task was available. This is unexpected--the GridJobDriver should have"
-                " sent a shutdown message or a SIGINT explicitly"
-            )
+        if timeout_seconds is not None and time.time() - t0 > timeout_seconds:
+            _raise_get_task_timeout()
 
         result = await sqs.receive_message(
-            QueueUrl=request_queue_url, WaitTimeSeconds=receive_message_wait_seconds
+            QueueUrl=request_queue_url,
+            WaitTimeSeconds=receive_message_wait_seconds,
+            MaxNumberOfMessages=max_num_tasks,
         )
 
         if "Messages" in result:
             break
 
-    messages = result["Messages"]
-    if len(messages) != 1:
-        raise ValueError(f"Requested one message but got {len(messages)}")
-
-    # parse the task request
-    task = json.loads(messages[0]["Body"])
-    if "task_id" in task:
-        task_id, attempt, range_from, range_end = (
-            task["task_id"],
-            task["attempt"],
-            task["range_from"],
-            task["range_end"],
-        )
-        arg = await download_task_arg(s3_bucket, job_id, (range_from, range_end))
+    # parse the task requests
+    tasks = []
+    messages_to_delete = []
+    shutdown_messages = []
+    for message in result["Messages"]:
+        task = json.loads(message["Body"])
+        if "task_id" in task:
+            tasks.append(
+                (
+                    task["task_id"],
+                    task["attempt"],
+                    (task["segment"], task["range_from"], task["range_end"]),
+                )
+            )
+            messages_to_delete.append(message)
+        else:
+            shutdown_messages.append(message)
+
+    if shutdown_messages:
+        # each shutdown message is meant for one worker, so we only consume one of them
+        # and make the rest visible again immediately for other workers
+        messages_to_delete.append(shutdown_messages[0])
+        if len(shutdown_messages) > 1:
+            # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs.html#SQS.Client.change_message_visibility_batch
+            await sqs.change_message_visibility_batch(
+                QueueUrl=request_queue_url,
+                Entries=[
+                    {
+                        "Id": str(i),
+                        "ReceiptHandle": message["ReceiptHandle"],
+                        "VisibilityTimeout": 0,
+                    }
+                    for i, message in enumerate(shutdown_messages[1:])
+                ],
+            )
 
-        # TODO store somewhere (DynamoDB?) that this worker has picked up the task.
+    args = await download_task_args(
+        s3_bucket, job_id, [byte_range for _, _, byte_range in tasks]
+    )
 
-        # acknowledge receipt/delete the task request message so we don't have duplicate
-        # tasks running
-        # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs.html#SQS.Client.delete_message
-        await sqs.delete_message(
-            QueueUrl=request_queue_url, ReceiptHandle=messages[0]["ReceiptHandle"]
+    # record that this worker has picked up the tasks, so that they can be rescheduled
+    # if this worker exits unexpectedly
+    if leases is not None and tasks:
+        await leases.add((task_id, attempt) for task_id, attempt, _ in tasks)
+
+    # acknowledge receipt/delete the task request messages so we don't have duplicate
+    # tasks running
+    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs.html#SQS.Client.delete_message_batch
+    delete_result = await sqs.delete_message_batch(
+        QueueUrl=request_queue_url,
+        Entries=[
+            {"Id": str(i), "ReceiptHandle": message["ReceiptHandle"]}
+            for i, message in enumerate(messages_to_delete)
+        ],
+    )
+    if "Failed" in delete_result:
+        # the tasks will become visible again and get run twice, which is fine, see
+        # create_request_queue
+        print(
+            "Meadowrun agent: Warning, some task messages could not be deleted: "
+            f"{delete_result['Failed']}"
         )
 
-        return task_id, attempt, arg
-
-    # it's a worker exit message, so return None to exit
-    await sqs.delete_message(
-        QueueUrl=request_queue_url, ReceiptHandle=messages[0]["ReceiptHandle"]
+    return (
+        [(task_id, attempt, arg) for (task_id, attempt, _), arg in zip(tasks, args)],
+        bool(shutdown_messages),
     )
-    return None
 
 
-async def _worker_iteration(
+async def _get_task(
     sqs: SQSClient,
     s3_bucket: S3Bucket,
     request_queue_url: str,
-    base_job_id: str,
+    job_id: str,
+    receive_message_wait_seconds: int,
+) -> Optional[Tuple[int, int, bytes]]:
+    """
+    Gets the next task from the specified request_queue, downloads the task argument
+    from S3, and then deletes the message from the request_queue.
+
+    Returns a tuple of task_id and pickled argument if there was a task, otherwise
+    returns None. Waits receive_message_wait_seconds for a task.
+    """
+    tasks, _ = await _get_tasks(
+        sqs, s3_bucket, request_queue_url, job_id, receive_message_wait_seconds, 1
+    )
+    if tasks:
+        return tasks[0]
+
+    # it's a worker exit message, so return None to exit
+    return None
+
+
+class _TaskPrefetchQueue:
+    """
+    A small local queue of tasks that have been leased from the request queue (i.e.
+    received, downloaded and deleted from the request queue) but not run yet. Tasks are
+    leased in batches of up to max_tasks_per_receive, so for short tasks we only make a
+    handful of requests per batch rather than per task.
+
+    If prefetch is True, as soon as we hand out the last task in the queue, we start
+    leasing the next batch in the background, so that the next task argument is usually
+    already downloaded by the time the task worker finishes the current task. get_task
+    can be called concurrently by an agent's task workers. In that case, we start
+    leasing the next batch when there are fewer tasks left than task workers.
+
+    Both batching and prefetching mean that a worker can end up holding on to tasks that
+    an idle worker could have run, which makes jobs with long-running tasks or roughly
+    as many tasks as workers slower. So by default (max_tasks_per_receive=1 and
+    prefetch=False), we only lease a task when a task worker is ready to run it, and
+    batching/prefetching should only be turned on for jobs with many short tasks.
+
+    If leases is provided, leased tasks are recorded in it, see TaskLeases.
+    """
+
+    def __init__(
+        self,
+        sqs: SQSClient,
+        s3_bucket: S3Bucket,
+        request_queue_url: str,
+        job_id: str,
+        max_tasks_per_receive: int,
+        receive_message_wait_seconds: int,
+        num_task_workers: int = 1,
+        leases: Optional[TaskLeases] = None,
+        prefetch: bool = False,
+    ):
+        if max_tasks_per_receive < 1 or max_tasks_per_receive > _MAX_TASKS_PER_RECEIVE:
+            raise ValueError(
+                f"max_tasks_per_receive must be between 1 and {_MAX_TASKS_PER_RECEIVE}"
+            )
+
+        self._sqs = sqs
+        self._s3_bucket = s3_bucket
+        self._request_queue_url = request_queue_url
+        self._job_id = job_id
+        self._max_tasks_per_receive = max_tasks_per_receive
+        self._receive_message_wait_seconds = receive_message_wait_seconds
+        self._num_task_workers = num_task_workers
+        self._leases = leases
+        self._prefetch_enabled = prefetch
+
+        self._lock = asyncio.Lock()
+        self._tasks: Deque[Tuple[int, int, bytes]] = collections.deque()
+        self._shutdown_received = False
+        self._prefetch: Optional[
+            asyncio.Task[Tuple[List[Tuple[int, int, bytes]], bool]]
+        ] = None
+
+    def _start_prefetch(self) -> None:
+        # The task worker may be busy for much longer than _GET_TASK_TIMEOUT_SECONDS,
+        # so we don't time out here. Instead, get_task applies the timeout to the time
+        # spent actually waiting for the next task.
+        self._prefetch = asyncio.create_task(
+            _get_tasks(
+                self._sqs,
+                self._s3_bucket,
+                self._request_queue_url,
+                self._job_id,
+                self._receive_message_wait_seconds,
+                self._max_tasks_per_receive,
+                None,
+                self._leases,
+            )
+        )
+
+    async def get_task(self) -> Optional[Tuple[int, int, bytes]]:
+        """
+        Returns the next task as (task_id, attempt, pickled argument), or None if we've
+        received a shutdown message and there are no tasks left to run
+        """
+        async with self._lock:
+            if not self._tasks and not self._shutdown_received:
+                if self._prefetch is None:
+                    self._start_prefetch()
+                assert self._prefetch is not None
+                try:
+                    tasks, self._shutdown_received = await asyncio.wait_for(
+                        self._prefetch, _GET_TASK_TIMEOUT_SECONDS
+                    )
+                except asyncio.TimeoutError:
+                    _raise_get_task_timeout()
+                finally:
+                    self._prefetch = None
+                self._tasks.extend(tasks)
+
+            if self._tasks:
+                task = self._tasks.popleft()
+                if (
+                    self._prefetch_enabled
+                    and len(self._tasks) < self._num_task_workers
+                    and not self._shutdown_received
+                    and self._prefetch is None
+                ):
+                    self._start_prefetch()
+                return task
+
+            return None
+
+    async def close(self) -> None:
+        if self._prefetch is not None:
+            await cancel_task(self._prefetch)
+            self._prefetch = None
+
+
+async def _worker_iteration(
+    task_queue: _TaskPrefetchQueue,
+    results: TaskResultBatcher,
     log_file_name: str,
     pid: int,
-    worker_server: TaskWorkerServer,
-    worker_monitor: WorkerMonitor,
-    get_job_state: Callable[[int], ProcessState],
+    task_worker: TaskWorker,
 ) -> bool:
-    task = await _get_task(
-        sqs,
-        s3_bucket,
-        request_queue_url,
-        base_job_id,
-        3,
-    )
+    task = await task_queue.get_task()
     if not task:
         print("Meadowrun agent: Received shutdown message. Exiting.")
         return False
@@ -261,11 +546,11 @@ async def _worker_iteration(
     task_id, attempt, arg = task
     print(f"Meadowrun agent: About to execute task #{task_id}, attempt #{attempt}")
     try:
-        worker_monitor.start_stats()
-        await worker_server.send_message(arg)
+        task_worker.monitor.start_stats()
+        await task_worker.server.send_message(arg)
 
-        state, result = await worker_server.receive_message()
-        stats = await worker_monitor.stop_stats()
+        state, result = await task_worker.server.receive_message()
+        stats = await task_worker.monitor.stop_stats()
 
         process_state = ProcessState(
             state=ProcessState.ProcessStateEnum.SUCCEEDED
@@ -276,16 +561,18 @@ async def _worker_iteration(
             return_code=0,
             log_file_name=log_file_name,
             max_memory_used_gb=stats.max_memory_used_gb,
+            duration_seconds=stats.duration_seconds,
         )
 
     except Exception:
-        stats = await worker_monitor.stop_stats()
+        stats = await task_worker.monitor.stop_stats()
 
-        process_state = get_job_state(  # type: ignore
-            return_code=(await worker_monitor.try_get_return_code()) or 0,
+        process_state = task_worker.get_job_state(  # type: ignore
+            return_code=(await task_worker.monitor.try_get_return_code()) or 0,
         )
         process_state.max_memory_used_gb = stats.max_memory_used_gb
-        process_state.was_oom_killed = await worker_monitor.was_oom_killed()
+        process_state.duration_seconds = stats.duration_seconds
+        process_state.was_oom_killed = await task_worker.monitor.was_oom_killed()
 
         oom_message = ""
         if process_state.was_oom_killed:
@@ -301,42 +588,102 @@ async def _worker_iteration(
         f"state {ProcessState.ProcessStateEnum.Name(process_state.state)}, max "
         f"memory {process_state.max_memory_used_gb}GB "
     )
-    await complete_task(s3_bucket, base_job_id, task_id, attempt, process_state)
+    # the result gets uploaded in the background (possibly batched with other results)
+    # so that we can start on the next task right away
+    await results.add(task_id, attempt, process_state)
 
     if worker_restart_needed:
-        await restart_worker(worker_server, worker_monitor)
+        await restart_worker(task_worker.server, task_worker.monitor)
 
     return True
 
 
+async def _task_worker_loop(
+    task_queue: _TaskPrefetchQueue,
+    results: TaskResultBatcher,
+    log_file_name: str,
+    pid: int,
+    task_worker: TaskWorker,
+) -> None:
+    await task_worker.server.wait_for_task_worker_connection()
+    while await _worker_iteration(task_queue, results, log_file_name, pid, task_worker):
+        pass
+
+
 async def agent_function(
     request_queue_url: str,
     region_name: str,
+    result_queue_url: Optional[str],
     log_file_name: str,
     base_job_id: str,
-    worker_server: TaskWorkerServer,
-    worker_monitor: WorkerMonitor,
-    get_job_state: Callable[[int], ProcessState],
+    job_id: str,
+    task_workers: List[TaskWorker],
+    max_tasks_per_receive: int = 1,
+    prefetch: bool = False,
 ) -> None:
     """
     Runs a loop that gets tasks off of the request_queue, communicates that via reader
-    and writer to the task worker, and uploads the results to S3.
+    and writer to the task worker, and uploads the results to S3. By default, each task
+    worker leases one task at a time when it's ready to run it. For jobs with many short
+    tasks, tasks can be leased in batches of up to max_tasks_per_receive, and if
+    prefetch is True the next batch is leased while the task worker is running the
+    current task, see _TaskPrefetchQueue.
+    Results are batched and uploaded in the background (see TaskResultBatcher), and if
+    result_queue_url is provided, their keys are sent to the result queue, see
+    SqsResultQueue.
+
+    If there is more than one task worker, each one runs its own loop, but they share
+    the same _TaskPrefetchQueue and TaskResultBatcher. A single shutdown message stops
+    all of the task workers.
+
+    The tasks that this agent has leased but not written results for are recorded under
+    job_id (see TaskLeases), so that if this agent exits unexpectedly, GridJobDriver can
+    reschedule them right away. The lease is also rewritten periodically as a heartbeat,
+    so that GridJobDriver can tell when this agent dies without writing a process state,
+    e.g. because its spot instance was interrupted.
     """
     pid = os.getpid()
     session = aiobotocore.session.get_session()
     async with session.create_client(
         "sqs", region_name=region_name
     ) as sqs, get_aws_s3_bucket(region_name) as s3_bucket:
-        await worker_server.wait_for_task_worker_connection()
-        while await _worker_iteration(
+        leases = TaskLeases(s3_bucket, base_job_id, job_id)
+        heartbeat_task = asyncio.create_task(leases.heartbeat_loop())
+        task_queue = _TaskPrefetchQueue(
             sqs,
             s3_bucket,
             request_queue_url,
             base_job_id,
-            log_file_name,
-            pid,
-            worker_server,
-            worker_monitor,
-            get_job_state,
-        ):
-            pass
+            max_tasks_per_receive,
+            3,
+            len(task_workers),
+            leases,
+            prefetch,
+        )
+        if result_queue_url is not None:
+            result_queue = SqsResultQueue(sqs, result_queue_url)
+        else:
+            result_queue = None
+        uploads = BackgroundUploads()
+        results = TaskResultBatcher(
+            s3_bucket, base_job_id, uploads, result_queue, leases=leases
+        )
+        try:
+            await gather_or_cancel(
+                *(
+                    _task_worker_loop(
+                        task_queue, results, log_file_name, pid, task_worker
+                    )
+                    for task_worker in task_workers
+                )
+            )
+
+            await results.close()
+            await uploads.wait_all()
+            await cancel_task(heartbeat_task)
+            await leases.close()
+        finally:
+            heartbeat_task.cancel()
+            await task_queue.close()
+            results.cancel()
+            uploads.cancel()
@@ -1,6 +1,7 @@
 from __future__ import annotations
 
 import asyncio
+import bisect
 import dataclasses
 import datetime
 import json
@@ -492,9 +493,9 @@ class AllocAzureVM(AllocVM):
         )
 
     def _create_grid_job_cloud_interface(
-        self, base_job_id: str
+        self, base_job_id: str, compression: str
     ) -> GridJobCloudInterface:
-        return AzureVMGridJobInterface(self, base_job_id)
+        return AzureVMGridJobInterface(self, base_job_id, compression)
 
     def _create_grid_job_worker_launcher(
         self,
@@ -558,22 +559,48 @@ class AzureVMGridJobInterface(GridJobCloudInterface, Generic[_T, _U]):
             "Retrying with more resources is not supported on Azure yet"
         )
 
-    def __init__(self, alloc_cloud_instance: AllocAzureVM, base_job_id: str):
+    def __init__(
+        self,
+        alloc_cloud_instance: AllocAzureVM,
+        base_job_id: str,
+        compression: str = "",
+    ):
         self._location = alloc_cloud_instance._get_location()
 
         self._request_result_queues: Optional[asyncio.Task[Tuple[Queue, Queue]]] = None
 
-        self._tasks: Optional[Sequence[_T]] = None
+        # the batches of tasks passed to setup_and_add_tasks/add_tasks, which we keep
+        # around for retry_task, and the task id of the first task in each batch
+        self._tasks: Optional[List[Sequence[_T]]] = None
+        self._first_task_ids: List[int] = []
 
         self._job_id = base_job_id
+        self._compression = compression
 
     async def setup_and_add_tasks(self, tasks: Sequence[_T]) -> None:
         print(f"The current run_map's id is {self._job_id}")
         self._request_result_queues = asyncio.create_task(
             create_queues_for_job(self._job_id, self._location)
         )
-        self._tasks = tasks
-        await add_tasks((await self._request_result_queues)[0], tasks)
+        self._tasks = []
+        await self.add_tasks(tasks)
+
+    async def add_tasks(self, tasks: Sequence[_T]) -> None:
+        if self._tasks is None or self._request_result_queues is None:
+            raise ValueError("Must call setup_and_add_tasks before calling add_tasks")
+
+        if self._tasks:
+            first_task_id = self._first_task_ids[-1] + len(self._tasks[-1])
+        else:
+            first_task_id = 0
+        self._tasks.append(tasks)
+        self._first_task_ids.append(first_task_id)
+        await add_tasks(
+            (await self._request_result_queues)[0],
+            tasks,
+            self._compression,
+            first_task_id,
+        )
 
     async def shutdown_workers(self, num_workers: int, queue_index: int) -> None:
         if queue_index != 0:
@@ -625,6 +652,11 @@ class AzureVMGridJobInterface(GridJobCloudInterface, Generic[_T, _U]):
             workers_done,
         )
 
+    def _get_task(self, task_id: int) -> _T:
+        assert self._tasks is not None
+        i = bisect.bisect_right(self._first_task_ids, task_id) - 1
+        return self._tasks[i][task_id - self._first_task_ids[i]]
+
     async def retry_task(
         self, task_id: int, attempts_so_far: int, queue_index: int
     ) -> None:
@@ -635,7 +667,8 @@ class AzureVMGridJobInterface(GridJobCloudInterface, Generic[_T, _U]):
             (await self._request_result_queues)[0],
             task_id,
             attempts_so_far + 1,
-            self._tasks[task_id],
+            self._get_task(task_id),
+            self._compression,
         )
 
 
@@ -166,6 +166,25 @@ class AzureBlobContainer(AbstractStorageBucket):
             binary_content=data,
         )
 
+    async def write_bytes_exclusive(self, data: bytes, key: str) -> bool:
+        try:
+            await azure_blob_api(
+                "PUT",
+                self._storage_account,
+                f"{self._container_name}/{key}",
+                additional_headers={
+                    "Content-Length": str(len(data)),
+                    "x-ms-blob-type": "BlockBlob",
+                    "If-None-Match": "*",
+                },
+                binary_content=data,
+            )
+            return True
+        except AzureRestApiError as error:
+            if error.status == 409:
+                return False
+            raise
+
     async def exists(self, key: str) -> bool:
         try:
             await azure_blob_api(
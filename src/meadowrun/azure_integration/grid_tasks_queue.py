@@ -5,14 +5,12 @@ import asyncio
 import dataclasses
 import datetime
 import os
-import pickle
 import time
 import traceback
 from typing import (
     TYPE_CHECKING,
     Any,
     AsyncIterable,
-    Callable,
     Iterable,
     List,
     Optional,
@@ -25,6 +23,10 @@ from meadowrun.azure_integration.azure_meadowrun_core import (
     ensure_meadowrun_storage_account,
     record_last_used,
 )
+from meadowrun.azure_integration.blob_storage import (
+    CONTAINER_NAME,
+    AzureBlobContainer,
+)
 from meadowrun.azure_integration.mgmt_functions.azure_constants import (
     _REQUEST_QUEUE_NAME_PREFIX,
     _RESULT_QUEUE_NAME_PREFIX,
@@ -40,13 +42,20 @@ from meadowrun.azure_integration.mgmt_functions.azure_core.azure_storage_api imp
     queue_receive_messages,
     queue_send_message,
 )
+from meadowrun.compression import dumps_payload
 from meadowrun.meadowrun_pb2 import GridTask, GridTaskStateResponse, ProcessState
 from meadowrun.run_job_core import TaskProcessState
-from meadowrun.run_job_local import WorkerMonitor, restart_worker
+from meadowrun.run_job_local import BackgroundUploads, restart_worker
+from meadowrun.shared import cancel_task, gather_or_cancel
+from meadowrun.storage_keys import (
+    parse_storage_key_task_result,
+    storage_key_task_result,
+    storage_prefix_outputs,
+)
 
 if TYPE_CHECKING:
     from meadowrun.run_job_core import WorkerProcessState
-    from meadowrun.run_job_local import TaskWorkerServer
+    from meadowrun.run_job_local import TaskWorker
 
 _T = TypeVar("_T")
 _U = TypeVar("_U")
@@ -88,7 +97,12 @@ async def create_queues_for_job(job_id: str, location: str) -> Tuple[Queue, Queu
 _WORKER_SHUTDOWN_MESSAGE = b"worker-shutdown"
 
 
-async def add_tasks(request_queue: Queue, tasks: Iterable[Any]) -> None:
+async def add_tasks(
+    request_queue: Queue,
+    tasks: Iterable[Any],
+    compression: str = "",
+    first_task_id: int = 0,
+) -> None:
     await asyncio.wait(
         [
             asyncio.create_task(
@@ -98,17 +112,19 @@ async def add_tasks(request_queue: Queue, tasks: Iterable[Any]) -> None:
                     GridTask(
                         task_id=i,
                         attempt=1,
-                        pickled_function_arguments=pickle.dumps(((task,), {})),
+                        pickled_function_arguments=dumps_payload(
+                            ((task,), {}), compression
+                        ),
                     ).SerializeToString(),
                 )
             )
-            for i, task in enumerate(tasks)
+            for i, task in enumerate(tasks, first_task_id)
         ]
     )
 
 
 async def retry_task(
-    request_queue: Queue, task_id: int, attempt: int, task: Any
+    request_queue: Queue, task_id: int, attempt: int, task: Any, compression: str = ""
 ) -> None:
     await queue_send_message(
         request_queue.storage_account,
@@ -116,7 +132,7 @@ async def retry_task(
         GridTask(
             task_id=task_id,
             attempt=attempt,
-            pickled_function_arguments=pickle.dumps(((task,), {})),
+            pickled_function_arguments=dumps_payload(((task,), {}), compression),
         ).SerializeToString(),
     )
 
@@ -182,34 +198,53 @@ async def _get_task(request_queue: Queue, result_queue: Queue) -> Optional[GridT
     return task
 
 
+# Azure queue messages can be up to 64KB after base64 encoding, so results bigger than
+# this get written to blob storage, and we just send the key on the result queue
+_MAX_INLINE_RESULT_BYTES = 47 * 1024
+
+# Messages on the result queue that start with this are followed by the key of a
+# ProcessState in blob storage. A serialized GridTaskStateResponse can never start with
+# this prefix, because "s" is not a valid tag for any of its fields
+_SPILLED_RESULT_PREFIX = b"spilled-result:"
+
+
+def _get_blob_container(queue: Queue) -> AzureBlobContainer:
+    # the queues are in the same storage account as the meadowrun blob container
+    return AzureBlobContainer(queue.storage_account, CONTAINER_NAME)
+
+
 async def _complete_task(
     result_queue: Queue,
     task: GridTask,
     process_state: ProcessState,
 ) -> None:
+    task_result = GridTaskStateResponse(
+        task_id=task.task_id, attempt=task.attempt, process_state=process_state
+    )
+    if task_result.ByteSize() <= _MAX_INLINE_RESULT_BYTES:
+        message = task_result.SerializeToString()
+    else:
+        key = storage_key_task_result(
+            result_queue.queue_job_id, task.task_id, task.attempt
+        )
+        await _get_blob_container(result_queue).write_bytes(
+            process_state.SerializeToString(), key
+        )
+        message = _SPILLED_RESULT_PREFIX + key.encode("utf-8")
+
     await queue_send_message(
-        result_queue.storage_account,
-        result_queue.queue_name,
-        GridTaskStateResponse(
-            task_id=task.task_id, attempt=task.attempt, process_state=process_state
-        ).SerializeToString(),
+        result_queue.storage_account, result_queue.queue_name, message
     )
 
 
 async def _worker_iteration(
-    request_queue: Queue,
+    task: GridTask,
     result_queue: Queue,
+    uploads: BackgroundUploads,
     log_file_name: str,
     pid: int,
-    worker_server: TaskWorkerServer,
-    worker_monitor: WorkerMonitor,
-    get_job_state: Callable[[int], ProcessState],
-) -> bool:
-    task = await _get_task(request_queue, result_queue)
-    if not task:
-        print("Meadowrun agent: Received shutdown message. Exiting.")
-        return False
-
+    task_worker: TaskWorker,
+) -> None:
     worker_restart_needed = False
 
     print(
@@ -218,10 +253,10 @@ async def _worker_iteration(
     )
 
     try:
-        worker_monitor.start_stats()
-        await worker_server.send_message(task.pickled_function_arguments)
-        state, result = await worker_server.receive_message()
-        stats = await worker_monitor.stop_stats()
+        task_worker.monitor.start_stats()
+        await task_worker.server.send_message(task.pickled_function_arguments)
+        state, result = await task_worker.server.receive_message()
+        stats = await task_worker.monitor.stop_stats()
 
         process_state = ProcessState(
             state=ProcessState.ProcessStateEnum.SUCCEEDED
@@ -232,16 +267,18 @@ async def _worker_iteration(
             return_code=0,
             log_file_name=log_file_name,
             max_memory_used_gb=stats.max_memory_used_gb,
+            duration_seconds=stats.duration_seconds,
         )
 
     except Exception:
-        stats = await worker_monitor.stop_stats()
+        stats = await task_worker.monitor.stop_stats()
 
-        process_state = get_job_state(  # type: ignore
-            return_code=(await worker_monitor.try_get_return_code()) or 0
+        process_state = task_worker.get_job_state(  # type: ignore
+            return_code=(await task_worker.monitor.try_get_return_code()) or 0
         )
         process_state.max_memory_used_gb = stats.max_memory_used_gb
-        process_state.was_oom_killed = await worker_monitor.was_oom_killed()
+        process_state.duration_seconds = stats.duration_seconds
+        process_state.was_oom_killed = await task_worker.monitor.was_oom_killed()
 
         oom_message = ""
         if process_state.was_oom_killed:
@@ -259,12 +296,38 @@ async def _worker_iteration(
         f"state {ProcessState.ProcessStateEnum.Name(process_state.state)}, max "
         f"memory {process_state.max_memory_used_gb}GB "
     )
-    await _complete_task(result_queue, task, process_state)
+    # send the result in the background so that we can start on the next task right
+    # away
+    await uploads.add(_complete_task(result_queue, task, process_state))
 
     if worker_restart_needed:
-        await restart_worker(worker_server, worker_monitor)
+        await restart_worker(task_worker.server, task_worker.monitor)
+
 
-    return True
+async def _task_worker_loop(
+    request_queue: Queue,
+    result_queue: Queue,
+    uploads: BackgroundUploads,
+    log_file_name: str,
+    pid: int,
+    task_worker: TaskWorker,
+) -> None:
+    # While the task worker is running a task, we get the next task from the queue and
+    # send the result of the previous task in the background
+    next_task = asyncio.create_task(_get_task(request_queue, result_queue))
+    try:
+        while True:
+            task = await next_task
+            if not task:
+                print("Meadowrun agent: Received shutdown message. Exiting.")
+                break
+
+            next_task = asyncio.create_task(_get_task(request_queue, result_queue))
+            await _worker_iteration(
+                task, result_queue, uploads, log_file_name, pid, task_worker
+            )
+    finally:
+        await cancel_task(next_task)
 
 
 async def agent_function(
@@ -272,22 +335,35 @@ async def agent_function(
     result_queue: Queue,
     log_file_name: str,
     base_job_id: str,
-    worker_server: TaskWorkerServer,
-    worker_monitor: WorkerMonitor,
-    get_job_state: Callable[[int], ProcessState],
+    job_id: str,
+    task_workers: List[TaskWorker],
 ) -> None:
+    """
+    If there is more than one task worker, each one gets tasks from request_queue
+    independently. There is one shutdown message per agent, but _get_task never deletes
+    it from request_queue, so each task worker will receive it.
+    """
     pid = os.getpid()
 
-    while await _worker_iteration(
-        request_queue,
-        result_queue,
-        log_file_name,
-        pid,
-        worker_server,
-        worker_monitor,
-        get_job_state,
-    ):
-        pass
+    uploads = BackgroundUploads()
+    try:
+        await gather_or_cancel(
+            *(
+                _task_worker_loop(
+                    request_queue,
+                    result_queue,
+                    uploads,
+                    log_file_name,
+                    pid,
+                    task_worker,
+                )
+                for task_worker in task_workers
+            )
+        )
+
+        await uploads.wait_all()
+    finally:
+        uploads.cancel()
 
 
 async def get_results_unordered(
@@ -302,6 +378,8 @@ async def get_results_unordered(
     # use them to react appropriately if a worker crashes unexpectedly.
 
     num_tasks_running, num_tasks_completed = 0, 0
+    blob_container = _get_blob_container(result_queue)
+    results_prefix = storage_prefix_outputs(result_queue.queue_job_id)
     t0 = None
     updated = True
     stop_receiving_wait_task = asyncio.create_task(stop_receiving.wait())
@@ -335,10 +413,28 @@ async def get_results_unordered(
             return
         else:
             results = []
+            spilled_result_keys = []
 
             for message in receive_messages_task.result():
                 updated = True
 
+                if message.message_content.startswith(_SPILLED_RESULT_PREFIX):
+                    # see _complete_task
+                    num_tasks_running -= 1
+                    num_tasks_completed += 1
+                    spilled_result_keys.append(
+                        message.message_content[len(_SPILLED_RESULT_PREFIX) :].decode(
+                            "utf-8"
+                        )
+                    )
+                    await queue_delete_message(
+                        result_queue.storage_account,
+                        result_queue.queue_name,
+                        message.message_id,
+                        message.pop_receipt,
+                    )
+                    continue
+
                 task_result = GridTaskStateResponse()
                 task_result.ParseFromString(message.message_content)
 
@@ -364,4 +460,38 @@ async def get_results_unordered(
                     message.pop_receipt,
                 )
 
+            if spilled_result_keys:
+                results.extend(
+                    await _download_spilled_results(
+                        blob_container, spilled_result_keys, results_prefix
+                    )
+                )
+
             yield results, []
+
+
+async def _download_spilled_results(
+    blob_container: AzureBlobContainer, keys: List[str], results_prefix: str
+) -> List[TaskProcessState]:
+    """Downloads and then deletes results written by _complete_task"""
+    keys = list(dict.fromkeys(keys))
+    process_states = await asyncio.gather(
+        *(blob_container.try_get_bytes(key) for key in keys)
+    )
+    await asyncio.gather(
+        *(blob_container.delete_object(key) for key in keys), return_exceptions=True
+    )
+
+    results = []
+    for key, process_state_bytes in zip(keys, process_states):
+        if process_state_bytes is None:
+            # a message can be delivered more than once, in which case we will have
+            # already downloaded and deleted this result
+            continue
+        task_id, attempt = parse_storage_key_task_result(key, results_prefix)
+        results.append(
+            TaskProcessState(
+                task_id, attempt, ProcessState.FromString(process_state_bytes)
+            )
+        )
+    return results
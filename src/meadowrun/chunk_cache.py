@@ -0,0 +1,140 @@
+"""
+A cache of the chunks of files that were uploaded via ensure_uploaded_incremental. Chunk
+keys end with the blake2b hash of the chunk's contents, so chunks can be shared between
+different versions of the same file (e.g. code zip files that only differ in a single
+file), and download_chunked_file only needs to download chunks that aren't in the cache.
+
+The cache is a folder on the local machine that can be shared by any number of
+processes. Each chunk is stored in a file named after its hash, the files' modification
+times record when they were last used, and the least recently used chunks are deleted
+when the cache is larger than its maximum size.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import os
+import re
+import tempfile
+from typing import Optional
+
+
+_DEFAULT_MAX_SIZE_BYTES = 1024**3
+
+# see ensure_uploaded_incremental for how chunk keys are constructed
+_CHUNK_KEY_REGEX = re.compile(r"(?:^|/)([0-9a-f]{128})\.part$")
+
+# prefix for files that are still being written
+_TEMP_FILE_PREFIX = "tmp"
+
+
+def _chunk_hash(key: str) -> Optional[str]:
+    match = _CHUNK_KEY_REGEX.search(key)
+    if match is None:
+        return None
+    return match.group(1)
+
+
+class ChunkCache:
+    """
+    Caches chunks in folder, which will be created if it doesn't exist. Chunks are
+    identified by their keys in the storage bucket, keys that don't end with a chunk
+    hash are never cached.
+    """
+
+    def __init__(self, folder: str, max_size_bytes: int = _DEFAULT_MAX_SIZE_BYTES):
+        self._folder = folder
+        self._max_size_bytes = max_size_bytes
+        os.makedirs(folder, exist_ok=True)
+
+    def get(self, key: str) -> Optional[bytes]:
+        chunk_hash = _chunk_hash(key)
+        if chunk_hash is None:
+            return None
+
+        path = os.path.join(self._folder, chunk_hash)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+
+        if hashlib.blake2b(data).hexdigest() != chunk_hash:
+            # should never happen, as we only ever write complete files
+            self._remove(path)
+            return None
+
+        # mark the chunk as recently used
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return data
+
+    def put(self, key: str, data: bytes) -> None:
+        chunk_hash = _chunk_hash(key)
+        if chunk_hash is None or hashlib.blake2b(data).hexdigest() != chunk_hash:
+            return
+
+        # write to a temporary file and then rename it so that other processes never
+        # see partially written chunks
+        f = tempfile.NamedTemporaryFile(
+            dir=self._folder, prefix=_TEMP_FILE_PREFIX, delete=False
+        )
+        try:
+            with f:
+                f.write(data)
+            os.replace(f.name, os.path.join(self._folder, chunk_hash))
+        except BaseException:
+            # e.g. the disk is full, don't leave the temporary file behind
+            self._remove(f.name)
+            raise
+
+    def evict(self) -> None:
+        """
+        Deletes the least recently used chunks until the cache is no larger than
+        max_size_bytes
+        """
+        chunks = []
+        total_size = 0
+        with os.scandir(self._folder) as entries:
+            for entry in entries:
+                if entry.name.startswith(_TEMP_FILE_PREFIX):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    # another process evicted this chunk
+                    continue
+                chunks.append((stat.st_mtime, stat.st_size, entry.path))
+                total_size += stat.st_size
+
+        if total_size <= self._max_size_bytes:
+            return
+
+        chunks.sort()
+        for _, size, path in chunks:
+            self._remove(path)
+            total_size -= size
+            if total_size <= self._max_size_bytes:
+                break
+
+    # get, put and evict do file I/O and hashing, so these versions run them on a thread
+    # to avoid blocking the event loop, e.g. while other chunks are being downloaded
+
+    async def get_async(self, key: str) -> Optional[bytes]:
+        return await asyncio.get_running_loop().run_in_executor(None, self.get, key)
+
+    async def put_async(self, key: str, data: bytes) -> None:
+        await asyncio.get_running_loop().run_in_executor(None, self.put, key, data)
+
+    async def evict_async(self) -> None:
+        await asyncio.get_running_loop().run_in_executor(None, self.evict)
+
+    @staticmethod
+    def _remove(path: str) -> None:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
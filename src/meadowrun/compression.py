@@ -0,0 +1,237 @@
+"""
+Optional compression for run_map task arguments and results, see Job.compression.
+
+Compressed payloads are prefixed with _COMPRESSED_PAYLOAD_MARKER and a byte identifying
+the codec. The marker is not a valid pickle opcode, so a payload that starts with it
+can't be an uncompressed pickle. This means decompress_payload can be called on any
+pickled argument or result, and compress_payload is free to leave a payload
+uncompressed if compressing it isn't worthwhile.
+
+Task arguments and results with out-of-band buffers (see dumps_payload and
+__meadowrun_task_worker.pickle_result) are sent as-is rather than being turned back
+into a single pickle, see pack_buffers_payload and loads_payload.
+
+The codecs are optional dependencies: zstd requires the zstandard package and lz4
+requires the lz4 package, and they need to be installed both locally and wherever the
+agent runs.
+"""
+
+from __future__ import annotations
+
+import pickle
+import struct
+from typing import Any, Callable, Dict, List, Sequence, Tuple, Union
+
+_COMPRESSED_PAYLOAD_MARKER = b"\x00"
+
+_CODEC_IDS = {"zstd": b"\x01", "lz4": b"\x02"}
+# Identifies a payload made by pack_buffers_payload. These payloads start with the same
+# marker as compressed payloads, followed by this id, the number of buffers, and the
+# length of the pickle and each buffer, followed by the pickle and the buffers.
+_BUFFERS_PAYLOAD_ID = b"\x10"
+_BUFFER_COUNT = struct.Struct("<I")
+_BUFFER_LENGTH = struct.Struct("<Q")
+_CODECS_BY_ID = {codec_id: compression for compression, codec_id in _CODEC_IDS.items()}
+COMPRESSION_CODECS = tuple(_CODEC_IDS.keys())
+
+# Buffers smaller than this are not worth sending out-of-band, see dumps_payload
+_OUT_OF_BAND_MIN_BYTES = 64 * 1024
+
+# Payloads smaller than this aren't worth compressing
+_MIN_COMPRESSED_PAYLOAD_BYTES = 1024
+# For payloads larger than this, we compress a sample first and give up if it doesn't
+# compress well, so that we don't spend time compressing e.g. numpy arrays of random
+# floats
+_SAMPLE_BYTES = 64 * 1024
+# We only keep a compressed payload if it is at most this fraction of the original size
+_MAX_COMPRESSED_RATIO = 0.9
+
+
+def _get_zstd() -> Tuple[Callable[[bytes], bytes], Callable[[bytes], bytes]]:
+    import zstandard
+
+    return zstandard.ZstdCompressor().compress, zstandard.ZstdDecompressor().decompress
+
+
+def _get_lz4() -> Tuple[Callable[[bytes], bytes], Callable[[bytes], bytes]]:
+    import lz4.frame
+
+    return lz4.frame.compress, lz4.frame.decompress
+
+
+_CODEC_GETTERS = {"zstd": _get_zstd, "lz4": _get_lz4}
+_CODEC_PACKAGES = {"zstd": "zstandard", "lz4": "lz4"}
+
+# codec name -> (compress, decompress), populated lazily by _get_codec
+_codecs: Dict[str, Tuple[Callable[[bytes], bytes], Callable[[bytes], bytes]]] = {}
+
+
+def _get_codec(
+    compression: str,
+) -> Tuple[Callable[[bytes], bytes], Callable[[bytes], bytes]]:
+    codec = _codecs.get(compression)
+    if codec is None:
+        if compression not in _CODEC_GETTERS:
+            raise ValueError(
+                f"Unknown compression {compression}, must be one of "
+                + ", ".join(COMPRESSION_CODECS)
+            )
+        try:
+            codec = _CODEC_GETTERS[compression]()
+        except ImportError as e:
+            raise ValueError(
+                f"Compression {compression} requires the "
+                f"{_CODEC_PACKAGES[compression]} package to be installed"
+            ) from e
+        _codecs[compression] = codec
+    return codec
+
+
+def validate_compression(compression: str) -> None:
+    """
+    Raises a ValueError if compression is not "" (i.e. no compression) or one of
+    COMPRESSION_CODECS, or if the package for the codec isn't installed
+    """
+    if compression:
+        _get_codec(compression)
+
+
+def compress_payload(data: bytes, compression: str) -> bytes:
+    """
+    Compresses a pickled task argument or result with the specified codec. If
+    compression is "", or the payload is tiny or doesn't compress well, returns data
+    unchanged.
+    """
+    if not compression or len(data) < _MIN_COMPRESSED_PAYLOAD_BYTES:
+        return data
+
+    compress, _ = _get_codec(compression)
+
+    if len(data) > 2 * _SAMPLE_BYTES:
+        sample = data[:_SAMPLE_BYTES]
+        if len(compress(sample)) > _MAX_COMPRESSED_RATIO * len(sample):
+            return data
+
+    compressed = compress(data)
+    if len(compressed) + 2 > _MAX_COMPRESSED_RATIO * len(data):
+        return data
+
+    return _COMPRESSED_PAYLOAD_MARKER + _CODEC_IDS[compression] + compressed
+
+
+def decompress_payload(data: Union[bytes, bytearray]) -> Union[bytes, bytearray]:
+    """
+    The inverse of compress_payload. Payloads that weren't compressed are returned
+    unchanged.
+    """
+    if not data.startswith(_COMPRESSED_PAYLOAD_MARKER):
+        return data
+    if data[1:2] == _BUFFERS_PAYLOAD_ID:
+        return data
+
+    compression = _CODECS_BY_ID.get(bytes(data[1:2]))
+    if compression is None:
+        raise ValueError(f"Payload was compressed with an unknown codec {data[1:2]!r}")
+    _, decompress = _get_codec(compression)
+    return decompress(bytes(data[2:]))
+
+
+def _buffers_payload_pieces(pickled: Any, buffers: Sequence[Any]) -> List[Any]:
+    """
+    Returns the pieces that make up a pack_buffers_payload payload, so that they can be
+    written out without joining them first
+    """
+    header = [
+        _COMPRESSED_PAYLOAD_MARKER,
+        _BUFFERS_PAYLOAD_ID,
+        _BUFFER_COUNT.pack(len(buffers)),
+        _BUFFER_LENGTH.pack(memoryview(pickled).nbytes),
+    ]
+    header.extend(_BUFFER_LENGTH.pack(memoryview(buffer).nbytes) for buffer in buffers)
+    return [b"".join(header), pickled, *buffers]
+
+
+def pack_buffers_payload(pickled: bytes, buffers: Sequence[Any]) -> bytes:
+    """
+    Combines a pickle and its out-of-band buffers into a single payload that
+    loads_payload can unpickle. This is much cheaper than putting the buffers back into
+    the pickle, which would require walking the entire pickle, and means the buffers can
+    be unpickled without copying them again.
+
+    The task worker builds the same payload for results, see
+    __meadowrun_task_worker.pickle_result.
+    """
+    if not buffers:
+        return pickled
+
+    return b"".join(_buffers_payload_pieces(pickled, buffers))
+
+
+def unpack_buffers_payload(
+    data: Union[bytes, bytearray]
+) -> Tuple[memoryview, List[memoryview]]:
+    """
+    The inverse of pack_buffers_payload: returns the pickle and its out-of-band buffers
+    as views into data, without copying them. data must already be decompressed. If data
+    is a plain pickle, returns it with an empty list of buffers.
+    """
+    view = memoryview(data)
+    if not data.startswith(_COMPRESSED_PAYLOAD_MARKER + _BUFFERS_PAYLOAD_ID):
+        return view, []
+
+    (count,) = _BUFFER_COUNT.unpack_from(data, 2)
+    offset = 2 + _BUFFER_COUNT.size
+    lengths = [
+        _BUFFER_LENGTH.unpack_from(data, offset + i * _BUFFER_LENGTH.size)[0]
+        for i in range(count + 1)
+    ]
+    offset += len(lengths) * _BUFFER_LENGTH.size
+
+    pieces = []
+    for length in lengths:
+        pieces.append(view[offset : offset + length])
+        offset += length
+    return pieces[0], pieces[1:]
+
+
+def dumps_payload(obj: Any, compression: str = "") -> bytes:
+    """
+    Pickles a task argument so that large buffers (e.g. the contents of numpy arrays)
+    are kept out-of-band (see pack_buffers_payload). The agent sends these buffers to
+    the task worker as separate frames, so they never get copied into or out of a
+    pickle. The payload is then compressed with compress_payload.
+    """
+    if pickle.HIGHEST_PROTOCOL < 5:
+        return compress_payload(pickle.dumps(obj), compression)
+
+    buffers = []
+
+    def buffer_callback(buffer: Any) -> bool:
+        # returning True means the buffer gets pickled in-band
+        try:
+            raw = buffer.raw()
+        except BufferError:
+            # non-contiguous buffers can't be sent out-of-band
+            return True
+        if raw.nbytes < _OUT_OF_BAND_MIN_BYTES:
+            return True
+        buffers.append(raw)
+        return False
+
+    pickled = pickle.dumps(obj, protocol=5, buffer_callback=buffer_callback)
+    return compress_payload(pack_buffers_payload(pickled, buffers), compression)
+
+
+def loads_payload(data: Union[bytes, bytearray]) -> Any:
+    """
+    Unpickles a pickled task argument or result that may have been compressed by
+    compress_payload and/or packed by pack_buffers_payload.
+
+    Out-of-band buffers are unpickled as views into data rather than being copied, so
+    e.g. numpy arrays in the result are only writable if data is writable (e.g. a
+    bytearray).
+    """
+    pickled, buffers = unpack_buffers_payload(decompress_payload(data))
+    if not buffers:
+        return pickle.loads(pickled)
+    return pickle.loads(pickled, buffers=buffers)
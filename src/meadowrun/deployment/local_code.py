@@ -1,22 +1,62 @@
+from __future__ import annotations
+
 import asyncio
+import collections
+import concurrent.futures
 import glob
+import hashlib
 import itertools
+import json
 import os
+import shutil
+import stat as statlib
 import sys
 import uuid
 import zipfile
+import zlib
 from os.path import join, realpath, splitext
-from typing import Iterable, List, Set, Tuple
+from typing import (
+    IO,
+    Deque,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    Union,
+)
 
 from meadowrun.shared import create_zipfile
 
 
+# increment if the format of _CACHE_INDEX_FILE changes
+_CACHE_VERSION = 1
+_CACHE_INDEX_FILE = "index.json"
+# each set of python root dirs gets its own cache, and we keep the caches of this many
+# of the most recently zipped sets, see _get_project_cache_dir
+_MAX_PROJECT_CACHES = 8
+# files are read and copied in pieces of this size
+_READ_SIZE = 1024 * 1024
+# the timestamp of every file in the zip file, see _zip_info
+_ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+# see _prepare_files
+_FILES_PER_BATCH = 64
+_MAX_BATCHES_IN_FLIGHT = 16
+
+# the stat of a file and, unless it's in the cache, its CRC-32, size, and compressed
+# data, see _prepare_file
+_PreparedFile = Tuple[os.stat_result, Optional[Tuple[int, int, List[bytes]]]]
+
+
 def zip_local_code(
     result_zip_dir: str,
     include_sys_path: bool,
     additional_python_paths: Iterable[str],
     python_paths_extensions: Iterable[str],
     globs: Iterable[str],
+    cache_dir: Optional[str] = None,
 ) -> Tuple[str, List[str], str]:
     """
     The goal of this function is to zip up "the current local python code excluding the
@@ -33,6 +73,10 @@ def zip_local_code(
 
     Args:
         result_zip_dir: directory where to put the resulting zip file.
+        cache_dir: if provided, the compressed contents of files are cached in this
+            directory, and files that haven't changed (according to their modification
+            time and size) since the last call with the same cache_dir and the same
+            python paths are not compressed again.
         See docstring on mirror_local for explanation of remaining parameters.
 
     Raises:
@@ -59,7 +103,7 @@ def zip_local_code(
 
     current_working_directory_parent = os.path.dirname(current_working_directory)
     for file_glob in globs:
-        for file_path in glob.glob(file_glob, recursive=True):
+        for file_path in sorted(glob.glob(file_glob, recursive=True)):
             if os.path.isfile(file_path):
                 file_real_path = realpath(file_path)
                 if not file_real_path.startswith(
@@ -88,57 +132,496 @@ def zip_local_code(
         python_root_dirs_and_zip_paths,
     ) = _consolidate_paths_to_zip(python_dirs, non_python_dirs)
 
-    zip_file_path = join(result_zip_dir, str(uuid.uuid4()) + ".zip")
-    # ZIP_DEFLATED because it's the fastest. All code gets zipped every time, even when
-    # it hasn't changed, so this needs to be fast above all else.
-    with create_zipfile(zip_file_path, "w", zipfile.ZIP_DEFLATED) as zip_file:
-        if python_paths_extensions:
-            for real_path, zip_path in python_root_dirs_and_zip_paths:
-                for dirpath, dir_names, filenames in os.walk(real_path):
-                    for dir_name in dir_names:
-                        # python_dirs (which ultimately populates real_path in this
-                        # loop) should already have excluded any paths that are
-                        # sys.prefix paths. However, a fairly common pattern is to have
-                        # "." as a non-sys.prefix path and ./.venv/lib/ be a sys.prefix
-                        # path. In that case, we want to exclude ./.venv/lib
-                        if _is_sys_prefix_path(os.path.join(dirpath, dir_name)):
-                            dir_names.remove(dir_name)
-                    for filename in filenames:
-                        if splitext(filename)[1].lower() in python_paths_extensions:
-                            full = join(dirpath, filename)
-                            full_zip = full.replace(real_path, zip_path, 1)
-                            try:
-                                zip_file.write(full, full_zip)
-                            except asyncio.CancelledError:
-                                raise
-                            except BaseException:
-                                print(
-                                    f"Warning, skipping file {full} that cannot be "
-                                    f"added to the zip file as {full_zip}"
-                                )
-
-        for (file_real_path, dir_real_path), dir_zip_path in zip(
-            non_python_files, itertools.islice(non_python_files_as_dirs_in_zip, 1, None)
-        ):
-            file_zip_path = file_real_path.replace(dir_real_path, dir_zip_path, 1)
-            if os.path.sep != "/":
-                # we have to make the sub-paths compatible with Linux which is our
-                # target OS
-                file_zip_path = file_zip_path.replace(os.path.sep, "/")
+    # (real path, zip path) for every non-python file
+    non_python_files_to_zip = []
+    for (file_real_path, dir_real_path), dir_zip_path in zip(
+        non_python_files, itertools.islice(non_python_files_as_dirs_in_zip, 1, None)
+    ):
+        file_zip_path = file_real_path.replace(dir_real_path, dir_zip_path, 1)
+        if os.path.sep != "/":
+            # we have to make the sub-paths compatible with Linux which is our
+            # target OS
+            file_zip_path = file_zip_path.replace(os.path.sep, "/")
+        non_python_files_to_zip.append((file_real_path, file_zip_path))
 
-            try:
-                zip_file.write(file_real_path, file_zip_path)
-            except asyncio.CancelledError:
-                raise
-            except BaseException:
-                print(
-                    f"Warning, skipping file {full} that cannot be added to the zip "
-                    f"file as {full_zip}"
+    zip_file_path = join(result_zip_dir, str(uuid.uuid4()) + ".zip")
+    if cache_dir is not None:
+        cache: Optional[_CompressedFileCache] = _CompressedFileCache(
+            _get_project_cache_dir(cache_dir, python_root_dirs_and_zip_paths)
+        )
+    else:
+        cache = None
+    try:
+        # ZIP_DEFLATED because it's the fastest. Directories are scanned and files are
+        # compressed in parallel on executor (zlib releases the GIL), and files that
+        # haven't changed since the last time we created a zip file are copied from
+        # cache without being compressed again. Files are added in a deterministic
+        # order with fixed timestamps (see _zip_info), so the same code always results
+        # in an identical zip file, even on different machines.
+        with concurrent.futures.ThreadPoolExecutor(os.cpu_count()) as executor:
+            files_to_zip = (
+                _get_python_files_to_zip(
+                    executor, python_root_dirs_and_zip_paths, python_paths_extensions
                 )
+                + non_python_files_to_zip
+            )
+            with create_zipfile(zip_file_path, "w", zipfile.ZIP_DEFLATED) as zip_file:
+                for file_real_path, file_zip_path, prepared_file in _prepare_files(
+                    executor, files_to_zip, cache
+                ):
+                    try:
+                        if isinstance(prepared_file, Exception):
+                            raise prepared_file
+                        _add_file(
+                            zip_file,
+                            file_real_path,
+                            file_zip_path,
+                            prepared_file,
+                            cache,
+                        )
+                    except asyncio.CancelledError:
+                        raise
+                    except BaseException:
+                        print(
+                            f"Warning, skipping file {file_real_path} that cannot be "
+                            f"added to the zip file as {file_zip_path}"
+                        )
+
+        if cache is not None:
+            cache.save(zip_file_path)
+    finally:
+        if cache is not None:
+            cache.close()
 
     return zip_file_path, python_dirs_as_zip_paths, non_python_files_as_dirs_in_zip[0]
 
 
+def _get_python_files_to_zip(
+    executor: concurrent.futures.Executor,
+    python_root_dirs_and_zip_paths: Iterable[Tuple[str, str]],
+    python_paths_extensions: Iterable[str],
+) -> List[Tuple[str, str]]:
+    """
+    Returns (real path, zip path) for the files in python_root_dirs that have one of
+    the python_paths_extensions, sorted by zip path. Directories are scanned in
+    parallel on executor.
+    """
+    python_paths_extensions = set(python_paths_extensions)
+    if not python_paths_extensions:
+        return []
+
+    result = []
+    # scan directory -> (root real path, root zip path)
+    scanning: Dict[
+        concurrent.futures.Future[Tuple[List[str], List[str]]], Tuple[str, str]
+    ] = {
+        executor.submit(_scan_dir, real_path): (real_path, zip_path)
+        for real_path, zip_path in python_root_dirs_and_zip_paths
+    }
+    while scanning:
+        done, _ = concurrent.futures.wait(
+            scanning, return_when=concurrent.futures.FIRST_COMPLETED
+        )
+        for future in done:
+            real_path, zip_path = scanning.pop(future)
+            file_paths, dir_paths = future.result()
+            for dir_path in dir_paths:
+                # python_dirs (which ultimately populates real_path) should already
+                # have excluded any paths that are sys.prefix paths. However, a fairly
+                # common pattern is to have "." as a non-sys.prefix path and
+                # ./.venv/lib/ be a sys.prefix path. In that case, we want to exclude
+                # ./.venv/lib
+                if not _is_sys_prefix_path(dir_path):
+                    scanning[executor.submit(_scan_dir, dir_path)] = (
+                        real_path,
+                        zip_path,
+                    )
+            for file_path in file_paths:
+                if splitext(file_path)[1].lower() in python_paths_extensions:
+                    result.append(
+                        (file_path, file_path.replace(real_path, zip_path, 1))
+                    )
+
+    result.sort(key=lambda paths: (paths[1], paths[0]))
+    return result
+
+
+def _scan_dir(dir_path: str) -> Tuple[List[str], List[str]]:
+    """
+    Returns the files and subdirectories in dir_path, following the same rules as
+    os.walk, i.e. symlinks to directories are not followed, and errors are ignored.
+    """
+    file_paths = []
+    dir_paths = []
+    try:
+        with os.scandir(dir_path) as entries:
+            for entry in entries:
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                if not is_dir:
+                    file_paths.append(entry.path)
+                elif not entry.is_symlink():
+                    dir_paths.append(entry.path)
+    except OSError:
+        pass
+    return file_paths, dir_paths
+
+
+def _zip_info(arcname: str, stat: os.stat_result) -> zipfile.ZipInfo:
+    """
+    Like ZipInfo.from_file for a regular file with the specified stat, except that the
+    timestamp is always _ZIP_DATE_TIME and the permissions are always 644 or 755. These
+    depend on when and how the code was checked out and aren't restored by
+    ZipFile.extractall anyway, so this makes the zip file only depend on the contents of
+    the files.
+    """
+    arcname = os.path.normpath(os.path.splitdrive(arcname)[1])
+    while arcname[0] in (os.sep, os.altsep):
+        arcname = arcname[1:]
+    zip_info = zipfile.ZipInfo(arcname, _ZIP_DATE_TIME)
+    if stat.st_mode & 0o111:
+        zip_info.external_attr = (statlib.S_IFREG | 0o755) << 16
+    else:
+        zip_info.external_attr = (statlib.S_IFREG | 0o644) << 16
+    zip_info.file_size = stat.st_size
+    zip_info.compress_type = zipfile.ZIP_DEFLATED
+    return zip_info
+
+
+def _compress_file(file_path: str) -> Tuple[int, int, List[bytes]]:
+    """
+    Returns CRC-32, size, compressed data for the specified file. The compressed data
+    is exactly what ZipFile would write for a ZIP_DEFLATED file.
+    """
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    crc = 0
+    file_size = 0
+    compressed = []
+    with open(file_path, "rb") as f:
+        while True:
+            data = f.read(_READ_SIZE)
+            if not data:
+                break
+            crc = zlib.crc32(data, crc)
+            file_size += len(data)
+            compressed.append(compressor.compress(data))
+    compressed.append(compressor.flush())
+    return crc, file_size, compressed
+
+
+def _write_compressed_file(
+    zip_file: zipfile.ZipFile,
+    zip_info: zipfile.ZipInfo,
+    crc: int,
+    file_size: int,
+    compress_size: int,
+    compressed: Iterable[bytes],
+) -> int:
+    """
+    Adds a file to zip_file whose contents have already been compressed. This does the
+    same thing as ZipFile.write(), but ZipFile doesn't have a public API for adding
+    compressed data, so we need to use some ZipFile internals.
+
+    Returns the offset of the compressed data in the zip file.
+    """
+    zip_info.CRC = crc
+    zip_info.file_size = file_size
+    zip_info.compress_size = compress_size
+    zip_info.flag_bits = 0
+    if not zip_info.external_attr:
+        zip_info.external_attr = 0o600 << 16
+    zip64 = (
+        file_size * 1.05 > zipfile.ZIP64_LIMIT or compress_size > zipfile.ZIP64_LIMIT
+    )
+
+    fp = zip_file.fp
+    assert fp is not None
+    # start_dir is always the current position in fp (calling fp.tell() is slow as it
+    # requires flushing fp)
+    zip_info.header_offset = zip_file.start_dir
+    zip_file._writecheck(zip_info)  # type: ignore[attr-defined]
+    zip_file._didModify = True  # type: ignore[attr-defined]
+    header = zip_info.FileHeader(zip64)
+    fp.write(header)
+    data_offset = zip_info.header_offset + len(header)
+    for data in compressed:
+        fp.write(data)
+    zip_file.start_dir = data_offset + compress_size
+    zip_file.filelist.append(zip_info)
+    zip_file.NameToInfo[zip_info.filename] = zip_info
+    return data_offset
+
+
+def _prepare_file(
+    file_path: str, cache: Optional[_CompressedFileCache]
+) -> _PreparedFile:
+    """
+    Returns the file's stat and, if it isn't in the cache, the result of
+    _compress_file. Runs on the executor.
+    """
+    stat = os.stat(file_path)
+    if cache is not None and cache.contains(file_path, stat):
+        return stat, None
+    return stat, _compress_file(file_path)
+
+
+def _prepare_files(
+    executor: concurrent.futures.Executor,
+    files_to_zip: Sequence[Tuple[str, str]],
+    cache: Optional[_CompressedFileCache],
+) -> Iterable[Tuple[str, str, Union[_PreparedFile, Exception]]]:
+    """
+    Runs _prepare_file for each of files_to_zip on executor, and yields
+    (real path, zip path, result or exception) in the same order as files_to_zip.
+
+    Files are prepared in batches of _FILES_PER_BATCH as most files are small, and
+    handing each file to the executor separately would take longer than compressing
+    them. At most _MAX_BATCHES_IN_FLIGHT batches are prepared ahead of the file that was
+    last yielded, to limit how much compressed data we hold in memory.
+    """
+    in_flight: Deque[
+        Tuple[
+            Sequence[Tuple[str, str]],
+            concurrent.futures.Future[List[Union[_PreparedFile, Exception]]],
+        ]
+    ] = collections.deque()
+
+    def yield_batch() -> Iterable[Tuple[str, str, Union[_PreparedFile, Exception]]]:
+        batch, future = in_flight.popleft()
+        for (file_path, zip_path), result in zip(batch, future.result()):
+            yield file_path, zip_path, result
+
+    try:
+        for i in range(0, len(files_to_zip), _FILES_PER_BATCH):
+            if len(in_flight) >= _MAX_BATCHES_IN_FLIGHT:
+                yield from yield_batch()
+            batch = files_to_zip[i : i + _FILES_PER_BATCH]
+            in_flight.append(
+                (
+                    batch,
+                    executor.submit(
+                        _prepare_batch, [file_path for file_path, _ in batch], cache
+                    ),
+                )
+            )
+        while in_flight:
+            yield from yield_batch()
+    finally:
+        for _, future in in_flight:
+            future.cancel()
+
+
+def _prepare_batch(
+    file_paths: List[str], cache: Optional[_CompressedFileCache]
+) -> List[Union[_PreparedFile, Exception]]:
+    results: List[Union[_PreparedFile, Exception]] = []
+    for file_path in file_paths:
+        try:
+            results.append(_prepare_file(file_path, cache))
+        except Exception as e:
+            results.append(e)
+    return results
+
+
+def _add_file(
+    zip_file: zipfile.ZipFile,
+    file_path: str,
+    zip_path: str,
+    prepared_file: _PreparedFile,
+    cache: Optional[_CompressedFileCache],
+) -> None:
+    stat, compressed_file = prepared_file
+    zip_info = _zip_info(zip_path, stat)
+
+    compressed: Iterable[bytes]
+    if compressed_file is None:
+        assert cache is not None
+        crc, file_size, compress_size, compressed = cache.get(file_path)
+    else:
+        crc, file_size, compressed_list = compressed_file
+        compress_size = sum(len(data) for data in compressed_list)
+        compressed = compressed_list
+
+    data_offset = _write_compressed_file(
+        zip_file, zip_info, crc, file_size, compress_size, compressed
+    )
+    if cache is not None:
+        cache.add(file_path, stat, crc, file_size, compress_size, data_offset)
+
+
+def _get_project_cache_dir(
+    cache_dir: str, python_root_dirs_and_zip_paths: Iterable[Tuple[str, str]]
+) -> str:
+    """
+    Returns a subdirectory of cache_dir for this set of python root dirs, so that
+    switching between projects doesn't overwrite each project's _CompressedFileCache.
+    Deletes the caches of all but the _MAX_PROJECT_CACHES most recently used projects.
+    """
+    project_hash = hashlib.blake2b(
+        json.dumps(sorted(python_root_dirs_and_zip_paths)).encode("utf-8"),
+        digest_size=16,
+    ).hexdigest()
+    project_cache_dir = join(cache_dir, project_hash)
+    os.makedirs(project_cache_dir, exist_ok=True)
+    # mark this project's cache as recently used
+    os.utime(project_cache_dir)
+
+    try:
+        entries = list(os.scandir(cache_dir))
+        project_caches = sorted(
+            (entry for entry in entries if entry.is_dir()),
+            key=lambda entry: entry.stat().st_mtime,
+            reverse=True,
+        )
+        for entry in project_caches[_MAX_PROJECT_CACHES:]:
+            if entry.name != project_hash:
+                shutil.rmtree(entry.path, ignore_errors=True)
+        for entry in entries:
+            if entry.is_file():
+                # left over from older versions of meadowrun that only had one cache
+                os.remove(entry.path)
+    except OSError as e:
+        print(f"Warning, unable to clean up the local code cache: {e}")
+
+    return project_cache_dir
+
+
+class _CompressedFileCache:
+    """
+    Remembers the compressed contents of the files in the last zip file created by
+    zip_local_code for a particular project (see _get_project_cache_dir). cache_dir
+    contains a copy of that zip file, and an index file that
+    maps file path -> (modification time, size) of the file when it was compressed and
+    where its compressed data is in the copy of the zip file. If the index or zip file
+    are missing or corrupt, we just start from scratch.
+    """
+
+    def __init__(self, cache_dir: str):
+        self._cache_dir = cache_dir
+        # file path -> [mtime_ns, stat size, crc, file size, compress size, offset]
+        self._entries: Dict[str, List[int]] = {}
+        self._new_entries: Dict[str, List[int]] = {}
+        self._archive_name: Optional[str] = None
+        self._archive: Optional[IO[bytes]] = None
+
+        try:
+            with open(join(cache_dir, _CACHE_INDEX_FILE), "r", encoding="utf-8") as f:
+                index = json.load(f)
+            if index["version"] == _CACHE_VERSION:
+                archive_name = index["archive"]
+                archive = open(join(cache_dir, archive_name), "rb")
+                if os.fstat(archive.fileno()).st_size != index["archive_size"]:
+                    archive.close()
+                else:
+                    self._archive_name = archive_name
+                    self._archive = archive
+                    self._entries = index["entries"]
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(
+                "Warning, local code cache appears to be created by an old version of "
+                f"Meadowrun or is corrupted, will regenerate: {e}"
+            )
+
+    def contains(self, file_path: str, stat: os.stat_result) -> bool:
+        """
+        Returns True if we have the compressed contents of file_path as of stat. Safe to
+        call from multiple threads.
+        """
+        entry = self._entries.get(file_path)
+        return (
+            entry is not None
+            and self._archive is not None
+            and entry[0] == stat.st_mtime_ns
+            and entry[1] == stat.st_size
+        )
+
+    def get(self, file_path: str) -> Tuple[int, int, int, Iterable[bytes]]:
+        """
+        Returns crc, file size, compress size, compressed data. Only valid if contains
+        returned True
+        """
+        _, _, crc, file_size, compress_size, offset = self._entries[file_path]
+        return crc, file_size, compress_size, self._read(offset, compress_size)
+
+    def _read(self, offset: int, length: int) -> Iterable[bytes]:
+        assert self._archive is not None
+        self._archive.seek(offset)
+        while length > 0:
+            data = self._archive.read(min(length, _READ_SIZE))
+            if not data:
+                raise ValueError("Local code cache zip file is truncated")
+            length -= len(data)
+            yield data
+
+    def add(
+        self,
+        file_path: str,
+        stat: os.stat_result,
+        crc: int,
+        file_size: int,
+        compress_size: int,
+        offset: int,
+    ) -> None:
+        self._new_entries[file_path] = [
+            stat.st_mtime_ns,
+            stat.st_size,
+            crc,
+            file_size,
+            compress_size,
+            offset,
+        ]
+
+    def save(self, zip_file_path: str) -> None:
+        """
+        Replaces the cache with the entries added since this cache was loaded, which
+        must be for zip_file_path
+        """
+        archive_name = str(uuid.uuid4()) + ".zip"
+        archive_path = join(self._cache_dir, archive_name)
+        try:
+            try:
+                os.link(zip_file_path, archive_path)
+            except OSError:
+                # e.g. zip_file_path is on a different file system
+                shutil.copyfile(zip_file_path, archive_path)
+
+            index_path = join(self._cache_dir, _CACHE_INDEX_FILE)
+            temp_index_path = f"{index_path}.{archive_name}"
+            with open(temp_index_path, "w", encoding="utf-8") as f:
+                json.dump(
+                    {
+                        "version": _CACHE_VERSION,
+                        "archive": archive_name,
+                        "archive_size": os.path.getsize(archive_path),
+                        "entries": self._new_entries,
+                    },
+                    f,
+                )
+            os.replace(temp_index_path, index_path)
+        except OSError as e:
+            print(f"Warning, unable to save the local code cache: {e}")
+            return
+
+        # clean up archives from previous calls (including any from other processes
+        # that lost the race to write the index)
+        for file_name in os.listdir(self._cache_dir):
+            if file_name != archive_name and file_name.endswith(".zip"):
+                try:
+                    os.remove(join(self._cache_dir, file_name))
+                except OSError:
+                    # e.g. another process is reading it on Windows
+                    pass
+
+    def close(self) -> None:
+        if self._archive is not None:
+            self._archive.close()
+            self._archive = None
+
+
 def _is_sys_prefix_path(path: str) -> bool:
     return path.startswith((sys.prefix, sys.base_prefix))
 
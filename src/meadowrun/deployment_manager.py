@@ -63,6 +63,7 @@ from meadowrun.meadowrun_pb2 import (
     ServerAvailableContainer,
     ServerAvailableInterpreter,
 )
+from meadowrun.chunk_cache import ChunkCache
 from meadowrun.run_job_core import CloudProviderType, ContainerRegistryHelper
 from meadowrun.storage_grid_job import download_chunked_file
 
@@ -73,6 +74,10 @@ if TYPE_CHECKING:
 
 _GIT_REPO_URL_SUFFIXES_TO_REMOVE = [".git", "/"]
 
+# the subfolder of local_copies_folder where chunks of CodeZipFiles are cached. When the
+# code changes, only the chunks of the zip file that changed need to be downloaded
+_CHUNK_CACHE_FOLDER = "chunk_cache"
+
 
 async def _run_git(
     args: List[str], cwd: str, credentials: Optional[RawCredentials]
@@ -281,6 +286,8 @@ async def _get_zip_file_code_paths(
     code_zip_file.url will be the URL of a file in the object storage system as
     generated by _upload_code_zip_file. This function should download the file and
     extract it to local_copies_folder if it has not already been extracted.
+
+    The chunks of the file are cached in local_copies_folder/_CHUNK_CACHE_FOLDER.
     """
     decoded_url = urllib.parse.urlparse(code_zip_file.url)
     if decoded_url.scheme != "mdrstorage":  # just a sanity check
@@ -291,22 +298,28 @@ async def _get_zip_file_code_paths(
 
     with filelock.FileLock(f"{extracted_folder}.lock", timeout=120):
         if not os.path.exists(extracted_folder):
-            zip_file_path = extracted_folder + ".zip"
             if storage_bucket_factory is None:
                 raise ValueError(
                     "storage_bucket_factory must be set to download CodeZipFiles"
                 )
-            elif isinstance(storage_bucket_factory, AbstractStorageBucket):
-                await download_chunked_file(
-                    storage_bucket_factory, object_name, zip_file_path
-                )
-            else:
-                async with await storage_bucket_factory() as storage_bucket:
+            chunk_cache = ChunkCache(
+                os.path.join(local_copies_folder, _CHUNK_CACHE_FOLDER)
+            )
+            # the chunks are assembled directly into this file, and we extract from the
+            # same open file, so the zip file is only written once
+            with tempfile.TemporaryFile(dir=local_copies_folder) as zip_file_data:
+                if isinstance(storage_bucket_factory, AbstractStorageBucket):
                     await download_chunked_file(
-                        storage_bucket, object_name, zip_file_path
+                        storage_bucket_factory, object_name, zip_file_data, chunk_cache
                     )
-            with zipfile.ZipFile(zip_file_path) as zip_file:
-                zip_file.extractall(extracted_folder)
+                else:
+                    async with await storage_bucket_factory() as storage_bucket:
+                        await download_chunked_file(
+                            storage_bucket, object_name, zip_file_data, chunk_cache
+                        )
+                zip_file_data.seek(0)
+                with zipfile.ZipFile(zip_file_data) as zip_file:
+                    zip_file.extractall(extracted_folder)
 
     return (
         [
@@ -49,6 +49,7 @@ from meadowrun.meadowrun_pb2 import (
     ServerAvailableInterpreter,
 )
 from meadowrun.deployment.pip import pip_freeze_exclude_editable, get_python_version
+from meadowrun.local_cache import get_cache_dir
 
 if TYPE_CHECKING:
     from typing_extensions import Literal
@@ -59,6 +60,10 @@ if TYPE_CHECKING:
         VersionedCodeDeployment,
     )
 
+# mirror_local caches compressed files in this directory in the local cache, see
+# zip_local_code
+_LOCAL_CODE_CACHE_DIR = "local_code"
+
 
 class Secret(abc.ABC):
     """
@@ -757,6 +762,7 @@ class Deployment:
             additional_sys_paths,
             sys_path_extensions,
             globs,
+            get_cache_dir(_LOCAL_CODE_CACHE_DIR),
         )
 
         # see comment on _upload_code_zip_file
@@ -7,31 +7,202 @@ import asyncio
 
 import importlib  # available in python 3.1+
 import argparse  # available in python 3.2+
+import mmap
+import os
 import pickle
 import struct
 import traceback
-from typing import Callable, Optional
+from typing import Any, Callable, List, Optional
+
+
+# Messages between the agent and the task worker are a 4-byte count of frames, followed
+# by that many frames, each of which is an 8-byte length followed by that many bytes.
+# See also TaskWorkerServer in run_job_local.py
+_FRAME_COUNT = struct.Struct(">i")
+_FRAME_LENGTH = struct.Struct(">q")
+
+# Buffers smaller than this are not worth sending out-of-band
+_OUT_OF_BAND_MIN_BYTES = 64 * 1024
+
+# The format of compression.pack_buffers_payload, which we can't import here because the
+# task worker runs in the user's environment
+_BUFFERS_PAYLOAD_PREFIX = b"\x00\x10"
+_BUFFER_COUNT = struct.Struct("<I")
+_BUFFER_LENGTH = struct.Struct("<Q")
+
+# Frames at least this big are sent via shared memory if it's enabled. Frames in shared
+# memory are indicated by a negative length, see TaskWorkerServer
+_SHARED_MEMORY_MIN_BYTES = 1024 * 1024
+
+
+class SharedMemory:
+    """
+    The folder that TaskWorkerServer creates for sending large frames via shared memory
+    segments
+    """
+
+    def __init__(self, shared_memory_path: str):
+        self.to_worker = os.path.join(shared_memory_path, "to_worker")
+        self.to_agent = os.path.join(shared_memory_path, "to_agent")
+
+
+def try_write_shared_memory_segment(
+    path: str, frame_pieces: List[Any], frame_length: int
+) -> bool:
+    """
+    Like run_job_local._try_write_shared_memory_segment: returns False and deletes the
+    segment if there isn't enough space for the frame
+    """
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o600)
+    try:
+        # see run_job_local._try_write_shared_memory_segment
+        os.posix_fallocate(fd, 0, frame_length)
+        with mmap.mmap(fd, frame_length) as segment:
+            offset = 0
+            for piece in frame_pieces:
+                piece_length = memoryview(piece).nbytes
+                segment[offset : offset + piece_length] = piece
+                offset += piece_length
+        return True
+    except OSError:
+        os.remove(path)
+        return False
+    finally:
+        os.close(fd)
+
+
+def map_shared_memory_segment(path: str) -> memoryview:
+    """
+    Maps the segment at path and unlinks it, so that its memory is freed once nothing
+    refers to the mapping anymore. The mapping is copy-on-write, so the returned view is
+    writable without affecting anything else.
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.remove(path)
+        return memoryview(mmap.mmap(fd, 0, access=mmap.ACCESS_COPY))
+    finally:
+        os.close(fd)
 
 
 async def send_message(
-    writer: asyncio.StreamWriter, state: str, result_bytes: bytes, pickle_protocol: int
+    writer: asyncio.StreamWriter,
+    state: str,
+    result_pieces: List[Any],
+    shared_memory: Optional[SharedMemory],
 ) -> None:
-    # it's important here that the result is pickled separately. If not, the agent's
-    # receive_message will unpickle result. This is not only unnecessary, but also
-    # potentially doesn't work because the agent doesn't run in the worker's
-    # environment.
-    msg_bs = pickle.dumps((state, result_bytes), protocol=pickle_protocol)
-    msg_len = struct.pack(">i", len(msg_bs))
-    writer.write(msg_len)
-    writer.write(msg_bs)
+    """
+    Sends two frames: the state and the result. The result frame is made up of
+    result_pieces, which are written one after another rather than being joined first.
+    """
+    # it's important here that the result is not pickled together with the state. If it
+    # were, the agent's receive_message would unpickle the result. This is not only
+    # unnecessary, but also potentially doesn't work because the agent doesn't run in
+    # the worker's environment.
+    state_bs = state.encode("utf-8")
+    writer.write(_FRAME_COUNT.pack(2))
+    writer.write(_FRAME_LENGTH.pack(len(state_bs)))
+    writer.write(state_bs)
+    result_length = sum(memoryview(piece).nbytes for piece in result_pieces)
+    if (
+        shared_memory is not None
+        and result_length >= _SHARED_MEMORY_MIN_BYTES
+        # if there isn't enough space in shared memory, we send the frame over the
+        # socket instead
+        and try_write_shared_memory_segment(
+            shared_memory.to_agent, result_pieces, result_length
+        )
+    ):
+        writer.write(_FRAME_LENGTH.pack(-result_length))
+    else:
+        writer.write(_FRAME_LENGTH.pack(result_length))
+        for piece in result_pieces:
+            writer.write(piece)
     await writer.drain()
 
 
-async def receive_bytes(reader: asyncio.StreamReader, bytes_len: int) -> bytearray:
-    result_bs = bytearray()
-    while len(result_bs) < bytes_len:
-        result_bs.extend(await reader.read(bytes_len - len(result_bs)))
-    return result_bs
+def pickle_result(result: Any, pickle_protocol: int) -> List[Any]:
+    """
+    Returns result_pieces for send_message. With pickle protocol 5, large buffers (e.g.
+    the contents of numpy arrays) are kept out-of-band so that they don't get copied
+    into the pickle, and the pieces make up a compression.pack_buffers_payload payload,
+    which the agent passes on to the client as-is.
+    """
+    if pickle_protocol < 5:
+        return [pickle.dumps(result, protocol=pickle_protocol)]
+
+    buffers = []
+
+    def buffer_callback(buffer: Any) -> bool:
+        # returning True means the buffer gets pickled in-band
+        try:
+            raw = buffer.raw()
+        except BufferError:
+            # non-contiguous buffers can't be sent out-of-band
+            return True
+        if raw.nbytes < _OUT_OF_BAND_MIN_BYTES:
+            return True
+        buffers.append(raw)
+        return False
+
+    pickled = pickle.dumps(
+        result, protocol=pickle_protocol, buffer_callback=buffer_callback
+    )
+    if not buffers:
+        return [pickled]
+
+    header = [
+        _BUFFERS_PAYLOAD_PREFIX,
+        _BUFFER_COUNT.pack(len(buffers)),
+        _BUFFER_LENGTH.pack(len(pickled)),
+    ]
+    header.extend(_BUFFER_LENGTH.pack(buffer.nbytes) for buffer in buffers)
+    return [b"".join(header), pickled, *buffers]
+
+
+async def receive_frames(
+    reader: asyncio.StreamReader, shared_memory: Optional[SharedMemory]
+) -> Optional[List[Any]]:
+    """
+    Returns the frames of a message from the agent: a pickle followed by its out-of-band
+    buffers (see TaskWorkerServer.send_message). The buffers are writable so that e.g.
+    numpy arrays in the arguments are writable, just like arguments that are pickled
+    in-band. Buffers sent via shared memory are views into the (copy-on-write) mapping
+    of the segment, so they don't get copied at all. Returns None if the agent has
+    closed the connection.
+    """
+    try:
+        frame_count_bs = await reader.readexactly(_FRAME_COUNT.size)
+    except asyncio.IncompleteReadError as e:
+        if len(e.partial) == 0:
+            return None
+        raise
+    (frame_count,) = _FRAME_COUNT.unpack(frame_count_bs)
+    segment: Optional[memoryview] = None
+    frames: List[Any] = []
+    for _ in range(frame_count):
+        (frame_length,) = _FRAME_LENGTH.unpack(
+            await reader.readexactly(_FRAME_LENGTH.size)
+        )
+        if frame_length < 0:
+            if shared_memory is None:
+                raise ValueError(
+                    "Agent sent a frame via shared memory but shared memory is not "
+                    "enabled"
+                )
+            if segment is None:
+                segment = map_shared_memory_segment(shared_memory.to_worker)
+            frames.append(segment[:-frame_length])
+            segment = segment[-frame_length:]
+        elif frames:
+            frames.append(bytearray(await reader.readexactly(frame_length)))
+        else:
+            frames.append(await reader.readexactly(frame_length))
+    return frames
 
 
 def do_tasks(
@@ -40,22 +211,25 @@ def do_tasks(
     writer: asyncio.StreamWriter,
     function: Callable,
     pickle_protocol: int,
+    shared_memory: Optional[SharedMemory],
 ) -> None:
     while True:
-        arg_size_bs = event_loop.run_until_complete(reader.read(4))
-        if len(arg_size_bs) == 0:
+        frames = event_loop.run_until_complete(receive_frames(reader, shared_memory))
+        if frames is None:
             break
-        (arg_size,) = struct.unpack(">i", arg_size_bs)
 
         try:
-            if arg_size > 0:
-                arg_bs = event_loop.run_until_complete(receive_bytes(reader, arg_size))
-                function_args, function_kwargs = pickle.loads(arg_bs)
+            if len(frames) > 1:
+                function_args, function_kwargs = pickle.loads(
+                    frames[0], buffers=frames[1:]
+                )
+            elif frames and len(frames[0]) > 0:
+                function_args, function_kwargs = pickle.loads(frames[0])
             else:
                 function_args, function_kwargs = (), {}
             # run the function
             result = function(*(function_args or ()), **(function_kwargs or {}))
-            result_bytes = pickle.dumps(result, protocol=pickle_protocol)
+            result_pieces = pickle_result(result, pickle_protocol)
         except Exception as e:
             # first print the exception for the local log file
             traceback.print_exc()
@@ -66,15 +240,21 @@ def do_tasks(
                 send_message(
                     writer,
                     "PYTHON_EXCEPTION",
-                    pickle.dumps((str(type(e)), str(e), tb), protocol=pickle_protocol),
-                    pickle_protocol,
+                    [
+                        pickle.dumps(
+                            (str(type(e)), str(e), tb), protocol=pickle_protocol
+                        )
+                    ],
+                    shared_memory,
                 )
             )
         else:
             # send back results
             event_loop.run_until_complete(
-                send_message(writer, "SUCCEEDED", result_bytes, pickle_protocol)
+                send_message(writer, "SUCCEEDED", result_pieces, shared_memory)
             )
+            # release out-of-band buffers as soon as possible
+            del result, result_pieces
 
 
 def get_function(args: argparse.Namespace) -> Callable:
@@ -104,6 +284,7 @@ def main() -> None:
     parser.add_argument("--result-highest-pickle-protocol", type=int, required=True)
     parser.add_argument("--host", required=True)
     parser.add_argument("--port", type=int, required=True)
+    parser.add_argument("--shared-memory-path")
 
     args = parser.parse_args()
 
@@ -135,7 +316,12 @@ def main() -> None:
             asyncio.open_connection(args.host, args.port)
         )
         function = get_function(args)
-        do_tasks(event_loop, reader, writer, function, result_pickle_protocol)
+        shared_memory: Optional[SharedMemory] = None
+        if args.shared_memory_path is not None:
+            shared_memory = SharedMemory(args.shared_memory_path)
+        do_tasks(
+            event_loop, reader, writer, function, result_pickle_protocol, shared_memory
+        )
 
     except Exception as e:
         # first print the exception for the local log file
@@ -53,6 +53,18 @@ class GoogleStorageBucket(AbstractStorageBucket):
     async def write_bytes(self, data: bytes, key: str) -> None:
         await self._storage.upload(self._bucket, key, data)
 
+    async def write_bytes_exclusive(self, data: bytes, key: str) -> bool:
+        try:
+            # a generation of 0 means the object must not exist yet
+            await self._storage.upload(
+                self._bucket, key, data, parameters={"ifGenerationMatch": "0"}
+            )
+            return True
+        except aiohttp.ClientResponseError as e:
+            if e.status == 412:
+                return False
+            raise
+
     async def exists(self, key: str) -> bool:
         try:
             await self._storage.download_metadata(self._bucket, key)
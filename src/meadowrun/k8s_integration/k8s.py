@@ -3,6 +3,7 @@ from __future__ import annotations
 import abc
 import argparse
 import asyncio
+import collections
 import dataclasses
 import math
 import os
@@ -18,11 +19,13 @@ from typing import (
     Awaitable,
     Callable,
     Coroutine,
+    Deque,
     Dict,
     Iterable,
     List,
     Optional,
     Sequence,
+    Set,
     Tuple,
     TypeVar,
 )
@@ -70,26 +73,34 @@ from meadowrun.run_job_core import (
 )
 from meadowrun.alloc_vm import _PRINT_RECEIVED_TASKS_SECONDS
 from meadowrun.run_job_local import (
-    TaskWorkerServer,
-    WorkerMonitor,
+    NUM_TASK_WORKERS_KWARG,
+    BackgroundUploads,
+    TaskWorker,
     _get_credentials_for_docker,
     _get_credentials_sources,
     _string_pairs_to_dict,
     restart_worker,
 )
-from meadowrun.shared import b32_encoded_uuid
+from meadowrun.shared import b32_encoded_uuid, cancel_task, gather_or_cancel
 from meadowrun.storage_grid_job import (
-    complete_task,
+    TaskResultBatcher,
     download_task_arg,
     get_job_completion_from_process_state,
     receive_results,
     upload_task_args,
 )
 from meadowrun.storage_keys import (
+    parse_storage_key_task_attempt,
+    storage_key_job_done,
     storage_key_job_to_run,
     storage_key_ranges,
-    storage_key_task_args,
+    storage_key_task_attempt,
+    storage_prefix_inputs,
     storage_prefix_outputs,
+    storage_prefix_task_claims,
+    storage_prefix_task_completions,
+    storage_prefix_task_retries,
+    storage_prefix_task_steals,
 )
 from meadowrun.version import __version__
 
@@ -107,85 +118,459 @@ _T = TypeVar("_T")
 _U = TypeVar("_U")
 
 
-async def _indexed_agent_function(
+async def _run_task(
+    task_worker: TaskWorker, arg: bytes, log_file_name: str, task_id: int
+) -> ProcessState:
+    """Runs a single task on task_worker and returns the result"""
+    restart_worker_needed = False
+
+    try:
+        task_worker.monitor.start_stats()
+        await task_worker.server.send_message(arg)
+        state, result_bytes = await task_worker.server.receive_message()
+        stats = await task_worker.monitor.stop_stats()
+
+        process_state = ProcessState(
+            state=ProcessState.ProcessStateEnum.SUCCEEDED
+            if state == "SUCCEEDED"
+            else ProcessState.ProcessStateEnum.PYTHON_EXCEPTION,
+            pickled_result=result_bytes,
+            return_code=0,
+            max_memory_used_gb=stats.max_memory_used_gb,
+            duration_seconds=stats.duration_seconds,
+            log_file_name=log_file_name,
+        )
+    except BaseException:
+        stats = await task_worker.monitor.stop_stats()
+        process_state = task_worker.get_job_state(  # type: ignore
+            return_code=(await task_worker.monitor.try_get_return_code()) or 0,
+        )
+        process_state.max_memory_used_gb = stats.max_memory_used_gb
+        process_state.duration_seconds = stats.duration_seconds
+        process_state.was_oom_killed = await task_worker.monitor.was_oom_killed()
+
+        restart_worker_needed = True
+
+    print(
+        f"Meadowrun agent: Completed task #{task_id}, "
+        f"state {ProcessState.ProcessStateEnum.Name(process_state.state)}, max "
+        f"memory {process_state.max_memory_used_gb}GB "
+    )
+
+    if restart_worker_needed:
+        await restart_worker(task_worker.server, task_worker.monitor)
+
+    return process_state
+
+
+async def _indexed_task_worker_loop(
+    storage_bucket: AbstractStorageBucket,
+    base_job_id: str,
+    byte_ranges: List[Tuple[int, int, int]],
+    results: TaskResultBatcher,
+    first_task: int,
+    task_step: int,
     total_num_tasks: int,
-    num_workers: int,
     log_file_name: str,
-    base_job_id: str,
-    worker_server: TaskWorkerServer,
-    worker_monitor: WorkerMonitor,
-    get_job_state: Callable[[int], ProcessState],
+    task_worker: TaskWorker,
 ) -> None:
     """
-    This is a worker function to help with running a run_map. This worker assumes that
-    JOB_COMPLETION_INDEX is set, which Kubernetes will set for indexed completion jobs.
-    This worker assumes task arguments are accessible via
-    meadowrun.func_worker_storage_helper.FUNC_WORKER_STORAGE_BUCKET and will just
-    complete all of the tasks where task_index % num_workers == current worker index.
+    Runs tasks first_task, first_task + task_step, first_task + 2 * task_step, etc. on
+    task_worker
     """
+    # While the task worker is running task i, we download the argument for the next
+    # task
+    next_arg: Optional[asyncio.Task[bytes]] = None
+    try:
+        i = first_task
+        if i < total_num_tasks:
+            next_arg = asyncio.create_task(
+                download_task_arg(storage_bucket, base_job_id, byte_ranges[i])
+            )
+
+        while i < total_num_tasks:
+            assert next_arg is not None
+            arg = await next_arg
+            next_arg = None
+            if i + task_step < total_num_tasks:
+                next_arg = asyncio.create_task(
+                    download_task_arg(
+                        storage_bucket, base_job_id, byte_ranges[i + task_step]
+                    )
+                )
+
+            process_state = await _run_task(task_worker, arg, log_file_name, i)
+            # we don't support retries in this mode so we're always on attempt 1
+            await results.add(i, 1, process_state)
+
+            i += task_step
+    finally:
+        if next_arg is not None:
+            await cancel_task(next_arg)
+
 
+# A task that has been running for longer than this multiple of the average task
+# duration (and at least _MIN_STRAGGLER_SECONDS) can be stolen by an idle worker
+_STRAGGLER_DURATION_MULTIPLE = 2
+_MIN_STRAGGLER_SECONDS = 10
+# How long idle workers wait before checking for new tasks again
+_TASK_CLAIM_POLL_SECONDS = 2
+
+
+class _TaskClaimer:
+    """
+    Decides which task a worker should run next for _dynamic_agent_function. Workers
+    claim a task by creating a claim object for it in the storage bucket with
+    write_bytes_exclusive, so each task is only run by one worker.
+
+    Each worker first tries to claim "its" tasks, i.e. the tasks
+    _indexed_agent_function would assign to it, which means that workers don't usually
+    compete for the same tasks. After that, it claims any unclaimed tasks, including
+    retries requested by the driver. When there are no more unclaimed tasks, it steals
+    tasks that have been running for much longer than the average task (e.g. because
+    the worker running them is slow or has disappeared). A task can only be stolen
+    once, and the driver uses whichever result arrives first. Finally, the worker waits
+    for retries until the driver says the job is done.
+
+    To keep the number of storage requests down for jobs with many tasks, a worker
+    doesn't list anything until its own tasks are used up. Then it lists the claims
+    once to find the tasks that haven't been claimed yet, and the completions once to
+    find the tasks that might need to be stolen. Claimed and completed tasks stay that
+    way, so after that the worker only keeps track of the remaining candidates itself,
+    and only the (usually short) list of retries is listed on every poll.
+    """
+
+    def __init__(
+        self,
+        storage_bucket: AbstractStorageBucket,
+        job_id: str,
+        total_num_tasks: int,
+        worker_index: int,
+        num_workers: int,
+    ):
+        self._storage_bucket = storage_bucket
+        self._job_id = job_id
+        self._total_num_tasks = total_num_tasks
+        self._worker_index = worker_index
+        self._num_workers = num_workers
+
+        self._own_tasks = iter(range(worker_index, total_num_tasks, num_workers))
+
+        self._claims_prefix = storage_prefix_task_claims(job_id)
+        self._steals_prefix = storage_prefix_task_steals(job_id)
+        self._completions_prefix = storage_prefix_task_completions(job_id)
+        self._retries_prefix = storage_prefix_task_retries(job_id)
+
+        # Tasks that might not have been claimed yet, in the order we'll try to claim
+        # them. None until our own tasks are used up.
+        self._unclaimed: Optional[Deque[Tuple[int, int]]] = None
+        # all of the retries we've seen so far
+        self._retries: Set[Tuple[int, int]] = set()
+        # Tasks that might need to be stolen, i.e. claimed tasks that might not be
+        # completed. None until we first look for tasks to steal.
+        self._steal_candidates: Optional[Set[Tuple[int, int]]] = None
+        # (task_id, attempt) -> time the task was claimed
+        self._claim_times: Dict[Tuple[int, int], float] = {}
+
+        self._num_tasks_completed = 0
+        self._total_task_seconds = 0.0
+
+    async def _try_claim(self, prefix: str, task_id: int, attempt: int) -> bool:
+        # the claim records when it was made so that other workers can tell if the task
+        # is taking too long
+        return await self._storage_bucket.write_bytes_exclusive(
+            str(time.time()).encode("utf-8"),
+            storage_key_task_attempt(prefix, task_id, attempt),
+        )
+
+    async def _list_task_attempts(self, prefix: str) -> Set[Tuple[int, int]]:
+        return {
+            parse_storage_key_task_attempt(key, prefix)
+            for key in await self._storage_bucket.list_objects(prefix)
+        }
+
+    async def _try_claim_unclaimed(
+        self, new_retries: List[Tuple[int, int]]
+    ) -> Optional[Tuple[int, int]]:
+        if self._unclaimed is None:
+            claimed = await self._list_task_attempts(self._claims_prefix)
+            unclaimed = [
+                (task_id, 1)
+                for task_id in range(self._total_num_tasks)
+                if (task_id, 1) not in claimed
+            ]
+            # start at a different point for each worker so that they don't all
+            # compete for the same tasks
+            start = self._worker_index * len(unclaimed) // self._num_workers
+            self._unclaimed = collections.deque(unclaimed[start:] + unclaimed[:start])
+            self._unclaimed.extend(sorted(self._retries))
+        else:
+            # retries don't need to be rotated, as there are usually only a few of them
+            self._unclaimed.extend(new_retries)
+
+        # tasks we fail to claim have been claimed by another worker, so we never need
+        # to try them again
+        while self._unclaimed:
+            task_id, attempt = self._unclaimed.popleft()
+            if await self._try_claim(self._claims_prefix, task_id, attempt):
+                return task_id, attempt
+        return None
+
+    async def _get_claim_time(self, task_id: int, attempt: int) -> Optional[float]:
+        claim_time = self._claim_times.get((task_id, attempt))
+        if claim_time is None:
+            claim = await self._storage_bucket.try_get_bytes(
+                storage_key_task_attempt(self._claims_prefix, task_id, attempt)
+            )
+            if claim is None:
+                return None
+            claim_time = float(claim.decode("utf-8"))
+            self._claim_times[(task_id, attempt)] = claim_time
+        return claim_time
+
+    async def _try_steal(
+        self, new_retries: List[Tuple[int, int]]
+    ) -> Optional[Tuple[int, int]]:
+        if self._num_tasks_completed == 0:
+            # we don't know how long tasks usually take yet
+            return None
+
+        if self._steal_candidates is None:
+            completed, stolen = await asyncio.gather(
+                self._list_task_attempts(self._completions_prefix),
+                self._list_task_attempts(self._steals_prefix),
+            )
+            self._steal_candidates = {
+                (task_id, 1) for task_id in range(self._total_num_tasks)
+            }
+            self._steal_candidates.update(self._retries)
+            self._steal_candidates -= completed | stolen
+        else:
+            self._steal_candidates.update(new_retries)
+
+        min_straggler_seconds = max(
+            _MIN_STRAGGLER_SECONDS,
+            _STRAGGLER_DURATION_MULTIPLE
+            * self._total_task_seconds
+            / self._num_tasks_completed,
+        )
+        now = time.time()
+        for task_id, attempt in sorted(self._steal_candidates):
+            if (task_id, attempt + 1) in self._retries:
+                # the driver has already given up on this attempt
+                self._steal_candidates.discard((task_id, attempt))
+                continue
+            claim_time = await self._get_claim_time(task_id, attempt)
+            if claim_time is None or now - claim_time <= min_straggler_seconds:
+                continue
+
+            # only now do we check whether this task has actually been completed, as
+            # most tasks will have completed before they become stragglers
+            if await self._storage_bucket.exists(
+                storage_key_task_attempt(self._completions_prefix, task_id, attempt)
+            ):
+                self._steal_candidates.discard((task_id, attempt))
+                continue
+
+            # whether or not we manage to steal it, nobody else will be able to
+            self._steal_candidates.discard((task_id, attempt))
+            if await self._try_claim(self._steals_prefix, task_id, attempt):
+                print(
+                    f"Meadowrun agent: Stealing task #{task_id}, attempt #{attempt} "
+                    f"which was claimed {now - claim_time:.1f}s ago"
+                )
+                return task_id, attempt
+        return None
+
+    async def claim_next_task(self) -> Optional[Tuple[int, int]]:
+        """
+        Returns (task_id, attempt) for the next task to run, or None if the job is done
+        """
+        for task_id in self._own_tasks:
+            if await self._try_claim(self._claims_prefix, task_id, 1):
+                return task_id, 1
+
+        while True:
+            new_retries = sorted(
+                await self._list_task_attempts(self._retries_prefix) - self._retries
+            )
+            self._retries.update(new_retries)
+            task = await self._try_claim_unclaimed(new_retries)
+            if task is None:
+                task = await self._try_steal(new_retries)
+            if task is not None:
+                return task
+
+            if await self._storage_bucket.exists(storage_key_job_done(self._job_id)):
+                return None
+
+            await asyncio.sleep(_TASK_CLAIM_POLL_SECONDS)
+
+    async def task_completed(
+        self, task_id: int, attempt: int, duration_seconds: float
+    ) -> None:
+        self._num_tasks_completed += 1
+        self._total_task_seconds += duration_seconds
+        if self._steal_candidates is not None:
+            self._steal_candidates.discard((task_id, attempt))
+        await self._storage_bucket.write_bytes(
+            b"",
+            storage_key_task_attempt(self._completions_prefix, task_id, attempt),
+        )
+
+
+async def _dynamic_task_worker_loop(
+    storage_bucket: AbstractStorageBucket,
+    base_job_id: str,
+    byte_ranges: List[Tuple[int, int, int]],
+    results: TaskResultBatcher,
+    uploads: BackgroundUploads,
+    claimer: _TaskClaimer,
+    log_file_name: str,
+    task_worker: TaskWorker,
+) -> None:
+    while True:
+        task = await claimer.claim_next_task()
+        if task is None:
+            print("Meadowrun agent: Job is done. Exiting.")
+            return
+
+        task_id, attempt = task
+        print(f"Meadowrun agent: About to execute task #{task_id}, attempt #{attempt}")
+        arg = await download_task_arg(storage_bucket, base_job_id, byte_ranges[task_id])
+        t0 = time.time()
+        process_state = await _run_task(task_worker, arg, log_file_name, task_id)
+        await results.add(task_id, attempt, process_state)
+        await uploads.add(claimer.task_completed(task_id, attempt, time.time() - t0))
+
+
+def _get_current_worker_index() -> int:
     # WORKER_INDEX will be available in reusable pods. In non-reusable pods we have to
     # use JOB_COMPLETION_INDEX
-    current_worker_index = int(
+    return int(
         os.environ.get("MEADOWRUN_WORKER_INDEX", os.environ["JOB_COMPLETION_INDEX"])
     )
 
+
+async def _get_storage_bucket_and_byte_ranges(
+    function_name: str, base_job_id: str
+) -> Tuple[AbstractStorageBucket, List[Tuple[int, int, int]]]:
     # we're always being called from run_job_local_storage_main which sets these
     # variables for us
     storage_bucket = meadowrun.func_worker_storage_helper.FUNC_WORKER_STORAGE_BUCKET
     if storage_bucket is None:
         raise ValueError(
-            "Programming error--_indexed_agent_function must be called from "
+            f"Programming error--{function_name} must be called from "
             "run_job_local_storage_main"
         )
 
     byte_ranges = pickle.loads(
         await storage_bucket.get_bytes(storage_key_ranges(base_job_id))
     )
+    return storage_bucket, byte_ranges
 
-    i = current_worker_index
-    while i < total_num_tasks:
-        arg = await download_task_arg(storage_bucket, base_job_id, byte_ranges[i])
 
-        restart_worker_needed = False
+async def _indexed_agent_function(
+    total_num_tasks: int,
+    num_workers: int,
+    log_file_name: str,
+    base_job_id: str,
+    job_id: str,
+    task_workers: List[TaskWorker],
+) -> None:
+    """
+    This is a worker function to help with running a run_map. This worker assumes that
+    JOB_COMPLETION_INDEX is set, which Kubernetes will set for indexed completion jobs.
+    This worker assumes task arguments are accessible via
+    meadowrun.func_worker_storage_helper.FUNC_WORKER_STORAGE_BUCKET and will just
+    complete all of the tasks where task_index % num_workers == current worker index.
 
-        try:
-            worker_monitor.start_stats()
-            await worker_server.send_message(arg)
-            state, result_bytes = await worker_server.receive_message()
-            stats = await worker_monitor.stop_stats()
-
-            process_state = ProcessState(
-                state=ProcessState.ProcessStateEnum.SUCCEEDED
-                if state == "SUCCEEDED"
-                else ProcessState.ProcessStateEnum.PYTHON_EXCEPTION,
-                pickled_result=result_bytes,
-                return_code=0,
-                max_memory_used_gb=stats.max_memory_used_gb,
-                log_file_name=log_file_name,
-            )
-        except BaseException:
-            stats = await worker_monitor.stop_stats()
-            process_state = get_job_state(  # type: ignore
-                return_code=(await worker_monitor.try_get_return_code()) or 0,
+    If there is more than one task worker, task worker j completes the tasks where
+    task_index % (num_workers * len(task_workers)) ==
+    current worker index + j * num_workers.
+    """
+    current_worker_index = _get_current_worker_index()
+    storage_bucket, byte_ranges = await _get_storage_bucket_and_byte_ranges(
+        "_indexed_agent_function", base_job_id
+    )
+
+    # we upload the results of previous tasks in the background
+    uploads = BackgroundUploads()
+    results = TaskResultBatcher(storage_bucket, base_job_id, uploads)
+    try:
+        await gather_or_cancel(
+            *(
+                _indexed_task_worker_loop(
+                    storage_bucket,
+                    base_job_id,
+                    byte_ranges,
+                    results,
+                    current_worker_index + j * num_workers,
+                    num_workers * len(task_workers),
+                    total_num_tasks,
+                    log_file_name,
+                    task_worker,
+                )
+                for j, task_worker in enumerate(task_workers)
             )
-            process_state.max_memory_used_gb = stats.max_memory_used_gb
-            process_state.was_oom_killed = await worker_monitor.was_oom_killed()
+        )
 
-            restart_worker_needed = True
+        await results.close()
+        await uploads.wait_all()
+    finally:
+        results.cancel()
+        uploads.cancel()
 
-        print(
-            f"Meadowrun agent: Completed task #{i}, "
-            f"state {ProcessState.ProcessStateEnum.Name(process_state.state)}, max "
-            f"memory {process_state.max_memory_used_gb}GB "
-        )
-        # we don't support retries yet so we're always on attempt 1
-        await complete_task(storage_bucket, base_job_id, i, 1, process_state)
 
-        if restart_worker_needed:
-            await restart_worker(worker_server, worker_monitor)
+async def _dynamic_agent_function(
+    total_num_tasks: int,
+    num_workers: int,
+    log_file_name: str,
+    base_job_id: str,
+    job_id: str,
+    task_workers: List[TaskWorker],
+) -> None:
+    """
+    Like _indexed_agent_function, but rather than assigning tasks to workers statically,
+    workers claim tasks as they go, see _TaskClaimer. This means that a slow worker
+    doesn't hold up the whole job, and tasks can be retried. Used when
+    Kubernetes.dynamic_task_assignment is set.
+    """
+    storage_bucket, byte_ranges = await _get_storage_bucket_and_byte_ranges(
+        "_dynamic_agent_function", base_job_id
+    )
+    claimer = _TaskClaimer(
+        storage_bucket,
+        base_job_id,
+        total_num_tasks,
+        _get_current_worker_index(),
+        num_workers,
+    )
+
+    uploads = BackgroundUploads()
+    results = TaskResultBatcher(storage_bucket, base_job_id, uploads)
+    try:
+        await gather_or_cancel(
+            *(
+                _dynamic_task_worker_loop(
+                    storage_bucket,
+                    base_job_id,
+                    byte_ranges,
+                    results,
+                    uploads,
+                    claimer,
+                    log_file_name,
+                    task_worker,
+                )
+                for task_worker in task_workers
+            )
+        )
 
-        i += num_workers
+        await results.close()
+        await uploads.wait_all()
+    finally:
+        results.cancel()
+        uploads.cancel()
 
 
 async def _image_name_from_job(job: Job) -> Tuple[bool, str, Optional[str], Job]:
@@ -319,6 +704,15 @@ class StorageBucketSpec(abc.ABC):
         # See get_command_line_arguments
         ...
 
+    async def get_storage_bucket_in_pod(self) -> AbstractStorageBucket:
+        # Re-creates the storage bucket from inside a pod, where credentials come from
+        # get_environment_variables rather than from the client
+        parser = argparse.ArgumentParser()
+        self.add_arguments_to_parser(parser)
+        return await self.from_parsed_args(
+            parser.parse_args(self.get_command_line_arguments())
+        )
+
 
 @dataclasses.dataclass(frozen=True)
 class Kubernetes(Host):
@@ -346,6 +740,15 @@ class Kubernetes(Host):
             argument in place and return it as the result, or construct a new
             [V1PodTemplateSpec](https://github.com/kubernetes-client/python/blob/master/kubernetes/docs/V1PodTemplateSpec.md)
             and return that.
+        dynamic_task_assignment: Only applies to run_map. When set to False, each
+            worker runs a fixed subset of the tasks, so a single slow pod can hold back
+            the whole map. When set to True, workers claim tasks from the storage bucket
+            as they become free and steal tasks that are taking much longer than usual
+            from other workers. This also makes it possible to use
+            max_num_task_attempts > 1 on Kubernetes. Requires a storage_spec that
+            supports write_bytes_exclusive. For S3-compatible storage, this requires a
+            version of botocore that supports conditional writes (IfNoneMatch), which is
+            newer than the minimum version meadowrun otherwise requires.
     """
 
     storage_spec: Optional[StorageBucketSpec] = None
@@ -357,6 +760,7 @@ class Kubernetes(Host):
             [kubernetes_client.V1PodTemplateSpec], kubernetes_client.V1PodTemplateSpec
         ]
     ] = None
+    dynamic_task_assignment: bool = False
 
     async def set_defaults(self) -> None:
         # this function needs to be called before anything else happens with the
@@ -372,6 +776,13 @@ class Kubernetes(Host):
 
         return await self.storage_spec.get_storage_bucket(self.kubernetes_namespace)
 
+    def _get_storage_bucket_for_workers(
+        self,
+    ) -> Callable[[], Awaitable[AbstractStorageBucket]]:
+        if self.storage_spec is None:
+            raise ValueError("result_sink requires specifying a storage_spec")
+        return self.storage_spec.get_storage_bucket_in_pod
+
     async def run_job(
         self,
         resources_required: Optional[ResourcesInternal],
@@ -637,23 +1048,43 @@ class Kubernetes(Host):
         wait_for_result: WaitOption,
         max_num_task_attempts: int,
         retry_with_more_memory: bool,
+        speculative_execution_multiple: Optional[float],
+        num_task_workers_per_agent: int,
+        max_num_concurrent_tasks: Optional[int],
     ) -> AsyncIterable[TaskResult[_U]]:
         # TODO add support for this feature
         if job_fields["sidecar_containers"]:
             raise NotImplementedError(
                 "Sidecar containers are not yet supported for Kubernetes"
             )
-        if max_num_task_attempts != 1:
-            raise NotImplementedError("max_num_task_attempts must be 1 on Kubernetes")
+        if speculative_execution_multiple is not None:
+            raise NotImplementedError(
+                "speculative_execution_multiple is not supported on Kubernetes, use "
+                "dynamic_task_assignment, which runs straggling tasks on idle workers"
+            )
+        if max_num_task_attempts != 1 and not self.dynamic_task_assignment:
+            raise NotImplementedError(
+                "max_num_task_attempts must be 1 on Kubernetes unless "
+                "dynamic_task_assignment is set"
+            )
 
         async with await self.get_storage_bucket() as storage_bucket:
+            if self.dynamic_task_assignment:
+                # workers claim tasks with write_bytes_exclusive, see _TaskClaimer
+                storage_bucket.check_write_bytes_exclusive_supported()
+
             # pretty much copied from AllocVM.run_map_as_completed
 
-            driver = KubernetesGridJobDriver(self, num_concurrent_tasks, storage_bucket)
+            driver = KubernetesGridJobDriver(
+                self,
+                math.ceil(num_concurrent_tasks / num_task_workers_per_agent),
+                storage_bucket,
+                num_task_workers_per_agent,
+            )
 
             # this should be in get_results, but with indexed workers we need to make
             # sure the tasks are uploaded before we can start workers
-            await driver._add_tasks(args)
+            await driver._add_tasks(args, job_fields.get("compression", ""))
 
             try:
                 run_worker_loops = asyncio.create_task(
@@ -668,17 +1099,18 @@ class Kubernetes(Host):
                 )
 
                 num_tasks_done = 0
-                async for result in driver.get_results(args):
+                async for result in driver.get_results(args, max_num_task_attempts):
                     yield result
                     num_tasks_done += 1
 
                 await run_worker_loops
 
             finally:
-                input_keys_to_delete = [
-                    storage_key_task_args(driver._job_id),
-                    storage_key_ranges(driver._job_id),
-                ]
+                # task arguments are uploaded in multiple segments, see
+                # upload_task_args_streaming
+                input_keys_to_delete = await storage_bucket.list_objects(
+                    storage_prefix_inputs(driver._job_id)
+                )
                 output_keys_to_delete = await storage_bucket.list_objects(
                     storage_prefix_outputs(driver._job_id)
                 )
@@ -712,13 +1144,20 @@ class KubernetesGridJobDriver:
     def __init__(
         self,
         kubernetes: Kubernetes,
-        num_concurrent_tasks: int,
+        num_workers: int,
         storage_bucket: AbstractStorageBucket,
+        num_task_workers_per_agent: int = 1,
     ):
+        """
+        num_workers is the number of pods to run. Each one runs
+        num_task_workers_per_agent task workers (see NUM_TASK_WORKERS_KWARG) and
+        requests num_task_workers_per_agent times the resources required per task.
+        """
         self._kubernetes = kubernetes
 
         # properties of the job
-        self._num_concurrent_tasks = num_concurrent_tasks
+        self._num_workers = num_workers
+        self._num_task_workers = num_task_workers_per_agent
         self._storage_bucket = storage_bucket
 
         self._job_id = str(uuid.uuid4())
@@ -732,7 +1171,7 @@ class KubernetesGridJobDriver:
         # these events aren't actually used right now, but for now we're keeping this
         # code similar to GridJobDriver with the goal of eventually merging these
         # classes
-        self._workers_needed = num_concurrent_tasks
+        self._workers_needed = num_workers
         self._workers_needed_changed = asyncio.Event()
 
         self._abort_launching_new_workers = asyncio.Event()
@@ -742,8 +1181,10 @@ class KubernetesGridJobDriver:
 
     # these three functions are effectively the GridJobCloudInterface
 
-    async def _add_tasks(self, args: Sequence[Any]) -> None:
-        ranges = await upload_task_args(self._storage_bucket, self._job_id, args)
+    async def _add_tasks(self, args: Sequence[Any], compression: str) -> None:
+        ranges = await upload_task_args(
+            self._storage_bucket, self._job_id, args, compression
+        )
         # this is a hack--"normally" this would get sent with the "task assignment"
         # message, but we don't have the infrastructure for that in the case of Indexed
         # Jobs (static task-to-worker assignment)
@@ -764,7 +1205,18 @@ class KubernetesGridJobDriver:
         )
 
     async def _retry_task(self, task_id: int, attempts_so_far: int) -> None:
-        raise NotImplementedError("Retries are not implemented for Kubernetes")
+        if not self._kubernetes.dynamic_task_assignment:
+            raise NotImplementedError(
+                "Retries are only implemented for Kubernetes with "
+                "dynamic_task_assignment"
+            )
+        # workers will see this and claim the next attempt, see _TaskClaimer
+        await self._storage_bucket.write_bytes(
+            b"",
+            storage_key_task_attempt(
+                storage_prefix_task_retries(self._job_id), task_id, attempts_so_far + 1
+            ),
+        )
 
     def _worker_function_job(
         self,
@@ -774,18 +1226,26 @@ class KubernetesGridJobDriver:
         pickle_protocol: int,
     ) -> Job:
 
-        indexed_map_worker_args = num_args, self._num_concurrent_tasks
+        indexed_map_worker_args = num_args, self._num_workers
+        if self._kubernetes.dynamic_task_assignment:
+            agent_function: Callable[..., Any] = _dynamic_agent_function
+        else:
+            agent_function = _indexed_agent_function
 
         return Job(
             base_job_id=self._job_id,
             py_agent=PyAgentJob(
                 pickled_function=cloudpickle.dumps(function, protocol=pickle_protocol),
                 qualified_agent_function_name=QualifiedFunctionName(
-                    module_name=_indexed_agent_function.__module__,
-                    function_name=_indexed_agent_function.__name__,
+                    module_name=agent_function.__module__,
+                    function_name=agent_function.__name__,
                 ),
                 pickled_agent_function_arguments=pickle.dumps(
-                    (indexed_map_worker_args, {}), protocol=pickle_protocol
+                    (
+                        indexed_map_worker_args,
+                        {NUM_TASK_WORKERS_KWARG: self._num_task_workers},
+                    ),
+                    protocol=pickle_protocol,
                 ),
             ),
             **job_fields,
@@ -823,6 +1283,12 @@ class KubernetesGridJobDriver:
                 job = self._worker_function_job(
                     function, num_args, job_fields, pickle_protocol
                 )
+                if resources_required_per_task is not None:
+                    resources_required_per_worker: Optional[
+                        ResourcesInternal
+                    ] = resources_required_per_task.multiply(self._num_task_workers)
+                else:
+                    resources_required_per_worker = None
                 (
                     is_custom_container_image,
                     image_name,
@@ -847,10 +1313,10 @@ class KubernetesGridJobDriver:
                     image_name,
                     image_pull_secret_name,
                     [int(p) for p in expand_ports(job_fields["ports"])],
-                    resources_required_per_task,
+                    resources_required_per_worker,
                     self._kubernetes.storage_spec,
                     self._job_id,
-                    self._num_concurrent_tasks,
+                    self._num_workers,
                     wait_for_result,
                     self._kubernetes.pod_customization,
                 )
@@ -936,11 +1402,22 @@ class KubernetesGridJobDriver:
                 except BaseException:
                     pass
 
-    async def get_results(self, args: Sequence[_T]) -> AsyncIterable[TaskResult]:
-        """Yields TaskResult objects as soon as tasks complete."""
+    async def get_results(
+        self, args: Sequence[_T], max_num_task_attempts: int = 1
+    ) -> AsyncIterable[TaskResult]:
+        """
+        Yields TaskResult objects as soon as tasks complete, and retries tasks as
+        needed.
+        """
 
         # semi-copy/paste from GridJobDriver.add_tasks_and_get_results
 
+        # With dynamic_task_assignment, a task can be stolen by another worker, so we
+        # can get more than one result for the same attempt. We also ignore results for
+        # attempts that we've already retried. latest_attempts[task_id] is -1 when the
+        # task is done.
+        latest_attempts = [1] * len(args)
+        # done = successful or exhausted retries
         num_tasks_done = 0
         # stop_receiving tells _cloud_interface.receive_task_results that there are no
         # more results to get
@@ -955,14 +1432,30 @@ class KubernetesGridJobDriver:
         async for task_batch, worker_batch in await self._receive_task_results(
             stop_receiving=stop_receiving, workers_done=self._no_workers_available
         ):
-            for task_process_state in task_batch:
-                task_result = TaskResult.from_process_state(task_process_state)
+            for task in task_batch:
+                if latest_attempts[task.task_id] != task.attempt:
+                    continue
+
+                task_result = TaskResult.from_process_state(task)
                 if task_result.is_success:
                     num_tasks_done += 1
+                    latest_attempts[task.task_id] = -1
                     yield task_result
+                elif task.attempt < max_num_task_attempts:
+                    print(
+                        f"Task {task.task_id} failed at attempt {task.attempt}, "
+                        f"retrying: {task_result._log_file_and_exception_traceback()}"
+                    )
+                    latest_attempts[task.task_id] = task.attempt + 1
+                    await self._retry_task(task.task_id, task.attempt)
                 else:
-                    print(f"Task {task_process_state.task_id} failed")
+                    print(
+                        f"Task {task.task_id} failed at attempt {task.attempt}, max "
+                        f"attempts is {max_num_task_attempts}, not retrying: "
+                        f"{task_result._log_file_and_exception_traceback()}"
+                    )
                     num_tasks_done += 1
+                    latest_attempts[task.task_id] = -1
                     yield task_result
 
             if worker_batch:
@@ -970,6 +1463,14 @@ class KubernetesGridJobDriver:
                 self._worker_process_state_received.set()
 
             if num_tasks_done >= len(args):
+                if (
+                    not stop_receiving.is_set()
+                    and self._kubernetes.dynamic_task_assignment
+                ):
+                    # tells idle workers waiting for retries that they can exit
+                    await self._storage_bucket.write_bytes(
+                        b"", storage_key_job_done(self._job_id)
+                    )
                 stop_receiving.set()
             else:
                 t0 = time.time()
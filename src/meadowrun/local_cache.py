@@ -53,6 +53,19 @@ if use_platformdirs:
         with open(file, "w", encoding="utf-8") as f:
             json.dump(json_data, f)
 
+    def get_cache_dir(name: str) -> Optional[str]:
+        """Returns a directory in the standard cache dir, creating it if needed.
+
+        Args:
+            name (str): The name of the directory. (not a path)
+
+        Returns:
+            Optional[str]: The path to the directory.
+        """
+        path = MEADOWRUN_DIRS.user_cache_path / name
+        path.mkdir(parents=True, exist_ok=True)
+        return str(path)
+
     def clear_cache(prefix: str) -> None:
         try:
             for file in glob.glob(
@@ -97,6 +110,10 @@ else:
         global cached_files
         cached_files[name] = (time.time(), json_data)
 
+    def get_cache_dir(name: str) -> Optional[str]:
+        """There's no standard cache dir, so this always returns None"""
+        return None
+
     def clear_cache(prefix: str) -> None:
         global cached_files
         cached_files.clear()
@@ -15,7 +15,7 @@ _sym_db = _symbol_database.Default()
 
 
 DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(
-    b'\n\x19meadowrun/meadowrun.proto\x12\tmeadowrun"(\n\nStringPair\x12\x0b\n\x03key\x18\x01 \x01(\t\x12\r\n\x05value\x18\x02 \x01(\t"+\n\x15ServerAvailableFolder\x12\x12\n\ncode_paths\x18\x01 \x03(\t"@\n\x0b\x43odeZipFile\x12\x0b\n\x03url\x18\x01 \x01(\t\x12\x12\n\ncode_paths\x18\x02 \x03(\t\x12\x10\n\x08\x63wd_path\x18\x03 \x01(\t"I\n\rGitRepoCommit\x12\x10\n\x08repo_url\x18\x01 \x01(\t\x12\x0e\n\x06\x63ommit\x18\x02 \x01(\t\x12\x16\n\x0epath_to_source\x18\x03 \x01(\t"I\n\rGitRepoBranch\x12\x10\n\x08repo_url\x18\x01 \x01(\t\x12\x0e\n\x06\x62ranch\x18\x02 \x01(\t\x12\x16\n\x0epath_to_source\x18\x03 \x01(\t"6\n\x1aServerAvailableInterpreter\x12\x18\n\x10interpreter_path\x18\x01 \x01(\t"7\n\x11\x43ontainerAtDigest\x12\x12\n\nrepository\x18\x01 \x01(\t\x12\x0e\n\x06\x64igest\x18\x02 \x01(\t"1\n\x0e\x43ontainerAtTag\x12\x12\n\nrepository\x18\x01 \x01(\t\x12\x0b\n\x03tag\x18\x02 \x01(\t"\xde\x02\n\x15\x45nvironmentSpecInCode\x12\x34\n\x10\x65nvironment_type\x18\x01 \x01(\x0e\x32\x1a.meadowrun.EnvironmentType\x12\x35\n\x0b\x66ile_format\x18\x07 \x01(\x0e\x32 .meadowrun.EnvironmentFileFormat\x12\x14\n\x0cpath_to_spec\x18\x02 \x01(\t\x12\x16\n\x0epython_version\x18\x03 \x01(\t\x12U\n\x13\x61\x64\x64itional_software\x18\x05 \x03(\x0b\x32\x38.meadowrun.EnvironmentSpecInCode.AdditionalSoftwareEntry\x12\x18\n\x10\x65\x64itable_install\x18\x06 \x01(\x08\x1a\x39\n\x17\x41\x64\x64itionalSoftwareEntry\x12\x0b\n\x03key\x18\x01 \x01(\t\x12\r\n\x05value\x18\x02 \x01(\t:\x02\x38\x01"\xdd\x02\n\x0f\x45nvironmentSpec\x12\x34\n\x10\x65nvironment_type\x18\x01 \x01(\x0e\x32\x1a.meadowrun.EnvironmentType\x12\x35\n\x0b\x66ile_format\x18\x07 \x01(\x0e\x32 .meadowrun.EnvironmentFileFormat\x12\x0c\n\x04spec\x18\x02 \x01(\t\x12\x11\n\tspec_lock\x18\x03 \x01(\t\x12\x16\n\x0epython_version\x18\x04 \x01(\t\x12O\n\x13\x61\x64\x64itional_software\x18\x05 \x03(\x0b\x32\x32.meadowrun.EnvironmentSpec.AdditionalSoftwareEntry\x12\x18\n\x10\x65\x64itable_install\x18\x06 \x01(\x08\x1a\x39\n\x17\x41\x64\x64itionalSoftwareEntry\x12\x0b\n\x03key\x18\x01 \x01(\t\x12\r\n\x05value\x18\x02 \x01(\t:\x02\x38\x01".\n\x18ServerAvailableContainer\x12\x12\n\nimage_name\x18\x01 \x01(\t"G\n\x0cPyCommandJob\x12\x14\n\x0c\x63ommand_line\x18\x01 \x03(\t\x12!\n\x19pickled_context_variables\x18\x02 \x01(\x0c"C\n\x15QualifiedFunctionName\x12\x13\n\x0bmodule_name\x18\x01 \x01(\t\x12\x15\n\rfunction_name\x18\x02 \x01(\t"\xa5\x01\n\rPyFunctionJob\x12\x43\n\x17qualified_function_name\x18\x01 \x01(\x0b\x32 .meadowrun.QualifiedFunctionNameH\x00\x12\x1a\n\x10pickled_function\x18\x02 \x01(\x0cH\x00\x12"\n\x1apickled_function_arguments\x18\x03 \x01(\x0c\x42\x0f\n\rfunction_spec"\xf1\x01\n\nPyAgentJob\x12\x43\n\x17qualified_function_name\x18\x01 \x01(\x0b\x32 .meadowrun.QualifiedFunctionNameH\x00\x12\x1a\n\x10pickled_function\x18\x02 \x01(\x0cH\x00\x12G\n\x1dqualified_agent_function_name\x18\x05 \x01(\x0b\x32 .meadowrun.QualifiedFunctionName\x12(\n pickled_agent_function_arguments\x18\x04 \x01(\x0c\x42\x0f\n\rfunction_spec"P\n\x08GridTask\x12\x0f\n\x07task_id\x18\x01 \x01(\x05\x12\x0f\n\x07\x61ttempt\x18\x03 \x01(\x05\x12"\n\x1apickled_function_arguments\x18\x02 \x01(\x0c"\xf4\x01\n\x0e\x43ontainerImage\x12\x41\n\x19\x63ontainer_image_at_digest\x18\x01 \x01(\x0b\x32\x1c.meadowrun.ContainerAtDigestH\x00\x12;\n\x16\x63ontainer_image_at_tag\x18\x02 \x01(\x0b\x32\x19.meadowrun.ContainerAtTagH\x00\x12O\n server_available_container_image\x18\x03 \x01(\x0b\x32#.meadowrun.ServerAvailableContainerH\x00\x42\x11\n\x0f\x63ontainer_image"\xdd\x08\n\x03Job\x12\x13\n\x0b\x62\x61se_job_id\x18\x01 \x01(\t\x12\x19\n\x11job_friendly_name\x18\x02 \x01(\t\x12\x43\n\x17server_available_folder\x18\x05 \x01(\x0b\x32 .meadowrun.ServerAvailableFolderH\x00\x12\x33\n\x0fgit_repo_commit\x18\x06 \x01(\x0b\x32\x18.meadowrun.GitRepoCommitH\x00\x12\x33\n\x0fgit_repo_branch\x18\x07 \x01(\x0b\x32\x18.meadowrun.GitRepoBranchH\x00\x12/\n\rcode_zip_file\x18\x13 \x01(\x0b\x32\x16.meadowrun.CodeZipFileH\x00\x12M\n\x1cserver_available_interpreter\x18\x08 \x01(\x0b\x32%.meadowrun.ServerAvailableInterpreterH\x01\x12;\n\x13\x63ontainer_at_digest\x18\t \x01(\x0b\x32\x1c.meadowrun.ContainerAtDigestH\x01\x12\x35\n\x10\x63ontainer_at_tag\x18\n \x01(\x0b\x32\x19.meadowrun.ContainerAtTagH\x01\x12I\n\x1aserver_available_container\x18\x0b \x01(\x0b\x32#.meadowrun.ServerAvailableContainerH\x01\x12\x44\n\x18\x65nvironment_spec_in_code\x18\x0c \x01(\x0b\x32 .meadowrun.EnvironmentSpecInCodeH\x01\x12\x36\n\x10\x65nvironment_spec\x18\x12 \x01(\x0b\x32\x1a.meadowrun.EnvironmentSpecH\x01\x12\x35\n\x12sidecar_containers\x18\x16 \x03(\x0b\x32\x19.meadowrun.ContainerImage\x12\x34\n\x15\x65nvironment_variables\x18\r \x03(\x0b\x32\x15.meadowrun.StringPair\x12&\n\x1eresult_highest_pickle_protocol\x18\x0e \x01(\x05\x12-\n\npy_command\x18\x0f \x01(\x0b\x32\x17.meadowrun.PyCommandJobH\x02\x12/\n\x0bpy_function\x18\x10 \x01(\x0b\x32\x18.meadowrun.PyFunctionJobH\x02\x12)\n\x08py_agent\x18\x17 \x01(\x0b\x32\x15.meadowrun.PyAgentJobH\x02\x12@\n\x13\x63redentials_sources\x18\x11 \x03(\x0b\x32#.meadowrun.CredentialsSourceMessage\x12\r\n\x05ports\x18\x14 \x03(\t\x12\x10\n\x08uses_gpu\x18\x15 \x01(\x08\x42\x11\n\x0f\x63ode_deploymentB\x18\n\x16interpreter_deploymentB\n\n\x08job_spec"\xda\x03\n\x0cProcessState\x12\x37\n\x05state\x18\x01 \x01(\x0e\x32(.meadowrun.ProcessState.ProcessStateEnum\x12\x0b\n\x03pid\x18\x02 \x01(\x05\x12\x14\n\x0c\x63ontainer_id\x18\x03 \x01(\t\x12\x15\n\rlog_file_name\x18\x04 \x01(\t\x12\x16\n\x0epickled_result\x18\x05 \x01(\x0c\x12\x13\n\x0breturn_code\x18\x06 \x01(\x05\x12\x1a\n\x12max_memory_used_gb\x18\x07 \x01(\x02\x12\x16\n\x0ewas_oom_killed\x18\x08 \x01(\x08"\xf5\x01\n\x10ProcessStateEnum\x12\x0b\n\x07\x44\x45\x46\x41ULT\x10\x00\x12\x11\n\rRUN_REQUESTED\x10\x01\x12\x0b\n\x07RUNNING\x10\x02\x12\r\n\tSUCCEEDED\x10\x03\x12\x16\n\x12RUN_REQUEST_FAILED\x10\x04\x12\x14\n\x10PYTHON_EXCEPTION\x10\x05\x12\x18\n\x14NON_ZERO_RETURN_CODE\x10\x06\x12\x1b\n\x17RESOURCES_NOT_AVAILABLE\x10\x07\x12\x17\n\x13\x45RROR_GETTING_STATE\x10\x08\x12\x1a\n\x16UNEXPECTED_WORKER_EXIT\x10\n\x12\x0b\n\x07UNKNOWN\x10\t"P\n\x0eJobStateUpdate\x12\x0e\n\x06job_id\x18\x01 \x01(\t\x12.\n\rprocess_state\x18\x02 \x01(\x0b\x32\x17.meadowrun.ProcessState"i\n\x15GridTaskStateResponse\x12\x0f\n\x07task_id\x18\x01 \x01(\x05\x12\x0f\n\x07\x61ttempt\x18\x03 \x01(\x05\x12.\n\rprocess_state\x18\x02 \x01(\x0b\x32\x17.meadowrun.ProcessState"\xd0\x02\n\x18\x43redentialsSourceMessage\x12/\n\x07service\x18\x01 \x01(\x0e\x32\x1e.meadowrun.Credentials.Service\x12\x13\n\x0bservice_url\x18\x02 \x01(\t\x12/\n\naws_secret\x18\x03 \x01(\x0b\x32\x19.meadowrun.AwsSecretProtoH\x00\x12\x33\n\x0c\x61zure_secret\x18\x05 \x01(\x0b\x32\x1b.meadowrun.AzureSecretProtoH\x00\x12?\n\x15server_available_file\x18\x04 \x01(\x0b\x32\x1e.meadowrun.ServerAvailableFileH\x00\x12=\n\x11kubernetes_secret\x18\x06 \x01(\x0b\x32 .meadowrun.KubernetesSecretProtoH\x00\x42\x08\n\x06source"\x95\x01\n\x0b\x43redentials\x12\x13\n\x0b\x63redentials\x18\x01 \x01(\x0c"3\n\x07Service\x12\x13\n\x0f\x44\x45\x46\x41ULT_SERVICE\x10\x00\x12\n\n\x06\x44OCKER\x10\x01\x12\x07\n\x03GIT\x10\x02"<\n\x04Type\x12\x10\n\x0c\x44\x45\x46\x41ULT_TYPE\x10\x00\x12\x15\n\x11USERNAME_PASSWORD\x10\x01\x12\x0b\n\x07SSH_KEY\x10\x02"\\\n\x0e\x41wsSecretProto\x12\x35\n\x10\x63redentials_type\x18\x01 \x01(\x0e\x32\x1b.meadowrun.Credentials.Type\x12\x13\n\x0bsecret_name\x18\x02 \x01(\t"r\n\x10\x41zureSecretProto\x12\x35\n\x10\x63redentials_type\x18\x01 \x01(\x0e\x32\x1b.meadowrun.Credentials.Type\x12\x12\n\nvault_name\x18\x02 \x01(\t\x12\x13\n\x0bsecret_name\x18\x03 \x01(\t"Z\n\x13ServerAvailableFile\x12\x35\n\x10\x63redentials_type\x18\x01 \x01(\x0e\x32\x1b.meadowrun.Credentials.Type\x12\x0c\n\x04path\x18\x02 \x01(\t"c\n\x15KubernetesSecretProto\x12\x35\n\x10\x63redentials_type\x18\x01 \x01(\x0e\x32\x1b.meadowrun.Credentials.Type\x12\x13\n\x0bsecret_name\x18\x02 \x01(\t*b\n\x0f\x45nvironmentType\x12\x14\n\x10\x45NV_TYPE_DEFAULT\x10\x00\x12\x12\n\x0e\x45NV_TYPE_CONDA\x10\x01\x12\x10\n\x0c\x45NV_TYPE_PIP\x10\x02\x12\x13\n\x0f\x45NV_TYPE_POETRY\x10\x03*z\n\x15\x45nvironmentFileFormat\x12\x1b\n\x17\x45NV_FILE_FORMAT_DEFAULT\x10\x00\x12$\n ENV_FILE_FORMAT_CONDA_ENV_EXPORT\x10\x01\x12\x1e\n\x1a\x45NV_FILE_FORMAT_CONDA_LIST\x10\x02\x62\x06proto3'
+    b'\n\x19meadowrun/meadowrun.proto\x12\tmeadowrun"(\n\nStringPair\x12\x0b\n\x03key\x18\x01 \x01(\t\x12\r\n\x05value\x18\x02 \x01(\t"+\n\x15ServerAvailableFolder\x12\x12\n\ncode_paths\x18\x01 \x03(\t"@\n\x0b\x43odeZipFile\x12\x0b\n\x03url\x18\x01 \x01(\t\x12\x12\n\ncode_paths\x18\x02 \x03(\t\x12\x10\n\x08\x63wd_path\x18\x03 \x01(\t"I\n\rGitRepoCommit\x12\x10\n\x08repo_url\x18\x01 \x01(\t\x12\x0e\n\x06\x63ommit\x18\x02 \x01(\t\x12\x16\n\x0epath_to_source\x18\x03 \x01(\t"I\n\rGitRepoBranch\x12\x10\n\x08repo_url\x18\x01 \x01(\t\x12\x0e\n\x06\x62ranch\x18\x02 \x01(\t\x12\x16\n\x0epath_to_source\x18\x03 \x01(\t"6\n\x1aServerAvailableInterpreter\x12\x18\n\x10interpreter_path\x18\x01 \x01(\t"7\n\x11\x43ontainerAtDigest\x12\x12\n\nrepository\x18\x01 \x01(\t\x12\x0e\n\x06\x64igest\x18\x02 \x01(\t"1\n\x0e\x43ontainerAtTag\x12\x12\n\nrepository\x18\x01 \x01(\t\x12\x0b\n\x03tag\x18\x02 \x01(\t"\xde\x02\n\x15\x45nvironmentSpecInCode\x12\x34\n\x10\x65nvironment_type\x18\x01 \x01(\x0e\x32\x1a.meadowrun.EnvironmentType\x12\x35\n\x0b\x66ile_format\x18\x07 \x01(\x0e\x32 .meadowrun.EnvironmentFileFormat\x12\x14\n\x0cpath_to_spec\x18\x02 \x01(\t\x12\x16\n\x0epython_version\x18\x03 \x01(\t\x12U\n\x13\x61\x64\x64itional_software\x18\x05 \x03(\x0b\x32\x38.meadowrun.EnvironmentSpecInCode.AdditionalSoftwareEntry\x12\x18\n\x10\x65\x64itable_install\x18\x06 \x01(\x08\x1a\x39\n\x17\x41\x64\x64itionalSoftwareEntry\x12\x0b\n\x03key\x18\x01 \x01(\t\x12\r\n\x05value\x18\x02 \x01(\t:\x02\x38\x01"\xdd\x02\n\x0f\x45nvironmentSpec\x12\x34\n\x10\x65nvironment_type\x18\x01 \x01(\x0e\x32\x1a.meadowrun.EnvironmentType\x12\x35\n\x0b\x66ile_format\x18\x07 \x01(\x0e\x32 .meadowrun.EnvironmentFileFormat\x12\x0c\n\x04spec\x18\x02 \x01(\t\x12\x11\n\tspec_lock\x18\x03 \x01(\t\x12\x16\n\x0epython_version\x18\x04 \x01(\t\x12O\n\x13\x61\x64\x64itional_software\x18\x05 \x03(\x0b\x32\x32.meadowrun.EnvironmentSpec.AdditionalSoftwareEntry\x12\x18\n\x10\x65\x64itable_install\x18\x06 \x01(\x08\x1a\x39\n\x17\x41\x64\x64itionalSoftwareEntry\x12\x0b\n\x03key\x18\x01 \x01(\t\x12\r\n\x05value\x18\x02 \x01(\t:\x02\x38\x01".\n\x18ServerAvailableContainer\x12\x12\n\nimage_name\x18\x01 \x01(\t"G\n\x0cPyCommandJob\x12\x14\n\x0c\x63ommand_line\x18\x01 \x03(\t\x12!\n\x19pickled_context_variables\x18\x02 \x01(\x0c"C\n\x15QualifiedFunctionName\x12\x13\n\x0bmodule_name\x18\x01 \x01(\t\x12\x15\n\rfunction_name\x18\x02 \x01(\t"\xa5\x01\n\rPyFunctionJob\x12\x43\n\x17qualified_function_name\x18\x01 \x01(\x0b\x32 .meadowrun.QualifiedFunctionNameH\x00\x12\x1a\n\x10pickled_function\x18\x02 \x01(\x0cH\x00\x12"\n\x1apickled_function_arguments\x18\x03 \x01(\x0c\x42\x0f\n\rfunction_spec"\xf1\x01\n\nPyAgentJob\x12\x43\n\x17qualified_function_name\x18\x01 \x01(\x0b\x32 .meadowrun.QualifiedFunctionNameH\x00\x12\x1a\n\x10pickled_function\x18\x02 \x01(\x0cH\x00\x12G\n\x1dqualified_agent_function_name\x18\x05 \x01(\x0b\x32 .meadowrun.QualifiedFunctionName\x12(\n pickled_agent_function_arguments\x18\x04 \x01(\x0c\x42\x0f\n\rfunction_spec"P\n\x08GridTask\x12\x0f\n\x07task_id\x18\x01 \x01(\x05\x12\x0f\n\x07\x61ttempt\x18\x03 \x01(\x05\x12"\n\x1apickled_function_arguments\x18\x02 \x01(\x0c"\xf4\x01\n\x0e\x43ontainerImage\x12\x41\n\x19\x63ontainer_image_at_digest\x18\x01 \x01(\x0b\x32\x1c.meadowrun.ContainerAtDigestH\x00\x12;\n\x16\x63ontainer_image_at_tag\x18\x02 \x01(\x0b\x32\x19.meadowrun.ContainerAtTagH\x00\x12O\n server_available_container_image\x18\x03 \x01(\x0b\x32#.meadowrun.ServerAvailableContainerH\x00\x42\x11\n\x0f\x63ontainer_image"\xf2\x08\n\x03Job\x12\x13\n\x0b\x62\x61se_job_id\x18\x01 \x01(\t\x12\x19\n\x11job_friendly_name\x18\x02 \x01(\t\x12\x43\n\x17server_available_folder\x18\x05 \x01(\x0b\x32 .meadowrun.ServerAvailableFolderH\x00\x12\x33\n\x0fgit_repo_commit\x18\x06 \x01(\x0b\x32\x18.meadowrun.GitRepoCommitH\x00\x12\x33\n\x0fgit_repo_branch\x18\x07 \x01(\x0b\x32\x18.meadowrun.GitRepoBranchH\x00\x12/\n\rcode_zip_file\x18\x13 \x01(\x0b\x32\x16.meadowrun.CodeZipFileH\x00\x12M\n\x1cserver_available_interpreter\x18\x08 \x01(\x0b\x32%.meadowrun.ServerAvailableInterpreterH\x01\x12;\n\x13\x63ontainer_at_digest\x18\t \x01(\x0b\x32\x1c.meadowrun.ContainerAtDigestH\x01\x12\x35\n\x10\x63ontainer_at_tag\x18\n \x01(\x0b\x32\x19.meadowrun.ContainerAtTagH\x01\x12I\n\x1aserver_available_container\x18\x0b \x01(\x0b\x32#.meadowrun.ServerAvailableContainerH\x01\x12\x44\n\x18\x65nvironment_spec_in_code\x18\x0c \x01(\x0b\x32 .meadowrun.EnvironmentSpecInCodeH\x01\x12\x36\n\x10\x65nvironment_spec\x18\x12 \x01(\x0b\x32\x1a.meadowrun.EnvironmentSpecH\x01\x12\x35\n\x12sidecar_containers\x18\x16 \x03(\x0b\x32\x19.meadowrun.ContainerImage\x12\x34\n\x15\x65nvironment_variables\x18\r \x03(\x0b\x32\x15.meadowrun.StringPair\x12&\n\x1eresult_highest_pickle_protocol\x18\x0e \x01(\x05\x12-\n\npy_command\x18\x0f \x01(\x0b\x32\x17.meadowrun.PyCommandJobH\x02\x12/\n\x0bpy_function\x18\x10 \x01(\x0b\x32\x18.meadowrun.PyFunctionJobH\x02\x12)\n\x08py_agent\x18\x17 \x01(\x0b\x32\x15.meadowrun.PyAgentJobH\x02\x12@\n\x13\x63redentials_sources\x18\x11 \x03(\x0b\x32#.meadowrun.CredentialsSourceMessage\x12\r\n\x05ports\x18\x14 \x03(\t\x12\x10\n\x08uses_gpu\x18\x15 \x01(\x08\x12\x13\n\x0b\x63ompression\x18\x18 \x01(\tB\x11\n\x0f\x63ode_deploymentB\x18\n\x16interpreter_deploymentB\n\n\x08job_spec"\xf4\x03\n\x0cProcessState\x12\x37\n\x05state\x18\x01 \x01(\x0e\x32(.meadowrun.ProcessState.ProcessStateEnum\x12\x0b\n\x03pid\x18\x02 \x01(\x05\x12\x14\n\x0c\x63ontainer_id\x18\x03 \x01(\t\x12\x15\n\rlog_file_name\x18\x04 \x01(\t\x12\x16\n\x0epickled_result\x18\x05 \x01(\x0c\x12\x13\n\x0breturn_code\x18\x06 \x01(\x05\x12\x1a\n\x12max_memory_used_gb\x18\x07 \x01(\x02\x12\x16\n\x0ewas_oom_killed\x18\x08 \x01(\x08\x12\x18\n\x10\x64uration_seconds\x18\t \x01(\x02"\xf5\x01\n\x10ProcessStateEnum\x12\x0b\n\x07\x44\x45\x46\x41ULT\x10\x00\x12\x11\n\rRUN_REQUESTED\x10\x01\x12\x0b\n\x07RUNNING\x10\x02\x12\r\n\tSUCCEEDED\x10\x03\x12\x16\n\x12RUN_REQUEST_FAILED\x10\x04\x12\x14\n\x10PYTHON_EXCEPTION\x10\x05\x12\x18\n\x14NON_ZERO_RETURN_CODE\x10\x06\x12\x1b\n\x17RESOURCES_NOT_AVAILABLE\x10\x07\x12\x17\n\x13\x45RROR_GETTING_STATE\x10\x08\x12\x1a\n\x16UNEXPECTED_WORKER_EXIT\x10\n\x12\x0b\n\x07UNKNOWN\x10\t"P\n\x0eJobStateUpdate\x12\x0e\n\x06job_id\x18\x01 \x01(\t\x12.\n\rprocess_state\x18\x02 \x01(\x0b\x32\x17.meadowrun.ProcessState"i\n\x15GridTaskStateResponse\x12\x0f\n\x07task_id\x18\x01 \x01(\x05\x12\x0f\n\x07\x61ttempt\x18\x03 \x01(\x05\x12.\n\rprocess_state\x18\x02 \x01(\x0b\x32\x17.meadowrun.ProcessState"\xd0\x02\n\x18\x43redentialsSourceMessage\x12/\n\x07service\x18\x01 \x01(\x0e\x32\x1e.meadowrun.Credentials.Service\x12\x13\n\x0bservice_url\x18\x02 \x01(\t\x12/\n\naws_secret\x18\x03 \x01(\x0b\x32\x19.meadowrun.AwsSecretProtoH\x00\x12\x33\n\x0c\x61zure_secret\x18\x05 \x01(\x0b\x32\x1b.meadowrun.AzureSecretProtoH\x00\x12?\n\x15server_available_file\x18\x04 \x01(\x0b\x32\x1e.meadowrun.ServerAvailableFileH\x00\x12=\n\x11kubernetes_secret\x18\x06 \x01(\x0b\x32 .meadowrun.KubernetesSecretProtoH\x00\x42\x08\n\x06source"\x95\x01\n\x0b\x43redentials\x12\x13\n\x0b\x63redentials\x18\x01 \x01(\x0c"3\n\x07Service\x12\x13\n\x0f\x44\x45\x46\x41ULT_SERVICE\x10\x00\x12\n\n\x06\x44OCKER\x10\x01\x12\x07\n\x03GIT\x10\x02"<\n\x04Type\x12\x10\n\x0c\x44\x45\x46\x41ULT_TYPE\x10\x00\x12\x15\n\x11USERNAME_PASSWORD\x10\x01\x12\x0b\n\x07SSH_KEY\x10\x02"\\\n\x0e\x41wsSecretProto\x12\x35\n\x10\x63redentials_type\x18\x01 \x01(\x0e\x32\x1b.meadowrun.Credentials.Type\x12\x13\n\x0bsecret_name\x18\x02 \x01(\t"r\n\x10\x41zureSecretProto\x12\x35\n\x10\x63redentials_type\x18\x01 \x01(\x0e\x32\x1b.meadowrun.Credentials.Type\x12\x12\n\nvault_name\x18\x02 \x01(\t\x12\x13\n\x0bsecret_name\x18\x03 \x01(\t"Z\n\x13ServerAvailableFile\x12\x35\n\x10\x63redentials_type\x18\x01 \x01(\x0e\x32\x1b.meadowrun.Credentials.Type\x12\x0c\n\x04path\x18\x02 \x01(\t"c\n\x15KubernetesSecretProto\x12\x35\n\x10\x63redentials_type\x18\x01 \x01(\x0e\x32\x1b.meadowrun.Credentials.Type\x12\x13\n\x0bsecret_name\x18\x02 \x01(\t*b\n\x0f\x45nvironmentType\x12\x14\n\x10\x45NV_TYPE_DEFAULT\x10\x00\x12\x12\n\x0e\x45NV_TYPE_CONDA\x10\x01\x12\x10\n\x0c\x45NV_TYPE_PIP\x10\x02\x12\x13\n\x0f\x45NV_TYPE_POETRY\x10\x03*z\n\x15\x45nvironmentFileFormat\x12\x1b\n\x17\x45NV_FILE_FORMAT_DEFAULT\x10\x00\x12$\n ENV_FILE_FORMAT_CONDA_ENV_EXPORT\x10\x01\x12\x1e\n\x1a\x45NV_FILE_FORMAT_CONDA_LIST\x10\x02\x62\x06proto3'
 )
 
 _ENVIRONMENTTYPE = DESCRIPTOR.enum_types_by_name["EnvironmentType"]
@@ -393,10 +393,10 @@ if _descriptor._USE_C_DESCRIPTORS == False:
     _ENVIRONMENTSPECINCODE_ADDITIONALSOFTWAREENTRY._serialized_options = b"8\001"
     _ENVIRONMENTSPEC_ADDITIONALSOFTWAREENTRY._options = None
     _ENVIRONMENTSPEC_ADDITIONALSOFTWAREENTRY._serialized_options = b"8\001"
-    _ENVIRONMENTTYPE._serialized_start = 4823
-    _ENVIRONMENTTYPE._serialized_end = 4921
-    _ENVIRONMENTFILEFORMAT._serialized_start = 4923
-    _ENVIRONMENTFILEFORMAT._serialized_end = 5045
+    _ENVIRONMENTTYPE._serialized_start = 4870
+    _ENVIRONMENTTYPE._serialized_end = 4968
+    _ENVIRONMENTFILEFORMAT._serialized_start = 4970
+    _ENVIRONMENTFILEFORMAT._serialized_end = 5092
     _STRINGPAIR._serialized_start = 40
     _STRINGPAIR._serialized_end = 80
     _SERVERAVAILABLEFOLDER._serialized_start = 82
@@ -436,29 +436,29 @@ if _descriptor._USE_C_DESCRIPTORS == False:
     _CONTAINERIMAGE._serialized_start = 1897
     _CONTAINERIMAGE._serialized_end = 2141
     _JOB._serialized_start = 2144
-    _JOB._serialized_end = 3261
-    _PROCESSSTATE._serialized_start = 3264
-    _PROCESSSTATE._serialized_end = 3738
-    _PROCESSSTATE_PROCESSSTATEENUM._serialized_start = 3493
-    _PROCESSSTATE_PROCESSSTATEENUM._serialized_end = 3738
-    _JOBSTATEUPDATE._serialized_start = 3740
-    _JOBSTATEUPDATE._serialized_end = 3820
-    _GRIDTASKSTATERESPONSE._serialized_start = 3822
-    _GRIDTASKSTATERESPONSE._serialized_end = 3927
-    _CREDENTIALSSOURCEMESSAGE._serialized_start = 3930
-    _CREDENTIALSSOURCEMESSAGE._serialized_end = 4266
-    _CREDENTIALS._serialized_start = 4269
-    _CREDENTIALS._serialized_end = 4418
-    _CREDENTIALS_SERVICE._serialized_start = 4305
-    _CREDENTIALS_SERVICE._serialized_end = 4356
-    _CREDENTIALS_TYPE._serialized_start = 4358
-    _CREDENTIALS_TYPE._serialized_end = 4418
-    _AWSSECRETPROTO._serialized_start = 4420
-    _AWSSECRETPROTO._serialized_end = 4512
-    _AZURESECRETPROTO._serialized_start = 4514
-    _AZURESECRETPROTO._serialized_end = 4628
-    _SERVERAVAILABLEFILE._serialized_start = 4630
-    _SERVERAVAILABLEFILE._serialized_end = 4720
-    _KUBERNETESSECRETPROTO._serialized_start = 4722
-    _KUBERNETESSECRETPROTO._serialized_end = 4821
+    _JOB._serialized_end = 3282
+    _PROCESSSTATE._serialized_start = 3285
+    _PROCESSSTATE._serialized_end = 3785
+    _PROCESSSTATE_PROCESSSTATEENUM._serialized_start = 3540
+    _PROCESSSTATE_PROCESSSTATEENUM._serialized_end = 3785
+    _JOBSTATEUPDATE._serialized_start = 3787
+    _JOBSTATEUPDATE._serialized_end = 3867
+    _GRIDTASKSTATERESPONSE._serialized_start = 3869
+    _GRIDTASKSTATERESPONSE._serialized_end = 3974
+    _CREDENTIALSSOURCEMESSAGE._serialized_start = 3977
+    _CREDENTIALSSOURCEMESSAGE._serialized_end = 4313
+    _CREDENTIALS._serialized_start = 4316
+    _CREDENTIALS._serialized_end = 4465
+    _CREDENTIALS_SERVICE._serialized_start = 4352
+    _CREDENTIALS_SERVICE._serialized_end = 4403
+    _CREDENTIALS_TYPE._serialized_start = 4405
+    _CREDENTIALS_TYPE._serialized_end = 4465
+    _AWSSECRETPROTO._serialized_start = 4467
+    _AWSSECRETPROTO._serialized_end = 4559
+    _AZURESECRETPROTO._serialized_start = 4561
+    _AZURESECRETPROTO._serialized_end = 4675
+    _SERVERAVAILABLEFILE._serialized_start = 4677
+    _SERVERAVAILABLEFILE._serialized_end = 4767
+    _KUBERNETESSECRETPROTO._serialized_start = 4769
+    _KUBERNETESSECRETPROTO._serialized_end = 4868
 # @@protoc_insertion_point(module_scope)
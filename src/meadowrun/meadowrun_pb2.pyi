@@ -787,6 +787,7 @@ class Job(google.protobuf.message.Message):
     CREDENTIALS_SOURCES_FIELD_NUMBER: builtins.int
     PORTS_FIELD_NUMBER: builtins.int
     USES_GPU_FIELD_NUMBER: builtins.int
+    COMPRESSION_FIELD_NUMBER: builtins.int
     base_job_id: builtins.str
     job_friendly_name: builtins.str
     @property
@@ -851,6 +852,11 @@ class Job(google.protobuf.message.Message):
         builtins.str
     ]: ...
     uses_gpu: builtins.bool
+    compression: builtins.str
+    """Only used for py_agent jobs. If this is set to "zstd" or "lz4", task arguments and
+    results are compressed with that codec, see compression.py. Empty means no
+    compression.
+    """
     def __init__(
         self,
         *,
@@ -878,6 +884,7 @@ class Job(google.protobuf.message.Message):
         | None = ...,
         ports: collections.abc.Iterable[builtins.str] | None = ...,
         uses_gpu: builtins.bool = ...,
+        compression: builtins.str = ...,
     ) -> None: ...
     def HasField(
         self,
@@ -925,6 +932,8 @@ class Job(google.protobuf.message.Message):
             b"code_deployment",
             "code_zip_file",
             b"code_zip_file",
+            "compression",
+            b"compression",
             "container_at_digest",
             b"container_at_digest",
             "container_at_tag",
@@ -1138,6 +1147,7 @@ class ProcessState(google.protobuf.message.Message):
     RETURN_CODE_FIELD_NUMBER: builtins.int
     MAX_MEMORY_USED_GB_FIELD_NUMBER: builtins.int
     WAS_OOM_KILLED_FIELD_NUMBER: builtins.int
+    DURATION_SECONDS_FIELD_NUMBER: builtins.int
     state: global___ProcessState.ProcessStateEnum.ValueType
     pid: builtins.int
     container_id: builtins.str
@@ -1146,6 +1156,10 @@ class ProcessState(google.protobuf.message.Message):
     return_code: builtins.int
     max_memory_used_gb: builtins.float
     was_oom_killed: builtins.bool
+    duration_seconds: builtins.float
+    """(run_map only) How long the task took to run on the task worker. Used for
+    speculative execution, see GridJobDriver
+    """
     def __init__(
         self,
         *,
@@ -1157,12 +1171,15 @@ class ProcessState(google.protobuf.message.Message):
         return_code: builtins.int = ...,
         max_memory_used_gb: builtins.float = ...,
         was_oom_killed: builtins.bool = ...,
+        duration_seconds: builtins.float = ...,
     ) -> None: ...
     def ClearField(
         self,
         field_name: typing_extensions.Literal[
             "container_id",
             b"container_id",
+            "duration_seconds",
+            b"duration_seconds",
             "log_file_name",
             b"log_file_name",
             "max_memory_used_gb",
@@ -0,0 +1,198 @@
+"""
+Support for the result_sink option of run_map. Instead of sending each task's result
+back to the client, the worker serializes the result (see ResultSink.format) and writes
+it to the host's storage bucket (see ResultSinkFunction), and only a small ResultHandle
+comes back. This is useful for maps that produce large arrays or dataframes that are
+consumed by another job or only need to be downloaded selectively.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import atexit
+import dataclasses
+import io
+import pickle
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    Generic,
+    Optional,
+    Tuple,
+    TypeVar,
+    TYPE_CHECKING,
+)
+
+if TYPE_CHECKING:
+    from typing_extensions import Literal
+
+    from meadowrun.abstract_storage_bucket import AbstractStorageBucket
+
+
+_T = TypeVar("_T")
+
+_RESULT_SINK_FORMATS = ("pickle", "npy", "parquet")
+
+
+@dataclasses.dataclass(frozen=True)
+class ResultSink:
+    """
+    Specifies that [run_map][meadowrun.run_map] should write the result of each task to
+    `{prefix}/{task_id}` in the host's storage bucket rather than returning it. run_map
+    will return a [ResultHandle][meadowrun.ResultHandle] for each task instead.
+
+    Attributes:
+        prefix: The prefix of the keys that the results will be written to in the
+            storage bucket, e.g. "my-job/results"
+        format: How results are serialized. "pickle" works for any result. "npy" saves
+            a numpy array via numpy.save and "parquet" saves a pandas DataFrame via
+            DataFrame.to_parquet, which means that the results can be read by other
+            tools. numpy or pandas (and a parquet engine like pyarrow) need to be
+            available in the environment that the tasks run in.
+
+    On AWS, the storage bucket is the meadowrun bucket, which has a bucket-wide
+    lifecycle rule that deletes every object 14 days after it's created (see
+    `meadowrun-manage-ec2 install`). This includes the results written by a ResultSink,
+    so they need to be copied elsewhere if they're needed for longer than that.
+    """
+
+    prefix: str
+    format: Literal["pickle", "npy", "parquet"] = "pickle"
+
+    def __post_init__(self) -> None:
+        if self.format not in _RESULT_SINK_FORMATS:
+            raise ValueError(
+                f"Unknown result sink format {self.format}, must be one of "
+                + ", ".join(_RESULT_SINK_FORMATS)
+            )
+        if not self.prefix.strip("/"):
+            raise ValueError("ResultSink.prefix must not be empty")
+
+    def key(self, task_id: int) -> str:
+        return f"{self.prefix.rstrip('/')}/{task_id}"
+
+
+@dataclasses.dataclass(frozen=True)
+class ResultHandle:
+    """
+    Identifies the result of a task that was written to a storage bucket because
+    [run_map][meadowrun.run_map] was called with a [ResultSink][meadowrun.ResultSink].
+
+    Attributes:
+        task_id: The index of the task in run_map's `args`
+        key: The key that the result was written to in the host's storage bucket
+        format: See ResultSink.format
+        size_bytes: The size of the serialized result
+    """
+
+    task_id: int
+    key: str
+    format: str
+    size_bytes: int
+
+    async def download(self, storage_bucket: AbstractStorageBucket) -> Any:
+        """
+        Downloads and deserializes the result. storage_bucket should usually be
+        `await host.get_storage_bucket()` for the host that run_map was called with.
+        """
+        return deserialize_result(await storage_bucket.get_bytes(self.key), self.format)
+
+
+def serialize_result(result: Any, format: str, pickle_protocol: int) -> bytes:
+    if format == "pickle":
+        return pickle.dumps(result, protocol=pickle_protocol)
+
+    buffer = io.BytesIO()
+    if format == "npy":
+        import numpy
+
+        numpy.save(buffer, result, allow_pickle=False)
+    elif format == "parquet":
+        result.to_parquet(buffer)
+    else:
+        raise ValueError(f"Unknown result sink format {format}")
+    return buffer.getvalue()
+
+
+def deserialize_result(data: bytes, format: str) -> Any:
+    if format == "pickle":
+        return pickle.loads(data)
+    if format == "npy":
+        import numpy
+
+        return numpy.load(io.BytesIO(data), allow_pickle=False)
+    if format == "parquet":
+        import pandas
+
+        return pandas.read_parquet(io.BytesIO(data))
+    raise ValueError(f"Unknown result sink format {format}")
+
+
+class ResultSinkFunction(Generic[_T]):
+    """
+    Wraps the user function so that it takes (task_id, arg), writes the result to the
+    storage bucket returned by get_storage_bucket, and returns a ResultHandle.
+    get_storage_bucket must be picklable, see Host._get_storage_bucket_for_workers.
+
+    Each worker process creates the storage bucket once (on its own event loop so that
+    the user function is still free to use asyncio.run) and reuses it for all of the
+    tasks it runs. The task worker doesn't tell the function when it's done, so the
+    storage bucket and event loop are closed at exit, see close.
+    """
+
+    def __init__(
+        self,
+        function: Callable[[_T], Any],
+        result_sink: ResultSink,
+        get_storage_bucket: Callable[[], Awaitable[AbstractStorageBucket]],
+        pickle_protocol: int,
+    ):
+        self._function = function
+        self._result_sink = result_sink
+        self._get_storage_bucket = get_storage_bucket
+        self._pickle_protocol = pickle_protocol
+        self._event_loop: Optional[asyncio.AbstractEventLoop] = None
+        self._storage_bucket: Optional[AbstractStorageBucket] = None
+
+    def __getstate__(self) -> Dict[str, Any]:
+        state = self.__dict__.copy()
+        state["_event_loop"] = None
+        state["_storage_bucket"] = None
+        return state
+
+    async def _write(self, data: bytes, key: str) -> None:
+        if self._storage_bucket is None:
+            self._storage_bucket = await (await self._get_storage_bucket()).__aenter__()
+        await self._storage_bucket.write_bytes(data, key)
+
+    def __call__(self, task: Tuple[int, _T]) -> ResultHandle:
+        task_id, arg = task
+        data = serialize_result(
+            self._function(arg), self._result_sink.format, self._pickle_protocol
+        )
+        key = self._result_sink.key(task_id)
+
+        if self._event_loop is None:
+            self._event_loop = asyncio.new_event_loop()
+            atexit.register(self.close)
+        self._event_loop.run_until_complete(self._write(data, key))
+
+        return ResultHandle(task_id, key, self._result_sink.format, len(data))
+
+    def close(self) -> None:
+        """Closes the storage bucket and event loop, if they've been created"""
+        if self._event_loop is None:
+            return
+
+        atexit.unregister(self.close)
+        try:
+            if self._storage_bucket is not None:
+                self._event_loop.run_until_complete(
+                    self._storage_bucket.__aexit__(None, None, None)
+                )
+        finally:
+            self._storage_bucket = None
+            self._event_loop.close()
+            self._event_loop = None
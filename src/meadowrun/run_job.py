@@ -26,6 +26,8 @@ from typing import (
 
 import cloudpickle
 
+from meadowrun.alloc_vm import AllocVM
+from meadowrun.compression import validate_compression
 from meadowrun.config import JOB_ID_VALID_CHARACTERS, MEADOWRUN_INTERPRETER
 from meadowrun.deployment_spec import (
     ContainerAtDigestInterpreter,
@@ -58,15 +60,25 @@ from meadowrun.meadowrun_pb2 import (
     ServerAvailableInterpreter,
     StringPair,
 )
+from meadowrun.result_sink import ResultSink, ResultSinkFunction
 from meadowrun.run_job_core import (
     Host,
     JobCompletion,
     Resources,
     TaskResult,
     WaitOption,
+    collect_run_map_results,
+    unpickle_task_results_in_threads,
 )
 from meadowrun.storage_grid_job import ensure_uploaded_incremental
 from meadowrun.storage_keys import STORAGE_CODE_CACHE_PREFIX
+from meadowrun.task_chunks import (
+    ChunkedFunction,
+    chunk_args,
+    get_chunk_size,
+    unpack_chunk_results,
+)
+from meadowrun.task_ordering import ordered_task_results
 
 if TYPE_CHECKING:
     from meadowrun.deployment_internal_types import (
@@ -76,6 +88,7 @@ if TYPE_CHECKING:
         VersionedInterpreterDeployment,
     )
     from meadowrun.credentials import CredentialsSourceForService
+    from typing_extensions import Literal
 
 _T = TypeVar("_T")
 _U = TypeVar("_U")
@@ -521,6 +534,13 @@ async def run_map(
     wait_for_result: bool = True,
     max_num_task_attempts: int = 1,
     retry_with_more_memory: bool = False,
+    compression: Optional[Literal["zstd", "lz4"]] = None,
+    speculative_execution_multiple: Optional[float] = None,
+    chunk_size: Union[int, Literal["auto"], None] = None,
+    num_unpickle_threads: Optional[int] = None,
+    result_sink: Optional[ResultSink] = None,
+    num_task_workers_per_agent: int = 1,
+    max_num_concurrent_tasks: Optional[int] = None,
 ) -> Optional[Sequence[_U]]:
     """
     Equivalent to `map(function, args)`, but runs distributed and in parallel.
@@ -559,11 +579,62 @@ async def run_map(
             used more than 95% of the requested memory, the task will be retried with
             more memory. Each attempt will be allocated (original requested memory) *
             (attempt number).
+        compression: If this is set to "zstd" or "lz4", task arguments and results
+            will be compressed with that codec, which can save time transferring large
+            but compressible arguments or results. Tiny or incompressible arguments and
+            results are not compressed. This requires the zstandard or lz4 package
+            respectively.
+        speculative_execution_multiple: If this is set (e.g. to 3), when there are idle
+            workers, tasks that have been running for longer than this multiple of the
+            median task duration will be started again on another worker, and whichever
+            attempt finishes first will be used. This means that a worker that is slow
+            for reasons unrelated to the task (e.g. a noisy neighbor) doesn't hold up
+            the whole map. Idle workers are kept around while the last tasks are
+            running so that they can run these duplicate attempts. Currently only
+            supported for AllocEC2Instance and AllocAzureVM.
+        chunk_size: If this is set, this many consecutive args are sent to a worker as a
+            single task, and the worker calls `function` on each of them in turn. This
+            reduces the per-task overhead, which can dominate for very short tasks. If
+            this is "auto", the chunk size is chosen so that each worker gets about 10
+            chunks. Results and exceptions are still reported for each arg. An arg that
+            raises an exception is retried immediately on the same worker (up to
+            max_num_task_attempts), and if a whole chunk fails (e.g. because the worker
+            ran out of memory), the whole chunk is retried.
+        num_unpickle_threads: If this is set, task results are unpickled (and
+            decompressed) on a pool of this many threads as they arrive, so that
+            unpickling large results overlaps with receiving further results. Otherwise,
+            each result is unpickled in the calling thread when it is first accessed.
+        result_sink: If this is set, each task's result is written by the worker to
+            the host's storage bucket (see [ResultSink][meadowrun.ResultSink]) rather
+            than being sent back, and run_map returns a
+            [ResultHandle][meadowrun.ResultHandle] for each task instead of the
+            results themselves. Currently only supported for AllocEC2Instance and
+            Kubernetes.
+        num_task_workers_per_agent: The number of processes that run tasks on each
+            worker. Each worker is an agent that gets tasks and sends them to its
+            task worker processes. If this is more than 1, we launch
+            ceil(num_concurrent_tasks / num_task_workers_per_agent) workers, each of
+            which requests num_task_workers_per_agent times resources_per_task, so
+            that num_concurrent_tasks is still the number of tasks that run at the
+            same time. This saves the per-worker overhead (e.g. starting the agent
+            and setting up the deployment) for each additional task process.
+        max_num_concurrent_tasks: A cost ceiling for adding workers while the map is
+            running. Workers are added to a queue of tasks whose backlog would take a
+            long time to finish with its current workers, e.g. tasks retried with more
+            memory because of retry_with_more_memory, but never so many that more than
+            max_num_concurrent_tasks tasks could run at the same time. A task retried
+            with n times the original memory counts as n tasks. Defaults to
+            num_concurrent_tasks, which means that workers are only added as other
+            queues need fewer workers, so there are never more workers for the
+            original tasks than we start with. Set this higher to let the number of
+            workers grow when tasks take longer than expected. Currently only used by
+            AllocEC2Instance and AllocAzureVM.
 
     Returns:
         If wait_for_result is True (which is the default), the return value will be the
-            result of running `function` on each of `args`. If wait_for_result is False,
-            the return value will always be None.
+            result of running `function` on each of `args` (or a ResultHandle for each
+            task if result_sink is set). If wait_for_result is False, the return value
+            will always be None.
     """
 
     if not num_concurrent_tasks:
@@ -582,6 +653,34 @@ async def run_map(
     )
     job_fields["job_friendly_name"] = _get_friendly_name(function)
     job_fields["ports"] = _prepare_ports(ports)
+    validate_compression(compression or "")
+    job_fields["compression"] = compression or ""
+    if (
+        speculative_execution_multiple is not None
+        and speculative_execution_multiple <= 1
+    ):
+        raise ValueError("speculative_execution_multiple must be greater than 1")
+    if num_task_workers_per_agent < 1:
+        raise ValueError("num_task_workers_per_agent must be at least 1")
+    if max_num_concurrent_tasks is not None and max_num_concurrent_tasks < 1:
+        raise ValueError("max_num_concurrent_tasks must be at least 1")
+
+    map_function: Callable[[Any], Any] = function
+    map_args: Sequence[Any] = args
+    if result_sink is not None:
+        map_function = ResultSinkFunction(
+            function,
+            result_sink,
+            host._get_storage_bucket_for_workers(),
+            pickle_protocol,
+        )
+        map_args = list(enumerate(args))
+
+    if chunk_size is not None:
+        chunk_size = get_chunk_size(chunk_size, len(args), num_concurrent_tasks)
+        map_function = ChunkedFunction(map_function, max_num_task_attempts)
+        map_args = chunk_args(map_args, chunk_size)
+        num_concurrent_tasks = min(num_concurrent_tasks, len(map_args))
 
     if not wait_for_result:
         wait_option = WaitOption.DO_NOT_WAIT
@@ -590,6 +689,30 @@ async def run_map(
     else:
         wait_option = WaitOption.WAIT_SILENTLY
 
+    if (
+        chunk_size is not None
+        or num_unpickle_threads is not None
+        or result_sink is not None
+    ):
+        task_results: AsyncIterable[TaskResult[Any]] = host.run_map_as_completed(
+            map_function,
+            map_args,
+            resources_per_task.to_internal_or_none(),
+            job_fields,
+            num_concurrent_tasks,
+            pickle_protocol,
+            wait_option,
+            max_num_task_attempts,
+            retry_with_more_memory,
+            speculative_execution_multiple,
+            num_task_workers_per_agent,
+            max_num_concurrent_tasks,
+        )
+        task_results = _maybe_unpickle_in_threads(task_results, num_unpickle_threads)
+        if chunk_size is not None:
+            task_results = unpack_chunk_results(task_results, chunk_size, len(args))
+        return await collect_run_map_results(task_results, args, wait_option)
+
     return await host.run_map(
         function,
         args,
@@ -600,12 +723,15 @@ async def run_map(
         wait_option,
         max_num_task_attempts,
         retry_with_more_memory,
+        speculative_execution_multiple,
+        num_task_workers_per_agent,
+        max_num_concurrent_tasks,
     )
 
 
 async def run_map_as_completed(
     function: Callable[[_T], _U],
-    args: Sequence[_T],
+    args: Union[Sequence[_T], Iterable[_T], AsyncIterable[_T]],
     host: Host,
     resources_per_task: Optional[Resources] = None,
     deployment: Union[Deployment, Awaitable[Deployment], None] = None,
@@ -616,6 +742,12 @@ async def run_map_as_completed(
     ports: Union[Iterable[str], str, Iterable[int], int, None] = None,
     max_num_task_attempts: int = 1,
     retry_with_more_memory: bool = False,
+    compression: Optional[Literal["zstd", "lz4"]] = None,
+    speculative_execution_multiple: Optional[float] = None,
+    chunk_size: Union[int, Literal["auto"], None] = None,
+    num_unpickle_threads: Optional[int] = None,
+    num_task_workers_per_agent: int = 1,
+    max_num_concurrent_tasks: Optional[int] = None,
 ) -> AsyncIterable[TaskResult[_U]]:
     """
     Equivalent to [run_map][meadowrun.run_map], but returns results from tasks as they
@@ -637,11 +769,25 @@ async def run_map_as_completed(
     corresponding to how the `args` parameter was ordered, whereas
     `run_map_as_completed` returns results as they complete. For simple use cases.
 
+    Results are only unpickled when `result` is first accessed. This means that if a
+    task's result cannot be unpickled (e.g. because it depends on a library that is only
+    available on the remote side), its TaskResult still has `is_success` set to True,
+    and accessing `result` (or calling `result_or_raise`) raises a TaskException. If
+    num_unpickle_threads is set, results are unpickled as they arrive, and these tasks
+    are instead returned as failed TaskResults with state RESULT_CANNOT_BE_UNPICKLED.
+
     Args:
         function: A reference to a function (e.g. `package.module.function_name`) or a
             lambda
         args: A list of objects, each item in the list represents a "task",
-            where each "task" is an invocation of `function` on the item in the list
+            where each "task" is an invocation of `function` on the item in the list.
+            This can also be an iterator or async iterator, e.g. for a large parameter
+            sweep that doesn't fit in memory. In that case, num_concurrent_tasks must
+            be specified, chunk_size is not supported, and for AllocEC2Instance and
+            AllocAzureVM, args are only consumed as workers finish tasks, so that the
+            whole list of args is never in memory at once (although AllocAzureVM keeps
+            args in memory in case they need to be retried). Other hosts read all of
+            the args before starting.
         resources_per_task: The resources (e.g. CPU and RAM) required to run a
             single task. For some hosts, this is optional, for other hosts it is
             required. See [Resources][meadowrun.Resources].
@@ -668,12 +814,65 @@ async def run_map_as_completed(
             used more than 95% of the requested memory, the task will be retried with
             more memory. Each attempt will be allocated (original requested memory) *
             (attempt number).
+        compression: If this is set to "zstd" or "lz4", task arguments and results
+            will be compressed with that codec, which can save time transferring large
+            but compressible arguments or results. Tiny or incompressible arguments and
+            results are not compressed. This requires the zstandard or lz4 package
+            respectively.
+        speculative_execution_multiple: If this is set (e.g. to 3), when there are idle
+            workers, tasks that have been running for longer than this multiple of the
+            median task duration will be started again on another worker, and whichever
+            attempt finishes first will be used. This means that a worker that is slow
+            for reasons unrelated to the task (e.g. a noisy neighbor) doesn't hold up
+            the whole map. Idle workers are kept around while the last tasks are
+            running so that they can run these duplicate attempts. Currently only
+            supported for AllocEC2Instance and AllocAzureVM.
+        chunk_size: If this is set, this many consecutive args are sent to a worker as a
+            single task, and the worker calls `function` on each of them in turn. This
+            reduces the per-task overhead, which can dominate for very short tasks. If
+            this is "auto", the chunk size is chosen so that each worker gets about 10
+            chunks. Results and exceptions are still reported for each arg. An arg that
+            raises an exception is retried immediately on the same worker (up to
+            max_num_task_attempts), and if a whole chunk fails (e.g. because the worker
+            ran out of memory), the whole chunk is retried.
+        num_unpickle_threads: If this is set, task results are unpickled (and
+            decompressed) on a pool of this many threads as they arrive, so that
+            unpickling large results overlaps with receiving further results. Otherwise,
+            each result is unpickled in the calling thread when it is first accessed.
+        num_task_workers_per_agent: The number of processes that run tasks on each
+            worker. Each worker is an agent that gets tasks and sends them to its
+            task worker processes. If this is more than 1, we launch
+            ceil(num_concurrent_tasks / num_task_workers_per_agent) workers, each of
+            which requests num_task_workers_per_agent times resources_per_task, so
+            that num_concurrent_tasks is still the number of tasks that run at the
+            same time. This saves the per-worker overhead (e.g. starting the agent
+            and setting up the deployment) for each additional task process.
+        max_num_concurrent_tasks: A cost ceiling for adding workers while the map is
+            running. Workers are added to a queue of tasks whose backlog would take a
+            long time to finish with its current workers, e.g. tasks retried with more
+            memory because of retry_with_more_memory, but never so many that more than
+            max_num_concurrent_tasks tasks could run at the same time. A task retried
+            with n times the original memory counts as n tasks. Defaults to
+            num_concurrent_tasks, which means that workers are only added as other
+            queues need fewer workers, so there are never more workers for the
+            original tasks than we start with. Set this higher to let the number of
+            workers grow when tasks take longer than expected. Currently only used by
+            AllocEC2Instance and AllocAzureVM.
 
     Returns:
         An async iterable returning [TaskResult][meadowrun.TaskResult] objects.
     """
 
-    if not num_concurrent_tasks:
+    lazy_args: Optional[AsyncIterable[_T]] = None
+    if not isinstance(args, Sequence):
+        if not num_concurrent_tasks:
+            raise ValueError(
+                "num_concurrent_tasks must be specified if args is an iterator"
+            )
+        if chunk_size is not None:
+            raise ValueError("chunk_size is not supported if args is an iterator")
+        lazy_args = _as_async_iterable(args)
+    elif not num_concurrent_tasks:
         num_concurrent_tasks = len(args) // 2 + 1
     else:
         num_concurrent_tasks = min(num_concurrent_tasks, len(args))
@@ -690,20 +889,184 @@ async def run_map_as_completed(
     )
     job_fields["job_friendly_name"] = friendly_name
     job_fields["ports"] = _prepare_ports(ports)
+    validate_compression(compression or "")
+    job_fields["compression"] = compression or ""
+    if (
+        speculative_execution_multiple is not None
+        and speculative_execution_multiple <= 1
+    ):
+        raise ValueError("speculative_execution_multiple must be greater than 1")
+    if num_task_workers_per_agent < 1:
+        raise ValueError("num_task_workers_per_agent must be at least 1")
+    if max_num_concurrent_tasks is not None and max_num_concurrent_tasks < 1:
+        raise ValueError("max_num_concurrent_tasks must be at least 1")
+
+    if lazy_args is not None:
+        if isinstance(host, AllocVM):
+            return _maybe_unpickle_in_threads(
+                host.run_map_as_completed(
+                    function,
+                    lazy_args,
+                    resources_per_task.to_internal_or_none(),
+                    job_fields,
+                    num_concurrent_tasks,
+                    pickle_protocol,
+                    wait_for_result=WaitOption.WAIT_SILENTLY,
+                    max_num_task_attempts=max_num_task_attempts,
+                    retry_with_more_memory=retry_with_more_memory,
+                    speculative_execution_multiple=speculative_execution_multiple,
+                    num_task_workers_per_agent=num_task_workers_per_agent,
+                    max_num_concurrent_tasks=max_num_concurrent_tasks,
+                ),
+                num_unpickle_threads,
+            )
 
-    return host.run_map_as_completed(
-        function,
-        args,
-        resources_per_task.to_internal_or_none(),
-        job_fields,
-        num_concurrent_tasks,
-        pickle_protocol,
-        wait_for_result=WaitOption.WAIT_SILENTLY,
-        max_num_task_attempts=max_num_task_attempts,
-        retry_with_more_memory=retry_with_more_memory,
+        # other hosts need all of the args up front
+        args = [arg async for arg in lazy_args]
+        num_concurrent_tasks = min(num_concurrent_tasks, len(args))
+    assert isinstance(args, Sequence)
+
+    if chunk_size is not None:
+        chunk_size = get_chunk_size(chunk_size, len(args), num_concurrent_tasks)
+        chunks = chunk_args(args, chunk_size)
+        return unpack_chunk_results(
+            _maybe_unpickle_in_threads(
+                host.run_map_as_completed(
+                    ChunkedFunction(function, max_num_task_attempts),
+                    chunks,
+                    resources_per_task.to_internal_or_none(),
+                    job_fields,
+                    min(num_concurrent_tasks, len(chunks)),
+                    pickle_protocol,
+                    wait_for_result=WaitOption.WAIT_SILENTLY,
+                    max_num_task_attempts=max_num_task_attempts,
+                    retry_with_more_memory=retry_with_more_memory,
+                    speculative_execution_multiple=speculative_execution_multiple,
+                    num_task_workers_per_agent=num_task_workers_per_agent,
+                    max_num_concurrent_tasks=max_num_concurrent_tasks,
+                ),
+                num_unpickle_threads,
+            ),
+            chunk_size,
+            len(args),
+        )
+
+    return _maybe_unpickle_in_threads(
+        host.run_map_as_completed(
+            function,
+            args,
+            resources_per_task.to_internal_or_none(),
+            job_fields,
+            num_concurrent_tasks,
+            pickle_protocol,
+            wait_for_result=WaitOption.WAIT_SILENTLY,
+            max_num_task_attempts=max_num_task_attempts,
+            retry_with_more_memory=retry_with_more_memory,
+            speculative_execution_multiple=speculative_execution_multiple,
+            num_task_workers_per_agent=num_task_workers_per_agent,
+            max_num_concurrent_tasks=max_num_concurrent_tasks,
+        ),
+        num_unpickle_threads,
     )
 
 
+async def run_map_ordered(
+    function: Callable[[_T], _U],
+    args: Union[Sequence[_T], Iterable[_T], AsyncIterable[_T]],
+    host: Host,
+    resources_per_task: Optional[Resources] = None,
+    deployment: Union[Deployment, Awaitable[Deployment], None] = None,
+    num_concurrent_tasks: Optional[int] = None,
+    sidecar_containers: Union[
+        Iterable[ContainerInterpreterBase], ContainerInterpreterBase, None
+    ] = None,
+    ports: Union[Iterable[str], str, Iterable[int], int, None] = None,
+    max_num_task_attempts: int = 1,
+    retry_with_more_memory: bool = False,
+    compression: Optional[Literal["zstd", "lz4"]] = None,
+    speculative_execution_multiple: Optional[float] = None,
+    chunk_size: Union[int, Literal["auto"], None] = None,
+    num_unpickle_threads: Optional[int] = None,
+    max_results_in_memory: int = 1000,
+    num_task_workers_per_agent: int = 1,
+    max_num_concurrent_tasks: Optional[int] = None,
+) -> AsyncIterable[TaskResult[_U]]:
+    """
+    Equivalent to [run_map_as_completed][meadowrun.run_map_as_completed], but returns
+    results in the same order as `args`. Each result is returned as soon as it and all
+    of the results before it are available, so, unlike [run_map][meadowrun.run_map],
+    results can be processed while later tasks are still running, and the results of
+    the whole map never need to be in memory at the same time:
+
+    ```python
+    async for task in await run_map_ordered(...):
+        process(task.result_or_raise())
+    ```
+
+    Results that complete before earlier results are buffered. Up to
+    `max_results_in_memory` of them are kept in memory, and the rest are written to a
+    temporary file until they're needed. If some tasks never return a result (e.g.
+    because all of the workers failed), the remaining results are returned in order at
+    the end, skipping the missing tasks.
+
+    Args:
+        max_results_in_memory: The maximum number of out-of-order results to keep in
+            memory before writing them to disk.
+
+        All other arguments are the same as for
+        [run_map_as_completed][meadowrun.run_map_as_completed].
+
+    Returns:
+        An async iterable returning [TaskResult][meadowrun.TaskResult] objects in
+            `task_id` order.
+    """
+    if max_results_in_memory < 1:
+        raise ValueError("max_results_in_memory must be at least 1")
+
+    return ordered_task_results(
+        await run_map_as_completed(
+            function,
+            args,
+            host,
+            resources_per_task,
+            deployment,
+            num_concurrent_tasks,
+            sidecar_containers,
+            ports,
+            max_num_task_attempts,
+            retry_with_more_memory,
+            compression,
+            speculative_execution_multiple,
+            chunk_size,
+            num_unpickle_threads,
+            num_task_workers_per_agent,
+            max_num_concurrent_tasks,
+        ),
+        max_results_in_memory,
+    )
+
+
+def _maybe_unpickle_in_threads(
+    task_results: AsyncIterable[TaskResult[_U]], num_unpickle_threads: Optional[int]
+) -> AsyncIterable[TaskResult[_U]]:
+    if num_unpickle_threads is None:
+        return task_results
+    return unpickle_task_results_in_threads(task_results, num_unpickle_threads)
+
+
+def _as_async_iterable(
+    args: Union[Iterable[_T], AsyncIterable[_T]]
+) -> AsyncIterable[_T]:
+    if isinstance(args, AsyncIterable):
+        return args
+
+    async def iterate() -> AsyncIterable[_T]:
+        for arg in args:
+            yield arg
+
+    return iterate()
+
+
 def _job_field_for_code_deployment(
     code_deployment: Union[CodeDeployment, VersionedCodeDeployment],
 ) -> str:
@@ -5,6 +5,7 @@ from __future__ import annotations
 
 import abc
 import asyncio
+import concurrent.futures
 import dataclasses
 import enum
 import pickle
@@ -13,6 +14,7 @@ from typing import (
     TYPE_CHECKING,
     Any,
     AsyncIterable,
+    AsyncIterator,
     Awaitable,
     Callable,
     Dict,
@@ -21,6 +23,7 @@ from typing import (
     List,
     Optional,
     Sequence,
+    Set,
     Tuple,
     Type,
     TypeVar,
@@ -31,6 +34,7 @@ import asyncssh
 from typing_extensions import Literal
 
 import meadowrun.ssh as ssh
+from meadowrun.compression import loads_payload
 from meadowrun.instance_selection import ResourcesInternal
 from meadowrun.meadowrun_pb2 import Job, ProcessState
 from meadowrun.shared import unpickle_exception
@@ -169,6 +173,9 @@ class Host(abc.ABC):
         wait_for_result: WaitOption,
         max_num_task_attempts: int,
         retry_with_more_memory: bool,
+        speculative_execution_multiple: Optional[float],
+        num_task_workers_per_agent: int,
+        max_num_concurrent_tasks: Optional[int],
     ) -> Optional[Sequence[_U]]:
         async_iterator = self.run_map_as_completed(
             function,
@@ -180,31 +187,11 @@ class Host(abc.ABC):
             wait_for_result,
             max_num_task_attempts,
             retry_with_more_memory,
+            speculative_execution_multiple,
+            num_task_workers_per_agent,
+            max_num_concurrent_tasks,
         )
-
-        if wait_for_result == WaitOption.DO_NOT_WAIT:
-            # we still need to iterate, even though no values are returned, to execute
-            # the rest of the code in the iterator.
-            async for _ in async_iterator:
-                pass
-            return None
-        else:
-            task_results: List[TaskResult] = []
-
-            # TODO - this will wait forever if any tasks are missing
-            async for task_result in async_iterator:
-                task_results.append(task_result)
-
-            task_results.sort(key=lambda tr: tr.task_id)
-
-            # if tasks were None, we'd have throw already
-            failed_tasks = [result for result in task_results if not result.is_success]
-            if failed_tasks:
-                raise RunMapTasksFailedException(
-                    failed_tasks, [args[task.task_id] for task in failed_tasks]
-                )
-
-            return [result.result for result in task_results]  # type: ignore[misc]
+        return await collect_run_map_results(async_iterator, args, wait_for_result)
 
     @abc.abstractmethod
     def run_map_as_completed(
@@ -218,6 +205,9 @@ class Host(abc.ABC):
         wait_for_result: WaitOption,
         max_num_task_attempts: int,
         retry_with_more_memory: bool,
+        speculative_execution_multiple: Optional[float],
+        num_task_workers_per_agent: int,
+        max_num_concurrent_tasks: Optional[int],
     ) -> AsyncIterable[TaskResult[_U]]:
         pass
 
@@ -225,6 +215,128 @@ class Host(abc.ABC):
     async def get_storage_bucket(self) -> AbstractStorageBucket:
         pass
 
+    def _get_storage_bucket_for_workers(
+        self,
+    ) -> Callable[[], Awaitable[AbstractStorageBucket]]:
+        """
+        Returns a picklable function that workers can call to get the same storage
+        bucket that get_storage_bucket returns on the client. Used by run_map's
+        result_sink option, see ResultSinkFunction.
+        """
+        raise NotImplementedError(
+            f"result_sink is not supported for {type(self).__name__}"
+        )
+
+
+async def collect_run_map_results(
+    async_iterator: AsyncIterable[TaskResult[_U]],
+    args: Sequence[_T],
+    wait_for_result: WaitOption,
+) -> Optional[Sequence[_U]]:
+    """
+    Implements run_map on top of the results of run_map_as_completed: returns the
+    results in the same order as args, or raises RunMapTasksFailedException if any tasks
+    failed
+    """
+    if wait_for_result == WaitOption.DO_NOT_WAIT:
+        # we still need to iterate, even though no values are returned, to execute
+        # the rest of the code in the iterator.
+        async for _ in async_iterator:
+            pass
+        return None
+    else:
+        # we only keep the results themselves (and the TaskResults of failed tasks)
+        # rather than every TaskResult, so that we don't hold on to more than we need
+        # for large maps
+        results: List[Optional[_U]] = [None] * len(args)
+        failed_tasks: List[TaskResult] = []
+
+        # TODO - this will wait forever if any tasks are missing
+        async for task_result in async_iterator:
+            if task_result.is_success:
+                unpickling_failure = task_result._unpickling_failure()
+                if unpickling_failure is None:
+                    results[task_result.task_id] = task_result.result
+                else:
+                    failed_tasks.append(unpickling_failure)
+            else:
+                failed_tasks.append(task_result)
+
+        if failed_tasks:
+            failed_tasks.sort(key=lambda tr: tr.task_id)
+            raise RunMapTasksFailedException(
+                failed_tasks, [args[task.task_id] for task in failed_tasks]
+            )
+
+        return results  # type: ignore[return-value]
+
+
+def _unpickle_task_result(task_result: TaskResult[_U]) -> TaskResult[_U]:
+    # we're unpickling eagerly anyway, so report results that can't be unpickled as
+    # failed tasks
+    return task_result._unpickling_failure() or task_result
+
+
+async def _next_or_done(iterator: AsyncIterator[_T]) -> Tuple[bool, Optional[_T]]:
+    try:
+        return False, await iterator.__anext__()
+    except StopAsyncIteration:
+        return True, None
+
+
+async def unpickle_task_results_in_threads(
+    task_results: AsyncIterable[TaskResult[_U]], num_threads: int
+) -> AsyncIterable[TaskResult[_U]]:
+    """
+    Unpickles the results of task_results (e.g. from run_map_as_completed) on a pool of
+    num_threads threads, so that unpickling (and decompressing) large results overlaps
+    with receiving further results rather than stalling the loop that receives them.
+    Results that can't be unpickled are replaced with failed TaskResults with state
+    RESULT_CANNOT_BE_UNPICKLED.
+    Yields the TaskResults as they finish unpickling, so this can change the order of
+    task_results. At most 2 * num_threads results are unpickled or waiting to be
+    unpickled at a time.
+    """
+    if num_threads < 1:
+        raise ValueError("num_threads must be at least 1")
+
+    loop = asyncio.get_running_loop()
+    iterator = task_results.__aiter__()
+    next_task: Optional[asyncio.Task[Tuple[bool, Optional[TaskResult[_U]]]]] = None
+    unpickling: Set[asyncio.Future[TaskResult[_U]]] = set()
+    iterator_done = False
+    with concurrent.futures.ThreadPoolExecutor(num_threads) as executor:
+        try:
+            while not iterator_done or unpickling:
+                if (
+                    not iterator_done
+                    and next_task is None
+                    and len(unpickling) < 2 * num_threads
+                ):
+                    next_task = asyncio.create_task(_next_or_done(iterator))
+
+                done, _ = await asyncio.wait(
+                    unpickling if next_task is None else unpickling | {next_task},
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+
+                if next_task is not None and next_task in done:
+                    iterator_done, task_result = next_task.result()
+                    next_task = None
+                    if task_result is not None:
+                        unpickling.add(
+                            loop.run_in_executor(
+                                executor, _unpickle_task_result, task_result
+                            )
+                        )
+
+                for future in unpickling.intersection(done):
+                    unpickling.remove(future)
+                    yield future.result()
+        finally:
+            if next_task is not None:
+                next_task.cancel()
+
 
 class SshHost(Host):
     """
@@ -424,6 +536,9 @@ class SshHost(Host):
         wait_for_result: WaitOption,
         max_num_task_attempts: int,
         retry_with_more_memory: bool,
+        speculative_execution_multiple: Optional[float],
+        num_task_workers_per_agent: int,
+        max_num_concurrent_tasks: Optional[int],
     ) -> Optional[Sequence[_U]]:
         raise NotImplementedError("run_map is not implemented for SshHost")
 
@@ -438,6 +553,9 @@ class SshHost(Host):
         wait_for_result: WaitOption,
         max_num_task_attempts: int,
         retry_with_more_memory: bool,
+        speculative_execution_multiple: Optional[float],
+        num_task_workers_per_agent: int,
+        max_num_concurrent_tasks: Optional[int],
     ) -> AsyncIterable[TaskResult[_U]]:
         raise NotImplementedError("run_map_as_completed is not implemented for SshHost")
 
@@ -519,11 +637,43 @@ class TaskException(Exception):
     pass
 
 
+class _LazyResult:
+    """
+    The descriptor for TaskResult.result, which unpickles the result of a successful
+    task when it's first accessed, see TaskResult._unpickle. The field is excluded from
+    the dataclass's __repr__, __eq__ and __hash__ so that those never unpickle the
+    result (or raise if it can't be unpickled).
+    """
+
+    def __get__(self, instance: Optional[TaskResult], owner: Any) -> Any:
+        if instance is None:
+            return self
+        instance._unpickle()
+        unpickle_exception = instance.__dict__.get("_unpickle_exception")
+        if unpickle_exception is not None:
+            raise TaskException(*unpickle_exception)
+        return instance.__dict__["_result"]
+
+    def __set__(self, instance: TaskResult, value: Any) -> None:
+        if value is self:
+            # the dataclass passes the field's default, i.e. this descriptor, to
+            # __init__ when result isn't specified
+            value = None
+        instance.__dict__["_result"] = value
+
+
 @dataclasses.dataclass(frozen=True)
 class TaskResult(Generic[_T]):
     """
     The result of a [run_map_as_completed][meadowrun.run_map_as_completed] task.
 
+    The result of a successful task is only unpickled when `result` (or
+    `result_or_raise`) is first accessed, so that large results that the caller doesn't
+    need are never unpickled. If the result cannot be unpickled, e.g. because it depends
+    on a library that is only available on the remote side, accessing `result` raises a
+    TaskException (and `run_map` reports the task as failed with state
+    RESULT_CANNOT_BE_UNPICKLED).
+
     Attributes:
         task_id: The index of the task as it was originally passed to
             `run_map_as_completed`.
@@ -540,11 +690,58 @@ class TaskResult(Generic[_T]):
     task_id: int
     is_success: bool
     state: str
-    result: Optional[_T] = None
+    result: Optional[_T] = dataclasses.field(
+        default=_LazyResult(), repr=False, compare=False  # type: ignore[assignment]
+    )
     exception: Optional[Tuple[str, str, str]] = None
     attempt: int = 1
     log_file_name: str = ""
 
+    def _unpickle(self) -> None:
+        """
+        Unpickles the result if that hasn't happened yet. If the result cannot be
+        unpickled, the exception is kept and raised whenever result is accessed.
+
+        The (possibly compressed) pickled result is set by from_process_state. This
+        bypasses the dataclass's frozen-ness, but is not observable from the outside.
+        """
+        pickled_result = self.__dict__.get("_pickled_result")
+        if pickled_result is None:
+            return
+
+        try:
+            self.__dict__["_result"] = loads_payload(pickled_result)
+        except asyncio.CancelledError:
+            raise
+        except BaseException as e:
+            # the task was successful but now the result cannot be unpickled. This is
+            # usually because there is a dependency available on the remote side that
+            # is not available locally.
+            self.__dict__["_unpickle_exception"] = (
+                str(type(e)),
+                f"The result of task {self.task_id} cannot be unpickled: {e}",
+                traceback.format_exc(),
+            )
+        del self.__dict__["_pickled_result"]
+
+    def _unpickling_failure(self) -> Optional[TaskResult]:
+        """
+        If the result cannot be unpickled, returns an equivalent failed TaskResult with
+        state RESULT_CANNOT_BE_UNPICKLED, e.g. for RunMapTasksFailedException
+        """
+        self._unpickle()
+        unpickle_exception = self.__dict__.get("_unpickle_exception")
+        if unpickle_exception is None:
+            return None
+        return TaskResult(
+            self.task_id,
+            is_success=False,
+            state="RESULT_CANNOT_BE_UNPICKLED",
+            exception=unpickle_exception,
+            attempt=self.attempt,
+            log_file_name=self.log_file_name,
+        )
+
     def _log_file_and_exception_traceback(self) -> str:
         if self.exception is None:
             return self.log_file_name
@@ -554,32 +751,16 @@ class TaskResult(Generic[_T]):
     @staticmethod
     def from_process_state(task: TaskProcessState) -> TaskResult:
         if task.result.state == ProcessState.ProcessStateEnum.SUCCEEDED:
-            try:
-                unpickled_result = pickle.loads(task.result.pickled_result)
-            except asyncio.CancelledError:
-                raise
-            except BaseException as e:
-                # the task was successful but now the result cannot be unpickled. This
-                # is usually because there is a dependency available on the remote side
-                # that is not available locally.
-                return TaskResult(
-                    task.task_id,
-                    is_success=False,
-                    state="RESULT_CANNOT_BE_UNPICKLED",
-                    exception=(str(type(e)), str(e), traceback.format_exc()),
-                    result=task.result.pickled_result,
-                    attempt=task.attempt,
-                    log_file_name=task.result.log_file_name,
-                )
-
-            return TaskResult(
+            task_result: TaskResult = TaskResult(
                 task.task_id,
                 is_success=True,
                 state=ProcessState.ProcessStateEnum.Name(task.result.state),
-                result=unpickled_result,
                 attempt=task.attempt,
                 log_file_name=task.result.log_file_name,
             )
+            # unpickling is deferred until the result is accessed, see _unpickle
+            task_result.__dict__["_pickled_result"] = task.result.pickled_result
+            return task_result
         elif task.result.state in _EXCEPTION_STATES:
             exception = unpickle_exception(task.result.pickled_result)
             if exception is None and task.result.return_code != 0:
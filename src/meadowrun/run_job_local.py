@@ -5,8 +5,10 @@ import asyncio
 import asyncio.subprocess
 import dataclasses
 import functools
+import glob
 import importlib
 import itertools
+import mmap
 import os
 import os.path
 import pathlib
@@ -14,6 +16,7 @@ import pickle
 import shutil
 import struct
 import sys
+import time
 import traceback
 from decimal import InvalidOperation
 from pathlib import PurePath
@@ -27,6 +30,7 @@ from typing import (
     List,
     Optional,
     Sequence,
+    Set,
     Tuple,
     TypeVar,
     Union,
@@ -36,6 +40,11 @@ import psutil
 
 from meadowrun.aws_integration.ecr import get_ecr_username_password
 from meadowrun.azure_integration.acr import get_acr_username_password
+from meadowrun.compression import (
+    compress_payload,
+    decompress_payload,
+    unpack_buffers_payload,
+)
 from meadowrun.config import (
     MEADOWRUN_AGENT_PID,
     MEADOWRUN_CODE_MOUNT_LINUX,
@@ -121,7 +130,19 @@ class _JobSpecTransformed:
     environment_variables: Dict[str, str] = dataclasses.field(
         default_factory=lambda: {}
     )
-    server: Optional[TaskWorkerServer] = None
+    # Only used for py_agent, see _prepare_py_agent. The first task worker is run with
+    # command_line and container_binds above.
+    task_workers: List[_TaskWorkerSpec] = dataclasses.field(default_factory=lambda: [])
+
+
+@dataclasses.dataclass
+class _TaskWorkerSpec:
+    """See _prepare_task_worker"""
+
+    worker_job_id: str
+    command_line: List[str]
+    container_binds: List[Tuple[str, str]]
+    server: TaskWorkerServer
 
 
 def _io_file_container_binds(
@@ -311,34 +332,37 @@ _TASK_WORKER_PATH = str(
 )
 
 
-async def _prepare_py_agent(
-    job: Job, job_id: str, io_folder: str, is_container: bool
-) -> _JobSpecTransformed:
+async def _prepare_task_worker(
+    job: Job, worker_job_id: str, io_folder: str, is_container: bool
+) -> _TaskWorkerSpec:
     """
-    Creates files in io_folder for the child process to use and returns
-    _JobSpecTransformed. We use __meadowrun_task_worker to start the function in the
-    child process.
+    Creates files in io_folder for a __meadowrun_task_worker child process to use,
+    starts the TaskWorkerServer that it will connect to, and returns its command line
+    and container binds. worker_job_id determines the names of the files in io_folder.
     """
 
     io_files = [
         # these line up with __meadowrun_task_worker
-        os.path.join(job_id + ".state"),
-        os.path.join(job_id + ".result"),
+        os.path.join(worker_job_id + ".state"),
+        os.path.join(worker_job_id + ".result"),
     ]
 
     if not is_container:
         worker_path = _TASK_WORKER_PATH
-        io_path_container = os.path.join(io_folder, job_id)
+        io_path_container = os.path.join(io_folder, worker_job_id)
     else:
         worker_path = (
             f"{MEADOWRUN_CODE_MOUNT_LINUX}{os.path.basename(_TASK_WORKER_PATH)}"
         )
-        io_path_container = f"{MEADOWRUN_IO_MOUNT_LINUX}/{job_id}"
+        io_path_container = f"{MEADOWRUN_IO_MOUNT_LINUX}/{worker_job_id}"
         for io_file in io_files:
             open(os.path.join(io_folder, io_file), "w", encoding="utf-8").close()
 
+    shared_memory_path = _get_shared_memory_path(worker_job_id)
     server = await TaskWorkerServer.start_serving(
-        "0.0.0.0" if is_container else "127.0.0.1"
+        "0.0.0.0" if is_container else "127.0.0.1",
+        shared_memory_path,
+        job.compression,
     )
     command_line = [
         "python",
@@ -353,40 +377,219 @@ async def _prepare_py_agent(
         str(server.port),
     ]
 
+    shared_memory_binds = []
+    if shared_memory_path is not None:
+        if is_container:
+            shared_memory_path_container = (
+                f"{MEADOWRUN_IO_MOUNT_LINUX}/{worker_job_id}.shm"
+            )
+            shared_memory_binds = [(shared_memory_path, shared_memory_path_container)]
+        else:
+            shared_memory_path_container = shared_memory_path
+        command_line.extend(["--shared-memory-path", shared_memory_path_container])
+
     command_line_for_function, io_files_for_function = _prepare_function(
-        job_id, job.py_agent, io_folder
+        worker_job_id, job.py_agent, io_folder
     )
 
-    return _JobSpecTransformed(
+    return _TaskWorkerSpec(
+        worker_job_id,
         list(itertools.chain(command_line, command_line_for_function)),
         _io_file_container_binds(
             io_folder,
             itertools.chain(io_files, io_files_for_function),
         )
+        + shared_memory_binds
         + [(_TASK_WORKER_PATH, worker_path)],
-        server=server,
+        server,
+    )
+
+
+# Agent functions can be run with more than one task worker by passing this keyword
+# argument in PyAgentJob.pickled_agent_function_arguments. It is consumed by
+# run_job_local rather than being passed to the agent function. run_map sets it from its
+# num_task_workers_per_agent argument.
+NUM_TASK_WORKERS_KWARG = "num_task_workers"
+
+
+def _get_agent_function_arguments(
+    job: Job,
+) -> Tuple[Sequence[Any], Dict[str, Any], int]:
+    """Returns args, kwargs, num_task_workers for job.py_agent"""
+    agent_func_args, agent_func_kwargs = pickle.loads(
+        job.py_agent.pickled_agent_function_arguments
+    )
+    num_task_workers = agent_func_kwargs.pop(NUM_TASK_WORKERS_KWARG, 1)
+    if num_task_workers < 1:
+        raise ValueError(f"{NUM_TASK_WORKERS_KWARG} must be at least 1")
+    return agent_func_args, agent_func_kwargs, num_task_workers
+
+
+async def _prepare_py_agent(
+    job: Job, job_id: str, io_folder: str, is_container: bool
+) -> _JobSpecTransformed:
+    """
+    Creates files in io_folder for the child process to use and returns
+    _JobSpecTransformed. We use __meadowrun_task_worker to start the function in the
+    child process.
+
+    The agent function can be run with more than one task worker, see
+    NUM_TASK_WORKERS_KWARG.
+    """
+    _, _, num_task_workers = _get_agent_function_arguments(job)
+
+    _remove_stale_shared_memory_files()
+    task_workers = [await _prepare_task_worker(job, job_id, io_folder, is_container)]
+    for i in range(1, num_task_workers):
+        task_workers.append(
+            await _prepare_task_worker(
+                job, f"{job_id}-task-worker{i}", io_folder, is_container
+            )
+        )
+
+    return _JobSpecTransformed(
+        task_workers[0].command_line,
+        task_workers[0].container_binds,
+        task_workers=task_workers,
     )
 
 
+# See __meadowrun_task_worker.py for the message format
+_FRAME_COUNT = struct.Struct(">i")
+_FRAME_LENGTH = struct.Struct(">q")
+
+# Frames at least this big are sent via shared memory if it's available, see
+# TaskWorkerServer
+_SHARED_MEMORY_MIN_BYTES = 1024 * 1024
+
+
+_SHARED_MEMORY_FOLDER = "/dev/shm"
+_SHARED_MEMORY_PREFIX = "meadowrun-"
+
+
+def _get_shared_memory_path(job_id: str) -> Optional[str]:
+    """
+    Returns a folder in /dev/shm (which is backed by memory rather than disk) for
+    TaskWorkerServer's shared memory segments, or None if /dev/shm isn't available (e.g.
+    on Windows). The path includes our pid, see _remove_stale_shared_memory_files.
+    """
+    if not os.path.isdir(_SHARED_MEMORY_FOLDER):
+        return None
+    return os.path.join(
+        _SHARED_MEMORY_FOLDER, f"{_SHARED_MEMORY_PREFIX}{os.getpid()}-{job_id}"
+    )
+
+
+def _remove_stale_shared_memory_files() -> None:
+    """
+    TaskWorkerServer.close deletes its shared memory folder, but if an agent crashes,
+    its folder is left behind and any segments in it keep using memory. This deletes
+    the folders of agents that are no longer running.
+    """
+    if not os.path.isdir(_SHARED_MEMORY_FOLDER):
+        return
+    for path in glob.glob(
+        os.path.join(_SHARED_MEMORY_FOLDER, _SHARED_MEMORY_PREFIX + "*")
+    ):
+        pid = os.path.basename(path)[len(_SHARED_MEMORY_PREFIX) :].split("-", 1)[0]
+        if pid.isdigit() and not psutil.pid_exists(int(pid)):
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+
+def _try_write_shared_memory_segment(path: str, frames: Sequence[memoryview]) -> bool:
+    """
+    Creates a new shared memory segment at path, maps it into memory and copies frames
+    into it one after another. If there isn't enough space (e.g. /dev/shm in a container
+    is only 64MB by default), deletes the segment and returns False so that the caller
+    can send the frames via the socket instead.
+
+    Any previous segment at path is unlinked rather than overwritten, so a receiver that
+    still has it mapped is unaffected.
+    """
+    length = sum(frame.nbytes for frame in frames)
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o600)
+    try:
+        # reserve the memory up front. Writing to a mapping of a tmpfs file that has run
+        # out of space would crash with a SIGBUS instead of raising an exception
+        os.posix_fallocate(fd, 0, length)
+        with mmap.mmap(fd, length) as segment:
+            offset = 0
+            for frame in frames:
+                segment[offset : offset + frame.nbytes] = frame
+                offset += frame.nbytes
+        return True
+    except OSError:
+        os.remove(path)
+        return False
+    finally:
+        os.close(fd)
+
+
+def _map_shared_memory_segment(path: str) -> mmap.mmap:
+    """
+    Maps the segment that _try_write_shared_memory_segment created at path for reading
+    and unlinks it, so that its memory is freed as soon as the mapping is closed.
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.remove(path)
+        return mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+    finally:
+        os.close(fd)
+
+
 class TaskWorkerServer:
     """This class opens a port in the agent process for the task worker to connect to.
     It allows waiting for connections from task workers, and sending and receiving
     messages.
+
+    If shared_memory_path is provided, it is a folder in which the large frames of each
+    message are written to a memory-mapped shared memory segment instead of being sent
+    over the socket (see _try_write_shared_memory_segment). Messages to the task worker
+    use the segment "to_worker" and messages to the agent use "to_agent". The socket
+    then only carries the frame lengths, with negative lengths indicating that the frame
+    is the next one in the segment. The receiver maps the segment and unlinks it right
+    away, so the segment only uses memory for as long as the receiver needs it, and the
+    sender creates a new segment for its next message. This works because the agent and
+    the task worker take turns sending messages. Frames that don't fit in shared memory
+    are sent over the socket as usual.
+
+    Compressed task arguments are decompressed before they're sent to the task worker,
+    and results are compressed with the specified compression (see compression.py) when
+    they're received, so that the task worker doesn't need the compression libraries.
     """
 
-    def __init__(self) -> None:
+    def __init__(
+        self, shared_memory_path: Optional[str] = None, compression: str = ""
+    ) -> None:
         self.server: Optional[asyncio.AbstractServer] = None
         self.reader: Optional[asyncio.StreamReader] = None
         self.writer: Optional[asyncio.StreamWriter] = None
         self.have_connection: asyncio.Event = asyncio.Event()
         self.port: Optional[int] = None
+        self.compression = compression
+
+        self.shared_memory_path = shared_memory_path
+        if shared_memory_path is not None:
+            # creating the folder here also means it can be bound into a container
+            os.makedirs(shared_memory_path, exist_ok=True)
 
     @staticmethod
     async def start_serving(
-        host: str,
+        host: str, shared_memory_path: Optional[str] = None, compression: str = ""
     ) -> TaskWorkerServer:
         """Create a TaskWorkerServer, open a free port, and return the server."""
-        server = TaskWorkerServer()
+        server = TaskWorkerServer(shared_memory_path, compression)
         await server._start_serving(host)
         return server
 
@@ -397,6 +600,7 @@ class TaskWorkerServer:
         server = await asyncio.start_server(self._handle_connection, host, 0)
         (socket,) = server.sockets
         self.port = socket.getsockname()[1]
+        self.server = server
 
     async def _handle_connection(
         self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
@@ -416,26 +620,83 @@ class TaskWorkerServer:
 
     async def send_message(self, bs: bytes) -> None:
         """Send the given bytes as a message to the task worker. If no task worker is
-        connected yet, waits for a connection."""
+        connected yet, waits for a connection.
+
+        bs is a pickled task argument made by compression.dumps_payload. Its out-of-band
+        buffers are sent as separate frames, see __meadowrun_task_worker.receive_frames.
+        """
         if not self.have_connection.is_set():
             await self.wait_for_task_worker_connection()
         assert self.writer is not None
-        msg_len = struct.pack(">i", len(bs))
-        self.writer.write(msg_len)
-        self.writer.write(bs)
+        pickled, buffers = unpack_buffers_payload(decompress_payload(bs))
+        frames = [pickled, *buffers]
+
+        in_shared_memory = [False] * len(frames)
+        if self.shared_memory_path is not None:
+            in_shared_memory = [
+                frame.nbytes >= _SHARED_MEMORY_MIN_BYTES for frame in frames
+            ]
+            if any(in_shared_memory) and not _try_write_shared_memory_segment(
+                os.path.join(self.shared_memory_path, "to_worker"),
+                [frame for frame, shared in zip(frames, in_shared_memory) if shared],
+            ):
+                in_shared_memory = [False] * len(frames)
+
+        self.writer.write(_FRAME_COUNT.pack(len(frames)))
+        for frame, shared in zip(frames, in_shared_memory):
+            if shared:
+                self.writer.write(_FRAME_LENGTH.pack(-frame.nbytes))
+            else:
+                self.writer.write(_FRAME_LENGTH.pack(frame.nbytes))
+                self.writer.write(frame)
         await self.writer.drain()
 
-    async def receive_message(self) -> Any:
-        """Receives a message from the task worker. If no task worker is
-        connected yet, waits for a connection. The message is unpickled."""
+    async def receive_message(self) -> Tuple[str, bytes]:
+        """Receives a message from the task worker. If no task worker is connected yet,
+        waits for a connection. Returns the state and the pickled result, which is not
+        unpickled, but may be compressed and/or include out-of-band buffers, see
+        compression.py.
+
+        The task worker sends the result and its out-of-band buffers as a single
+        pack_buffers_payload frame, so we can pass it on to the client as-is.
+        """
         if not self.have_connection.is_set():
             await self.wait_for_task_worker_connection()
         assert self.reader is not None
-        (result_len,) = struct.unpack(">i", await self.reader.read(4))
-        result_bs = bytearray()
-        while len(result_bs) < result_len:
-            result_bs.extend(await self.reader.read(result_len - len(result_bs)))
-        return pickle.loads(result_bs)
+        (frame_count,) = _FRAME_COUNT.unpack(
+            await self.reader.readexactly(_FRAME_COUNT.size)
+        )
+        segment: Optional[mmap.mmap] = None
+        segment_offset = 0
+        frames = []
+        try:
+            for _ in range(frame_count):
+                (frame_length,) = _FRAME_LENGTH.unpack(
+                    await self.reader.readexactly(_FRAME_LENGTH.size)
+                )
+                if frame_length < 0:
+                    if self.shared_memory_path is None:
+                        raise ValueError(
+                            "Task worker sent a frame via shared memory but shared "
+                            "memory is not enabled"
+                        )
+                    if segment is None:
+                        segment = _map_shared_memory_segment(
+                            os.path.join(self.shared_memory_path, "to_agent")
+                        )
+                    # the result needs to be bytes for ProcessState, so this is the one
+                    # copy we need to make
+                    frames.append(
+                        segment[segment_offset : segment_offset - frame_length]
+                    )
+                    segment_offset -= frame_length
+                else:
+                    frames.append(await self.reader.readexactly(frame_length))
+        finally:
+            if segment is not None:
+                segment.close()
+        state, result = frames
+        return state.decode("utf-8"), compress_payload(result, self.compression)
 
     async def close_task_worker_connection(self) -> None:
         """Cleanly close the connection to the task worker."""
@@ -450,6 +711,9 @@ class TaskWorkerServer:
         if self.server:
             self.server.close()
             await self.server.wait_closed()
+        if self.shared_memory_path is not None:
+            # segments in /dev/shm take up memory until they're deleted
+            shutil.rmtree(self.shared_memory_path, ignore_errors=True)
 
 
 @dataclasses.dataclass(frozen=True)
@@ -461,6 +725,8 @@ class Stats:
 @dataclasses.dataclass
 class StatsAccumulator:
     max_memory_used_gb: float = 0
+    # set by WorkerMonitor.stop_stats
+    duration_seconds: float = 0
 
     def accumulate(self, stats: Stats) -> None:
         if stats.memory_in_use_gb > self.max_memory_used_gb:
@@ -476,6 +742,7 @@ class WorkerMonitor(abc.ABC):
     def __init__(self) -> None:
         super().__init__()
         self._stats_accumulator = StatsAccumulator()
+        self._stats_start_time = 0.0
         self._stats_task: Optional[asyncio.Task[None]] = None
 
     @abc.abstractmethod
@@ -503,7 +770,6 @@ class WorkerMonitor(abc.ABC):
     async def _start_stats(self) -> None:
         """Subclasses should start this as a task to accumulate statistics,
         and cancel the task when done."""
-        self._stats_accumulator = StatsAccumulator()
         while True:
             try:
                 stats = await self.get_stats()
@@ -516,11 +782,17 @@ class WorkerMonitor(abc.ABC):
             await asyncio.sleep(1)
 
     def start_stats(self) -> None:
+        self._stats_accumulator = StatsAccumulator()
+        self._stats_start_time = time.time()
         self._stats_task = asyncio.create_task(self._start_stats())
 
     async def stop_stats(self) -> StatsAccumulator:
         if self._stats_task is not None:
             await cancel_task(self._stats_task)
+            self._stats_task = None
+            self._stats_accumulator.duration_seconds = (
+                time.time() - self._stats_start_time
+            )
         return self._stats_accumulator
 
     async def was_oom_killed(self) -> bool:
@@ -731,6 +1003,19 @@ class WorkerContainerMonitor(WorkerMonitor):
         return (await self.container.show()).get("State", {}).get("OOMKilled", False)
 
 
+@dataclasses.dataclass(frozen=True)
+class TaskWorker:
+    """
+    A task worker that an agent function sends tasks to. get_job_state takes the
+    return code of an unexpectedly exited task worker and returns a ProcessState
+    describing what happened.
+    """
+
+    server: TaskWorkerServer
+    monitor: WorkerMonitor
+    get_job_state: Callable[[int], ProcessState]
+
+
 async def restart_worker(
     server: TaskWorkerServer, worker_monitor: WorkerMonitor
 ) -> None:
@@ -744,6 +1029,44 @@ async def restart_worker(
     await server.wait_for_task_worker_connection()
 
 
+class BackgroundUploads:
+    """
+    Lets an agent upload task results in the background, so that it can send the next
+    task to the task worker without waiting for the previous result to be uploaded.
+    Exceptions from uploads are raised from the next call to add or wait_all.
+    """
+
+    def __init__(self, max_pending: int = 4):
+        self._max_pending = max_pending
+        self._pending: Set[asyncio.Task[None]] = set()
+
+    async def add(self, upload: Coroutine[Any, Any, None]) -> None:
+        """
+        Starts running upload in the background. Waits if there are already max_pending
+        uploads in flight.
+        """
+        while len(self._pending) >= self._max_pending:
+            done, self._pending = await asyncio.wait(
+                self._pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                task.result()
+
+        self._pending.add(asyncio.create_task(upload))
+
+    async def wait_all(self) -> None:
+        """Waits for all uploads to complete"""
+        pending, self._pending = self._pending, set()
+        if pending:
+            for task in asyncio.as_completed(pending):
+                await task
+
+    def cancel(self) -> None:
+        for task in self._pending:
+            task.cancel()
+        self._pending = set()
+
+
 async def _launch_non_container_job(
     job_spec_type: JobSpecType,
     job_spec_transformed: _JobSpecTransformed,
@@ -821,6 +1144,10 @@ async def _launch_non_container_job(
         job_spec_transformed.command_line = [
             new_first_command_line
         ] + job_spec_transformed.command_line[1:]
+        for task_worker_spec in job_spec_transformed.task_workers[1:]:
+            task_worker_spec.command_line = [
+                new_first_command_line
+            ] + task_worker_spec.command_line[1:]
 
     # (4) run the process
 
@@ -836,9 +1163,19 @@ async def _launch_non_container_job(
     )
     await worker.start_and_tail()
 
+    # additional task workers for py_agent, see _prepare_py_agent
+    additional_workers = []
+    for task_worker_spec in job_spec_transformed.task_workers[1:]:
+        additional_worker = WorkerProcessMonitor(
+            task_worker_spec.command_line, working_directory, env_vars
+        )
+        additional_workers.append(additional_worker)
+        await additional_worker.start_and_tail()
+
     # (5) return the pid and continuation
     return worker.pid, _non_container_job_continuation(
         worker,
+        additional_workers,
         job_spec_type,
         job_spec_transformed,
         job,
@@ -850,6 +1187,7 @@ async def _launch_non_container_job(
 
 async def _non_container_job_continuation(
     worker: WorkerProcessMonitor,
+    additional_workers: List[WorkerProcessMonitor],
     job_spec_type: JobSpecType,
     job_spec_transformed: _JobSpecTransformed,
     job: Job,
@@ -861,27 +1199,39 @@ async def _non_container_job_continuation(
     Takes an asyncio.subprocess.Process, waits for it to finish, gets results from
     io_folder from the child process if necessary, and then returns an appropriate
     ProcessState indicating how the child process completed.
+
+    additional_workers are only used for py_agent, see _prepare_py_agent.
     """
 
     try:
         if job_spec_type == "py_agent":
             await _run_agent(
-                job_spec_transformed,
                 job,
+                job_id,
                 log_file_name,
-                worker,
-                functools.partial(
-                    _completed_job_state,
-                    job_spec_type=job_spec_type,
-                    job_id=job_id,
-                    io_folder=io_folder,
-                    log_file_name=log_file_name,
-                    pid=worker.pid,
-                    container_id=None,
-                ),
+                [
+                    TaskWorker(
+                        task_worker_spec.server,
+                        task_worker,
+                        functools.partial(
+                            _completed_job_state,
+                            job_spec_type=job_spec_type,
+                            job_id=task_worker_spec.worker_job_id,
+                            io_folder=io_folder,
+                            log_file_name=log_file_name,
+                            pid=task_worker.pid,
+                            container_id=None,
+                        ),
+                    )
+                    for task_worker_spec, task_worker in zip(
+                        job_spec_transformed.task_workers,
+                        itertools.chain([worker], additional_workers),
+                    )
+                ],
             )
-            await worker.stop()
-            await worker.wait_until_exited()
+            for task_worker in itertools.chain([worker], additional_workers):
+                await task_worker.stop()
+                await task_worker.wait_until_exited()
             return ProcessState(
                 state=ProcessStateEnum.SUCCEEDED,
                 pid=worker.pid or 0,
@@ -913,10 +1263,11 @@ async def _non_container_job_continuation(
     finally:
         # TODO this is not 100% bulletproof--there will be a tiny sliver of time between
         # when we create the process and we enter this try/finally block
-        try:
-            await worker.stop()
-        except BaseException:
-            print("Exception trying to kill process: " + traceback.format_exc())
+        for task_worker in itertools.chain([worker], additional_workers):
+            try:
+                await task_worker.stop()
+            except BaseException:
+                print("Exception trying to kill process: " + traceback.format_exc())
 
 
 async def _launch_container_job(
@@ -1011,7 +1362,9 @@ async def _launch_container_job(
             itertools.chain(code_paths, existing_python_path)
         )
 
-    # now, expose any files we need for communication with the container
+    # now, expose any files we need for communication with the container. Additional
+    # task workers for py_agent get their own files
+    common_binds = list(binds)
     binds.extend(job_spec_transformed.container_binds)
 
     # now run any sidecar_containers that were specified
@@ -1060,8 +1413,30 @@ async def _launch_container_job(
     )
     await worker.start_and_tail()
 
+    # additional task workers for py_agent, see _prepare_py_agent
+    additional_workers = []
+    for task_worker_spec in job_spec_transformed.task_workers[1:]:
+        additional_worker = WorkerContainerMonitor(
+            worker.docker_client,
+            container_image_name,
+            task_worker_spec.command_line,
+            job_spec_transformed.environment_variables,
+            working_dir,
+            common_binds + task_worker_spec.container_binds,
+            # only the first task worker gets the ports
+            [],
+            [
+                (f"sidecar-container-{i}", ip)
+                for i, ip in enumerate(sidecar_container_ips)
+            ],
+            job.uses_gpu,
+        )
+        additional_workers.append(additional_worker)
+        await additional_worker.start_and_tail()
+
     return worker.container_id, _container_job_continuation(
         worker,
+        additional_workers,
         job_spec_type,
         job_spec_transformed,
         job,
@@ -1074,6 +1449,7 @@ async def _launch_container_job(
 
 async def _container_job_continuation(
     worker: WorkerContainerMonitor,
+    additional_workers: List[WorkerContainerMonitor],
     job_spec_type: JobSpecType,
     job_spec_transformed: _JobSpecTransformed,
     job: Job,
@@ -1088,23 +1464,34 @@ async def _container_job_continuation(
     finished.
 
     docker_client just needs to be closed when the container process has completed.
+
+    additional_workers are only used for py_agent, see _prepare_py_agent.
     """
     try:
         if job_spec_type == "py_agent":
             await _run_agent(
-                job_spec_transformed,
                 job,
+                job_id,
                 log_file_name,
-                worker,
-                functools.partial(
-                    _completed_job_state,
-                    job_spec_type=job_spec_type,
-                    job_id=job_id,
-                    io_folder=io_folder,
-                    log_file_name=log_file_name,
-                    pid=None,
-                    container_id=worker.container_id,
-                ),
+                [
+                    TaskWorker(
+                        task_worker_spec.server,
+                        task_worker,
+                        functools.partial(
+                            _completed_job_state,
+                            job_spec_type=job_spec_type,
+                            job_id=task_worker_spec.worker_job_id,
+                            io_folder=io_folder,
+                            log_file_name=log_file_name,
+                            pid=None,
+                            container_id=task_worker.container_id,
+                        ),
+                    )
+                    for task_worker_spec, task_worker in zip(
+                        job_spec_transformed.task_workers,
+                        itertools.chain([worker], additional_workers),
+                    )
+                ],
             )
             return ProcessState(
                 state=ProcessStateEnum.SUCCEEDED,
@@ -1140,6 +1527,7 @@ async def _container_job_continuation(
         try:
             await asyncio.gather(
                 remove_container(worker.container),
+                *(remove_container(w.container) for w in additional_workers),
                 *(remove_container(c) for c in sidecar_containers),
             )
         except BaseException:
@@ -1149,32 +1537,27 @@ async def _container_job_continuation(
 
 
 async def _run_agent(
-    job_spec_transformed: _JobSpecTransformed,
-    job: Job,
-    log_file_name: str,
-    worker: WorkerMonitor,
-    get_job_state: Callable[[int], ProcessState],
+    job: Job, job_id: str, log_file_name: str, task_workers: List[TaskWorker]
 ) -> None:
-    # run the agent function. The agent function connects to another
-    # process, the task worker, which runs the actual user function.
-    assert job_spec_transformed.server is not None
+    # run the agent function. The agent function connects to other processes, the task
+    # workers, which run the actual user function.
     agent_func = getattr(
         importlib.import_module(job.py_agent.qualified_agent_function_name.module_name),
         job.py_agent.qualified_agent_function_name.function_name,
     )
-    agent_func_args, agent_func_kwargs = pickle.loads(
-        job.py_agent.pickled_agent_function_arguments
-    )
-    await agent_func(
-        *agent_func_args,
-        log_file_name=log_file_name,
-        base_job_id=job.base_job_id,
-        worker_server=job_spec_transformed.server,
-        worker_monitor=worker,
-        get_job_state=get_job_state,
-        **agent_func_kwargs,
-    )
-    await job_spec_transformed.server.close()
+    agent_func_args, agent_func_kwargs, _ = _get_agent_function_arguments(job)
+    try:
+        await agent_func(
+            *agent_func_args,
+            log_file_name=log_file_name,
+            base_job_id=job.base_job_id,
+            job_id=job_id,
+            task_workers=task_workers,
+            **agent_func_kwargs,
+        )
+    finally:
+        for task_worker in task_workers:
+            await task_worker.server.close()
 
 
 def _completed_job_state(
@@ -9,8 +9,19 @@ import sys
 import traceback
 import uuid
 import zipfile
-from typing import Optional, Tuple, TypeVar, IO, TYPE_CHECKING, Iterable
-
+from typing import (
+    TYPE_CHECKING,
+    IO,
+    Any,
+    Awaitable,
+    Iterable,
+    List,
+    Optional,
+    Tuple,
+    TypeVar,
+)
+
+from meadowrun.compression import decompress_payload
 from meadowrun.meadowrun_pb2 import ProcessState
 
 if TYPE_CHECKING:
@@ -31,7 +42,8 @@ def pickle_exception(e: Exception, pickle_protocol: int) -> bytes:
 
 
 def unpickle_exception(bs: bytes) -> Tuple[str, str, str]:
-    return pickle.loads(bs)
+    # task results from py_agent jobs may be compressed, see compression.py
+    return pickle.loads(decompress_payload(bs))
 
 
 COMPLETED_PROCESS_STATES = {
@@ -74,6 +86,20 @@ async def cancel_task(task: asyncio.Task) -> None:
         pass
 
 
+async def gather_or_cancel(*coroutines: Awaitable[Any]) -> List[Any]:
+    """
+    Like asyncio.gather, but if any of the coroutines raises an exception, the rest are
+    cancelled before the exception is re-raised
+    """
+    tasks = [asyncio.ensure_future(coroutine) for coroutine in coroutines]
+    try:
+        return await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            if not task.done():
+                await cancel_task(task)
+
+
 def create_zipfile(
     file: str | PathLike[str] | IO[bytes],
     mode: Literal["r", "w", "x", "a"],
@@ -8,17 +8,22 @@ EC2 and Kubernetes
 from __future__ import annotations
 
 import asyncio
+import collections
+import datetime
 import hashlib
 import io
 import json
-import os
+import math
 import pickle
-import shutil
-import tempfile
+import struct
 import time
+import uuid
 from typing import (
     Any,
     AsyncIterable,
+    Deque,
+    Dict,
+    IO,
     Iterable,
     List,
     Optional,
@@ -26,21 +31,27 @@ from typing import (
     TYPE_CHECKING,
     Tuple,
     Type,
+    Union,
 )
 
 import aiobotocore.session
 import boto3.exceptions
+import botocore
 import botocore.exceptions
 from botocore.exceptions import ClientError
 
 from meadowrun._vendor.fastcdc.fastcdc_py import fastcdc_py
+from meadowrun.abstract_result_queue import AbstractResultQueue
 from meadowrun.abstract_storage_bucket import AbstractStorageBucket
+from meadowrun.compression import dumps_payload
 from meadowrun.aws_integration.aws_core import (
     MeadowrunAWSAccessError,
     MeadowrunNotInstalledError,
     get_bucket_name,
 )
+from meadowrun.local_cache import clear_cache, get_cached_json, save_json_to_cache
 from meadowrun.meadowrun_pb2 import ProcessState
+from meadowrun.shared import cancel_task, gather_or_cancel
 from meadowrun.run_job_core import (
     JobCompletion,
     MeadowrunException,
@@ -49,17 +60,22 @@ from meadowrun.run_job_core import (
 )
 from meadowrun.storage_keys import (
     STORAGE_KEY_PROCESS_STATE_SUFFIX,
+    STORAGE_KEY_TASK_RESULT_BATCH_SUFFIX,
     STORAGE_KEY_TASK_RESULT_SUFFIX,
     parse_storage_key_process_state,
     parse_storage_key_task_result,
     storage_key_process_state,
     storage_key_task_args,
     storage_key_task_result,
+    storage_key_task_result_batch,
+    storage_key_worker_lease,
     storage_prefix_outputs,
 )
 
 if TYPE_CHECKING:
     import types_aiobotocore_s3
+    from meadowrun.chunk_cache import ChunkCache
+    from meadowrun.run_job_local import BackgroundUploads
     from typing_extensions import Literal
     from types import TracebackType
 
@@ -70,6 +86,8 @@ class GenericStorageBucket(AbstractStorageBucket):
     username/password-based S3-compatible object storage systems (e.g. Minio)
     """
 
+    list_objects_returns_all_keys = True
+
     def __init__(
         self, s3_client: types_aiobotocore_s3.S3Client, bucket: str, cache_key: str
     ):
@@ -116,6 +134,38 @@ class GenericStorageBucket(AbstractStorageBucket):
     async def write_bytes(self, data: bytes, key: str) -> None:
         await self._s3_client.put_object(Bucket=self._bucket, Key=key, Body=data)
 
+    def check_write_bytes_exclusive_supported(self) -> None:
+        # conditional writes were added to S3 in 2024. Older versions of botocore don't
+        # know about IfNoneMatch and reject it before sending the request
+        put_object = self._s3_client.meta.service_model.operation_model("PutObject")
+        if (
+            put_object.input_shape is None
+            or "IfNoneMatch" not in put_object.input_shape.members
+        ):
+            raise ValueError(
+                "write_bytes_exclusive requires a version of botocore that supports "
+                f"IfNoneMatch for S3 PutObject, but botocore {botocore.__version__} is "
+                "installed. Please upgrade aiobotocore and botocore."
+            )
+
+    async def write_bytes_exclusive(self, data: bytes, key: str) -> bool:
+        self.check_write_bytes_exclusive_supported()
+        while True:
+            try:
+                await self._s3_client.put_object(
+                    Bucket=self._bucket, Key=key, Body=data, IfNoneMatch="*"
+                )
+                return True
+            except ClientError as error:
+                code = error.response["Error"]["Code"]
+                if code in ("412", "PreconditionFailed"):
+                    return False
+                if code not in ("409", "ConditionalRequestConflict"):
+                    raise
+                # another conditional write to the same key is in progress, try again
+                # to find out whether it succeeded
+                await asyncio.sleep(0.1)
+
     async def exists(self, key: str) -> bool:
         try:
             await self._s3_client.head_object(Bucket=self._bucket, Key=key)
@@ -172,6 +222,8 @@ class S3Bucket(GenericStorageBucket):
     username/password-based S3-compatible object storage systems (e.g. Minio)
     """
 
+    list_objects_returns_all_keys = True
+
     def __init__(
         self, s3_client: types_aiobotocore_s3.S3Client, bucket: str, cache_key: str
     ):
@@ -182,11 +234,11 @@ class S3Bucket(GenericStorageBucket):
         await super().__aenter__()
         return self
 
-    async def write_bytes_if_not_exists(self, data: bytes, key: str) -> None:
+    async def write_bytes_if_not_exists(self, data: bytes, key: str) -> bool:
         # this override just provides some nicer error messages. This function is
         # usually called before other functions
         try:
-            await super().write_bytes_if_not_exists(data, key)
+            return await super().write_bytes_if_not_exists(data, key)
         except boto3.exceptions.S3UploadFailedError as e:
             if len(e.args) >= 1 and "NoSuchBucket" in e.args[0]:
                 raise MeadowrunNotInstalledError("S3 bucket")
@@ -246,36 +298,185 @@ async def get_aws_s3_bucket_async(region_name: str) -> S3Bucket:
     return get_aws_s3_bucket(region_name)
 
 
-async def upload_task_args(
+# Identifies where a task's pickled arguments are stored: (segment, range_from,
+# range_to). range_from and range_to are inclusive byte offsets into the segment object,
+# see upload_task_args_streaming
+TaskArgRange = Tuple[int, int, int]
+
+# Task arguments are pickled into segments of roughly this size, and each segment is
+# uploaded as a separate object. We can't just use e.g. an S3 multipart upload, because
+# a multipart object can't be read until all of its parts have been uploaded, and we
+# want workers to be able to start on the first tasks while we're still pickling the
+# rest.
+_TASK_ARGS_SEGMENT_SIZE_BYTES = 16 * 1024 * 1024
+_MAX_CONCURRENT_SEGMENT_UPLOADS = 4
+
+
+async def upload_task_args_streaming(
     storage_bucket: AbstractStorageBucket,
     job_id: str,
     args: Iterable[Any],
-) -> List[Tuple[int, int]]:
-    range_from = 0
-    ranges = []
-    with io.BytesIO() as buffer:
-        for i, arg in enumerate(args):
-            pickle.dump(((arg,), {}), buffer)
+    segment_size_bytes: int = _TASK_ARGS_SEGMENT_SIZE_BYTES,
+    max_concurrent_uploads: int = _MAX_CONCURRENT_SEGMENT_UPLOADS,
+    compression: str = "",
+    first_task_id: int = 0,
+    first_segment: int = 0,
+) -> AsyncIterable[List[Tuple[int, TaskArgRange]]]:
+    """
+    Pickles args into segments and uploads each segment as a separate object. Every
+    time a segment has been uploaded, yields [(task_id, TaskArgRange), ...] for all of
+    the tasks in that segment, so that the caller can enqueue those tasks right away.
+    Segments are uploaded concurrently so they may be yielded out of order.
+
+    At most max_concurrent_uploads segments are held in memory at once, which means we
+    never need much more than segment_size_bytes * max_concurrent_uploads of memory
+    regardless of how many args there are.
+
+    Each arg is pickled separately with dumps_payload (and compressed if compression is
+    specified) so that it can still be downloaded on its own.
+
+    To upload more args for the same job, pass in first_task_id and first_segment so
+    that the task ids and segments continue on from the previous call.
+    """
+
+    async def upload_segment(
+        segment: int, data: bytes, ranges: List[Tuple[int, TaskArgRange]]
+    ) -> List[Tuple[int, TaskArgRange]]:
+        await storage_bucket.write_bytes(data, storage_key_task_args(job_id, segment))
+        return ranges
+
+    pending: Set[asyncio.Task[List[Tuple[int, TaskArgRange]]]] = set()
+    try:
+        segment = first_segment
+        buffer = io.BytesIO()
+        ranges: List[Tuple[int, TaskArgRange]] = []
+        range_from = 0
+        for task_id, arg in enumerate(args, first_task_id):
+            buffer.write(dumps_payload(((arg,), {}), compression))
             range_to = buffer.tell() - 1
-            ranges.append((range_from, range_to))
+            ranges.append((task_id, (segment, range_from, range_to)))
             range_from = range_to + 1
 
-        await storage_bucket.write_bytes(
-            buffer.getvalue(), storage_key_task_args(job_id)
-        )
+            if range_from >= segment_size_bytes:
+                if len(pending) >= max_concurrent_uploads:
+                    done, pending = await asyncio.wait(
+                        pending, return_when=asyncio.FIRST_COMPLETED
+                    )
+                    for task in done:
+                        yield task.result()
+
+                pending.add(
+                    asyncio.create_task(
+                        upload_segment(segment, buffer.getvalue(), ranges)
+                    )
+                )
+                # give the upload a chance to start before we go back to pickling
+                await asyncio.sleep(0)
+
+                done = {task for task in pending if task.done()}
+                pending -= done
+                for task in done:
+                    yield task.result()
+
+                segment += 1
+                buffer = io.BytesIO()
+                ranges = []
+                range_from = 0
+
+        if ranges:
+            pending.add(
+                asyncio.create_task(upload_segment(segment, buffer.getvalue(), ranges))
+            )
+        buffer.close()
+
+        while pending:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                yield task.result()
+    finally:
+        for task in pending:
+            task.cancel()
+
 
-    return ranges
+async def upload_task_args(
+    storage_bucket: AbstractStorageBucket,
+    job_id: str,
+    args: Iterable[Any],
+    compression: str = "",
+) -> List[TaskArgRange]:
+    """
+    Like upload_task_args_streaming, but waits for all of the segments to be uploaded
+    and returns the TaskArgRange for each arg in order.
+    """
+    ranges: Dict[int, TaskArgRange] = {}
+    async for segment_ranges in upload_task_args_streaming(
+        storage_bucket, job_id, args, compression=compression
+    ):
+        ranges.update(segment_ranges)
+    return [ranges[task_id] for task_id in range(len(ranges))]
 
 
 async def download_task_arg(
     storage_bucket: AbstractStorageBucket,
     job_id: str,
-    byte_range: Tuple[int, int],
+    byte_range: TaskArgRange,
 ) -> Any:
+    segment, range_from, range_to = byte_range
     return await storage_bucket.get_byte_range(
-        storage_key_task_args(job_id), byte_range
+        storage_key_task_args(job_id, segment), (range_from, range_to)
+    )
+
+
+# When downloading multiple task arguments at once, ranges in the same segment that are
+# at most this far apart get downloaded with a single request
+_MAX_COALESCED_GAP_BYTES = 1024 * 1024
+
+
+async def download_task_args(
+    storage_bucket: AbstractStorageBucket,
+    job_id: str,
+    byte_ranges: List[TaskArgRange],
+) -> List[bytes]:
+    """
+    Like download_task_arg, but for multiple tasks at once. Ranges that are close
+    together in the same segment are coalesced into a single ranged GET, so that e.g. a
+    batch of consecutive tasks only needs one request. Returns the pickled arguments in
+    the same order as byte_ranges.
+    """
+    # groups of [(range_from, range_to, [index into byte_ranges, ...]), ...], keyed by
+    # segment
+    coalesced: Dict[int, List[Tuple[int, int, List[int]]]] = {}
+    for i in sorted(range(len(byte_ranges)), key=lambda i: byte_ranges[i]):
+        segment, range_from, range_to = byte_ranges[i]
+        groups = coalesced.setdefault(segment, [])
+        if groups and range_from - groups[-1][1] <= _MAX_COALESCED_GAP_BYTES:
+            group_from, group_to, indices = groups[-1]
+            groups[-1] = (group_from, max(group_to, range_to), indices)
+            indices.append(i)
+        else:
+            groups.append((range_from, range_to, [i]))
+
+    requests = [
+        (segment, group) for segment, groups in coalesced.items() for group in groups
+    ]
+    responses = await asyncio.gather(
+        *(
+            storage_bucket.get_byte_range(
+                storage_key_task_args(job_id, segment), (group_from, group_to)
+            )
+            for segment, (group_from, group_to, _) in requests
+        )
     )
 
+    results: List[bytes] = [b""] * len(byte_ranges)
+    for (_, (group_from, _, indices)), response in zip(requests, responses):
+        for i in indices:
+            _, range_from, range_to = byte_ranges[i]
+            results[i] = response[range_from - group_from : range_to - group_from + 1]
+    return results
+
 
 async def complete_task(
     storage_bucket: AbstractStorageBucket,
@@ -283,21 +484,378 @@ async def complete_task(
     task_id: int,
     attempt: int,
     process_state: ProcessState,
+    result_queue: Optional[AbstractResultQueue] = None,
 ) -> None:
-    """Uploads the result of the task to S3."""
-    await storage_bucket.write_bytes(
-        process_state.SerializeToString(),
-        storage_key_task_result(job_id, task_id, attempt),
+    """
+    Uploads the result of the task to S3. If result_queue is provided, also sends the
+    key of the result to result_queue so that receive_results doesn't have to poll for
+    it.
+    """
+    key = storage_key_task_result(job_id, task_id, attempt)
+    await storage_bucket.write_bytes(process_state.SerializeToString(), key)
+    if result_queue is not None:
+        await result_queue.send_result_keys([key])
+
+
+# Each task result in a task result batch is framed as a header with the task_id,
+# attempt and length of the serialized ProcessState, followed by the serialized
+# ProcessState
+_TASK_RESULT_HEADER = struct.Struct(">iiI")
+
+
+def serialize_task_result_batch(
+    task_results: Iterable[Tuple[int, int, ProcessState]]
+) -> bytes:
+    buffer = io.BytesIO()
+    for task_id, attempt, process_state in task_results:
+        process_state_bytes = process_state.SerializeToString()
+        buffer.write(
+            _TASK_RESULT_HEADER.pack(task_id, attempt, len(process_state_bytes))
+        )
+        buffer.write(process_state_bytes)
+    return buffer.getvalue()
+
+
+def parse_task_result_batch(data: bytes) -> List[TaskProcessState]:
+    """The inverse of serialize_task_result_batch"""
+    results = []
+    offset = 0
+    while offset < len(data):
+        task_id, attempt, length = _TASK_RESULT_HEADER.unpack_from(data, offset)
+        offset += _TASK_RESULT_HEADER.size
+        if offset + length > len(data):
+            raise ValueError("Task result batch is truncated")
+        process_state = ProcessState.FromString(data[offset : offset + length])
+        offset += length
+        results.append(TaskProcessState(task_id, attempt, process_state))
+    return results
+
+
+_TASK_RESULT_BATCH_MAX_BYTES = 4 * 1024 * 1024
+_TASK_RESULT_BATCH_MAX_SECONDS = 1.0
+
+
+# An agent rewrites its lease at least this often as a heartbeat, see TaskLeases
+_LEASE_HEARTBEAT_SECONDS = 30
+# The driver considers an agent dead if its heartbeat hasn't changed for this long, see
+# WorkerHeartbeats
+_WORKER_HEARTBEAT_TIMEOUT_SECONDS = 300
+
+
+class TaskLeases:
+    """
+    Keeps track of the tasks that an agent has taken off of the request queue but hasn't
+    written results for yet, and writes them to storage_key_worker_lease, so that if the
+    agent exits unexpectedly, GridJobDriver can reschedule them immediately (see
+    get_leased_tasks).
+
+    The lease also serves as a heartbeat: heartbeat_loop rewrites it periodically, and
+    close marks it as exited when the agent shuts down normally. This lets the driver
+    detect agents that die without any chance to report it, e.g. when their spot
+    instance is interrupted, see WorkerHeartbeats.
+
+    add and remove wait until the lease has been written. Concurrent calls are coalesced
+    so that there is at most one write in flight and one waiting.
+    """
+
+    def __init__(
+        self, storage_bucket: AbstractStorageBucket, base_job_id: str, job_id: str
+    ):
+        self._storage_bucket = storage_bucket
+        self._key = storage_key_worker_lease(base_job_id, job_id)
+
+        self._leases: Set[Tuple[int, int]] = set()
+        self._exited = False
+        self._version = 0
+        self._written_version = 0
+        self._lock = asyncio.Lock()
+
+    async def add(self, tasks: Iterable[Tuple[int, int]]) -> None:
+        """tasks is a list of (task_id, attempt)"""
+        self._leases.update(tasks)
+        self._version += 1
+        await self._write()
+
+    async def remove(self, tasks: Iterable[Tuple[int, int]]) -> None:
+        self._leases.difference_update(tasks)
+        self._version += 1
+        await self._write()
+
+    async def heartbeat_loop(self) -> None:
+        """Rewrites the lease every _LEASE_HEARTBEAT_SECONDS, runs until cancelled"""
+        while True:
+            self._version += 1
+            await self._write()
+            await asyncio.sleep(_LEASE_HEARTBEAT_SECONDS)
+
+    async def close(self) -> None:
+        """Tells the driver that this agent has exited normally"""
+        self._exited = True
+        self._version += 1
+        await self._write()
+
+    async def _write(self) -> None:
+        version = self._version
+        async with self._lock:
+            if self._written_version >= version:
+                # a write that started after our change already includes it
+                return
+            self._written_version = self._version
+            await self._storage_bucket.write_bytes(
+                json.dumps(
+                    {
+                        # only compared with previous heartbeats from the same agent
+                        "heartbeat": time.time(),
+                        "exited": self._exited,
+                        "tasks": sorted(self._leases),
+                    }
+                ).encode("utf-8"),
+                self._key,
+            )
+
+
+async def _get_lease(
+    storage_bucket: AbstractStorageBucket, base_job_id: str, job_id: str
+) -> Optional[Dict[str, Any]]:
+    data = await storage_bucket.try_get_bytes(
+        storage_key_worker_lease(base_job_id, job_id)
     )
+    if data is None:
+        return None
+    return json.loads(data)
+
+
+async def get_leased_tasks(
+    storage_bucket: AbstractStorageBucket, base_job_id: str, job_id: str
+) -> List[Tuple[int, int]]:
+    """
+    Returns the (task_id, attempt) of the tasks that the worker with the specified
+    job_id has leased, see TaskLeases
+    """
+    lease = await _get_lease(storage_bucket, base_job_id, job_id)
+    if lease is None:
+        return []
+    return [(task_id, attempt) for task_id, attempt in lease["tasks"]]
+
+
+class WorkerHeartbeats:
+    """
+    Used by the driver to find agents that have stopped heartbeating (see TaskLeases)
+    without exiting normally. We time how long each agent's heartbeat has stayed the
+    same with our own clock, so clock skew between the driver and the agents doesn't
+    matter.
+
+    Agents that haven't written a lease yet, e.g. because they're still building their
+    environment, are never considered dead, as we can't tell whether they've started.
+    """
+
+    def __init__(
+        self,
+        storage_bucket: AbstractStorageBucket,
+        base_job_id: str,
+        timeout_seconds: float = _WORKER_HEARTBEAT_TIMEOUT_SECONDS,
+    ):
+        self._storage_bucket = storage_bucket
+        self._base_job_id = base_job_id
+        self._timeout_seconds = timeout_seconds
+        # job_id -> (last heartbeat, when we first saw that heartbeat)
+        self._last_heartbeats: Dict[str, Tuple[float, float]] = {}
+
+    async def get_unresponsive_workers(self, job_ids: Iterable[str]) -> List[str]:
+        job_ids = list(job_ids)
+        leases = await asyncio.gather(
+            *(
+                _get_lease(self._storage_bucket, self._base_job_id, job_id)
+                for job_id in job_ids
+            )
+        )
+        now = time.time()
+        unresponsive = []
+        for job_id, lease in zip(job_ids, leases):
+            if lease is None or lease["exited"]:
+                self._last_heartbeats.pop(job_id, None)
+                continue
+            last_heartbeat = self._last_heartbeats.get(job_id)
+            if last_heartbeat is None or last_heartbeat[0] != lease["heartbeat"]:
+                self._last_heartbeats[job_id] = lease["heartbeat"], now
+            elif now - last_heartbeat[1] > self._timeout_seconds:
+                unresponsive.append(job_id)
+                del self._last_heartbeats[job_id]
+        return unresponsive
+
+
+class TaskResultBatcher:
+    """
+    Accumulates task results in an agent and writes them to the storage bucket as a
+    single task result batch object (see serialize_task_result_batch) rather than one
+    object per task. A batch gets written as soon as it has max_batch_bytes of results,
+    or when its oldest result is max_batch_seconds old, so for short tasks we make a
+    small number of requests, and for long tasks results are not delayed by much.
+
+    Batches are written via uploads, and if result_queue is provided the key of each
+    batch is sent to result_queue, see receive_results. Batches that are small enough
+    (see AbstractResultQueue.max_inline_batch_bytes) are sent directly on result_queue
+    instead of being written to the storage bucket. To make that work for short tasks,
+    we send the current batch before adding a result that would make it too big to
+    send inline. close must be called to write the last batch.
+
+    If leases is provided, tasks are removed from it once their results have been
+    written.
+    """
+
+    def __init__(
+        self,
+        storage_bucket: AbstractStorageBucket,
+        job_id: str,
+        uploads: BackgroundUploads,
+        result_queue: Optional[AbstractResultQueue] = None,
+        max_batch_bytes: int = _TASK_RESULT_BATCH_MAX_BYTES,
+        max_batch_seconds: float = _TASK_RESULT_BATCH_MAX_SECONDS,
+        leases: Optional[TaskLeases] = None,
+    ):
+        self._storage_bucket = storage_bucket
+        self._job_id = job_id
+        self._uploads = uploads
+        self._result_queue = result_queue
+        self._leases = leases
+        self._max_batch_bytes = max_batch_bytes
+        self._max_batch_seconds = max_batch_seconds
+        if result_queue is not None:
+            self._max_inline_bytes = result_queue.max_inline_batch_bytes()
+        else:
+            self._max_inline_bytes = 0
+
+        # batch ids just need to be unique within the job
+        self._batcher_id = str(uuid.uuid4())
+        self._next_batch_index = 0
+
+        self._batch: List[Tuple[int, int, ProcessState]] = []
+        self._batch_bytes = 0
+        self._flush_timer: Optional[asyncio.Task[None]] = None
+
+    async def add(
+        self, task_id: int, attempt: int, process_state: ProcessState
+    ) -> None:
+        result_bytes = process_state.ByteSize() + _TASK_RESULT_HEADER.size
+        if (
+            self._batch
+            and self._batch_bytes
+            <= self._max_inline_bytes
+            < self._batch_bytes + result_bytes
+        ):
+            # send the current batch while it can still be sent inline
+            await self.flush()
+
+        self._batch.append((task_id, attempt, process_state))
+        self._batch_bytes += result_bytes
+
+        if self._batch_bytes >= self._max_batch_bytes:
+            await self.flush()
+        elif self._flush_timer is None:
+            self._flush_timer = asyncio.create_task(self._flush_after_timeout())
+
+    async def _flush_after_timeout(self) -> None:
+        await asyncio.sleep(self._max_batch_seconds)
+        # flush would cancel us, so clear _flush_timer first
+        self._flush_timer = None
+        await self.flush()
+
+    async def flush(self) -> None:
+        """Starts writing the current batch (if there is one) via uploads"""
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+
+        if not self._batch:
+            return
+
+        batch, self._batch, self._batch_bytes = self._batch, [], 0
+        key = storage_key_task_result_batch(
+            self._job_id, f"{self._batcher_id}.{self._next_batch_index:06d}"
+        )
+        self._next_batch_index += 1
+        await self._uploads.add(self._write_batch(key, batch))
+
+    async def _write_batch(
+        self, key: str, batch: List[Tuple[int, int, ProcessState]]
+    ) -> None:
+        data = serialize_task_result_batch(batch)
+        if self._result_queue is not None and len(data) <= self._max_inline_bytes:
+            await self._result_queue.send_result_batch(data)
+        else:
+            await self._storage_bucket.write_bytes(data, key)
+            if self._result_queue is not None:
+                await self._result_queue.send_result_keys([key])
+
+        if self._leases is not None:
+            await self._leases.remove(
+                (task_id, attempt) for task_id, attempt, _ in batch
+            )
+
+    async def close(self) -> None:
+        """Writes the current batch. Callers should then wait for uploads"""
+        await self.flush()
+
+    def cancel(self) -> None:
+        """Discards the current batch"""
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+        self._batch, self._batch_bytes = [], 0
 
 
-async def receive_results(
+async def _download_results(
+    storage_bucket: AbstractStorageBucket,
+    keys: Iterable[str],
+    results_prefix: str,
+    delete_tasks: List[asyncio.Task[None]],
+) -> Tuple[List[TaskProcessState], List[WorkerProcessState]]:
+    """
+    Downloads and parses the .taskresult, .taskresultbatch and .process_state files at
+    keys. Adds tasks
+    that delete the downloaded files to delete_tasks.
+    """
+    download_tasks = [
+        asyncio.create_task(storage_bucket.get_bytes_and_key(key)) for key in keys
+    ]
+
+    task_results = []
+    worker_results = []
+    for task_result_future in asyncio.as_completed(download_tasks):
+        process_state_bytes, key = await task_result_future
+        if key.endswith(STORAGE_KEY_TASK_RESULT_BATCH_SUFFIX):
+            task_results.extend(parse_task_result_batch(process_state_bytes))
+        elif key.endswith(STORAGE_KEY_TASK_RESULT_SUFFIX):
+            task_id, attempt = parse_storage_key_task_result(key, results_prefix)
+            task_results.append(
+                TaskProcessState(
+                    task_id, attempt, ProcessState.FromString(process_state_bytes)
+                )
+            )
+        elif key.endswith(STORAGE_KEY_PROCESS_STATE_SUFFIX):
+            worker_index = parse_storage_key_process_state(key, results_prefix)
+            worker_results.append(
+                WorkerProcessState(
+                    worker_index, ProcessState.FromString(process_state_bytes)
+                )
+            )
+        else:
+            print(f"Warning, unrecognized key {key}, will ignore")
+            continue  # don't delete if we can't parse the key
+
+        delete_tasks.append(asyncio.create_task(storage_bucket.delete_object(key)))
+
+    return task_results, worker_results
+
+
+def receive_results(
     storage_bucket: AbstractStorageBucket,
     job_id: str,
     stop_receiving: asyncio.Event,
     all_workers_exited: asyncio.Event,
     initial_wait_seconds: int = 1,
     receive_message_wait_seconds: int = 20,
+    result_queue: Optional[AbstractResultQueue] = None,
 ) -> AsyncIterable[Tuple[List[TaskProcessState], List[WorkerProcessState]]]:
     """
     Listens to a result queue until we have results for num_tasks.
@@ -305,13 +863,146 @@ async def receive_results(
     As results become available, yields (task results, worker results). Task results
     will be a list of TaskProcessState. Worker results will be a list of
     WorkerProcessState
+
+    If result_queue is provided, we find out about new results from result_queue (see
+    complete_task and TaskResultBatcher), otherwise we poll the storage bucket with
+    list_objects. Task results sent directly on result_queue are yielded along with the
+    results downloaded from the storage bucket.
     """
+    if result_queue is not None:
+        return _receive_results_from_queue(
+            storage_bucket,
+            job_id,
+            stop_receiving,
+            all_workers_exited,
+            receive_message_wait_seconds,
+            result_queue,
+        )
+    else:
+        return _receive_results_by_listing(
+            storage_bucket,
+            job_id,
+            stop_receiving,
+            all_workers_exited,
+            initial_wait_seconds,
+            receive_message_wait_seconds,
+        )
+
+
+# Even if we have a result queue, we still list the storage bucket every so often,
+# because workers write their final .process_state files without sending a message, and
+# just in case a message gets lost
+_LIST_RESULTS_INTERVAL_SECONDS = 30
+
+
+async def _receive_results_from_queue(
+    storage_bucket: AbstractStorageBucket,
+    job_id: str,
+    stop_receiving: asyncio.Event,
+    all_workers_exited: asyncio.Event,
+    receive_message_wait_seconds: int,
+    result_queue: AbstractResultQueue,
+) -> AsyncIterable[Tuple[List[TaskProcessState], List[WorkerProcessState]]]:
+    """See receive_results"""
+
+    # Same behavior as _receive_results_by_listing for stop_receiving and
+    # all_workers_exited
+
+    delete_tasks: List[asyncio.Task[None]] = []
+
+    try:
+        results_prefix = storage_prefix_outputs(job_id)
+        download_keys_received: Set[str] = set()
+        # messages can be delivered more than once, so we need to deduplicate task
+        # results that were sent inline
+        inline_results_received: Set[Tuple[int, int]] = set()
+        last_listed = time.time()
+        workers_exited_wait_count = 0
+        received_results = False
+        while not stop_receiving.is_set() and (
+            workers_exited_wait_count < 3 or received_results
+        ):
+            if all_workers_exited.is_set():
+                workers_exited_wait_count += 1
+                # there shouldn't be many more results coming in, so don't wait long
+                wait = 1
+            else:
+                wait = receive_message_wait_seconds
+
+            receive_task = asyncio.create_task(result_queue.receive_results(wait))
+            events_to_wait_for = [asyncio.create_task(stop_receiving.wait())]
+            if workers_exited_wait_count == 0:
+                events_to_wait_for.append(
+                    asyncio.create_task(all_workers_exited.wait())
+                )
+            await asyncio.wait(
+                [receive_task, *events_to_wait_for],
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            for event_task in events_to_wait_for:
+                event_task.cancel()
+            if stop_receiving.is_set():
+                await cancel_task(receive_task)
+                break
+
+            if receive_task.done():
+                keys, inline_batches = receive_task.result()
+            else:
+                # all_workers_exited was set. Any messages that were in flight will be
+                # picked up by the next receive, and keys will also be picked up by
+                # list_objects below
+                await cancel_task(receive_task)
+                keys, inline_batches = [], []
+
+            inline_results = []
+            for inline_batch in inline_batches:
+                for task_result in parse_task_result_batch(inline_batch):
+                    task_result_id = (task_result.task_id, task_result.attempt)
+                    if task_result_id not in inline_results_received:
+                        inline_results_received.add(task_result_id)
+                        inline_results.append(task_result)
+
+            if (
+                workers_exited_wait_count > 0
+                or time.time() - last_listed > _LIST_RESULTS_INTERVAL_SECONDS
+            ):
+                keys.extend(await storage_bucket.list_objects(results_prefix))
+                last_listed = time.time()
+
+            new_keys = [
+                key for key in dict.fromkeys(keys) if key not in download_keys_received
+            ]
+            download_keys_received.update(new_keys)
+
+            received_results = len(new_keys) > 0 or len(inline_results) > 0
+            if received_results:
+                if new_keys:
+                    task_results, worker_results = await _download_results(
+                        storage_bucket, new_keys, results_prefix, delete_tasks
+                    )
+                    task_results.extend(inline_results)
+                else:
+                    task_results, worker_results = inline_results, []
+                yield task_results, worker_results
+    finally:
+        await asyncio.gather(*delete_tasks, return_exceptions=True)
+
+
+async def _receive_results_by_listing(
+    storage_bucket: AbstractStorageBucket,
+    job_id: str,
+    stop_receiving: asyncio.Event,
+    all_workers_exited: asyncio.Event,
+    initial_wait_seconds: int,
+    receive_message_wait_seconds: int,
+) -> AsyncIterable[Tuple[List[TaskProcessState], List[WorkerProcessState]]]:
+    """See receive_results"""
 
     # Behavior is that if stop_receiving is set, we want to return immediately. If
     # all_workers_exited is set, then keep trying for about 3 seconds (just in case some
     # results are still coming in), and then return
 
-    delete_tasks = []
+    delete_tasks: List[asyncio.Task[None]] = []
 
     try:
         results_prefix = storage_prefix_outputs(job_id)
@@ -347,50 +1038,19 @@ async def receive_results(
 
             keys = await storage_bucket.list_objects(results_prefix)
 
-            download_tasks = []
-            for key in keys:
-                if key not in download_keys_received:
-                    download_tasks.append(
-                        asyncio.create_task(storage_bucket.get_bytes_and_key(key))
-                    )
-
+            new_keys = [key for key in keys if key not in download_keys_received]
             download_keys_received.update(keys)
 
-            if len(download_tasks) == 0:
+            if len(new_keys) == 0:
                 if wait == 0:
                     wait = 1
                 else:
                     wait = min(wait + 1, receive_message_wait_seconds)
             else:
                 wait = 0
-                task_results = []
-                worker_results = []
-                for task_result_future in asyncio.as_completed(download_tasks):
-                    process_state_bytes, key = await task_result_future
-                    process_state = ProcessState()
-                    process_state.ParseFromString(process_state_bytes)
-                    if key.endswith(STORAGE_KEY_TASK_RESULT_SUFFIX):
-                        task_id, attempt = parse_storage_key_task_result(
-                            key, results_prefix
-                        )
-                        task_results.append(
-                            TaskProcessState(task_id, attempt, process_state)
-                        )
-                    elif key.endswith(STORAGE_KEY_PROCESS_STATE_SUFFIX):
-                        worker_index = parse_storage_key_process_state(
-                            key, results_prefix
-                        )
-                        worker_results.append(
-                            WorkerProcessState(worker_index, process_state)
-                        )
-                    else:
-                        print(f"Warning, unrecognized key {key}, will ignore")
-                        continue  # don't delete if we can't parse the key
-
-                    delete_tasks.append(
-                        asyncio.create_task(storage_bucket.delete_object(key))
-                    )
-                yield task_results, worker_results
+                yield await _download_results(
+                    storage_bucket, new_keys, results_prefix, delete_tasks
+                )
     finally:
         await asyncio.gather(*delete_tasks, return_exceptions=True)
 
@@ -446,10 +1106,67 @@ async def get_job_completion_from_process_state(
         raise MeadowrunException(process_state)
 
 
-# This is ugly, but avoids repeated checking if the same bucket+key exists. Only used in
-# ensure_uploaded_incremental
-_existing_keys: Set[Tuple[str, str]] = set()
+# ensure_uploaded_incremental keeps a list of the keys that it has uploaded to each
+# storage bucket in the local cache (see local_cache), so that new processes don't have
+# to check whether each chunk exists. Objects in the storage bucket get deleted by its
+# lifecycle policy a fixed number of days after they were created (14 by default, see
+# e.g. ensure_bucket in aws_install_uninstall), so we record when we uploaded each key,
+# never refresh that time, and forget keys after _UPLOADED_KEYS_TTL, which needs to be
+# well under the lifecycle policy's expiration. We don't know when keys that we didn't
+# upload were created, so we don't record those and check whether they exist each
+# time.
+_UPLOADED_KEYS_PREFIX = "uploaded_keys"
+_UPLOADED_KEYS_FILENAME = f"{_UPLOADED_KEYS_PREFIX}-{{bucket_hash}}.json"
+_UPLOADED_KEYS_TTL = datetime.timedelta(days=1)
+# The number of keys that one list_objects request returns (S3 and Google Cloud Storage
+# return up to 1000, Azure up to 5000), see _write_chunks_if_not_exist
+_LIST_OBJECTS_PAGE_SIZE = 1000
 _CHUNKS_KEY = "chunks"
+# the size of each chunk in bytes, so that download_chunked_file knows where each chunk
+# goes before downloading the chunks before it
+_SIZES_KEY = "sizes"
+# limits how many chunks download_chunked_file downloads (and keeps in memory) at once
+_MAX_CONCURRENT_CHUNK_DOWNLOADS = 16
+
+
+def _uploaded_keys_filename(storage_bucket: AbstractStorageBucket) -> str:
+    return _UPLOADED_KEYS_FILENAME.format(
+        bucket_hash=hashlib.blake2b(
+            storage_bucket.get_cache_key().encode("utf-8"), digest_size=16
+        ).hexdigest()
+    )
+
+
+def _get_uploaded_keys(storage_bucket: AbstractStorageBucket) -> Dict[str, float]:
+    """
+    Returns key -> time that we uploaded that key for keys that we've uploaded in the
+    last _UPLOADED_KEYS_TTL
+    """
+    try:
+        cached = get_cached_json(
+            _uploaded_keys_filename(storage_bucket), _UPLOADED_KEYS_TTL
+        )
+    except ValueError:
+        # e.g. another process was writing the file at the same time
+        return {}
+    if not isinstance(cached, dict):
+        return {}
+
+    cutoff = time.time() - _UPLOADED_KEYS_TTL.total_seconds()
+    return {key: t for key, t in cached.items() if t > cutoff}
+
+
+def _save_uploaded_keys(
+    storage_bucket: AbstractStorageBucket, uploaded_keys: Dict[str, float]
+) -> None:
+    try:
+        save_json_to_cache(_uploaded_keys_filename(storage_bucket), uploaded_keys)
+    except OSError as e:
+        print(f"Warning, unable to save the list of uploaded files: {e}")
+
+
+def clear_uploaded_keys_cache() -> None:
+    clear_cache(_UPLOADED_KEYS_PREFIX)
 
 
 async def ensure_uploaded_incremental(
@@ -467,85 +1184,240 @@ async def ensure_uploaded_incremental(
     The file is split using content-based-chunking - this means there's no exact size
     for each chunk, but the size can be controlled by setting avg_chunk_size.
 
-    If any S3 object already exists, it is not re-uploaded.
+    If any S3 object already exists, it is not re-uploaded. The JSON file is only
+    uploaded after all of the chunks, so if the JSON file exists we don't check for the
+    chunks. Keys that we know exist are cached locally (see _get_uploaded_keys), so
+    uploading a file that hasn't changed usually doesn't require any requests.
 
     key_prefix should usually be "" or end in a "/" like "code/".
 
     Returns the key of the JSON file in the S3 bucket, e.g. "code/123456789abcdefg.json"
     """
 
-    # TODO: only check for existence of chunks if chunks_json does not exist?
-
-    chunk_upload_tasks = []
+    chunks: Dict[str, bytes] = {}
     keys = []
+    sizes = []
     for chunk in fastcdc_py(
         local_file_path, avg_size=avg_chunk_size, fat=True, hf=hashlib.blake2b
     ):
         key = f"{key_prefix}{chunk.hash}.part"
         keys.append(key)
-        cache_key = (storage_bucket.get_cache_key(), key)
-        if (storage_bucket.get_cache_key(), key) not in _existing_keys:
-            chunk_upload_tasks.append(
-                asyncio.create_task(
-                    storage_bucket.write_bytes_if_not_exists(chunk.data, key)
-                )
-            )
-            _existing_keys.add(cache_key)
-
-    results = await asyncio.gather(*chunk_upload_tasks, return_exceptions=True)
-    for result in results:
-        if isinstance(result, Exception):
-            # on exceptions, we're not sure what the state of the uploaded keys is.
-            _existing_keys.clear()
-            raise result
+        sizes.append(len(chunk.data))
+        chunks[key] = chunk.data
 
-    chunks_json = json.dumps({_CHUNKS_KEY: keys}).encode("utf-8")
+    chunks_json = json.dumps({_CHUNKS_KEY: keys, _SIZES_KEY: sizes}).encode("utf-8")
     chunks_json_key = f"{key_prefix}{hashlib.blake2b(chunks_json).hexdigest()}.json"
-    await storage_bucket.write_bytes_if_not_exists(chunks_json, chunks_json_key)
+
+    uploaded_keys = _get_uploaded_keys(storage_bucket)
+    if chunks_json_key in uploaded_keys:
+        return chunks_json_key
+
+    if await storage_bucket.exists(chunks_json_key):
+        # we didn't upload this, see _UPLOADED_KEYS_FILENAME
+        return chunks_json_key
+
+    unknown_keys = [key for key in chunks if key not in uploaded_keys]
+    written_keys = await _write_chunks_if_not_exist(
+        storage_bucket, chunks, unknown_keys, key_prefix
+    )
+
+    await storage_bucket.write_bytes(chunks_json, chunks_json_key)
+
+    # keys that were already in uploaded_keys keep the time they were uploaded
+    now = time.time()
+    for key in written_keys:
+        uploaded_keys[key] = now
+    uploaded_keys[chunks_json_key] = now
+    _save_uploaded_keys(storage_bucket, uploaded_keys)
 
     return chunks_json_key
 
 
+async def _write_chunks_if_not_exist(
+    storage_bucket: AbstractStorageBucket,
+    chunks: Dict[str, bytes],
+    unknown_keys: List[str],
+    key_prefix: str,
+) -> List[str]:
+    """
+    Writes the chunks in unknown_keys that don't exist in the storage bucket yet and
+    returns the keys that were written.
+
+    We can check whether each chunk exists (one request per chunk) or list the objects
+    that start with the first few characters of the chunks' hashes (one request per
+    _LIST_OBJECTS_PAGE_SIZE objects, shared by all of the chunks that start with those
+    characters). We never list all of key_prefix, as it is shared with every other file
+    uploaded to the bucket (e.g. code_cache/), and could have any number of objects.
+    Instead, we list each hash prefix if that is expected to take fewer requests than
+    checking its chunks individually. We don't know how many objects there are under a
+    hash prefix until we list one, so we list the hash prefix with the most chunks first
+    and assume that the other hash prefixes have as many objects as that one.
+    """
+    if not unknown_keys:
+        return []
+
+    to_check: List[str] = []
+    if storage_bucket.list_objects_returns_all_keys:
+        # aim for a few chunks per hash prefix, hashes are hex so there are 16 ** n
+        # hash prefixes of length n
+        hash_prefix_length = max(1, int(math.log(len(unknown_keys) / 4, 16)))
+        groups: Dict[str, List[str]] = collections.defaultdict(list)
+        for key in unknown_keys:
+            groups[key[: len(key_prefix) + hash_prefix_length]].append(key)
+        sorted_groups = sorted(
+            groups.items(), key=lambda item: len(item[1]), reverse=True
+        )
+
+        list_requests_per_prefix = 1
+        to_list: List[Tuple[str, List[str]]] = []
+        existing_keys: Set[str] = set()
+        for i, (prefix, keys) in enumerate(sorted_groups):
+            if len(keys) <= list_requests_per_prefix:
+                to_check.extend(keys)
+            elif i == 0:
+                listed_keys = await storage_bucket.list_objects(prefix)
+                existing_keys.update(listed_keys)
+                to_list.append((prefix, keys))
+                list_requests_per_prefix = max(
+                    1, math.ceil(len(listed_keys) / _LIST_OBJECTS_PAGE_SIZE)
+                )
+            else:
+                to_list.append((prefix, keys))
+
+        for listed_keys in await gather_or_cancel(
+            *(storage_bucket.list_objects(prefix) for prefix, _ in to_list[1:])
+        ):
+            existing_keys.update(listed_keys)
+        keys_to_write = [
+            key for _, keys in to_list for key in keys if key not in existing_keys
+        ]
+    else:
+        to_check = unknown_keys
+        keys_to_write = []
+
+    were_written = await gather_or_cancel(
+        *(
+            storage_bucket.write_bytes_if_not_exists(chunks[key], key)
+            for key in to_check
+        ),
+        *(storage_bucket.write_bytes(chunks[key], key) for key in keys_to_write),
+    )
+    return keys_to_write + [
+        key for key, was_written in zip(to_check, were_written) if was_written
+    ]
+
+
 async def download_chunked_file(
     storage_bucket: AbstractStorageBucket,
     object_name: str,
-    file_name: str,
+    file: Union[str, IO[bytes]],
+    chunk_cache: Optional[ChunkCache] = None,
 ) -> None:
-    """Download a file that was uploaded in chunks via ensure_uploaded_incremental"""
-    chunk_list_bs = await storage_bucket.get_bytes(object_name)
-    chunks = json.loads(chunk_list_bs.decode("utf-8"))[_CHUNKS_KEY]
+    """
+    Download a file that was uploaded in chunks via ensure_uploaded_incremental. file
+    can be a file name or a seekable file object opened for writing, in which case the
+    chunks are written starting at offset 0.
+
+    Up to _MAX_CONCURRENT_CHUNK_DOWNLOADS chunks are downloaded at a time, and each
+    chunk is written straight into its place in the destination file as soon as it's
+    downloaded, so the file is only written once.
+
+    If chunk_cache is provided, only chunks that aren't already in the cache are
+    downloaded, and downloaded chunks are added to the cache.
+    """
+    chunk_list = json.loads(
+        (await storage_bucket.get_bytes(object_name)).decode("utf-8")
+    )
+    chunks: List[str] = chunk_list[_CHUNKS_KEY]
+    sizes: Optional[List[int]] = chunk_list.get(_SIZES_KEY)
+
+    if isinstance(file, str):
+        with open(file, "wb") as f:
+            await _assemble_chunks(storage_bucket, chunks, sizes, f, chunk_cache)
+    else:
+        await _assemble_chunks(storage_bucket, chunks, sizes, file, chunk_cache)
+
+    if chunk_cache is not None:
+        await chunk_cache.evict_async()
+
 
-    with tempfile.TemporaryDirectory() as tmp:
-        await _download_files(storage_bucket, chunks, tmp)
-        _concat_chunks(tmp, chunks, file_name)
+async def _get_chunk(
+    storage_bucket: AbstractStorageBucket, key: str, chunk_cache: Optional[ChunkCache]
+) -> bytes:
+    if chunk_cache is not None:
+        data = await chunk_cache.get_async(key)
+        if data is not None:
+            return data
 
+    data = await storage_bucket.get_bytes(key)
+    if chunk_cache is not None:
+        await chunk_cache.put_async(key, data)
+    return data
 
-def _concat_chunks(
-    source_folder: str, chunks: Iterable[str], destination_file: str
+
+async def _assemble_chunks(
+    storage_bucket: AbstractStorageBucket,
+    chunks: List[str],
+    sizes: Optional[List[int]],
+    destination: IO[bytes],
+    chunk_cache: Optional[ChunkCache],
 ) -> None:
-    with open(destination_file, "wb") as dest:
-        for source_file in chunks:
-            with open(
-                os.path.join(source_folder, os.path.basename(source_file)), "rb"
-            ) as src:
-                shutil.copyfileobj(src, dest)
+    if sizes is None:
+        # chunk lists uploaded by older versions of meadowrun don't have sizes
+        await _assemble_chunks_in_order(
+            storage_bucket, chunks, destination, chunk_cache
+        )
+        return
+
+    # keys can contain duplicates, each key is only downloaded once
+    offsets: Dict[str, List[int]] = {}
+    offset = 0
+    for key, size in zip(chunks, sizes):
+        offsets.setdefault(key, []).append(offset)
+        offset += size
+    # preallocate the destination file
+    destination.truncate(offset)
+
+    semaphore = asyncio.Semaphore(_MAX_CONCURRENT_CHUNK_DOWNLOADS)
+
+    async def download_chunk(key: str, size: int) -> None:
+        async with semaphore:
+            data = await _get_chunk(storage_bucket, key, chunk_cache)
+        if len(data) != size:
+            raise ValueError(
+                f"Chunk {key} should be {size} bytes but {len(data)} bytes were "
+                "downloaded"
+            )
+        for chunk_offset in offsets[key]:
+            destination.seek(chunk_offset)
+            destination.write(data)
+
+    await gather_or_cancel(
+        *(download_chunk(key, size) for key, size in dict(zip(chunks, sizes)).items())
+    )
 
 
-async def _download_files(
+async def _assemble_chunks_in_order(
     storage_bucket: AbstractStorageBucket,
-    keys: Iterable[str],
-    target_folder: str,
+    chunks: List[str],
+    destination: IO[bytes],
+    chunk_cache: Optional[ChunkCache],
 ) -> None:
-    """Download all given keys in the bucket as separate files to the target folder, in
-    parallel. Keys can contain duplicates, they'll be downloaded only once.
-    """
-    download_tasks = []
-    for key in set(keys):
-        download_tasks.append(
-            asyncio.create_task(
-                storage_bucket.get_file(
-                    key, os.path.join(target_folder, os.path.basename(key))
-                )
+    """
+    Without the chunk sizes we don't know where each chunk goes until all of the chunks
+    before it have been downloaded, so we download up to
+    _MAX_CONCURRENT_CHUNK_DOWNLOADS chunks ahead and write them in order.
+    """
+    downloads: Deque[asyncio.Task[bytes]] = collections.deque()
+    try:
+        for key in chunks:
+            if len(downloads) >= _MAX_CONCURRENT_CHUNK_DOWNLOADS:
+                destination.write(await downloads.popleft())
+            downloads.append(
+                asyncio.create_task(_get_chunk(storage_bucket, key, chunk_cache))
             )
-        )
-    await asyncio.gather(*download_tasks)
+        while downloads:
+            destination.write(await downloads.popleft())
+    finally:
+        for download in downloads:
+            await cancel_task(download)
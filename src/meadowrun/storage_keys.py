@@ -6,8 +6,10 @@ STORAGE_ENV_CACHE_PREFIX = "env_cache/"
 STORAGE_CODE_CACHE_PREFIX = "code_cache/"
 
 
-def storage_key_task_args(job_id: str) -> str:
-    return f"inputs/{job_id}.task_args"
+def storage_key_task_args(job_id: str, segment: int) -> str:
+    # the task arguments for a job are uploaded in segments, see
+    # upload_task_args_streaming
+    return f"inputs/{job_id}.{segment:05d}.task_args"
 
 
 def storage_key_ranges(job_id: str) -> str:
@@ -46,6 +48,62 @@ def parse_storage_key_task_result(key: str, results_prefix: str) -> Tuple[int, i
     return int(task_id), int(attempt)
 
 
+# The following keys are used to assign tasks to workers dynamically, see
+# _dynamic_agent_function. They're under the inputs prefix so that they get cleaned up
+# along with the task arguments
+
+
+def storage_prefix_task_claims(job_id: str) -> str:
+    return f"{storage_prefix_inputs(job_id)}.claims/"
+
+
+def storage_prefix_task_steals(job_id: str) -> str:
+    return f"{storage_prefix_inputs(job_id)}.steals/"
+
+
+def storage_prefix_task_completions(job_id: str) -> str:
+    return f"{storage_prefix_inputs(job_id)}.completions/"
+
+
+def storage_prefix_task_retries(job_id: str) -> str:
+    return f"{storage_prefix_inputs(job_id)}.retries/"
+
+
+def storage_key_task_attempt(prefix: str, task_id: int, attempt: int) -> str:
+    """
+    prefix should be one of storage_prefix_task_claims, storage_prefix_task_steals,
+    etc.
+    """
+    return f"{prefix}{task_id:06d}.{attempt:03d}"
+
+
+def parse_storage_key_task_attempt(key: str, prefix: str) -> Tuple[int, int]:
+    """Returns task_id, attempt based on a key from storage_key_task_attempt"""
+    [task_id, attempt] = key.replace(prefix, "").split(".")
+    return int(task_id), int(attempt)
+
+
+def storage_key_job_done(job_id: str) -> str:
+    return f"{storage_prefix_inputs(job_id)}.done"
+
+
+def storage_key_worker_lease(base_job_id: str, job_id: str) -> str:
+    # see TaskLeases. Also under the inputs prefix so it gets cleaned up with the task
+    # arguments
+    return f"{storage_prefix_inputs(base_job_id)}.leases/{job_id}"
+
+
+def storage_key_task_result_batch(job_id: str, batch_id: str) -> str:
+    # see TaskResultBatcher
+    return (
+        f"{storage_prefix_outputs(job_id)}{batch_id}"
+        f"{STORAGE_KEY_TASK_RESULT_BATCH_SUFFIX}"
+    )
+
+
+STORAGE_KEY_TASK_RESULT_BATCH_SUFFIX = ".taskresultbatch"
+
+
 STORAGE_KEY_PROCESS_STATE_SUFFIX = ".process_state"
 
 
@@ -0,0 +1,154 @@
+"""
+Support for the chunk_size option of run_map and run_map_as_completed. Consecutive args
+are packed into a single task (see chunk_args), the task worker runs the user function
+on each arg in the chunk in a loop (see ChunkedFunction), and unpack_chunk_results turns
+the result of each chunk back into one TaskResult per arg. This means that for very
+short tasks we only pay the per-task overhead (a queue message, an IPC round trip to the
+task worker, a result object) once per chunk rather than once per arg.
+"""
+
+from __future__ import annotations
+
+import math
+import traceback
+from typing import (
+    Any,
+    AsyncIterable,
+    Callable,
+    Generic,
+    List,
+    Sequence,
+    Tuple,
+    TypeVar,
+    Union,
+    TYPE_CHECKING,
+)
+
+from meadowrun.run_job_core import TaskResult
+
+if TYPE_CHECKING:
+    from typing_extensions import Literal
+
+
+_T = TypeVar("_T")
+_U = TypeVar("_U")
+
+# With chunk_size="auto", we aim for each worker to run about this many chunks. More
+# chunks means better load balancing between workers, fewer chunks means less overhead
+_AUTO_CHUNKS_PER_WORKER = 10
+
+# (is_success, result if is_success otherwise the exception tuple as in
+# TaskResult.exception, the attempt within the chunk)
+_ChunkElementResult = Tuple[bool, Any, int]
+
+
+def get_chunk_size(
+    chunk_size: Union[int, Literal["auto"]], num_args: int, num_concurrent_tasks: int
+) -> int:
+    if chunk_size == "auto":
+        return max(
+            1, math.ceil(num_args / (num_concurrent_tasks * _AUTO_CHUNKS_PER_WORKER))
+        )
+    if not isinstance(chunk_size, int) or chunk_size < 1:
+        raise ValueError('chunk_size must be a positive integer or "auto"')
+    return chunk_size
+
+
+def chunk_args(args: Sequence[_T], chunk_size: int) -> List[Sequence[_T]]:
+    return [args[i : i + chunk_size] for i in range(0, len(args), chunk_size)]
+
+
+class ChunkedFunction(Generic[_T, _U]):
+    """
+    Wraps the user function so that it takes a chunk of args and returns a
+    _ChunkElementResult for each one. An arg that raises an exception is retried
+    immediately, up to max_num_task_attempts times in total, so that an exception in
+    one arg doesn't require rerunning the whole chunk. Failures that take down the whole
+    task worker (e.g. running out of memory) fail the whole chunk, which is then retried
+    (or not) like any other task.
+    """
+
+    def __init__(self, function: Callable[[_T], _U], max_num_task_attempts: int):
+        self._function = function
+        self._max_num_task_attempts = max_num_task_attempts
+
+    def __call__(self, chunk: Sequence[_T]) -> List[_ChunkElementResult]:
+        results: List[_ChunkElementResult] = []
+        for arg in chunk:
+            attempt = 1
+            while True:
+                try:
+                    results.append((True, self._function(arg), attempt))
+                    break
+                except Exception as e:
+                    if attempt >= self._max_num_task_attempts:
+                        # same format as pickle_exception
+                        tb = "".join(
+                            traceback.format_exception(type(e), e, e.__traceback__)
+                        )
+                        results.append((False, (str(type(e)), str(e), tb), attempt))
+                        break
+                    traceback.print_exc()
+                    attempt += 1
+        return results
+
+
+def _unpack_chunk_result(
+    chunk_result: TaskResult[List[_ChunkElementResult]],
+    chunk_size: int,
+    num_args: int,
+) -> List[TaskResult]:
+    first_task_id = chunk_result.task_id * chunk_size
+    task_ids = range(first_task_id, min(first_task_id + chunk_size, num_args))
+
+    if chunk_result.is_success:
+        # we need the result to unpack it, so if it can't be unpickled, the whole chunk
+        # fails
+        unpickling_failure = chunk_result._unpickling_failure()
+        if unpickling_failure is not None:
+            chunk_result = unpickling_failure
+
+    if not chunk_result.is_success:
+        # the whole chunk failed, so every arg in it failed the same way
+        return [
+            TaskResult(
+                task_id,
+                is_success=False,
+                state=chunk_result.state,
+                exception=chunk_result.exception,
+                attempt=chunk_result.attempt,
+                log_file_name=chunk_result.log_file_name,
+            )
+            for task_id in task_ids
+        ]
+
+    assert chunk_result.result is not None
+    results = []
+    for task_id, (is_success, result, attempt) in zip(task_ids, chunk_result.result):
+        results.append(
+            TaskResult(
+                task_id,
+                is_success=is_success,
+                state="SUCCEEDED" if is_success else "PYTHON_EXCEPTION",
+                result=result if is_success else None,
+                exception=None if is_success else result,
+                # attempts of the whole chunk plus attempts within the chunk
+                attempt=chunk_result.attempt + attempt - 1,
+                log_file_name=chunk_result.log_file_name,
+            )
+        )
+    return results
+
+
+async def unpack_chunk_results(
+    chunk_results: AsyncIterable[TaskResult[List[_ChunkElementResult]]],
+    chunk_size: int,
+    num_args: int,
+) -> AsyncIterable[TaskResult]:
+    """
+    Turns the results of chunks created by chunk_args and run by ChunkedFunction into
+    results for the original args
+    """
+    async for chunk_result in chunk_results:
+        for task_result in _unpack_chunk_result(chunk_result, chunk_size, num_args):
+            yield task_result
@@ -0,0 +1,123 @@
+"""
+Support for run_map_ordered, which yields task results in the same order as the args as
+soon as each result and all of the results before it are available. Results that arrive
+before the results that come before them are held in a ReorderBuffer. A few of them are
+kept in memory, and the rest are spilled to a temporary file, so that a single slow
+early task doesn't require holding the results of the whole job in memory.
+"""
+
+from __future__ import annotations
+
+import pickle
+import tempfile
+from typing import IO, AsyncIterable, Dict, Generic, Iterable, Optional, Tuple, TypeVar
+
+from meadowrun.run_job_core import TaskResult
+
+
+_U = TypeVar("_U")
+
+
+class ReorderBuffer(Generic[_U]):
+    """
+    Holds out-of-order TaskResults until they can be returned in task_id order. At most
+    max_results_in_memory results are kept in memory. Once that limit is reached,
+    additional results are pickled and appended to a temporary file until they're
+    needed. The temporary file is created on demand and deleted by close.
+    """
+
+    def __init__(self, max_results_in_memory: int, first_task_id: int = 0):
+        if max_results_in_memory < 1:
+            raise ValueError("max_results_in_memory must be at least 1")
+        self._max_results_in_memory = max_results_in_memory
+        # the task_id of the next result to return
+        self.next_task_id = first_task_id
+        self._in_memory: Dict[int, TaskResult[_U]] = {}
+        # task_id -> (offset, length) in _spill_file
+        self._spilled: Dict[int, Tuple[int, int]] = {}
+        self._spill_file: Optional[IO[bytes]] = None
+
+    def __len__(self) -> int:
+        return len(self._in_memory) + len(self._spilled)
+
+    def add(self, task_result: TaskResult[_U]) -> None:
+        if (
+            task_result.task_id < self.next_task_id
+            or task_result.task_id in self._in_memory
+            or task_result.task_id in self._spilled
+        ):
+            # we already have a result for this task
+            return
+
+        if (
+            task_result.task_id == self.next_task_id
+            or len(self._in_memory) < self._max_results_in_memory
+        ):
+            self._in_memory[task_result.task_id] = task_result
+        else:
+            if self._spill_file is None:
+                self._spill_file = tempfile.TemporaryFile()
+            pickled = pickle.dumps(task_result, protocol=pickle.HIGHEST_PROTOCOL)
+            offset = self._spill_file.seek(0, 2)
+            self._spill_file.write(pickled)
+            self._spilled[task_result.task_id] = offset, len(pickled)
+
+    def _pop(self, task_id: int) -> TaskResult[_U]:
+        task_result = self._in_memory.pop(task_id, None)
+        if task_result is not None:
+            return task_result
+
+        offset, length = self._spilled.pop(task_id)
+        assert self._spill_file is not None
+        self._spill_file.seek(offset)
+        return pickle.loads(self._spill_file.read(length))
+
+    def pop_ready(self) -> Iterable[TaskResult[_U]]:
+        """
+        Removes and returns the results for next_task_id and consecutive task_ids after
+        it that are available
+        """
+        while (
+            self.next_task_id in self._in_memory or self.next_task_id in self._spilled
+        ):
+            task_result = self._pop(self.next_task_id)
+            self.next_task_id += 1
+            yield task_result
+
+    def pop_remaining(self) -> Iterable[TaskResult[_U]]:
+        """
+        Removes and returns all remaining results in task_id order, skipping over any
+        task_ids that we never got a result for
+        """
+        for task_id in sorted([*self._in_memory, *self._spilled]):
+            task_result = self._pop(task_id)
+            self.next_task_id = task_id + 1
+            yield task_result
+
+    def close(self) -> None:
+        if self._spill_file is not None:
+            self._spill_file.close()
+            self._spill_file = None
+        self._spilled.clear()
+
+
+async def ordered_task_results(
+    task_results: AsyncIterable[TaskResult[_U]], max_results_in_memory: int
+) -> AsyncIterable[TaskResult[_U]]:
+    """
+    Reorders task_results (e.g. from run_map_as_completed) into task_id order, see
+    ReorderBuffer
+    """
+    buffer: ReorderBuffer[_U] = ReorderBuffer(max_results_in_memory)
+    try:
+        async for task_result in task_results:
+            buffer.add(task_result)
+            for ready_result in buffer.pop_ready():
+                yield ready_result
+
+        # if any tasks are missing, e.g. because we gave up on workers, return what we
+        # have rather than waiting forever
+        for task_result in buffer.pop_remaining():
+            yield task_result
+    finally:
+        buffer.close()
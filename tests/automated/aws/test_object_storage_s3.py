@@ -8,7 +8,7 @@ import pytest
 from botocore.exceptions import ClientError
 from meadowrun.storage_grid_job import (
     S3Bucket,
-    _existing_keys,
+    clear_uploaded_keys_cache,
     download_chunked_file,
     ensure_uploaded_incremental,
     get_aws_s3_bucket,
@@ -23,7 +23,7 @@ if TYPE_CHECKING:
 
 @pytest.mark.asyncio
 async def test_incremental_fresh_upload(tmp_path: Path, mocker: MockerFixture) -> None:
-    _existing_keys.clear()
+    clear_uploaded_keys_cache()
 
     s3_client_mock = mocker.create_autospec(S3Client)
     bucket_name = "test_bucket"
@@ -77,7 +77,7 @@ async def test_incremental_fresh_upload(tmp_path: Path, mocker: MockerFixture) -
 
 @pytest.mark.asyncio
 async def test_incremental_no_upload(tmp_path: Path, mocker: MockerFixture) -> None:
-    _existing_keys.clear()
+    clear_uploaded_keys_cache()
     s3_client_mock = mocker.create_autospec(S3Client)
     bucket_name = "test_bucket"
     s3_client = S3Bucket(s3_client_mock, bucket_name, f"mock/{bucket_name}")
@@ -91,10 +91,17 @@ async def test_incremental_no_upload(tmp_path: Path, mocker: MockerFixture) -> N
         s3_client, str(local_file_path), key_prefix, avg_chunk_size=1000
     )
 
-    expected_call_count = 4
+    # the chunks json already exists, so we don't need to check the chunks
+    expected_call_count = 1
     assert s3_client_mock.head_object.call_count == expected_call_count
     assert s3_client_mock.head_object.await_count == expected_call_count
 
+    # the second time, we don't need to check anything
+    await ensure_uploaded_incremental(
+        s3_client, str(local_file_path), key_prefix, avg_chunk_size=1000
+    )
+    assert s3_client_mock.head_object.call_count == expected_call_count
+
     assert s3_client_mock.put_object.call_count == 0
     assert s3_client_mock.put_object.await_count == 0
 
@@ -103,7 +110,7 @@ async def test_incremental_no_upload(tmp_path: Path, mocker: MockerFixture) -> N
 async def test_incremental_roundtrip(tmp_path: Path) -> None:
     # this test actually uploads to S3
 
-    _existing_keys.clear()
+    clear_uploaded_keys_cache()
     region_name = "us-east-2"
     source_file = _make_big_file(tmp_path, size_bytes=8000)
     async with get_aws_s3_bucket(region_name) as s3_client:
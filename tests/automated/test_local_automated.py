@@ -4,6 +4,7 @@ manual intervention beyond some initial setup.
 """
 from __future__ import annotations
 
+import asyncio
 import os
 import pathlib
 import pickle
@@ -32,6 +33,7 @@ from suites import (
     _test_code_available,
 )
 from meadowrun import Deployment, Resources, TaskResult, run_command
+from meadowrun.abstract_result_queue import AbstractResultQueue
 from meadowrun.abstract_storage_bucket import AbstractStorageBucket
 from meadowrun.config import MEADOWRUN_INTERPRETER
 from meadowrun.deployment_internal_types import get_latest_interpreter_version
@@ -68,10 +70,13 @@ _U = TypeVar("_U")
 
 class LocalFileBucket(AbstractStorageBucket):
     """
-    Currently nothing on this class is implemented. If we want to be able to test e.g.
-    mirror_local we will need to implement methods on this class.
+    Stores objects as files under tmp_path. Not everything on this class is
+    implemented, if we want to be able to test e.g. mirror_local we will need to
+    implement more methods on this class.
     """
 
+    list_objects_returns_all_keys = True
+
     def __init__(self, tmp_path: pathlib.Path) -> None:
         self.tmp_path = tmp_path
 
@@ -83,10 +88,14 @@ class LocalFileBucket(AbstractStorageBucket):
             return f.read()
 
     async def try_get_bytes(self, key: str) -> Optional[bytes]:
-        raise NotImplementedError()
+        if not await self.exists(key):
+            return None
+        return await self.get_bytes(key)
 
     async def get_byte_range(self, key: str, byte_range: Tuple[int, int]) -> bytes:
-        raise NotImplementedError()
+        with open(self.tmp_path / key, "rb") as f:
+            f.seek(byte_range[0])
+            return f.read(byte_range[1] - byte_range[0] + 1)
 
     async def write_bytes(self, data: bytes, key: str) -> None:
         path = self.tmp_path / key
@@ -94,6 +103,16 @@ class LocalFileBucket(AbstractStorageBucket):
         with open(path, "wb") as f:
             f.write(data)
 
+    async def write_bytes_exclusive(self, data: bytes, key: str) -> bool:
+        path = self.tmp_path / key
+        os.makedirs(path.parent, exist_ok=True)
+        try:
+            with open(path, "xb") as f:
+                f.write(data)
+            return True
+        except FileExistsError:
+            return False
+
     async def exists(self, key: str) -> bool:
         return os.path.exists(self.tmp_path / key)
 
@@ -109,10 +128,43 @@ class LocalFileBucket(AbstractStorageBucket):
         raise NotImplementedError()
 
     async def list_objects(self, key_prefix: str) -> List[str]:
-        raise NotImplementedError()
+        return sorted(
+            path.relative_to(self.tmp_path).as_posix()
+            for path in self.tmp_path.rglob("*")
+            if path.is_file()
+            and path.relative_to(self.tmp_path).as_posix().startswith(key_prefix)
+        )
 
     async def delete_object(self, key: str) -> None:
-        raise NotImplementedError()
+        os.remove(self.tmp_path / key)
+
+
+class LocalResultQueue(AbstractResultQueue):
+    """An in-memory stand-in for e.g. SqsResultQueue"""
+
+    def __init__(self, max_inline_batch_bytes: int = 0) -> None:
+        self._max_inline_batch_bytes = max_inline_batch_bytes
+        self._messages: asyncio.Queue[Tuple[List[str], List[bytes]]] = asyncio.Queue()
+
+    def max_inline_batch_bytes(self) -> int:
+        return self._max_inline_batch_bytes
+
+    async def send_result_keys(self, keys: List[str]) -> None:
+        await self._messages.put((keys, []))
+
+    async def send_result_batch(self, batch: bytes) -> None:
+        await self._messages.put(([], [batch]))
+
+    async def receive_results(self, wait_seconds: int) -> Tuple[List[str], List[bytes]]:
+        try:
+            keys, batches = await asyncio.wait_for(self._messages.get(), wait_seconds)
+        except asyncio.TimeoutError:
+            return [], []
+        while not self._messages.empty():
+            more_keys, more_batches = self._messages.get_nowait()
+            keys = keys + more_keys
+            batches = batches + more_batches
+        return keys, batches
 
 
 class LocalHost(Host):
@@ -175,6 +227,9 @@ class LocalHost(Host):
         wait_for_result: WaitOption,
         max_num_task_attempts: int,
         retry_with_more_memory: bool,
+        speculative_execution_multiple: Optional[float],
+        num_task_workers_per_agent: int,
+        max_num_concurrent_tasks: Optional[int],
     ) -> Optional[Sequence[_U]]:
         return [
             result.result_or_raise()
@@ -188,6 +243,9 @@ class LocalHost(Host):
                 wait_for_result,
                 max_num_task_attempts,
                 retry_with_more_memory,
+                speculative_execution_multiple,
+                num_task_workers_per_agent,
+                max_num_concurrent_tasks,
             )
         ]
 
@@ -202,6 +260,9 @@ class LocalHost(Host):
         wait_for_result: WaitOption,
         max_num_task_attempts: int,
         retry_with_more_memory: bool,
+        speculative_execution_multiple: Optional[float],
+        num_task_workers_per_agent: int,
+        max_num_concurrent_tasks: Optional[int],
     ) -> AsyncIterable[TaskResult[_U]]:
         for i, arg in enumerate(args):
             result = await self.run_job(
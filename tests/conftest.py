@@ -14,6 +14,7 @@ from typing import (
     AsyncIterable,
     Callable,
     Iterable,
+    Optional,
     Tuple,
 )
 
@@ -37,10 +38,18 @@ if sys.platform == "win32" and sys.version_info < (3, 8):
 
 @pytest.fixture
 @pytest.mark.asyncio
-async def agent_server() -> AsyncIterable[TaskWorkerServer]:
+async def agent_server(
+    request: pytest.FixtureRequest, tmp_path: Path
+) -> AsyncIterable[TaskWorkerServer]:
     from meadowrun.run_job_local import TaskWorkerServer
 
-    server = await TaskWorkerServer.start_serving("127.0.0.1")
+    # parametrize with indirect=True and True to use shared memory
+    if getattr(request, "param", False):
+        shared_memory_path: Optional[str] = str(tmp_path / "shared_memory")
+    else:
+        shared_memory_path = None
+
+    server = await TaskWorkerServer.start_serving("127.0.0.1", shared_memory_path)
     yield server
     await server.close()
 
@@ -64,6 +73,12 @@ async def task_worker_process_monitor(
         try:
             python = Path(sys.executable)
             io_path = tmp_path / "testagent"
+            shared_memory_args = []
+            if agent_server.shared_memory_path is not None:
+                shared_memory_args = [
+                    "--shared-memory-path",
+                    agent_server.shared_memory_path,
+                ]
             monitor = WorkerProcessMonitor(
                 [
                     str(python),
@@ -80,6 +95,7 @@ async def task_worker_process_monitor(
                     "127.0.0.1",
                     "--port",
                     str(agent_server.port),
+                    *shared_memory_args,
                 ],
                 working_directory=None,
                 env_vars={"PYTHONPATH": "tests/example_user_code"},
@@ -1,3 +1,4 @@
+import pickle
 import sys
 import time
 from typing import Any
@@ -33,3 +34,14 @@ def crash(_: Any) -> None:
 
 def the_same(inp: Any) -> Any:
     return inp
+
+
+def large_buffer(size: int, padding: str = "") -> Any:
+    # gets pickled out-of-band with pickle protocol 5
+    return {"buffer": pickle.PickleBuffer(bytearray(b"x" * size)), "size": size}
+
+
+def mark_buffer(buffer: Any) -> Any:
+    # buffer is sent out-of-band and should be writable like an in-band argument
+    memoryview(buffer)[0:1] = b"y"
+    return pickle.PickleBuffer(buffer)
@@ -0,0 +1,616 @@
+from __future__ import annotations
+
+import asyncio
+import pickle
+from typing import (
+    Any,
+    AsyncIterable,
+    Dict,
+    List,
+    Sequence,
+    Tuple,
+    TYPE_CHECKING,
+    cast,
+)
+
+import pytest
+
+import meadowrun.alloc_vm
+from meadowrun.alloc_vm import (
+    GridJobCloudInterface,
+    GridJobDriver,
+    GridJobWorkerLauncher,
+    WorkerQueue,
+    WorkerTask,
+    _DurationWindow,
+    _StragglerSpeculator,
+    _TaskStates,
+    _WorkerAutoscaler,
+)
+from meadowrun.instance_selection import ResourcesInternal
+from meadowrun.meadowrun_pb2 import ProcessState
+from meadowrun.run_job_core import TaskProcessState, TaskResult
+
+if TYPE_CHECKING:
+    from meadowrun.meadowrun_pb2 import QualifiedFunctionName
+    from meadowrun.run_job_core import WorkerProcessState
+
+
+def _task_states_with_done_tasks(num_tasks: int, done: List[int]) -> _TaskStates:
+    task_states = _TaskStates()
+    task_states.add_tasks(num_tasks)
+    for task_id in done:
+        task_states.mark_done(task_id)
+    return task_states
+
+
+def test_task_states() -> None:
+    task_states = _TaskStates()
+    task_states.add_tasks(3)
+    assert task_states.num_outstanding == {0: 3}
+    assert list(task_states.latest_attempts) == [1, 1, 1]
+
+    task_states.set_queue_index(1, 1)
+    task_states.mark_done(0)
+    assert task_states.num_outstanding == {0: 1, 1: 1}
+    task_states.add_tasks(2)
+    assert task_states.num_outstanding == {0: 3, 1: 1}
+
+    task_states.mark_done(1)
+    # marking a task done twice doesn't change the counts
+    task_states.mark_done(1)
+    assert task_states.num_outstanding == {0: 3}
+    assert [task_states.is_done(task_id) for task_id in range(5)] == [
+        True,
+        True,
+        False,
+        False,
+        False,
+    ]
+
+
+def test_straggler_speculator(monkeypatch: pytest.MonkeyPatch) -> None:
+    now = 1000.0
+    monkeypatch.setattr(meadowrun.alloc_vm.time, "time", lambda: now)
+
+    speculator = _StragglerSpeculator(3)
+    worker_queue = WorkerQueue(0, 4, num_workers_launched=4)
+    # tasks 0, 1, 2 are done, tasks 3, 4 are still running
+    task_states = _task_states_with_done_tasks(5, [0, 1, 2])
+
+    # not enough completed tasks to know the median yet
+    speculator.task_succeeded(1)
+    speculator.task_succeeded(2)
+    assert speculator.get_stragglers(task_states, [worker_queue]) == []
+
+    speculator.task_succeeded(10)
+    # we find out that all tasks have been picked up at t=1000, so nothing has been
+    # running for longer than 3 * the median of 2 seconds yet
+    assert speculator.get_stragglers(task_states, [worker_queue]) == []
+
+    # task 4 was retried more recently, so only task 3 is a straggler
+    now = 1005.0
+    speculator.task_retried(4, 0)
+    now = 1007.0
+    assert speculator.get_stragglers(task_states, [worker_queue]) == [3]
+    # tasks are only speculatively executed once
+    now = 1012.0
+    assert speculator.get_stragglers(task_states, [worker_queue]) == [4]
+    assert speculator.get_stragglers(task_states, [worker_queue]) == []
+
+
+def test_straggler_speculator_no_idle_workers(monkeypatch: pytest.MonkeyPatch) -> None:
+    now = 1000.0
+    monkeypatch.setattr(meadowrun.alloc_vm.time, "time", lambda: now)
+
+    speculator = _StragglerSpeculator(3)
+    for _ in range(3):
+        speculator.task_succeeded(1)
+    worker_queue = WorkerQueue(0, 3, num_workers_launched=3)
+    task_states = _task_states_with_done_tasks(5, [0, 1, 2])
+
+    assert speculator.get_stragglers(task_states, [worker_queue]) == []
+    now = 1010.0
+    # there's only one idle worker
+    assert speculator.get_stragglers(task_states, [worker_queue]) == [3]
+    assert speculator.get_stragglers(task_states, [worker_queue]) == []
+
+
+def test_straggler_speculator_other_attempt_running(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    now = 1000.0
+    monkeypatch.setattr(meadowrun.alloc_vm.time, "time", lambda: now)
+
+    speculator = _StragglerSpeculator(3)
+    for _ in range(3):
+        speculator.task_succeeded(1)
+    worker_queue = WorkerQueue(0, 4, num_workers_launched=4)
+    task_states = _task_states_with_done_tasks(5, [0, 1, 2])
+
+    assert speculator.get_stragglers(task_states, [worker_queue]) == []
+    now = 1010.0
+    assert speculator.get_stragglers(task_states, [worker_queue]) == [3, 4]
+    for task_id in (3, 4):
+        task_states.latest_attempts[task_id] += 1
+
+    # task 3's speculative attempt fails, but the original attempt is still running
+    assert speculator.attempt_failed(3, 2)
+    assert not speculator.attempt_failed(3, 1)
+    # once the task is retried, we're back to one attempt
+    speculator.task_retried(3, 0)
+    assert speculator.attempt_failed(3, 3) is None
+
+    # task 4's original attempt fails, and then its speculative attempt succeeds
+    assert speculator.attempt_failed(4, 1)
+    speculator.task_done(4)
+    assert speculator.attempt_failed(4, 2) is None
+
+    # tasks that weren't speculatively executed only have one attempt
+    assert speculator.attempt_failed(0, 1) is None
+
+
+def test_duration_window() -> None:
+    window = _DurationWindow(3)
+    for duration in (5, 1, 3):
+        window.add(duration)
+    assert len(window) == 3
+    assert window.median() == 3
+
+    # the oldest duration (5) is dropped
+    window.add(2)
+    assert len(window) == 3
+    assert window.median() == 2
+
+
+def test_worker_autoscaler(monkeypatch: pytest.MonkeyPatch) -> None:
+    now = 1000.0
+    monkeypatch.setattr(meadowrun.alloc_vm.time, "time", lambda: now)
+
+    autoscaler = _WorkerAutoscaler(10)
+    worker_queues = [WorkerQueue(0, 2), WorkerQueue(1, 1)]
+
+    # we don't know how long tasks take yet
+    assert not autoscaler.scale_up(worker_queues, {0: 2, 1: 1000})
+
+    # tasks take 60 seconds, so the 1000 tasks on queue 1 need 500 workers to finish in
+    # _AUTOSCALE_TARGET_BACKLOG_SECONDS, but each worker on queue 1 costs 2 units, and
+    # queue 0 is using 2 units
+    autoscaler.task_completed(0, 60)
+    assert autoscaler.scale_up(worker_queues, {0: 2, 1: 1000})
+    assert [q.num_workers_needed for q in worker_queues] == [2, 4]
+    assert not autoscaler.scale_up(worker_queues, {0: 2, 1: 1000})
+
+    # once queue 0 is done, queue 1 can use its units
+    worker_queues[0].num_workers_needed = 0
+    assert autoscaler.scale_up(worker_queues, {0: 0, 1: 1000})
+    assert [q.num_workers_needed for q in worker_queues] == [0, 5]
+
+
+def test_worker_autoscaler_max_num_concurrent_tasks() -> None:
+    def max_worker_units(*args: Any) -> int:
+        driver = GridJobDriver(
+            _ImmediateCloudInterface(),
+            cast(GridJobWorkerLauncher, None),
+            4,
+            ResourcesInternal.from_cpu_and_memory(1, 1),
+            *args,
+        )
+        return driver._autoscaler._max_worker_units
+
+    # by default, the autoscaler can't go beyond the initial workers
+    assert max_worker_units() == 4
+    assert max_worker_units(1, 10) == 10
+    # each worker runs 2 tasks at a time
+    assert max_worker_units(2, 10) == 5
+    # the ceiling can't be lower than num_concurrent_tasks
+    assert max_worker_units(1, 2) == 4
+
+
+def test_worker_autoscaler_small_backlog(monkeypatch: pytest.MonkeyPatch) -> None:
+    now = 1000.0
+    monkeypatch.setattr(meadowrun.alloc_vm.time, "time", lambda: now)
+
+    autoscaler = _WorkerAutoscaler(100)
+    worker_queues = [WorkerQueue(0, 1)]
+    for _ in range(3):
+        autoscaler.task_completed(0, 1)
+
+    # 100 one-second tasks only need one worker
+    assert not autoscaler.scale_up(worker_queues, {0: 100})
+
+    # but the observed throughput says that each task takes a worker 30 seconds
+    now = 1090.0
+    assert autoscaler.scale_up(worker_queues, {0: 100})
+    assert worker_queues[0].num_workers_needed == 25
+
+
+def test_worker_queue_crash_loop_guard() -> None:
+    worker_queue = WorkerQueue(0, 2, num_workers_launched=2)
+    assert worker_queue.replace_workers_that_exited()
+
+    # we replace workers until as many workers as we need (but at least 3) have exited
+    # without any tasks completing
+    worker_queue.num_workers_exited_unexpectedly = 2
+    worker_queue.num_workers_exited_since_last_result = 2
+    assert worker_queue.num_workers_running() == 0
+    assert worker_queue.replace_workers_that_exited()
+    worker_queue.num_workers_exited_since_last_result = 3
+    assert not worker_queue.replace_workers_that_exited()
+
+    worker_queue.num_workers_needed = 10
+    assert worker_queue.replace_workers_that_exited()
+
+
+class _ImmediateCloudInterface(GridJobCloudInterface):
+    """Runs tasks (doubling their args) as soon as they're added"""
+
+    def __init__(self) -> None:
+        self._queue: List[Tuple[int, int]] = []
+        self._num_tasks = 0
+
+    def create_queue(self) -> int:
+        return 0
+
+    async def setup_and_add_tasks(self, tasks: Sequence[int]) -> None:
+        await self.add_tasks(tasks)
+
+    async def add_tasks(self, tasks: Sequence[int]) -> None:
+        self._queue.extend(enumerate(tasks, self._num_tasks))
+        self._num_tasks += len(tasks)
+
+    async def get_agent_function(
+        self, queue_index: int
+    ) -> Tuple[QualifiedFunctionName, Sequence[Any]]:
+        raise NotImplementedError()
+
+    async def _results(
+        self, stop_receiving: asyncio.Event
+    ) -> AsyncIterable[Tuple[List[TaskProcessState], List[WorkerProcessState]]]:
+        while not stop_receiving.is_set():
+            await asyncio.sleep(0)
+            batch, self._queue = self._queue[:2], self._queue[2:]
+            yield [
+                TaskProcessState(
+                    task_id,
+                    1,
+                    ProcessState(
+                        state=ProcessState.ProcessStateEnum.SUCCEEDED,
+                        pickled_result=pickle.dumps(arg * 2),
+                    ),
+                )
+                for task_id, arg in batch
+            ], []
+
+    async def receive_task_results(
+        self, *, stop_receiving: asyncio.Event, workers_done: asyncio.Event
+    ) -> AsyncIterable[Tuple[List[TaskProcessState], List[WorkerProcessState]]]:
+        return self._results(stop_receiving)
+
+    async def retry_task(
+        self, task_id: int, attempts_so_far: int, queue_index: int
+    ) -> None:
+        raise NotImplementedError()
+
+    async def shutdown_workers(self, num_workers: int, queue_index: int) -> None:
+        pass
+
+
+@pytest.mark.asyncio
+async def test_lazy_args() -> None:
+    num_args_taken = 0
+    num_results = 0
+    max_outstanding = 0
+
+    async def args() -> AsyncIterable[int]:
+        nonlocal num_args_taken, max_outstanding
+        for i in range(100):
+            num_args_taken += 1
+            max_outstanding = max(max_outstanding, num_args_taken - num_results)
+            yield i
+
+    driver = GridJobDriver(
+        _ImmediateCloudInterface(),
+        cast(GridJobWorkerLauncher, None),
+        2,
+        ResourcesInternal.from_cpu_and_memory(1, 1),
+    )
+    results = {}
+    async for result in driver.add_tasks_and_get_results(args(), 1, False):
+        results[result.task_id] = result.result
+        num_results += 1
+        if num_args_taken < 100:
+            # we keep the workers we need for the rest of the args
+            assert driver._worker_queues[0].num_workers_needed == 2
+
+    assert results == {i: i * 2 for i in range(100)}
+    assert driver.num_tasks == 100
+    # we never take more than _LAZY_ARGS_TASKS_PER_WORKER tasks per worker at a time
+    assert max_outstanding <= meadowrun.alloc_vm._LAZY_ARGS_TASKS_PER_WORKER * 2
+
+
+class _SlowUploadCloudInterface(_ImmediateCloudInterface):
+    """Checks that the driver doesn't know about tasks that are still being uploaded"""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.driver: GridJobDriver
+        self.num_tasks_during_upload: List[int] = []
+
+    async def add_tasks(self, tasks: Sequence[int]) -> None:
+        self.num_tasks_during_upload.append(self.driver.num_tasks)
+        await asyncio.sleep(0)
+        await super().add_tasks(tasks)
+
+
+@pytest.mark.asyncio
+async def test_lazy_args_registered_after_upload() -> None:
+    async def args() -> AsyncIterable[int]:
+        for i in range(20):
+            yield i
+
+    cloud_interface = _SlowUploadCloudInterface()
+    driver = GridJobDriver(
+        cloud_interface,
+        cast(GridJobWorkerLauncher, None),
+        1,
+        ResourcesInternal.from_cpu_and_memory(1, 1),
+    )
+    cloud_interface.driver = driver
+    results = [
+        result.task_id
+        async for result in driver.add_tasks_and_get_results(args(), 1, False)
+    ]
+
+    assert sorted(results) == list(range(20))
+    assert len(cloud_interface.num_tasks_during_upload) > 1
+    # the driver only starts tracking each batch of tasks once it has been uploaded
+    assert cloud_interface.num_tasks_during_upload[0] == 0
+    assert all(
+        prev < current
+        for prev, current in zip(
+            cloud_interface.num_tasks_during_upload,
+            cloud_interface.num_tasks_during_upload[1:],
+        )
+    )
+
+
+class _NoResultsCloudInterface(_ImmediateCloudInterface):
+    """Never returns any results, and can't tell which tasks a worker had leased"""
+
+    async def _results(
+        self, stop_receiving: asyncio.Event
+    ) -> AsyncIterable[Tuple[List[TaskProcessState], List[WorkerProcessState]]]:
+        await stop_receiving.wait()
+        yield [], []
+
+    async def get_leased_tasks(self, worker_id: str) -> List[Tuple[int, int]]:
+        raise ValueError("Could not get leased tasks")
+
+
+@pytest.mark.asyncio
+async def test_background_task_exception_is_raised() -> None:
+    driver = GridJobDriver(
+        _NoResultsCloudInterface(),
+        cast(GridJobWorkerLauncher, None),
+        1,
+        ResourcesInternal.from_cpu_and_memory(1, 1),
+    )
+
+    async def get_results() -> None:
+        async for _ in driver.add_tasks_and_get_results([1, 2], 1, False):
+            pass
+
+    get_results_task = asyncio.create_task(get_results())
+    await asyncio.sleep(0.01)
+    driver._worker_exited_unexpectedly(0, "worker-1")
+    # without supervising _reschedule_lost_tasks, this would wait forever
+    with pytest.raises(ValueError, match="Could not get leased tasks"):
+        await asyncio.wait_for(get_results_task, 5)
+
+
+class _LostTasksCloudInterface(_NoResultsCloudInterface):
+    """Every attempt of every task is lost because its worker exits"""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.retried: List[Tuple[int, int, int]] = []
+        self._latest_attempts: Dict[int, int] = {}
+
+    async def retry_task(
+        self, task_id: int, attempts_so_far: int, queue_index: int
+    ) -> None:
+        self.retried.append((task_id, attempts_so_far, queue_index))
+        self._latest_attempts[task_id] = attempts_so_far + 1
+
+    async def get_leased_tasks(self, worker_id: str) -> List[Tuple[int, int]]:
+        return [
+            (task_id, self._latest_attempts.get(task_id, 1))
+            for task_id in range(self._num_tasks)
+        ]
+
+
+@pytest.mark.asyncio
+async def test_lost_task_runs_out_of_attempts() -> None:
+    cloud_interface = _LostTasksCloudInterface()
+    driver = GridJobDriver(
+        cloud_interface,
+        cast(GridJobWorkerLauncher, None),
+        1,
+        ResourcesInternal.from_cpu_and_memory(1, 1),
+    )
+
+    async def get_results() -> List[TaskResult]:
+        return [
+            result async for result in driver.add_tasks_and_get_results([1], 2, False)
+        ]
+
+    get_results_task = asyncio.create_task(get_results())
+    for i in range(4):
+        await asyncio.sleep(0.01)
+        driver._worker_exited_unexpectedly(0, f"worker-{i}")
+    # without yielding a result for the lost task, this would wait forever
+    results = await asyncio.wait_for(get_results_task, 5)
+
+    # two reschedules that don't count as attempts, then one retry, which is the
+    # second of max_num_task_attempts=2
+    assert cloud_interface.retried == [(0, 1, 0), (0, 2, 0), (0, 3, 0)]
+    assert len(results) == 1
+    assert results[0].task_id == 0
+    assert not results[0].is_success
+    assert results[0].state == "WORKER_LOST"
+    assert results[0].attempt == 4
+
+
+class _EvictionCloudInterface(_ImmediateCloudInterface):
+    """
+    Tasks are leased by the first worker, which then dies without reporting it (like a
+    spot instance being interrupted). Tasks only run when they're retried.
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.retried: List[Tuple[int, int, int]] = []
+        self.worker_ids_checked: List[List[str]] = []
+
+    async def add_tasks(self, tasks: Sequence[int]) -> None:
+        self._num_tasks += len(tasks)
+
+    async def get_agent_function(
+        self, queue_index: int
+    ) -> Tuple[QualifiedFunctionName, Sequence[Any]]:
+        return cast("QualifiedFunctionName", None), []
+
+    async def retry_task(
+        self, task_id: int, attempts_so_far: int, queue_index: int
+    ) -> None:
+        self.retried.append((task_id, attempts_so_far, queue_index))
+        self._queue.append((task_id, task_id))
+
+    async def get_leased_tasks(self, worker_id: str) -> List[Tuple[int, int]]:
+        if worker_id == "job-worker0":
+            return [(task_id, 1) for task_id in range(self._num_tasks)]
+        return []
+
+    async def get_unresponsive_workers(self, worker_ids: Sequence[str]) -> List[str]:
+        self.worker_ids_checked.append(sorted(worker_ids))
+        return [worker_id for worker_id in worker_ids if worker_id == "job-worker0"]
+
+
+class _PlaceholderWorkerLauncher(GridJobWorkerLauncher):
+    """Like GridJobQueueWorkerLauncher, worker tasks never complete"""
+
+    def __init__(self) -> None:
+        self.num_workers_launched = 0
+        # (num_workers_to_launch, resources_required_per_worker, num_task_workers)
+        self.launches: List[Tuple[int, ResourcesInternal, int]] = []
+
+    async def launch_workers(
+        self,
+        agent_function_task: asyncio.Task[Tuple[QualifiedFunctionName, Sequence[Any]]],
+        num_workers_to_launch: int,
+        resources_required_per_worker: ResourcesInternal,
+        num_task_workers: int,
+        queue_index: int,
+        abort_launching_new_workers: asyncio.Event,
+    ) -> AsyncIterable[List[WorkerTask]]:
+        self.launches.append(
+            (num_workers_to_launch, resources_required_per_worker, num_task_workers)
+        )
+        worker_ids = [
+            f"job-worker{i}"
+            for i in range(
+                self.num_workers_launched,
+                self.num_workers_launched + num_workers_to_launch,
+            )
+        ]
+        self.num_workers_launched += num_workers_to_launch
+        yield [
+            WorkerTask(
+                "placeholder",
+                queue_index,
+                asyncio.create_task(asyncio.Event().wait()),
+                worker_ids,
+            )
+        ]
+
+
+@pytest.mark.asyncio
+async def test_unresponsive_worker(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(meadowrun.alloc_vm, "_UNRESPONSIVE_WORKERS_CHECK_SECONDS", 0.01)
+
+    cloud_interface = _EvictionCloudInterface()
+    worker_launcher = _PlaceholderWorkerLauncher()
+    driver = GridJobDriver(
+        cloud_interface,
+        worker_launcher,
+        2,
+        ResourcesInternal.from_cpu_and_memory(1, 1),
+    )
+
+    async def get_results() -> Dict[int, Any]:
+        return {
+            result.task_id: result.result
+            async for result in driver.add_tasks_and_get_results([0, 1], 1, False)
+        }
+
+    run_worker_functions = asyncio.create_task(driver.run_worker_functions())
+    # without noticing that the worker is dead, this would wait forever
+    results = await asyncio.wait_for(get_results(), 5)
+    await asyncio.wait_for(run_worker_functions, 5)
+
+    assert results == {0: 0, 1: 2}
+    # the dead worker's tasks were rescheduled, and it was replaced
+    assert sorted(cloud_interface.retried) == [(0, 1, 0), (1, 1, 0)]
+    assert worker_launcher.num_workers_launched == 3
+    assert cloud_interface.worker_ids_checked[0] == ["job-worker0", "job-worker1"]
+    # we stop checking on a worker once we've given up on it
+    assert all(
+        "job-worker0" not in worker_ids
+        for worker_ids in cloud_interface.worker_ids_checked[1:]
+    )
+
+
+class _ShutdownCountingCloudInterface(_ImmediateCloudInterface):
+    def __init__(self) -> None:
+        super().__init__()
+        self.num_shutdown_messages = 0
+
+    async def get_agent_function(
+        self, queue_index: int
+    ) -> Tuple[QualifiedFunctionName, Sequence[Any]]:
+        return cast("QualifiedFunctionName", None), []
+
+    async def shutdown_workers(self, num_workers: int, queue_index: int) -> None:
+        self.num_shutdown_messages += num_workers
+
+
+@pytest.mark.asyncio
+async def test_multiple_task_workers_per_agent() -> None:
+    cloud_interface = _ShutdownCountingCloudInterface()
+    worker_launcher = _PlaceholderWorkerLauncher()
+    driver = GridJobDriver(
+        cloud_interface,
+        worker_launcher,
+        5,
+        ResourcesInternal.from_cpu_and_memory(1, 2),
+        num_task_workers_per_agent=2,
+    )
+
+    run_worker_functions = asyncio.create_task(driver.run_worker_functions())
+    results = {
+        result.task_id: result.result
+        async for result in driver.add_tasks_and_get_results(list(range(10)), 1, False)
+    }
+    await asyncio.wait_for(run_worker_functions, 5)
+
+    assert results == {i: i * 2 for i in range(10)}
+    # 5 concurrent tasks need 3 workers with 2 task workers each, and each worker
+    # requests enough resources for both of its task workers
+    ((num_workers, resources, num_task_workers),) = worker_launcher.launches
+    assert (num_workers, num_task_workers) == (3, 2)
+    assert (
+        resources.consumable == ResourcesInternal.from_cpu_and_memory(2, 4).consumable
+    )
+    # a single shutdown message stops all of a worker's task workers
+    assert cloud_interface.num_shutdown_messages == 3
@@ -0,0 +1,124 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+from typing import TYPE_CHECKING, List
+
+import pytest
+
+from automated.test_local_automated import LocalFileBucket
+from meadowrun.chunk_cache import ChunkCache
+from meadowrun.storage_grid_job import (
+    clear_uploaded_keys_cache,
+    download_chunked_file,
+    ensure_uploaded_incremental,
+)
+
+if TYPE_CHECKING:
+    from pathlib import Path
+
+
+def _key(data: bytes) -> str:
+    return f"prefix/{hashlib.blake2b(data).hexdigest()}.part"
+
+
+def test_chunk_cache(tmp_path: Path) -> None:
+    cache = ChunkCache(str(tmp_path / "cache"), max_size_bytes=250)
+    chunks = [bytes([i]) * 100 for i in range(3)]
+
+    assert cache.get(_key(chunks[0])) is None
+    cache.put(_key(chunks[0]), chunks[0])
+    assert cache.get(_key(chunks[0])) == chunks[0]
+    # keys that don't match the data and keys without hashes aren't cached
+    cache.put(_key(chunks[0]), chunks[1])
+    cache.put("prefix/chunk.part", chunks[1])
+    assert cache.get(_key(chunks[0])) == chunks[0]
+    assert cache.get("prefix/chunk.part") is None
+
+    cache.put(_key(chunks[1]), chunks[1])
+    cache.put(_key(chunks[2]), chunks[2])
+    # make chunk 1 the least recently used chunk
+    for i, timestamp in enumerate([200, 100, 300]):
+        os.utime(
+            tmp_path / "cache" / hashlib.blake2b(chunks[i]).hexdigest(),
+            (timestamp, timestamp),
+        )
+    cache.evict()
+    assert [cache.get(_key(chunk)) is not None for chunk in chunks] == [
+        True,
+        False,
+        True,
+    ]
+
+
+class _RecordingBucket(LocalFileBucket):
+    def __init__(self, tmp_path: Path) -> None:
+        super().__init__(tmp_path)
+        self.keys_downloaded: List[str] = []
+
+    async def get_bytes(self, key: str) -> bytes:
+        self.keys_downloaded.append(key)
+        return await super().get_bytes(key)
+
+
+@pytest.mark.asyncio
+async def test_download_chunked_file_with_cache(tmp_path: Path) -> None:
+    clear_uploaded_keys_cache()
+    bucket = _RecordingBucket(tmp_path / "bucket")
+    cache = ChunkCache(str(tmp_path / "cache"))
+    data = os.urandom(50000)
+    source_file = tmp_path / "source"
+
+    source_file.write_bytes(data)
+    chunks_key1 = await ensure_uploaded_incremental(
+        bucket, str(source_file), avg_chunk_size=1000, key_prefix="chunks/"
+    )
+    await download_chunked_file(bucket, chunks_key1, str(tmp_path / "target1"), cache)
+    assert (tmp_path / "target1").read_bytes() == data
+
+    # change a few bytes in the middle of the file, only the chunk list and the
+    # changed chunks should be downloaded
+    changed_data = data[:25000] + b"changed" + data[25007:]
+    source_file.write_bytes(changed_data)
+    chunks_key2 = await ensure_uploaded_incremental(
+        bucket, str(source_file), avg_chunk_size=1000, key_prefix="chunks/"
+    )
+    chunks1 = json.loads(await bucket.get_bytes(chunks_key1))["chunks"]
+    chunks2 = json.loads(await bucket.get_bytes(chunks_key2))["chunks"]
+    new_chunks = set(chunks2) - set(chunks1)
+    bucket.keys_downloaded.clear()
+    await download_chunked_file(bucket, chunks_key2, str(tmp_path / "target2"), cache)
+    assert (tmp_path / "target2").read_bytes() == changed_data
+    assert bucket.keys_downloaded[0] == chunks_key2
+    assert 1 <= len(new_chunks) < len(chunks2) // 2
+    assert sorted(bucket.keys_downloaded[1:]) == sorted(new_chunks)
+
+
+def test_chunk_cache_put_failure(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    cache = ChunkCache(str(tmp_path / "cache"))
+    data = b"x" * 100
+
+    def fail_replace(src: str, dst: str) -> None:
+        raise OSError("No space left on device")
+
+    monkeypatch.setattr(os, "replace", fail_replace)
+    with pytest.raises(OSError):
+        cache.put(_key(data), data)
+    # the temporary file is cleaned up
+    assert os.listdir(tmp_path / "cache") == []
+
+
+@pytest.mark.asyncio
+async def test_chunk_cache_async(tmp_path: Path) -> None:
+    cache = ChunkCache(str(tmp_path / "cache"), max_size_bytes=150)
+    chunks = [bytes([i]) * 100 for i in range(2)]
+
+    assert await cache.get_async(_key(chunks[0])) is None
+    await cache.put_async(_key(chunks[0]), chunks[0])
+    assert await cache.get_async(_key(chunks[0])) == chunks[0]
+    await cache.put_async(_key(chunks[1]), chunks[1])
+    await cache.evict_async()
+    assert len(os.listdir(tmp_path / "cache")) == 1
@@ -0,0 +1,57 @@
+from __future__ import annotations
+
+import os
+import pickle
+from typing import List
+
+import pytest
+
+from meadowrun.compression import (
+    compress_payload,
+    decompress_payload,
+    loads_payload,
+    pack_buffers_payload,
+    validate_compression,
+)
+
+
+@pytest.mark.parametrize(
+    "compression, package", [("zstd", "zstandard"), ("lz4", "lz4.frame")]
+)
+def test_compress_payload(compression: str, package: str) -> None:
+    pytest.importorskip(package)
+
+    data = pickle.dumps(["abcdefg"] * 10_000)
+    compressed = compress_payload(data, compression)
+    assert len(compressed) < len(data) / 10
+    assert decompress_payload(compressed) == data
+
+    # payloads with out-of-band buffers can be compressed too
+    buffers: List[pickle.PickleBuffer] = []
+    pickled = pickle.dumps(
+        [pickle.PickleBuffer(b"a" * 100_000)],
+        protocol=5,
+        buffer_callback=buffers.append,
+    )
+    packed = pack_buffers_payload(pickled, [bytes(b.raw()) for b in buffers])
+    compressed = compress_payload(packed, compression)
+    assert len(compressed) < len(packed) / 10
+    assert [bytes(b) for b in loads_payload(compressed)] == [b"a" * 100_000]
+
+    # tiny and incompressible payloads are left alone
+    tiny = pickle.dumps("abc")
+    assert compress_payload(tiny, compression) == tiny
+    incompressible = pickle.dumps(os.urandom(1_000_000))
+    assert compress_payload(incompressible, compression) == incompressible
+
+
+def test_uncompressed_payload() -> None:
+    data = pickle.dumps(["abcdefg"] * 10_000)
+    assert compress_payload(data, "") == data
+    assert decompress_payload(data) == data
+    assert loads_payload(data) == ["abcdefg"] * 10_000
+
+    with pytest.raises(ValueError):
+        validate_compression("gzip")
+    with pytest.raises(ValueError):
+        decompress_payload(b"\x00\xff" + data)
@@ -0,0 +1,97 @@
+from __future__ import annotations
+
+import asyncio
+import json
+from typing import TYPE_CHECKING, Any, List, Tuple
+
+import pytest
+
+from automated.test_local_automated import LocalFileBucket
+from meadowrun.aws_integration.grid_tasks_sqs import _TaskPrefetchQueue
+from meadowrun.storage_grid_job import upload_task_args
+
+if TYPE_CHECKING:
+    from pathlib import Path
+
+
+class _FakeSqs:
+    """Just enough of an SQS client for _TaskPrefetchQueue"""
+
+    def __init__(self, messages: List[str]):
+        self.messages = messages
+        self.receive_sizes: List[int] = []
+
+    async def receive_message(self, **kwargs: Any) -> Any:
+        self.receive_sizes.append(kwargs["MaxNumberOfMessages"])
+        received = self.messages[: kwargs["MaxNumberOfMessages"]]
+        del self.messages[: len(received)]
+        return {
+            "Messages": [{"Body": body, "ReceiptHandle": body} for body in received]
+        }
+
+    async def delete_message_batch(self, **kwargs: Any) -> Any:
+        return {}
+
+
+async def _get_queue_and_sqs(
+    tmp_path: Path, num_tasks: int, **kwargs: Any
+) -> Tuple[_TaskPrefetchQueue, _FakeSqs]:
+    bucket = LocalFileBucket(tmp_path)
+    byte_ranges = await upload_task_args(bucket, "job1", range(num_tasks))
+    messages = [
+        json.dumps(
+            {
+                "task_id": i,
+                "attempt": 1,
+                "segment": segment,
+                "range_from": range_from,
+                "range_end": range_end,
+            }
+        )
+        for i, (segment, range_from, range_end) in enumerate(byte_ranges)
+    ] + ["{}"]
+    sqs = _FakeSqs(messages)
+    queue = _TaskPrefetchQueue(
+        sqs, bucket, "queue", "job1", **kwargs  # type: ignore[arg-type]
+    )
+    return queue, sqs
+
+
+@pytest.mark.asyncio
+async def test_task_queue_leases_one_task_at_a_time(tmp_path: Path) -> None:
+    queue, sqs = await _get_queue_and_sqs(
+        tmp_path, 3, max_tasks_per_receive=1, receive_message_wait_seconds=0
+    )
+    task = await queue.get_task()
+    assert task is not None and task[0] == 0
+    # while the task is "running", nothing else gets leased
+    await asyncio.sleep(0.01)
+    assert sqs.receive_sizes == [1]
+    assert len(sqs.messages) == 3
+
+    for task_id in [1, 2]:
+        task = await queue.get_task()
+        assert task is not None and task[0] == task_id
+    assert await queue.get_task() is None
+    assert sqs.receive_sizes == [1, 1, 1, 1]
+    await queue.close()
+
+
+@pytest.mark.asyncio
+async def test_task_queue_prefetch(tmp_path: Path) -> None:
+    queue, sqs = await _get_queue_and_sqs(
+        tmp_path,
+        15,
+        max_tasks_per_receive=10,
+        receive_message_wait_seconds=0,
+        prefetch=True,
+    )
+    task_ids = []
+    while True:
+        task = await queue.get_task()
+        if task is None:
+            break
+        task_ids.append(task[0])
+    assert task_ids == list(range(15))
+    assert sqs.receive_sizes == [10, 10]
+    await queue.close()
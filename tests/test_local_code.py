@@ -1,7 +1,9 @@
+import io
 import os
+import shutil
 import tempfile
 import zipfile
-from typing import Sequence, Dict
+from typing import Dict, List, Optional, Sequence, Tuple
 
 import pytest
 from meadowrun.deployment import local_code
@@ -266,3 +268,129 @@ def test_zip_local_code_exception() -> None:
             ["nested/root"],
             "nested/root",
         )
+
+
+def test_zip_local_code_cache(monkeypatch: pytest.MonkeyPatch) -> None:
+    # files are compressed on multiple threads
+    compressed: List[str] = []
+    compress_file = local_code._compress_file
+
+    def counting_compress_file(file_path: str) -> Tuple[int, int, List[bytes]]:
+        compressed.append(file_path)
+        return compress_file(file_path)
+
+    monkeypatch.setattr(local_code, "_compress_file", counting_compress_file)
+
+    with tempfile.TemporaryDirectory() as temp_source, tempfile.TemporaryDirectory() as temp_dest, tempfile.TemporaryDirectory() as temp_cache:  # noqa: E501
+        root = os.path.join(temp_source, "root")
+        for file in ["b.py", "a.py", "c/d.py", "x.txt"]:
+            file_path = os.path.join(root, file)
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            with open(file_path, mode="w", encoding="utf-8") as f:
+                f.write(f"print('{file}')\n" * 100)
+
+        orig_dir = os.getcwd()
+        try:
+            os.chdir(root)
+
+            def zip_code(cache_dir: Optional[str]) -> bytes:
+                zip_file_path, _, _ = local_code.zip_local_code(
+                    temp_dest, False, [root], (".py",), ["*.txt"], cache_dir
+                )
+                with zipfile.ZipFile(zip_file_path) as zf:
+                    assert zf.testzip() is None
+                with open(zip_file_path, "rb") as f:
+                    return f.read()
+
+            zip_data = zip_code(temp_cache)
+            assert len(compressed) == 4
+            with zipfile.ZipFile(io.BytesIO(zip_data)) as zf:
+                assert zf.namelist() == [
+                    "root/a.py",
+                    "root/b.py",
+                    "root/c/d.py",
+                    "root/x.txt",
+                ]
+
+            # nothing has changed, so the zip file is identical and nothing needs to be
+            # compressed
+            assert zip_code(temp_cache) == zip_data
+            assert len(compressed) == 4
+            assert zip_code(None) == zip_data
+            assert len(compressed) == 8
+
+            # only the file that changed is compressed again
+            with open(os.path.join(root, "b.py"), mode="w", encoding="utf-8") as f:
+                f.write("print('changed')\n")
+            compressed.clear()
+            with zipfile.ZipFile(io.BytesIO(zip_code(temp_cache))) as zf:
+                assert zf.read("root/b.py") == b"print('changed')\n"
+                assert zf.read("root/c/d.py") == b"print('c/d.py')\n" * 100
+            assert len(compressed) == 1
+
+            # zipping a different project doesn't replace this project's cache
+            other_root = os.path.join(temp_source, "other_root")
+            os.makedirs(other_root)
+            with open(os.path.join(other_root, "e.py"), "w", encoding="utf-8") as f:
+                f.write("print('e.py')\n")
+            local_code.zip_local_code(
+                temp_dest, False, [other_root], (".py",), [], temp_cache
+            )
+            compressed.clear()
+            zip_code(temp_cache)
+            assert compressed == []
+            assert len(os.listdir(temp_cache)) == 2
+        finally:
+            os.chdir(orig_dir)
+
+
+def test_project_cache_dirs(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(local_code, "_MAX_PROJECT_CACHES", 2)
+    with tempfile.TemporaryDirectory() as temp_cache:
+        # left over from older versions
+        with open(os.path.join(temp_cache, "index.json"), "w") as f:
+            f.write("{}")
+
+        project_cache_dirs = []
+        for i in range(3):
+            project_cache_dirs.append(
+                local_code._get_project_cache_dir(temp_cache, [(f"/src/{i}", "x")])
+            )
+            # make sure the modification times are different
+            os.utime(project_cache_dirs[-1], (1000 + i, 1000 + i))
+        assert sorted(os.listdir(temp_cache)) == sorted(
+            os.path.basename(path) for path in project_cache_dirs[1:]
+        )
+
+        # the same project always gets the same cache dir
+        assert (
+            local_code._get_project_cache_dir(temp_cache, [("/src/1", "x")])
+            == project_cache_dirs[1]
+        )
+
+
+def test_zip_local_code_deterministic() -> None:
+    with tempfile.TemporaryDirectory() as temp_source, tempfile.TemporaryDirectory() as temp_dest:  # noqa: E501
+        root = os.path.join(temp_source, "root")
+
+        def zip_code(files: Sequence[str], mtime: int) -> bytes:
+            # simulate checking out the same code on a different machine
+            shutil.rmtree(root, ignore_errors=True)
+            for file in files:
+                file_path = os.path.join(root, file)
+                os.makedirs(os.path.dirname(file_path), exist_ok=True)
+                with open(file_path, mode="w", encoding="utf-8") as f:
+                    f.write(f"print('{file}')\n")
+                os.utime(file_path, (mtime, mtime))
+
+            zip_file_path, _, _ = local_code.zip_local_code(
+                temp_dest, False, [root], (".py",), ()
+            )
+            with open(zip_file_path, "rb") as f:
+                return f.read()
+
+        files = [f"{c}/{i}.py" for c in "abc" for i in range(20)]
+        zip_data = zip_code(files, 1_000_000_000)
+        assert zip_code(list(reversed(files)), 1_600_000_000) == zip_data
+        with zipfile.ZipFile(io.BytesIO(zip_data)) as zf:
+            assert zf.namelist() == sorted(f"root/{file}" for file in files)
@@ -0,0 +1,89 @@
+from __future__ import annotations
+
+import asyncio
+import functools
+import pickle
+from pathlib import Path
+from typing import Any
+
+import cloudpickle
+import pytest
+
+from automated.test_local_automated import LocalFileBucket
+from meadowrun.abstract_storage_bucket import AbstractStorageBucket
+from meadowrun.result_sink import ResultHandle, ResultSink, ResultSinkFunction
+from meadowrun.task_chunks import ChunkedFunction
+
+
+async def _get_local_file_bucket(tmp_path: Path) -> AbstractStorageBucket:
+    return LocalFileBucket(tmp_path)
+
+
+def _square(x: int) -> int:
+    return x * x
+
+
+def test_result_sink() -> None:
+    assert ResultSink("results/").key(3) == "results/3"
+    with pytest.raises(ValueError):
+        ResultSink("results", "csv")  # type: ignore[arg-type]
+    with pytest.raises(ValueError):
+        ResultSink("/")
+
+
+def test_result_sink_function(tmp_path: Path) -> None:
+    function = ResultSinkFunction(
+        _square,
+        ResultSink("job1/results"),
+        functools.partial(_get_local_file_bucket, tmp_path),
+        pickle.HIGHEST_PROTOCOL,
+    )
+    # simulate sending the function to a worker
+    worker_function = cloudpickle.loads(cloudpickle.dumps(function))
+
+    handle = worker_function((7, 3))
+    assert handle == ResultHandle(7, "job1/results/7", "pickle", handle.size_bytes)
+    assert (tmp_path / "job1" / "results" / "7").exists()
+    assert asyncio.run(handle.download(LocalFileBucket(tmp_path))) == 9
+
+    # the worker's storage bucket isn't pickled with the function
+    worker_function = cloudpickle.loads(cloudpickle.dumps(worker_function))
+    chunk_results = ChunkedFunction(worker_function, 1)([(0, 1), (1, 2)])
+    assert [
+        asyncio.run(result.download(LocalFileBucket(tmp_path)))
+        for _, result, _ in chunk_results
+    ] == [1, 4]
+
+
+class _ClosableBucket(LocalFileBucket):
+    def __init__(self, tmp_path: Path) -> None:
+        super().__init__(tmp_path)
+        self.closed = False
+
+    async def __aexit__(self, *args: Any) -> None:
+        self.closed = True
+
+
+def test_result_sink_function_close(tmp_path: Path) -> None:
+    bucket = _ClosableBucket(tmp_path)
+
+    async def get_bucket() -> AbstractStorageBucket:
+        return bucket
+
+    function = ResultSinkFunction(
+        _square, ResultSink("job2/results"), get_bucket, pickle.HIGHEST_PROTOCOL
+    )
+    # closing before any tasks have run does nothing
+    function.close()
+
+    function((0, 2))
+    function((1, 3))
+    event_loop = function._event_loop
+    assert event_loop is not None and not bucket.closed
+
+    function.close()
+    assert bucket.closed
+    assert event_loop.is_closed()
+    # the function can still be used after being closed
+    assert function((2, 4)).size_bytes > 0
+    function.close()
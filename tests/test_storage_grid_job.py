@@ -0,0 +1,609 @@
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import json
+import os
+import pickle
+import time
+from typing import TYPE_CHECKING, Dict, List, Optional
+
+import aiobotocore.session
+import pytest
+
+from automated.test_local_automated import LocalFileBucket, LocalResultQueue
+from meadowrun.compression import decompress_payload
+from meadowrun.k8s_integration import k8s
+from meadowrun.meadowrun_pb2 import ProcessState
+from meadowrun import storage_grid_job
+from meadowrun.run_job_local import BackgroundUploads
+from meadowrun.storage_grid_job import (
+    TaskArgRange,
+    TaskLeases,
+    GenericStorageBucket,
+    TaskResultBatcher,
+    WorkerHeartbeats,
+    _CHUNKS_KEY,
+    _UPLOADED_KEYS_TTL,
+    _get_uploaded_keys,
+    complete_task,
+    clear_uploaded_keys_cache,
+    download_chunked_file,
+    download_task_arg,
+    download_task_args,
+    get_leased_tasks,
+    ensure_uploaded_incremental,
+    receive_results,
+    upload_task_args,
+    upload_task_args_streaming,
+)
+from meadowrun.storage_keys import (
+    storage_key_job_done,
+    storage_key_task_attempt,
+    storage_prefix_inputs,
+    storage_prefix_outputs,
+    storage_prefix_task_claims,
+    storage_prefix_task_completions,
+    storage_prefix_task_retries,
+    storage_prefix_task_steals,
+)
+
+if TYPE_CHECKING:
+    from pathlib import Path
+
+
+@pytest.mark.asyncio
+async def test_upload_task_args_streaming(tmp_path: Path) -> None:
+    bucket = LocalFileBucket(tmp_path)
+    args = [str(i) * 100 for i in range(50)]
+
+    segments = [
+        segment_ranges
+        async for segment_ranges in upload_task_args_streaming(
+            bucket, "job1", args, segment_size_bytes=1000, max_concurrent_uploads=2
+        )
+    ]
+    assert len(segments) > 1
+    assert len(await bucket.list_objects(storage_prefix_inputs("job1"))) == len(
+        segments
+    )
+
+    task_ids = sorted(task_id for ranges in segments for task_id, _ in ranges)
+    assert task_ids == list(range(len(args)))
+
+    # every task's argument must be readable as soon as its segment has been yielded
+    for ranges in segments:
+        for task_id, byte_range in ranges:
+            arg = await download_task_arg(bucket, "job1", byte_range)
+            assert pickle.loads(arg) == ((args[task_id],), {})
+
+
+@pytest.mark.asyncio
+async def test_download_chunked_file(tmp_path: Path) -> None:
+    clear_uploaded_keys_cache()
+    bucket = LocalFileBucket(tmp_path / "bucket")
+    # repeated data so that some chunks are duplicates
+    data = os.urandom(3000) * 5 + os.urandom(20000)
+    source_file = tmp_path / "source"
+    source_file.write_bytes(data)
+    chunks_key = await ensure_uploaded_incremental(
+        bucket, str(source_file), avg_chunk_size=1000, key_prefix="chunks/"
+    )
+
+    target_file = tmp_path / "target"
+    target_file.write_bytes(b"longer than the source file" * 2000)
+    await download_chunked_file(bucket, chunks_key, str(target_file))
+    assert target_file.read_bytes() == data
+
+    # chunk lists without sizes are downloaded in order
+    chunks = json.loads(await bucket.get_bytes(chunks_key))[_CHUNKS_KEY]
+    await bucket.write_bytes(json.dumps({_CHUNKS_KEY: chunks}).encode(), "old.json")
+    with open(tmp_path / "target", "w+b") as f:
+        await download_chunked_file(bucket, "old.json", f)
+        f.seek(0)
+        assert f.read() == data
+
+
+class _CountingBucket(LocalFileBucket):
+    def __init__(self, tmp_path: Path) -> None:
+        super().__init__(tmp_path)
+        self.num_exists = 0
+        self.num_list_objects = 0
+        self.listed_prefixes: List[str] = []
+        self.num_gets = 0
+        self.num_exclusive_writes = 0
+
+    async def exists(self, key: str) -> bool:
+        self.num_exists += 1
+        return await super().exists(key)
+
+    async def list_objects(self, key_prefix: str) -> List[str]:
+        self.num_list_objects += 1
+        self.listed_prefixes.append(key_prefix)
+        return await super().list_objects(key_prefix)
+
+    async def try_get_bytes(self, key: str) -> Optional[bytes]:
+        self.num_gets += 1
+        return await super().try_get_bytes(key)
+
+    async def write_bytes_exclusive(self, data: bytes, key: str) -> bool:
+        self.num_exclusive_writes += 1
+        return await super().write_bytes_exclusive(data, key)
+
+
+@pytest.mark.asyncio
+async def test_ensure_uploaded_incremental(tmp_path: Path) -> None:
+    clear_uploaded_keys_cache()
+    bucket = _CountingBucket(tmp_path / "bucket")
+    source_file = tmp_path / "source"
+    source_file.write_bytes(os.urandom(50000))
+
+    # there are lots of chunks, so we list the objects under hash prefixes that have
+    # more than one chunk rather than checking each chunk, and never list all of
+    # key_prefix
+    chunks_key = await ensure_uploaded_incremental(
+        bucket, str(source_file), avg_chunk_size=1000, key_prefix="chunks/"
+    )
+    num_chunks = len(json.loads(await bucket.get_bytes(chunks_key))[_CHUNKS_KEY])
+    assert bucket.num_list_objects > 0
+    assert all(len(prefix) == len("chunks/") + 1 for prefix in bucket.listed_prefixes)
+    assert bucket.num_exists + bucket.num_list_objects < num_chunks
+    assert set(await bucket.list_objects("chunks/")) == {
+        chunks_key,
+        *json.loads(await bucket.get_bytes(chunks_key))[_CHUNKS_KEY],
+    }
+
+    # the uploaded keys are cached locally
+    bucket = _CountingBucket(tmp_path / "bucket")
+    assert (
+        await ensure_uploaded_incremental(
+            bucket, str(source_file), avg_chunk_size=1000, key_prefix="chunks/"
+        )
+        == chunks_key
+    )
+    assert (bucket.num_exists, bucket.num_list_objects) == (0, 0)
+
+    # without the local cache, we only need to check for the chunks json
+    clear_uploaded_keys_cache()
+    await ensure_uploaded_incremental(
+        bucket, str(source_file), avg_chunk_size=1000, key_prefix="chunks/"
+    )
+    assert (bucket.num_exists, bucket.num_list_objects) == (1, 0)
+    # we don't know when keys that we didn't upload were created (and so when they'll
+    # be deleted by the lifecycle policy), so they're not cached
+    assert _get_uploaded_keys(bucket) == {}
+
+
+@pytest.mark.asyncio
+async def test_ensure_uploaded_incremental_crowded_prefix(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    clear_uploaded_keys_cache()
+    monkeypatch.setattr(storage_grid_job, "_LIST_OBJECTS_PAGE_SIZE", 5)
+    bucket = _CountingBucket(tmp_path / "bucket")
+    # other files' chunks, about 50 per hash prefix
+    for i in range(800):
+        await bucket.write_bytes(
+            b"", f"chunks/{hashlib.blake2b(str(i).encode()).hexdigest()}.part"
+        )
+    source_file = tmp_path / "source"
+    source_file.write_bytes(os.urandom(50000))
+
+    # listing a hash prefix takes more requests than checking its few chunks, so after
+    # listing one hash prefix we check the rest of the chunks individually
+    chunks_key = await ensure_uploaded_incremental(
+        bucket, str(source_file), avg_chunk_size=1000, key_prefix="chunks/"
+    )
+    chunks = json.loads(await bucket.get_bytes(chunks_key))[_CHUNKS_KEY]
+    assert bucket.num_list_objects == 1
+    assert bucket.num_exists > 1
+    assert set(chunks) <= set(await bucket.list_objects("chunks/"))
+
+
+@pytest.mark.asyncio
+async def test_uploaded_keys_times(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    clear_uploaded_keys_cache()
+    bucket = LocalFileBucket(tmp_path / "bucket")
+    source_file = tmp_path / "source"
+    data = os.urandom(50000)
+    source_file.write_bytes(data)
+
+    monkeypatch.setattr(time, "time", lambda: 1_000_000.0)
+    chunks_key1 = await ensure_uploaded_incremental(
+        bucket, str(source_file), avg_chunk_size=1000, key_prefix="chunks/"
+    )
+    chunks1 = json.loads(await bucket.get_bytes(chunks_key1))[_CHUNKS_KEY]
+
+    # uploading a slightly different file later doesn't refresh the upload times of
+    # the chunks it shares with the first file
+    source_file.write_bytes(data[:25000] + b"changed" + data[25007:])
+    monkeypatch.setattr(time, "time", lambda: 1_000_100.0)
+    chunks_key2 = await ensure_uploaded_incremental(
+        bucket, str(source_file), avg_chunk_size=1000, key_prefix="chunks/"
+    )
+    chunks2 = json.loads(await bucket.get_bytes(chunks_key2))[_CHUNKS_KEY]
+
+    uploaded_keys = _get_uploaded_keys(bucket)
+    assert uploaded_keys[chunks_key1] == 1_000_000.0
+    assert uploaded_keys[chunks_key2] == 1_000_100.0
+    assert 0 < len(set(chunks2) - set(chunks1)) < len(chunks2)
+    for key in chunks2:
+        assert uploaded_keys[key] == (1_000_000.0 if key in chunks1 else 1_000_100.0)
+
+    # and keys are forgotten well before the storage bucket's lifecycle policy
+    # deletes them
+    monkeypatch.setattr(
+        time, "time", lambda: 1_000_000.0 + _UPLOADED_KEYS_TTL.total_seconds() + 50
+    )
+    assert set(_get_uploaded_keys(bucket)) == {chunks_key2} | (
+        set(chunks2) - set(chunks1)
+    )
+
+
+@pytest.mark.asyncio
+async def test_upload_task_args_compressed(tmp_path: Path) -> None:
+    pytest.importorskip("zstandard")
+
+    bucket = LocalFileBucket(tmp_path)
+    args = ["abc", "abcdefg" * 10_000]
+
+    ranges = await upload_task_args(bucket, "job-compressed", args, "zstd")
+    downloaded = await download_task_args(bucket, "job-compressed", ranges)
+    # the small argument isn't worth compressing
+    assert downloaded[0] == pickle.dumps((("abc",), {}), protocol=5)
+    assert len(downloaded[1]) < len(args[1]) / 10
+    assert [pickle.loads(decompress_payload(arg)) for arg in downloaded] == [
+        ((arg,), {}) for arg in args
+    ]
+
+
+@pytest.mark.asyncio
+async def test_upload_task_args(tmp_path: Path) -> None:
+    bucket = LocalFileBucket(tmp_path)
+    args = list(range(10))
+
+    ranges = await upload_task_args(bucket, "job2", args)
+    assert len(ranges) == len(args)
+    for arg, byte_range in zip(args, ranges):
+        assert pickle.loads(await download_task_arg(bucket, "job2", byte_range)) == (
+            (arg,),
+            {},
+        )
+
+    assert await upload_task_args(bucket, "job3", []) == []
+
+
+@pytest.mark.asyncio
+async def test_download_task_args(tmp_path: Path) -> None:
+    bucket = LocalFileBucket(tmp_path)
+    args = [str(i) * 100 for i in range(50)]
+
+    ranges: Dict[int, TaskArgRange] = {}
+    async for segment_ranges in upload_task_args_streaming(
+        bucket, "job4", args, segment_size_bytes=1000
+    ):
+        ranges.update(segment_ranges)
+    assert len({segment for segment, _, _ in ranges.values()}) > 1
+
+    # out of order, with gaps and across segments
+    indices = [7, 3, 4, 5, 40, 0]
+    pickled_args = await download_task_args(
+        bucket, "job4", [ranges[i] for i in indices]
+    )
+    assert [pickle.loads(arg) for arg in pickled_args] == [
+        ((args[i],), {}) for i in indices
+    ]
+
+
+@pytest.mark.asyncio
+async def test_receive_results_from_queue(tmp_path: Path) -> None:
+    bucket = LocalFileBucket(tmp_path)
+    result_queue = LocalResultQueue()
+    num_tasks = 5
+
+    async def complete_tasks() -> None:
+        for i in range(num_tasks):
+            await complete_task(
+                bucket,
+                "job5",
+                i,
+                1,
+                ProcessState(
+                    state=ProcessState.ProcessStateEnum.SUCCEEDED,
+                    pickled_result=pickle.dumps(i),
+                ),
+                result_queue,
+            )
+            await asyncio.sleep(0.01)
+
+    complete_tasks_task = asyncio.create_task(complete_tasks())
+
+    t0 = time.time()
+    stop_receiving = asyncio.Event()
+    results = {}
+    async for task_results, _ in receive_results(
+        bucket,
+        "job5",
+        stop_receiving=stop_receiving,
+        all_workers_exited=asyncio.Event(),
+        result_queue=result_queue,
+    ):
+        for task_result in task_results:
+            results[task_result.task_id] = pickle.loads(
+                task_result.result.pickled_result
+            )
+        if len(results) == num_tasks:
+            stop_receiving.set()
+
+    await complete_tasks_task
+    assert results == {i: i for i in range(num_tasks)}
+    # we should not be waiting for a polling interval
+    assert time.time() - t0 < 5
+    # results get deleted once they've been received
+    assert await bucket.list_objects(storage_prefix_outputs("job5")) == []
+
+
+@pytest.mark.asyncio
+async def test_task_result_batcher(tmp_path: Path) -> None:
+    bucket = LocalFileBucket(tmp_path)
+    result_queue = LocalResultQueue()
+    uploads = BackgroundUploads()
+    batcher = TaskResultBatcher(
+        bucket, "job6", uploads, result_queue, max_batch_bytes=1000
+    )
+
+    num_tasks = 20
+    for i in range(num_tasks):
+        await batcher.add(
+            i,
+            1,
+            ProcessState(
+                state=ProcessState.ProcessStateEnum.SUCCEEDED,
+                pickled_result=pickle.dumps("x" * 100),
+            ),
+        )
+    await batcher.close()
+    await uploads.wait_all()
+
+    # results should be batched by size
+    keys = await bucket.list_objects(storage_prefix_outputs("job6"))
+    assert 1 < len(keys) < num_tasks
+
+    stop_receiving = asyncio.Event()
+    task_ids = []
+    async for task_results, _ in receive_results(
+        bucket,
+        "job6",
+        stop_receiving=stop_receiving,
+        all_workers_exited=asyncio.Event(),
+        result_queue=result_queue,
+    ):
+        for task_result in task_results:
+            assert pickle.loads(task_result.result.pickled_result) == "x" * 100
+            task_ids.append(task_result.task_id)
+        if len(task_ids) == num_tasks:
+            stop_receiving.set()
+    assert sorted(task_ids) == list(range(num_tasks))
+
+    # results should also be batched by time
+    batcher = TaskResultBatcher(bucket, "job7", uploads, max_batch_seconds=0.01)
+    await batcher.add(0, 1, ProcessState())
+    await asyncio.sleep(0.1)
+    await uploads.wait_all()
+    assert len(await bucket.list_objects(storage_prefix_outputs("job7"))) == 1
+
+
+@pytest.mark.asyncio
+async def test_task_result_batcher_inline(tmp_path: Path) -> None:
+    bucket = LocalFileBucket(tmp_path)
+    result_queue = LocalResultQueue(max_inline_batch_bytes=500)
+    uploads = BackgroundUploads()
+    batcher = TaskResultBatcher(bucket, "job8", uploads, result_queue)
+
+    # small results are sent directly on the queue, large ones via the bucket
+    for i in range(10):
+        await batcher.add(
+            i,
+            1,
+            ProcessState(
+                state=ProcessState.ProcessStateEnum.SUCCEEDED,
+                pickled_result=pickle.dumps("x" * (1000 if i == 5 else 100)),
+            ),
+        )
+    await batcher.close()
+    await uploads.wait_all()
+
+    assert len(await bucket.list_objects(storage_prefix_outputs("job8"))) == 1
+
+    stop_receiving = asyncio.Event()
+    results = {}
+    async for task_results, _ in receive_results(
+        bucket,
+        "job8",
+        stop_receiving=stop_receiving,
+        all_workers_exited=asyncio.Event(),
+        result_queue=result_queue,
+    ):
+        for task_result in task_results:
+            assert task_result.task_id not in results
+            results[task_result.task_id] = pickle.loads(
+                task_result.result.pickled_result
+            )
+        if len(results) == 10:
+            stop_receiving.set()
+
+    assert results == {i: "x" * (1000 if i == 5 else 100) for i in range(10)}
+    assert await bucket.list_objects(storage_prefix_outputs("job8")) == []
+
+
+@pytest.mark.asyncio
+async def test_task_leases(tmp_path: Path) -> None:
+    bucket = LocalFileBucket(tmp_path)
+    assert await get_leased_tasks(bucket, "job9", "job9-worker0") == []
+
+    leases = TaskLeases(bucket, "job9", "job9-worker0")
+    await leases.add([(0, 1), (1, 1), (2, 2)])
+    assert await get_leased_tasks(bucket, "job9", "job9-worker0") == [
+        (0, 1),
+        (1, 1),
+        (2, 2),
+    ]
+    assert await get_leased_tasks(bucket, "job9", "job9-worker1") == []
+
+    # leases are released once the results have been written
+    uploads = BackgroundUploads()
+    batcher = TaskResultBatcher(bucket, "job9", uploads, leases=leases)
+    await batcher.add(1, 1, ProcessState())
+    assert len(await get_leased_tasks(bucket, "job9", "job9-worker0")) == 3
+    await batcher.close()
+    await uploads.wait_all()
+    assert await get_leased_tasks(bucket, "job9", "job9-worker0") == [(0, 1), (2, 2)]
+
+    # concurrent changes are all written
+    await asyncio.gather(leases.remove([(0, 1)]), leases.add([(3, 1)]))
+    assert await get_leased_tasks(bucket, "job9", "job9-worker0") == [(2, 2), (3, 1)]
+
+
+@pytest.mark.asyncio
+async def test_worker_heartbeats(tmp_path: Path) -> None:
+    bucket = LocalFileBucket(tmp_path)
+    heartbeats = WorkerHeartbeats(bucket, "job10", timeout_seconds=0.05)
+    workers = ["job10-worker0", "job10-worker1", "job10-worker2"]
+
+    alive = TaskLeases(bucket, "job10", workers[0])
+    dead = TaskLeases(bucket, "job10", workers[1])
+    # workers[2] never starts, so it never writes a lease
+    heartbeat_task = asyncio.create_task(alive.heartbeat_loop())
+    await dead.add([(0, 1)])
+
+    assert await heartbeats.get_unresponsive_workers(workers) == []
+    await asyncio.sleep(0.1)
+    await alive.add([(1, 1)])
+    # only the worker whose heartbeat hasn't changed is unresponsive
+    assert await heartbeats.get_unresponsive_workers(workers) == [workers[1]]
+    assert await get_leased_tasks(bucket, "job10", workers[1]) == [(0, 1)]
+
+    # a worker that exits normally is never unresponsive
+    heartbeat_task.cancel()
+    await alive.close()
+    await asyncio.sleep(0.1)
+    assert await heartbeats.get_unresponsive_workers([workers[0], workers[2]]) == []
+
+
+@pytest.mark.asyncio
+async def test_check_write_bytes_exclusive_supported(tmp_path: Path) -> None:
+    # creating the client doesn't make any requests
+    session = aiobotocore.session.get_session()
+    async with GenericStorageBucket(
+        session.create_client(
+            "s3",
+            region_name="us-east-1",
+            aws_access_key_id="test",
+            aws_secret_access_key="test",
+        ),  # type: ignore[arg-type]
+        "test-bucket",
+        "test",
+    ) as bucket:
+        bucket.check_write_bytes_exclusive_supported()
+
+        # simulate an older version of botocore that doesn't know about IfNoneMatch
+        put_object = bucket._s3_client.meta.service_model.operation_model("PutObject")
+        assert put_object.input_shape is not None
+        members = put_object.input_shape.members
+        if_none_match = members.pop("IfNoneMatch")
+        try:
+            with pytest.raises(ValueError, match="IfNoneMatch"):
+                bucket.check_write_bytes_exclusive_supported()
+            with pytest.raises(ValueError, match="IfNoneMatch"):
+                await bucket.write_bytes_exclusive(b"data", "key")
+        finally:
+            members["IfNoneMatch"] = if_none_match
+
+    LocalFileBucket(tmp_path).check_write_bytes_exclusive_supported()
+
+
+@pytest.mark.asyncio
+async def test_task_claimer(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(k8s, "_MIN_STRAGGLER_SECONDS", 0)
+    monkeypatch.setattr(k8s, "_TASK_CLAIM_POLL_SECONDS", 0.01)
+
+    bucket = LocalFileBucket(tmp_path)
+    claimers = [k8s._TaskClaimer(bucket, "job9", 5, i, 2) for i in range(2)]
+
+    # each worker starts with its own tasks, then claims whatever is left over
+    assert await claimers[0].claim_next_task() == (0, 1)
+    assert await claimers[0].claim_next_task() == (2, 1)
+    assert await claimers[0].claim_next_task() == (4, 1)
+    assert await claimers[0].claim_next_task() == (1, 1)
+    assert await claimers[1].claim_next_task() == (3, 1)
+    await claimers[0].task_completed(0, 1, 0.0)
+    await claimers[1].task_completed(3, 1, 0.0)
+
+    # retries requested by the driver are claimed like any other task
+    await bucket.write_bytes(
+        b"", storage_key_task_attempt(storage_prefix_task_retries("job9"), 2, 2)
+    )
+    assert await claimers[1].claim_next_task() == (2, 2)
+
+    # then unfinished tasks are stolen, but only once, and not attempts that have
+    # already been retried
+    assert await claimers[1].claim_next_task() == (1, 1)
+    assert await claimers[0].claim_next_task() == (2, 2)
+    assert await claimers[1].claim_next_task() == (4, 1)
+
+    await bucket.write_bytes(b"", storage_key_job_done("job9"))
+    assert await claimers[0].claim_next_task() is None
+    assert await claimers[1].claim_next_task() is None
+
+
+@pytest.mark.asyncio
+async def test_task_claimer_requests(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(k8s, "_MIN_STRAGGLER_SECONDS", 1000)
+    monkeypatch.setattr(k8s, "_TASK_CLAIM_POLL_SECONDS", 0.01)
+
+    bucket = _CountingBucket(tmp_path)
+    claimers = [k8s._TaskClaimer(bucket, "job9", 1000, i, 4) for i in range(4)]
+
+    # while workers have their own tasks, they don't list anything
+    for claimer in claimers[:3]:
+        for _ in range(250):
+            task = await claimer.claim_next_task()
+            assert task is not None
+            await claimer.task_completed(task[0], task[1], 0.0)
+    assert bucket.listed_prefixes == []
+
+    # then they list the claims once to find unclaimed tasks
+    task = await claimers[0].claim_next_task()
+    assert task is not None and task[0] % 4 == 3
+    await claimers[0].task_completed(task[0], task[1], 0.0)
+    assert bucket.listed_prefixes == [
+        storage_prefix_task_retries("job9"),
+        storage_prefix_task_claims("job9"),
+    ]
+    for _ in range(249):
+        assert await claimers[3].claim_next_task() is not None
+
+    # idle polls only list the retries, and only check for stragglers once
+    bucket.listed_prefixes.clear()
+    bucket.num_gets = 0
+    bucket.num_exclusive_writes = 0
+    poll = asyncio.create_task(claimers[0].claim_next_task())
+    await asyncio.sleep(0.2)
+    await bucket.write_bytes(b"", storage_key_job_done("job9"))
+    assert await poll is None
+    assert bucket.listed_prefixes.count(storage_prefix_task_retries("job9")) >= 2
+    assert set(bucket.listed_prefixes) == {
+        storage_prefix_task_completions("job9"),
+        storage_prefix_task_steals("job9"),
+        storage_prefix_task_retries("job9"),
+    }
+    assert bucket.listed_prefixes.count(storage_prefix_task_completions("job9")) == 1
+    # the tasks of the last worker haven't completed yet, so we get each claim once to
+    # see how long it has been running
+    assert bucket.num_gets == 249
+    # the tasks that were claimed since we listed the claims are tried once each
+    assert bucket.num_exclusive_writes == 249
@@ -0,0 +1,154 @@
+from __future__ import annotations
+
+import pickle
+from typing import AsyncIterable, List, Sequence
+
+import cloudpickle
+import pytest
+
+from meadowrun.meadowrun_pb2 import ProcessState
+from meadowrun.run_job_core import (
+    RunMapTasksFailedException,
+    TaskProcessState,
+    TaskResult,
+    WaitOption,
+    collect_run_map_results,
+)
+from meadowrun.task_chunks import (
+    ChunkedFunction,
+    chunk_args,
+    get_chunk_size,
+    unpack_chunk_results,
+)
+
+
+def test_get_chunk_size() -> None:
+    assert get_chunk_size(5, 100, 4) == 5
+    assert get_chunk_size("auto", 100, 4) == 3
+    assert get_chunk_size("auto", 10, 4) == 1
+    with pytest.raises(ValueError):
+        get_chunk_size(0, 100, 4)
+
+    assert chunk_args(list(range(7)), 3) == [[0, 1, 2], [3, 4, 5], [6]]
+
+
+class _FailsOnce:
+    def __init__(self) -> None:
+        self.failed: List[int] = []
+
+    def __call__(self, x: int) -> int:
+        if x == 13:
+            raise ValueError("unlucky")
+        if x % 2 == 1 and x not in self.failed:
+            self.failed.append(x)
+            raise ValueError("odd")
+        return x * 10
+
+
+def _run_chunks(
+    function: ChunkedFunction, chunks: List[Sequence[int]]
+) -> AsyncIterable[TaskResult]:
+    async def chunk_results() -> AsyncIterable[TaskResult]:
+        # run the chunks out of order, the way a run_map would return them
+        for chunk_id in reversed(range(len(chunks))):
+            # make sure the results survive the trip back from the task worker
+            result = pickle.loads(
+                cloudpickle.dumps(
+                    cloudpickle.loads(cloudpickle.dumps(function))(chunks[chunk_id])
+                )
+            )
+            yield TaskResult(
+                chunk_id, is_success=True, state="SUCCEEDED", result=result
+            )
+
+    return chunk_results()
+
+
+@pytest.mark.asyncio
+async def test_chunked_function() -> None:
+    args = list(range(10))
+    chunks = chunk_args(args, 4)
+
+    # with retries, every arg eventually succeeds
+    results = await collect_run_map_results(
+        unpack_chunk_results(
+            _run_chunks(ChunkedFunction(_FailsOnce(), 2), chunks), 4, len(args)
+        ),
+        args,
+        WaitOption.WAIT_SILENTLY,
+    )
+    assert results == [x * 10 for x in args]
+
+    # without retries, exceptions are reported for the individual args
+    task_results = [
+        task_result
+        async for task_result in unpack_chunk_results(
+            _run_chunks(ChunkedFunction(_FailsOnce(), 1), chunks), 4, len(args)
+        )
+    ]
+    assert sorted(task_result.task_id for task_result in task_results) == args
+    for task_result in task_results:
+        assert task_result.is_success == (task_result.task_id % 2 == 0)
+        if not task_result.is_success:
+            assert task_result.state == "PYTHON_EXCEPTION"
+            assert task_result.exception is not None
+            assert "odd" in task_result.exception[1]
+
+    args = [12, 13]
+    with pytest.raises(RunMapTasksFailedException, match="unlucky"):
+        await collect_run_map_results(
+            unpack_chunk_results(
+                _run_chunks(ChunkedFunction(_FailsOnce(), 3), chunk_args(args, 4)),
+                4,
+                len(args),
+            ),
+            args,
+            WaitOption.WAIT_SILENTLY,
+        )
+
+
+@pytest.mark.asyncio
+async def test_unpack_failed_chunk() -> None:
+    async def chunk_results() -> AsyncIterable[TaskResult]:
+        yield TaskResult(
+            1,
+            is_success=False,
+            state="NON_ZERO_RETURN_CODE",
+            exception=("", "Non-zero return code: 137 (OOM)", ""),
+            attempt=2,
+        )
+
+    # the last chunk only has 2 args
+    task_results = [
+        task_result async for task_result in unpack_chunk_results(chunk_results(), 3, 5)
+    ]
+    assert [task_result.task_id for task_result in task_results] == [3, 4]
+    for task_result in task_results:
+        assert not task_result.is_success
+        assert task_result.state == "NON_ZERO_RETURN_CODE"
+        assert task_result.attempt == 2
+
+
+@pytest.mark.asyncio
+async def test_unpack_chunk_that_cannot_be_unpickled() -> None:
+    async def chunk_results() -> AsyncIterable[TaskResult]:
+        yield TaskResult.from_process_state(
+            TaskProcessState(
+                0,
+                1,
+                ProcessState(
+                    state=ProcessState.ProcessStateEnum.SUCCEEDED,
+                    # refers to a module that doesn't exist locally
+                    pickled_result=b"cmeadowrun_nonexistent_module\nfunction\n.",
+                ),
+            )
+        )
+
+    task_results = [
+        task_result async for task_result in unpack_chunk_results(chunk_results(), 2, 5)
+    ]
+    assert [task_result.task_id for task_result in task_results] == [0, 1]
+    for task_result in task_results:
+        assert not task_result.is_success
+        assert task_result.state == "RESULT_CANNOT_BE_UNPICKLED"
+        assert task_result.exception is not None
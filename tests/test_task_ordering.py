@@ -0,0 +1,63 @@
+from __future__ import annotations
+
+from typing import AsyncIterable, List
+
+import pytest
+
+from meadowrun.run_job_core import TaskResult
+from meadowrun.task_ordering import ReorderBuffer, ordered_task_results
+
+
+def _result(task_id: int) -> TaskResult[int]:
+    return TaskResult(task_id, is_success=True, state="SUCCEEDED", result=task_id * 10)
+
+
+def test_reorder_buffer() -> None:
+    buffer: ReorderBuffer[int] = ReorderBuffer(2)
+    try:
+        for task_id in [3, 2, 5, 4, 1]:
+            buffer.add(_result(task_id))
+            assert list(buffer.pop_ready()) == []
+        # only 2 results fit in memory, the rest were spilled to disk
+        assert buffer._spill_file is not None
+        assert len(buffer._spilled) == 3
+
+        buffer.add(_result(0))
+        assert [result.result for result in buffer.pop_ready()] == [
+            0,
+            10,
+            20,
+            30,
+            40,
+            50,
+        ]
+        assert len(buffer) == 0
+
+        # duplicate results (e.g. from speculative execution) are ignored
+        buffer.add(_result(3))
+        buffer.add(_result(7))
+        buffer.add(_result(7))
+        assert len(buffer) == 1
+        assert [result.task_id for result in buffer.pop_remaining()] == [7]
+        assert buffer.next_task_id == 8
+    finally:
+        buffer.close()
+
+
+@pytest.mark.asyncio
+async def test_ordered_task_results() -> None:
+    async def task_results(task_ids: List[int]) -> AsyncIterable[TaskResult[int]]:
+        for task_id in task_ids:
+            yield _result(task_id)
+
+    task_ids = [9, 1, 8, 0, 2, 7, 3, 6, 5, 4]
+    assert [
+        result.task_id
+        async for result in ordered_task_results(task_results(task_ids), 3)
+    ] == list(range(10))
+
+    # task 1 is missing, so the rest are returned at the end
+    assert [
+        result.result
+        async for result in ordered_task_results(task_results([3, 2, 0]), 1)
+    ] == [0, 20, 30]
@@ -1,9 +1,18 @@
+import dataclasses
 import pickle
+from typing import AsyncIterable, List
 
 import pytest
 from meadowrun import TaskResult
 from meadowrun.meadowrun_pb2 import ProcessState
-from meadowrun.run_job_core import TaskException, TaskProcessState
+from meadowrun.run_job_core import (
+    RunMapTasksFailedException,
+    TaskException,
+    TaskProcessState,
+    WaitOption,
+    collect_run_map_results,
+    unpickle_task_results_in_threads,
+)
 from meadowrun.shared import pickle_exception
 
 
@@ -55,9 +64,112 @@ def test_task_result_from_process_state_success() -> None:
     )
     assert task_result.task_id == 2
     assert task_result.attempt == 1
+    # the result isn't unpickled until it's accessed
     assert task_result.is_success
+    assert task_result.state == "SUCCEEDED"
+    assert "_pickled_result" in task_result.__dict__
     assert task_result.result == "OK"
+    assert "_pickled_result" not in task_result.__dict__
+
+    # TaskResults are immutable and hashable
+    with pytest.raises(dataclasses.FrozenInstanceError):
+        task_result.result = "changed"  # type: ignore[misc]
+    assert task_result == TaskResult(2, True, "SUCCEEDED", "OK")
+    assert len({task_result, TaskResult(2, True, "SUCCEEDED", "OK")}) == 1
+
+
+def _successful_task_process_state(task_id: int, pickled_result: bytes) -> TaskResult:
+    return TaskResult.from_process_state(
+        TaskProcessState(
+            task_id,
+            1,
+            ProcessState(
+                state=ProcessState.ProcessStateEnum.SUCCEEDED,
+                pickled_result=pickled_result,
+            ),
+        )
+    )
+
+
+async def _as_async_iterable(
+    task_results: List[TaskResult],
+) -> AsyncIterable[TaskResult]:
+    for task_result in task_results:
+        yield task_result
+
+
+@pytest.mark.asyncio
+async def test_task_result_cannot_be_unpickled() -> None:
+    # refers to a module that doesn't exist locally
+    pickled_result = b"cmeadowrun_nonexistent_module\nfunction\n."
+    task_result = _successful_task_process_state(3, pickled_result)
+
+    # repr and == don't unpickle the result
+    assert "task_id=3" in repr(task_result)
+    assert task_result == _successful_task_process_state(3, pickled_result)
+    assert "_pickled_result" in task_result.__dict__
+
+    # we only find out that the result can't be unpickled when it's accessed
+    assert task_result.is_success
     assert task_result.state == "SUCCEEDED"
+    with pytest.raises(TaskException, match="cannot be unpickled"):
+        task_result.result
+    with pytest.raises(TaskException, match="cannot be unpickled"):
+        task_result.result_or_raise()
+
+    # run_map reports these results as failed tasks
+    with pytest.raises(RunMapTasksFailedException) as exc_info:
+        await collect_run_map_results(
+            _as_async_iterable([task_result, _successful_task_process_state(0, b"N.")]),
+            ["a", "b", "c", "d"],
+            WaitOption.WAIT_SILENTLY,
+        )
+    assert [
+        (failed_task.task_id, failed_task.state)
+        for failed_task in exc_info.value.failed_tasks
+    ] == [(3, "RESULT_CANNOT_BE_UNPICKLED")]
+    assert exc_info.value.failed_task_args == ["d"]
+
+    # a TaskResult can be pickled before its result is unpickled, e.g. by
+    # ReorderBuffer
+    task_result = pickle.loads(
+        pickle.dumps(_successful_task_process_state(4, pickle.dumps([1, 2])))
+    )
+    assert task_result.result_or_raise() == [1, 2]
+
+
+@pytest.mark.asyncio
+async def test_unpickle_task_results_in_threads() -> None:
+    async def task_results() -> AsyncIterable[TaskResult]:
+        for i in range(20):
+            yield _successful_task_process_state(i, pickle.dumps(i * 2))
+
+    results: List[TaskResult] = [
+        task_result
+        async for task_result in unpickle_task_results_in_threads(task_results(), 3)
+    ]
+    assert all("_pickled_result" not in task_result.__dict__ for task_result in results)
+    assert sorted(
+        (task_result.task_id, task_result.result) for task_result in results
+    ) == [(i, i * 2) for i in range(20)]
+
+    # results that can't be unpickled are reported as failed tasks
+    results = [
+        task_result
+        async for task_result in unpickle_task_results_in_threads(
+            _as_async_iterable(
+                [
+                    _successful_task_process_state(
+                        0, b"cmeadowrun_nonexistent_module\nfunction\n."
+                    )
+                ]
+            ),
+            1,
+        )
+    ]
+    assert [(r.task_id, r.is_success, r.state) for r in results] == [
+        (0, False, "RESULT_CANNOT_BE_UNPICKLED")
+    ]
 
 
 def test_task_result_from_process_state_exception() -> None:
@@ -1,10 +1,37 @@
 from __future__ import annotations
 
 import asyncio
+import errno
+import mmap
+import os
 import pickle
+import subprocess
 import sys
-from typing import TYPE_CHECKING, Any, AsyncContextManager, Callable, Tuple
-
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    AsyncContextManager,
+    Callable,
+    List,
+    Sequence,
+    Tuple,
+)
+
+from meadowrun.compression import (
+    dumps_payload,
+    loads_payload,
+    pack_buffers_payload,
+    unpack_buffers_payload,
+)
+from meadowrun import run_job_local
+from meadowrun.alloc_vm import _agent_job
+from meadowrun.config import MEADOWRUN_INTERPRETER
+from meadowrun.meadowrun_pb2 import (
+    ProcessState,
+    QualifiedFunctionName,
+    ServerAvailableFolder,
+    ServerAvailableInterpreter,
+)
 from meadowrun.run_job_local import restart_worker
 
 if TYPE_CHECKING:
@@ -115,6 +142,180 @@ async def test_process_does_not_unpickle_result(
         assert arg == res
 
 
+def _record_shared_memory_segments(
+    monkeypatch: pytest.MonkeyPatch,
+) -> Tuple[List[str], List[str]]:
+    """
+    Returns lists that the paths of shared memory segments get appended to when the
+    agent writes or maps them
+    """
+    written: List[str] = []
+    mapped: List[str] = []
+    write_segment = run_job_local._try_write_shared_memory_segment
+    map_segment = run_job_local._map_shared_memory_segment
+
+    def record_write(path: str, frames: Sequence[memoryview]) -> bool:
+        result = write_segment(path, frames)
+        if result:
+            written.append(path)
+        return result
+
+    def record_map(path: str) -> mmap.mmap:
+        mapped.append(path)
+        return map_segment(path)
+
+    monkeypatch.setattr(run_job_local, "_try_write_shared_memory_segment", record_write)
+    monkeypatch.setattr(run_job_local, "_map_shared_memory_segment", record_map)
+    return written, mapped
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("agent_server", [False, True], indirect=True)
+async def test_out_of_band_buffers(
+    agent_server: TaskWorkerServer,
+    task_worker_process_monitor: Callable[
+        [str, str], AsyncContextManager[Tuple[WorkerProcessMonitor, Path]]
+    ],
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    written, mapped = _record_shared_memory_segments(monkeypatch)
+    async with task_worker_process_monitor("example_package.example", "large_buffer"):
+        await agent_server.wait_for_task_worker_connection(timeout=2)
+
+        for size in (10, 1_000_000, 3_000_000):
+            await agent_server.send_message(
+                pickle.dumps(((size,), {"padding": "x" * size}))
+            )
+            actual_state, actual_result = await agent_server.receive_message()
+            assert actual_state == "SUCCEEDED"
+            assert loads_payload(actual_result) == {
+                "buffer": bytearray(b"x" * size),
+                "size": size,
+            }
+            if agent_server.shared_memory_path is not None:
+                # the out-of-band buffer should have been sent via shared memory
+                assert len(mapped) == (size > 1_000_000)
+                # and the segments are unlinked as soon as they have been received
+                assert os.listdir(agent_server.shared_memory_path) == []
+            mapped.clear()
+        assert all(path.endswith("to_worker") for path in written)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("agent_server", [False, True], indirect=True)
+async def test_out_of_band_argument_buffers(
+    agent_server: TaskWorkerServer,
+    task_worker_process_monitor: Callable[
+        [str, str], AsyncContextManager[Tuple[WorkerProcessMonitor, Path]]
+    ],
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    written, _ = _record_shared_memory_segments(monkeypatch)
+    async with task_worker_process_monitor("example_package.example", "mark_buffer"):
+        await agent_server.wait_for_task_worker_connection(timeout=2)
+
+        for size in (10, 1_000_000, 3_000_000):
+            arg = dumps_payload(((pickle.PickleBuffer(bytearray(b"x" * size)),), {}))
+            if size > 1_000:
+                assert unpack_buffers_payload(arg)[1]
+            await agent_server.send_message(arg)
+            actual_state, actual_result = await agent_server.receive_message()
+            assert actual_state == "SUCCEEDED"
+            assert bytes(loads_payload(actual_result)) == b"y" + b"x" * (size - 1)
+            if agent_server.shared_memory_path is not None:
+                # the out-of-band buffer should have been sent via shared memory
+                assert len(written) == (size > 1_000_000)
+                assert os.listdir(agent_server.shared_memory_path) == []
+            written.clear()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("agent_server", [True], indirect=True)
+async def test_shared_memory_full(
+    agent_server: TaskWorkerServer,
+    task_worker_process_monitor: Callable[
+        [str, str], AsyncContextManager[Tuple[WorkerProcessMonitor, Path]]
+    ],
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    # pretend that shared memory is full in the agent, the task worker is unaffected
+    def posix_fallocate(fd: int, offset: int, length: int) -> None:
+        raise OSError(errno.ENOSPC, "No space left on device")
+
+    monkeypatch.setattr(os, "posix_fallocate", posix_fallocate)
+    written, mapped = _record_shared_memory_segments(monkeypatch)
+    async with task_worker_process_monitor("example_package.example", "large_buffer"):
+        await agent_server.wait_for_task_worker_connection(timeout=2)
+
+        size = 3_000_000
+        await agent_server.send_message(
+            pickle.dumps(((size,), {"padding": "x" * size}))
+        )
+        actual_state, actual_result = await agent_server.receive_message()
+        assert actual_state == "SUCCEEDED"
+        assert loads_payload(actual_result) == {
+            "buffer": bytearray(b"x" * size),
+            "size": size,
+        }
+        assert agent_server.shared_memory_path is not None
+        # the argument was sent over the socket instead, and the result via shared
+        # memory
+        assert written == []
+        assert len(mapped) == 1
+        assert os.listdir(agent_server.shared_memory_path) == []
+
+
+def test_remove_stale_shared_memory_files(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(run_job_local, "_SHARED_MEMORY_FOLDER", str(tmp_path))
+    exited_process = subprocess.run(
+        [sys.executable, "-c", "import os; print(os.getpid())"],
+        capture_output=True,
+        check=True,
+    )
+    dead_pid = int(exited_process.stdout)
+    live_path = run_job_local._get_shared_memory_path("job1")
+    assert live_path is not None
+    stale_path = str(tmp_path / f"meadowrun-{dead_pid}-job2")
+    for path in (live_path, stale_path):
+        os.makedirs(path)
+        open(os.path.join(path, "to_worker"), "wb").close()
+    # files left behind by older versions
+    open(stale_path + ".to_agent", "wb").close()
+    (tmp_path / "other-file").touch()
+
+    run_job_local._remove_stale_shared_memory_files()
+    assert sorted(os.listdir(tmp_path)) == sorted(
+        [os.path.basename(live_path), "other-file"]
+    )
+    assert os.listdir(live_path) == ["to_worker"]
+
+
+def test_pack_buffers_payload() -> None:
+    obj = [
+        pickle.PickleBuffer(bytearray(b"a" * 100_000)),
+        "x" * 100_000,
+        {"b": pickle.PickleBuffer(b"b" * 10)},
+    ]
+    buffers: List[pickle.PickleBuffer] = []
+    pickled = pickle.dumps(obj, protocol=5, buffer_callback=buffers.append)
+    assert len(buffers) == 2
+
+    expected = pickle.loads(pickled, buffers=buffers)
+    payload = pack_buffers_payload(pickled, [bytes(b.raw()) for b in buffers])
+    actual = loads_payload(payload)
+    assert actual == expected
+    assert bytes(actual[0]) == b"a" * 100_000
+    assert bytes(actual[2]["b"]) == b"b" * 10
+    # buffers are not copied when they're unpickled, so they're only writable if the
+    # payload is
+    assert memoryview(actual[0]).readonly
+    assert not memoryview(loads_payload(bytearray(payload))[0]).readonly
+
+    assert pack_buffers_payload(pickled, []) == pickled
+
+
 async def _check_start(
     agent_server: TaskWorkerServer, monitor: WorkerMonitor, io_path: Path
 ) -> None:
@@ -188,3 +389,69 @@ async def test_restart_container(
 
         await _check_restart(agent_server, monitor, io_path)
         assert monitor.container_id is not None
+
+
+# (state, result) for each task worker, see _run_one_task_per_task_worker
+_task_worker_results: List[Tuple[str, Any]] = []
+
+
+async def _run_one_task_per_task_worker(
+    log_file_name: str,
+    base_job_id: str,
+    job_id: str,
+    task_workers: List[run_job_local.TaskWorker],
+) -> None:
+    """An agent function that runs the job's function once on each task worker"""
+
+    async def run_task(task_worker: run_job_local.TaskWorker) -> Tuple[str, Any]:
+        await task_worker.server.wait_for_task_worker_connection()
+        await task_worker.server.send_message(pickle.dumps(((), {})))
+        state, result = await task_worker.server.receive_message()
+        return state, pickle.loads(result)
+
+    _task_worker_results.extend(
+        await asyncio.gather(*(run_task(task_worker) for task_worker in task_workers))
+    )
+
+
+@pytest.mark.asyncio
+async def test_multiple_task_workers_per_agent(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    folders = tuple(
+        str(tmp_path / folder) for folder in ("io", "git_repos", "local_copies", "misc")
+    )
+    for folder in folders:
+        os.makedirs(folder)
+    monkeypatch.setattr(run_job_local, "_set_up_working_folder", lambda: folders)
+    _task_worker_results.clear()
+
+    # the same job that GridJobWorkerLauncher runs for each worker
+    job = _agent_job(
+        "base-job-id",
+        os.getpid,
+        pickle.HIGHEST_PROTOCOL,
+        {
+            "result_highest_pickle_protocol": pickle.HIGHEST_PROTOCOL,
+            "server_available_interpreter": ServerAvailableInterpreter(
+                interpreter_path=MEADOWRUN_INTERPRETER
+            ),
+            "server_available_folder": ServerAvailableFolder(),
+        },
+        QualifiedFunctionName(
+            module_name=__name__, function_name=_run_one_task_per_task_worker.__name__
+        ),
+        [],
+        3,
+    )
+    initial_state, continuation = await run_job_local.run_local(
+        job, "job-id", str(tmp_path / "job-id.log")
+    )
+    assert continuation is not None, initial_state
+    final_state = await asyncio.wait_for(continuation, 30)
+
+    assert final_state.state == ProcessState.ProcessStateEnum.SUCCEEDED, final_state
+    # each task worker is a separate process
+    assert len(_task_worker_results) == 3
+    assert all(state == "SUCCEEDED" for state, _ in _task_worker_results)
+    assert len({pid for _, pid in _task_worker_results}) == 3